@@ -0,0 +1,482 @@
+# -*- coding: UTF-8 -*-
+"""
+A simulated vCenter, for benchmarking the worker without a lab.
+
+``FakeServer`` stands in for the pyVmomi SOAP stub. The real pyVmomi objects
+(``vim.VirtualMachine``, ``vmodl.query.PropertyCollector``, etc.) send every
+method call and property read to ``InvokeMethod`` and ``InvokeAccessor``, so
+the worker code runs unchanged, and every round trip is counted and delayed
+by ``latency`` seconds.
+
+Only the calls the worker makes are simulated:
+
+- property reads, including dotted paths like ``runtime.powerState``
+- ``RetrievePropertiesEx`` with traversal specs, plus the ``WaitForUpdatesEx`` change feed
+- container views, ``FindChild``, clone tickets
+- datastores and their free space
+- power on/off, destroy, clone, reconfigure, snapshot and rename tasks, which
+  finish ``task_seconds`` after they start
+"""
+import time
+import datetime
+import itertools
+import threading
+
+import ujson
+import OpenSSL
+from pyVmomi import vim, vmodl
+from vlab_inf_common.constants import const as inf_const
+
+from vlab_winserver_api.lib import const
+from vlab_winserver_api.lib.worker.session import PooledvCenter
+
+
+class Data(object):
+    """A plain data object; reading its attributes is free"""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self, name):
+        # unset properties of a vSphere data object read as None
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return None
+
+
+def meta(component, version='2016'):
+    """Make the VM notes vLab writes"""
+    return ujson.dumps({'component': component, 'created': 0, 'version': version,
+                        'generation': 1, 'configured': False})
+
+
+class FakeServer(object):
+    """The state of a simulated vCenter, and the SOAP stub to talk to it
+
+    :param latency: How many seconds every round trip takes
+    :type latency: Float
+
+    :param task_seconds: How many seconds every task takes to finish
+    :type task_seconds: Float
+    """
+    def __init__(self, latency=0.0, task_seconds=0.0):
+        self.latency = latency
+        self.task_seconds = task_seconds
+        self.round_trips = 0
+        self._lock = threading.RLock()
+        self._objects = {}
+        self._collectors = {}
+        self.folders = {}
+        self._ids = itertools.count(1)
+        self._build()
+
+    # --- the inventory -----------------------------------------------------
+
+    def _new(self, kind, prefix, **props):
+        """Add an object to the inventory
+
+        :Returns: pyVmomi.VmomiSupport.ManagedObject
+        """
+        obj = kind('{}-{}'.format(prefix, next(self._ids)), stub=self)
+        props['obj'] = obj
+        self._objects[obj._moId] = props
+        return obj
+
+    def _build(self):
+        self.root = self._new(vim.Folder, 'group-d', name='Datacenters', childEntity=[])
+        self.vm_folder = self._new(vim.Folder, 'group-v', name='vm', childEntity=[])
+        datacenter = self._new(vim.Datacenter, 'datacenter', name='Datacenter', vmFolder=self.vm_folder)
+        self._objects[self.root._moId]['childEntity'].append(datacenter)
+        self.top = self.vm_folder
+        # The folders the worker looks for, so build them from its constants
+        for name in const.INF_VCENTER_TOP_LVL_DIR.strip('/').split('/'):
+            if name:
+                self.top = self.add_folder(name, parent=self.top)
+        self.resource_pool = self._new(vim.ResourcePool, 'resgroup', name='Resources')
+        self.network_folder = self._new(vim.Folder, 'group-n', name='network', childEntity=[])
+        self._objects[self.root._moId]['childEntity'].append(self.network_folder)
+        self.datastore_folder = self._new(vim.Folder, 'group-s', name='datastore', childEntity=[])
+        self._objects[self.root._moId]['childEntity'].append(self.datastore_folder)
+        self.dvs = Data(uuid='dvs-uuid-1')
+        self.session_manager = vim.SessionManager('SessionManager', stub=self)
+        self.content = vim.ServiceInstanceContent(
+            rootFolder=self.root,
+            propertyCollector=vmodl.query.PropertyCollector('propertyCollector', stub=self),
+            viewManager=vim.view.ViewManager('ViewManager', stub=self),
+            searchIndex=vim.SearchIndex('SearchIndex', stub=self),
+            sessionManager=self.session_manager,
+            setting=vim.option.OptionManager('VpxSettings', stub=self),
+            about=vim.AboutInfo(instanceUuid='fake-vcenter-uuid'))
+
+    def add_folder(self, name, parent=None):
+        """Create a VM folder, i.e. the one every user has
+
+        :Returns: vim.Folder
+        """
+        with self._lock:
+            parent = parent if parent is not None else self.top
+            folder = self._new(vim.Folder, 'group-v', name=name, childEntity=[], parent=parent)
+            self._objects[parent._moId]['childEntity'].append(folder)
+            self.folders[name] = folder
+            return folder
+
+    def add_network(self, name, distributed=False):
+        """Create a standard or distributed portgroup
+
+        :Returns: vim.Network
+        """
+        with self._lock:
+            if distributed:
+                network = self._new(vim.dvs.DistributedVirtualPortgroup, 'dvportgroup', name=name,
+                                    config=Data(distributedVirtualSwitch=self.dvs))
+                self._objects[network._moId]['key'] = network._moId
+            else:
+                network = self._new(vim.Network, 'network', name=name)
+            self._objects[self.network_folder._moId]['childEntity'].append(network)
+            return network
+
+    def add_datastore(self, name, capacity, free):
+        """Create a datastore, with its size in bytes
+
+        :Returns: vim.Datastore
+        """
+        with self._lock:
+            datastore = self._new(vim.Datastore, 'datastore', name=name, parent=self.datastore_folder,
+                                  summary=Data(capacity=capacity, freeSpace=free, accessible=True,
+                                               maintenanceMode='normal'))
+            self._objects[self.datastore_folder._moId]['childEntity'].append(datastore)
+            return datastore
+
+    def add_vm(self, folder, name, annotation, network=None, power_state='poweredOn', snapshot=False):
+        """Create a VM, as if it was deployed and booted a while ago
+
+        :Returns: vim.VirtualMachine
+        """
+        with self._lock:
+            nic = vim.vm.device.VirtualVmxnet3(key=4000, deviceInfo=vim.Description(label='Network adapter 1', summary=''))
+            the_vm = self._new(vim.VirtualMachine, 'vm', name=name, parent=folder,
+                               runtime=Data(powerState=power_state, bootTime=datetime.datetime(2020, 1, 1)),
+                               config=Data(annotation=annotation, hardware=Data(device=[nic])),
+                               guest=Data(net=[Data(ipAddress=['192.168.1.{}'.format(len(self._objects) % 250 + 2)])]),
+                               network=[network] if network is not None else [],
+                               snapshot=None)
+            if snapshot:
+                self._objects[the_vm._moId]['snapshot'] = Data(currentSnapshot=vim.vm.Snapshot('snapshot-{}'.format(the_vm._moId), stub=self))
+            self._objects[folder._moId]['childEntity'].append(the_vm)
+            return the_vm
+
+    def get_server_certificate(self, addr):
+        """Use in place of ``ssl.get_server_certificate``; the TLS handshake costs one round trip
+
+        :Returns: String
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        return certificate()
+
+    def connect(self):
+        """Open a session; use in place of ``session._connect``
+
+        :Returns: vlab_winserver_api.lib.worker.session.PooledvCenter
+        """
+        vcenter = PooledvCenter.__new__(PooledvCenter)
+        vcenter._conn = vim.ServiceInstance('ServiceInstance', stub=self)
+        vcenter._base_dir = inf_const.INF_VCENTER_TOP_LVL_DIR
+        vcenter.reset()
+        return vcenter
+
+    # --- the SOAP stub -----------------------------------------------------
+
+    def InvokeMethod(self, mo, info, args):
+        self._round_trip()
+        handler = getattr(self, '_{}'.format(info.wsdlName), None)
+        if handler is None:
+            raise NotImplementedError('The fake vCenter has no {}'.format(info.wsdlName))
+        with self._lock:
+            return handler(mo, *args)
+
+    def InvokeAccessor(self, mo, info):
+        self._round_trip()
+        with self._lock:
+            return self._get(mo, info.name)
+
+    def DropConnections(self):
+        pass
+
+    def _round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _get(self, obj, path):
+        """Read a (dotted) property path off an object
+
+        :Returns: Object, or None if it's unset
+        """
+        if isinstance(obj, vim.Task):
+            return self._get_task(obj, path)
+        if isinstance(obj, vim.SessionManager) and path == 'currentSession':
+            return Data(key='fake-session')
+        if isinstance(obj, vim.option.OptionManager) and path == 'setting':
+            return []
+        if isinstance(obj, vim.Network) and path == 'vm':
+            return [x['obj'] for x in self._objects.values()
+                    if any(y._moId == obj._moId for y in x.get('network', []))]
+        first, _, rest = path.partition('.')
+        value = self._objects.get(obj._moId, {}).get(first, None)
+        for name in rest.split('.') if rest else []:
+            value = getattr(value, name, None)
+        return value
+
+    def _get_task(self, the_task, path):
+        """Tasks are done once ``task_seconds`` have passed since they started
+
+        :Returns: Object
+        """
+        task = self._objects[the_task._moId]
+        done = time.time() >= task['finish']
+        info = Data(state=vim.TaskInfo.State.success if done else vim.TaskInfo.State.running,
+                    completeTime=datetime.datetime.now() if done else None,
+                    result=task['result'] if done else None,
+                    error=None)
+        if path == 'info':
+            return info
+        return getattr(info, path.split('.', 1)[1], None)
+
+    def _start_task(self, result=None):
+        """Begin a simulated task
+
+        :Returns: vim.Task
+        """
+        return self._new(vim.Task, 'task', finish=time.time() + self.task_seconds, result=result)
+
+    def _remove(self, obj):
+        """Delete an object from the inventory"""
+        props = self._objects.pop(obj._moId, {})
+        parent = props.get('parent', None)
+        if parent is not None:
+            children = self._objects[parent._moId]['childEntity']
+            children[:] = [x for x in children if x._moId != obj._moId]
+
+    # ServiceInstance / SessionManager / SearchIndex
+
+    def _RetrieveServiceContent(self, mo):
+        return self.content
+
+    def _AcquireCloneTicket(self, mo):
+        return 'fake-ticket-{}'.format(next(self._ids))
+
+    def _Logout(self, mo):
+        return None
+
+    def _FindChild(self, mo, entity, name):
+        for child in self._objects.get(entity._moId, {}).get('childEntity', []):
+            if self._objects.get(child._moId, {}).get('name', None) == name:
+                return child
+        return None
+
+    # Views
+
+    def _CreateContainerView(self, mo, container, type, recursive):
+        found = [x for x in self._descendants(container, recursive) if isinstance(x, tuple(type))]
+        return self._new(vim.view.ContainerView, 'session[view]', view=found)
+
+    def _DestroyView(self, mo):
+        self._objects.pop(mo._moId, None)
+
+    def _descendants(self, obj, recursive):
+        """Walk the inventory below an object
+
+        :Returns: List
+        """
+        found = []
+        props = self._objects.get(obj._moId, {})
+        for child in props.get('childEntity', []) + ([props['vmFolder']] if 'vmFolder' in props else []):
+            found.append(child)
+            if recursive:
+                found += self._descendants(child, recursive)
+        if obj is self.root or obj._moId == self.root._moId:
+            found.append(self.resource_pool)
+        return found
+
+    # PropertyCollector
+
+    def _RetrievePropertiesEx(self, mo, specSet, options):
+        objects = [Data(obj=obj, propSet=[Data(name=x, val=y) for x, y in props.items()])
+                   for spec in specSet for obj, props in self._collect(spec)]
+        if not objects:
+            return None
+        return Data(objects=objects, token=None)
+
+    def _ContinueRetrievePropertiesEx(self, mo, token):
+        return None
+
+    def _collect(self, spec):
+        """Run a FilterSpec against the inventory
+
+        :Returns: List of Tuples - (object, Dictionary of properties)
+        """
+        named = {}
+        _name_traversals(spec.objectSet, named)
+        found = []
+        for object_spec in spec.objectSet:
+            self._walk(object_spec.obj, object_spec.selectSet or [], object_spec.skip, named, found)
+        answer = []
+        seen = set()
+        for obj in found:
+            if obj._moId in seen or (obj._moId not in self._objects and not isinstance(obj, vim.Task)):
+                continue
+            seen.add(obj._moId)
+            props = {}
+            for prop_spec in spec.propSet:
+                if isinstance(obj, prop_spec.type):
+                    for path in prop_spec.pathSet:
+                        value = self._get(obj, path)
+                        if value is not None:
+                            props[path] = value
+            answer.append((obj, props))
+        return answer
+
+    def _walk(self, obj, select_set, skip, named, found):
+        if not skip:
+            found.append(obj)
+        for selection in select_set:
+            traversal = selection if isinstance(selection, vmodl.query.PropertyCollector.TraversalSpec) else named[selection.name]
+            if not isinstance(obj, traversal.type):
+                continue
+            children = self._get(obj, traversal.path) or []
+            for child in children if isinstance(children, list) else [children]:
+                self._walk(child, traversal.selectSet or [], traversal.skip, named, found)
+
+    def _CreatePropertyCollector(self, mo):
+        collector = self._new(vmodl.query.PropertyCollector, 'session[collector]')
+        self._collectors[collector._moId] = {'filters': [], 'seen': {}, 'version': 0}
+        return collector
+
+    def _DestroyPropertyCollector(self, mo):
+        self._collectors.pop(mo._moId, None)
+        self._objects.pop(mo._moId, None)
+
+    def _CreateFilter(self, mo, spec, partialUpdates):
+        self._collectors[mo._moId]['filters'].append(spec)
+        return vmodl.query.PropertyCollector.Filter('session[filter]', stub=self)
+
+    def _WaitForUpdatesEx(self, mo, version, options):
+        max_wait = options.maxWaitSeconds if options is not None and options.maxWaitSeconds is not None else 60
+        deadline = time.time() + max_wait
+        while True:
+            update_set = self._updates(self._collectors[mo._moId])
+            if update_set is not None or time.time() >= deadline:
+                return update_set
+            # let tasks finish while we wait
+            self._lock.release()
+            try:
+                time.sleep(min(0.01, max(0, deadline - time.time())))
+            finally:
+                self._lock.acquire()
+
+    def _updates(self, collector):
+        """Diff what a collector's filters match against what it already reported
+
+        :Returns: Data, or None if nothing changed
+        """
+        changes = []
+        for spec in collector['filters']:
+            for obj, props in self._collect(spec):
+                seen = collector['seen'].get(obj._moId, None)
+                changed = [Data(name=x, val=y, op='assign') for x, y in props.items()
+                           if seen is None or seen.get(x, None) != y]
+                if changed:
+                    changes.append(Data(obj=obj, kind='enter' if seen is None else 'modify', changeSet=changed))
+                    collector['seen'][obj._moId] = props
+        if not changes:
+            return None
+        collector['version'] += 1
+        return Data(version=str(collector['version']), truncated=False, filterSet=[Data(objectSet=changes)])
+
+    # Tasks
+
+    def _CancelTask(self, mo):
+        return None
+
+    def _PowerOnVM_Task(self, mo, host):
+        self._objects[mo._moId]['runtime'] = Data(powerState='poweredOn', bootTime=datetime.datetime.now())
+        return self._start_task()
+
+    def _PowerOffVM_Task(self, mo):
+        if self._objects[mo._moId]['runtime'].powerState != 'poweredOn':
+            raise vim.fault.InvalidPowerState(msg='The VM is already off')
+        self._objects[mo._moId]['runtime'] = Data(powerState='poweredOff', bootTime=None)
+        return self._start_task()
+
+    def _Destroy_Task(self, mo):
+        self._remove(mo)
+        return self._start_task()
+
+    def _CloneVM_Task(self, mo, folder, name, spec):
+        template = self._objects[mo._moId]
+        the_vm = self.add_vm(folder, name, template['config'].annotation, power_state='poweredOff')
+        return self._start_task(result=the_vm)
+
+    def _ReconfigVM_Task(self, mo, spec):
+        props = self._objects[mo._moId]
+        if spec.annotation is not None:
+            props['config'] = Data(annotation=spec.annotation, hardware=props['config'].hardware)
+        for change in spec.deviceChange or []:
+            backing = change.device.backing
+            if isinstance(backing, vim.vm.device.VirtualEthernetCard.NetworkBackingInfo):
+                props['network'] = [backing.network]
+            elif isinstance(backing, vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo):
+                props['network'] = [vim.dvs.DistributedVirtualPortgroup(backing.port.portgroupKey, stub=self)]
+        return self._start_task()
+
+    def _CreateSnapshot_Task(self, mo, name, description, memory, quiesce):
+        self._objects[mo._moId]['snapshot'] = Data(currentSnapshot=vim.vm.Snapshot('snapshot-{}'.format(mo._moId), stub=self))
+        return self._start_task()
+
+    def _Rename_Task(self, mo, newName):
+        self._objects[mo._moId]['name'] = newName
+        return self._start_task()
+
+    def _MoveIntoFolder_Task(self, mo, list):
+        for the_vm in list:
+            props = self._objects[the_vm._moId]
+            self._remove(the_vm)
+            props['parent'] = mo
+            self._objects[the_vm._moId] = props
+            self._objects[mo._moId]['childEntity'].append(the_vm)
+        return self._start_task()
+
+
+_CERT = None
+
+
+def certificate():
+    """A self-signed cert, so the console URL has a thumbprint to show
+
+    :Returns: String
+    """
+    global _CERT
+    if _CERT is None:
+        crypto = OpenSSL.crypto
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, 2048)
+        cert = crypto.X509()
+        cert.get_subject().CN = 'fake-vcenter'
+        cert.set_serial_number(1)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(3600)
+        cert.set_issuer(cert.get_subject())
+        cert.set_pubkey(key)
+        cert.sign(key, 'sha256')
+        _CERT = crypto.dump_certificate(crypto.FILETYPE_PEM, cert).decode()
+    return _CERT
+
+
+def _name_traversals(select_set, named):
+    """Index every TraversalSpec in a FilterSpec by name, so SelectionSpecs can refer to them"""
+    for spec in select_set or []:
+        if isinstance(spec, vmodl.query.PropertyCollector.TraversalSpec):
+            if spec.name:
+                named[spec.name] = spec
+        _name_traversals(getattr(spec, 'selectSet', None), named)
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Measures the worker and the API against a simulated vCenter (see
+``fake_vcenter.py``), so performance can be tracked without a lab.
+
+Each scenario runs ``--iterations`` times, ``--concurrency`` at a time, and
+reports the throughput, the p50/p99 latency, and the vCenter round trips per
+operation. The ``api-*`` scenarios go through the Flask app and a Celery worker
+(in this process) over an in-memory broker, polling the task end point until
+the task is done.
+
+Creates are linked clones of a template with a DHCP address; uploading an OVA
+streams the disks over HTTP, which the fake vCenter does not simulate.
+
+Usage::
+
+    python benchmarks/run.py                 # print the results
+    python benchmarks/run.py --save          # record them as the baselines
+    python benchmarks/run.py --check         # exit 1 if any scenario regressed
+"""
+import os
+import ssl
+import sys
+import time
+import shutil
+import tarfile
+import logging
+import argparse
+import tempfile
+import threading
+import collections
+import collections.abc
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+import ujson
+
+WORK_DIR = tempfile.mkdtemp(prefix='winserver-bench-')
+# The constants are read at import time
+os.environ.update({'INF_VCENTER_TOP_LVL_DIR': '/vlab',
+                   'VLAB_MESSAGE_BROKER': 'memory://',
+                   'VLAB_WINSERVER_LOG_LEVEL': 'WARNING',
+                   'VLAB_WINSERVER_DEPLOY_MODE': 'linked-clone',
+                   'VLAB_WINSERVER_DATASTORES': 'ds1,ds2,ds3',
+                   'VLAB_WINSERVER_WARM_POOL': '',
+                   'VLAB_WINSERVER_CHANGE_FEED': 'false',
+                   'VLAB_WINSERVER_CACHE_URL': 'memory://',
+                   'VLAB_WINSERVER_RESULT_BACKEND': 'sqlite:///{}'.format(os.path.join(WORK_DIR, 'results.db')),
+                   'VLAB_WINSERVER_IMAGES_DIR': os.path.join(WORK_DIR, 'images'),
+                   'VLAB_WINSERVER_METRICS_DIR': os.path.join(WORK_DIR, 'metrics')})
+if not hasattr(collections, 'Iterable'):
+    # vlab_inf_common uses the alias that Python 3.10 removed
+    collections.Iterable = collections.abc.Iterable
+
+from celery.contrib.testing.worker import start_worker
+from vlab_api_common import get_task_logger
+from vlab_api_common.http_auth import generate_v2_test_token
+
+from vlab_winserver_api.app import app
+from vlab_winserver_api.lib import const
+from vlab_winserver_api.lib.worker import session, tasks, vmware
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_vcenter
+
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+SHOW_USER = 'alice'
+CHURN_USER = 'bob'
+IMAGE = '2016'
+DHCP = {'static-ip': None, 'default-gateway': None, 'netmask': None, 'dns': None}
+OVF = """<?xml version="1.0" encoding="UTF-8"?>
+<Envelope xmlns="http://schemas.dmtf.org/ovf/envelope/1" xmlns:ovf="http://schemas.dmtf.org/ovf/envelope/1">
+  <NetworkSection><Network ovf:name="VM Network"/></NetworkSection>
+</Envelope>
+"""
+# Round trips barely vary (only with how tasks and polls interleave), so allow little slack
+ROUND_TRIP_SLACK = 0.1
+POLL_INTERVAL = 0.01
+# Milliseconds of jitter are not a regression, whatever the percentage
+P50_FLOOR = 0.02
+# The round trips of these include whatever runs alongside them
+BACKGROUND_LOAD = ('api-show-busy',)
+
+
+def make_lab(server, vms, networks):
+    """Fill the fake vCenter with datastores, the template, the users, their VMs and networks
+
+    :Returns: None
+    """
+    for name in const.VLAB_WINSERVER_DATASTORES.split(','):
+        server.add_datastore(name, capacity=4 * 1024 ** 4, free=2 * 1024 ** 4)
+    template_folder = server.add_folder(const.VLAB_WINSERVER_TEMPLATE_DIR)
+    server.add_vm(template_folder, 'WinServer-{}-template'.format(IMAGE), fake_vcenter.meta('WinServer', IMAGE),
+                  power_state='poweredOff', snapshot=True)
+    for idx in range(networks):
+        server.add_network('user{}_lab'.format(idx), distributed=bool(idx % 2))
+    show_network = server.add_network('{}_lab'.format(SHOW_USER), distributed=True)
+    server.add_network('{}_lab'.format(CHURN_USER), distributed=True)
+    show_folder = server.add_folder(SHOW_USER)
+    server.add_folder(CHURN_USER)
+    for idx in range(vms):
+        # Users have more than just WinServers in their folder
+        component = 'CentOS' if idx % 4 == 3 else 'WinServer'
+        server.add_vm(show_folder, 'vm{}'.format(idx), fake_vcenter.meta(component), network=show_network)
+
+
+def make_images():
+    """Put a (tiny) OVA in the images dir, so the catalog knows the image version
+
+    :Returns: None
+    """
+    images_dir = const.VLAB_WINSERVER_IMAGES_DIR
+    os.makedirs(images_dir, exist_ok=True)
+    with tarfile.open(os.path.join(images_dir, 'WinServer-{}.ova'.format(IMAGE)), 'w') as ova:
+        descriptor = OVF.encode()
+        member = tarfile.TarInfo('WinServer-{}.ovf'.format(IMAGE))
+        member.size = len(descriptor)
+        ova.addfile(member, BytesIO(descriptor))
+
+
+def add_victims(server, prefix, count):
+    """Create the VMs a delete scenario destroys
+
+    :Returns: None
+    """
+    for idx in range(count):
+        server.add_vm(server.folders[CHURN_USER], '{}{}'.format(prefix, idx), fake_vcenter.meta('WinServer', IMAGE))
+
+
+def percentile(values, pct):
+    """Obtain a percentile of some measurements, by the nearest rank
+
+    :Returns: Float
+    """
+    ordered = sorted(values)
+    rank = max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def measure(server, operation, iterations, concurrency):
+    """Run an operation many times, and summarize how it went
+
+    :Returns: Dictionary
+
+    :param server: The fake vCenter
+    :type server: fake_vcenter.FakeServer
+
+    :param operation: Called with the iteration number
+    :type operation: Function
+
+    :param iterations: How many times to call the operation
+    :type iterations: Integer
+
+    :param concurrency: How many calls to make at the same time
+    :type concurrency: Integer
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    def timed(idx):
+        start = time.time()
+        operation(idx)
+        with lock:
+            latencies.append(time.time() - start)
+
+    round_trips = server.round_trips
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(timed, range(iterations)))
+    elapsed = time.time() - start
+    return {'throughput': round(iterations / elapsed, 2),
+            'p50': round(percentile(latencies, 50), 4),
+            'p99': round(percentile(latencies, 99), 4),
+            'round_trips': round((server.round_trips - round_trips) / iterations, 1)}
+
+
+def call_api(client, method, token, body=None, query=''):
+    """Make a request, and poll the task it started until it's done
+
+    :Returns: Dictionary
+
+    :Raises: RuntimeError if the request or task failed
+    """
+    url = '/api/2/inf/winserver{}'.format(query)
+    resp = client.open(url, method=method, headers={'X-Auth': token}, json=body)
+    if resp.status_code == 200:
+        return resp.get_json()
+    elif resp.status_code != 202:
+        raise RuntimeError('{} {} failed: {} {}'.format(method, url, resp.status_code, resp.get_data(as_text=True)))
+    task_url = '/api/2/inf/winserver/task/{}'.format(resp.get_json()['content']['task-id'])
+    while True:
+        resp = client.get(task_url, headers={'X-Auth': token})
+        if resp.status_code == 200:
+            return resp.get_json()
+        elif resp.status_code != 202:
+            raise RuntimeError('Task for {} {} failed: {}'.format(method, url, resp.get_data(as_text=True)))
+        time.sleep(POLL_INTERVAL)
+
+
+def scenarios(server, iterations):
+    """Define what to measure; the order matters, i.e. ``api-show-cached``
+    relies on ``api-show`` having filled the cache.
+
+    :Returns: List of Tuples - (name, setup function, operation)
+    """
+    logger = get_task_logger(txn_id='benchmark', task_id='benchmark', loglevel='WARNING')
+    client = app.test_client()
+    show_token = generate_v2_test_token(username=SHOW_USER)
+    churn_token = generate_v2_test_token(username=CHURN_USER)
+    network = '{}_lab'.format(CHURN_USER)
+    return [
+        ('show', None,
+         lambda idx: vmware.show_winserver(SHOW_USER)),
+        ('delete', lambda: add_victims(server, 'delete', iterations),
+         lambda idx: vmware.delete_winserver(CHURN_USER, 'delete{}'.format(idx), logger)),
+        ('create', None,
+         lambda idx: vmware.create_winserver(CHURN_USER, 'create{}'.format(idx), IMAGE, network, DHCP, logger)),
+        ('api-show', None,
+         lambda idx: call_api(client, 'GET', show_token, query='?async=true')),
+        ('api-show-cached', None,
+         lambda idx: call_api(client, 'GET', show_token)),
+        ('api-delete', lambda: add_victims(server, 'api-delete', iterations),
+         lambda idx: call_api(client, 'DELETE', churn_token, body={'name': 'api-delete{}'.format(idx)})),
+        ('api-create', None,
+         lambda idx: call_api(client, 'POST', churn_token,
+                              body={'name': 'api-create{}'.format(idx), 'image': IMAGE, 'network': 'lab'})),
+        # Shows should not slow down while the provisioning workers are busy
+        ('api-show-busy', lambda: flood(client, churn_token, iterations * 2),
+         lambda idx: call_api(client, 'GET', show_token, query='?async=true')),
+    ]
+
+
+def flood(client, token, count):
+    """Queue up creates without waiting on them
+
+    :Returns: None
+    """
+    for idx in range(count):
+        client.post('/api/2/inf/winserver', headers={'X-Auth': token},
+                    json={'name': 'flood{}'.format(idx), 'image': IMAGE, 'network': 'lab'})
+
+
+def run(args):
+    """Build the lab, start a worker, and measure every scenario
+
+    :Returns: Dictionary
+    """
+    server = fake_vcenter.FakeServer(latency=args.latency, task_seconds=args.task_seconds)
+    make_lab(server, args.vms, args.networks)
+    make_images()
+    ssl.get_server_certificate = server.get_server_certificate
+    # One pool stands in for the pools of the read and provisioning workers
+    session._POOL = session.SessionPool(max_size=args.concurrency * 2,
+                                        timeout=const.VLAB_WINSERVER_VCENTER_POOL_TIMEOUT,
+                                        keepalive=const.VLAB_WINSERVER_VCENTER_KEEPALIVE,
+                                        factory=server.connect)
+    # The in-memory broker is polled; the default of once a second would dwarf everything else
+    tasks.app.conf.broker_transport_options = {'polling_interval': POLL_INTERVAL}
+    # A worker on a polled broker blocks in drain_events for 2 seconds when it
+    # hits its prefetch limit; RabbitMQ pushes, so that's not what production sees
+    tasks.app.conf.worker_prefetch_multiplier = 4
+    app.config['TESTING'] = True
+    app.celery_app = tasks.app
+    results = {}
+    # Like the docker-compose layout, reads and provisioning get their own workers
+    read_worker = start_worker(tasks.app, pool='threads', concurrency=args.concurrency, perform_ping_check=False,
+                               loglevel='WARNING', queues=[const.VLAB_WINSERVER_READ_QUEUE])
+    provision_worker = start_worker(tasks.app, pool='threads', concurrency=args.concurrency, perform_ping_check=False,
+                                    loglevel='WARNING', queues=[const.VLAB_WINSERVER_PROVISION_QUEUE])
+    with read_worker, provision_worker:
+        for name, setup, operation in scenarios(server, args.iterations):
+            if args.only and name not in args.only:
+                continue
+            if setup is not None:
+                setup()
+            results[name] = measure(server, operation, args.iterations, args.concurrency)
+            print('{:<16} {throughput:>9} ops/s  p50 {p50:>8.4f}s  p99 {p99:>8.4f}s  {round_trips:>7} round trips/op'.format(name, **results[name]))
+    return results
+
+
+def settings(args):
+    """The options that change the results; baselines only compare with the same settings
+
+    :Returns: Dictionary
+    """
+    return {'latency': args.latency, 'task_seconds': args.task_seconds, 'vms': args.vms,
+            'networks': args.networks, 'iterations': args.iterations, 'concurrency': args.concurrency}
+
+
+def check(results, baselines, tolerance):
+    """Compare the results to the baselines
+
+    :Returns: List of Strings - the regressions
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        baseline = baselines.get(name, None)
+        if baseline is None:
+            continue
+        if name not in BACKGROUND_LOAD and result['round_trips'] > baseline['round_trips'] * (1 + ROUND_TRIP_SLACK):
+            regressions.append('{}: {} round trips/op, baseline is {}'.format(name, result['round_trips'], baseline['round_trips']))
+        slower = result['p50'] - baseline['p50']
+        if result['p50'] > baseline['p50'] * (1 + tolerance) and slower > P50_FLOOR:
+            regressions.append('{}: p50 of {}s, baseline is {}s'.format(name, result['p50'], baseline['p50']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip(),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.002, help='Seconds each vCenter round trip takes')
+    parser.add_argument('--task-seconds', type=float, default=0.05, help='Seconds each vCenter task takes')
+    parser.add_argument('--vms', type=int, default=40, help='How many VMs are in the folder being shown')
+    parser.add_argument('--networks', type=int, default=100, help='How many other networks vCenter has')
+    parser.add_argument('--iterations', type=int, default=20, help='How many times to run each scenario')
+    parser.add_argument('--concurrency', type=int, default=4, help='How many operations run at once')
+    parser.add_argument('--only', nargs='+', help='Only run these scenarios')
+    parser.add_argument('--save', action='store_true', help='Record the results as the baselines')
+    parser.add_argument('--check', action='store_true', help='Exit 1 if the results regressed from the baselines')
+    parser.add_argument('--tolerance', type=float, default=1.0,
+                        help='How much slower (as a fraction) the p50 can be than the baseline')
+    args = parser.parse_args()
+    # The access log of every poll (and warnings about the test token) drown out the results
+    logging.disable(logging.WARNING)
+    try:
+        results = run(args)
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    if args.save:
+        with open(BASELINES, 'w') as the_file:
+            the_file.write(ujson.dumps({'settings': settings(args), 'results': results}, indent=2, sort_keys=True))
+            the_file.write('\n')
+        print('Saved baselines to {}'.format(BASELINES))
+    elif args.check:
+        with open(BASELINES) as the_file:
+            baselines = ujson.load(the_file)
+        if baselines['settings'] != settings(args):
+            print('Baselines were recorded with {}; run with the same options, or --save new ones'.format(baselines['settings']))
+            sys.exit(2)
+        regressions = check(results, baselines['results'], args.tolerance)
+        for regression in regressions:
+            print('REGRESSION {}'.format(regression))
+        if regressions:
+            sys.exit(1)
+        print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
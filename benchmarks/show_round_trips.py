@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Compares the number of vCenter round trips made by ``show_winserver`` when
+calling ``virtual_machine.get_info`` per VM, versus the bulk PropertyCollector
+path in ``inventory.show``.
+
+Every property read off a pyVmomi managed object is a SOAP request, so the fake
+objects below count one round trip per managed-object property access, and
+per method call. Data objects (like the ServiceContent) are free to read.
+
+Usage::
+
+    python benchmarks/show_round_trips.py
+"""
+from unittest.mock import patch
+
+import ujson
+
+from vlab_inf_common.vmware import virtual_machine
+from vlab_winserver_api.lib.worker import inventory
+
+
+USERNAME = 'bob'
+WINSERVER_META = ujson.dumps({'component': 'WinServer', 'created': 0, 'version': '2016',
+                              'generation': 1, 'configured': True})
+OTHER_META = ujson.dumps({'component': 'CentOS', 'created': 0, 'version': '8',
+                          'generation': 1, 'configured': True})
+
+
+class RoundTrips(object):
+    """Tallies the requests sent to the fake vCenter"""
+    count = 0
+
+    @classmethod
+    def hit(cls, value=None):
+        cls.count += 1
+        return value
+
+
+class Data(object):
+    """A pyVmomi data object; reading attributes is free"""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class ManagedObject(object):
+    """A pyVmomi managed object; every property read is a round trip"""
+    def __init__(self, moid, **props):
+        self._moId = moid
+        self._props = props
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return RoundTrips.hit(self._props[name])
+
+
+def make_folder(size, winserver_ratio=0.25):
+    """Build a user folder with ``size`` VMs, and the networks they use"""
+    network = ManagedObject('network-1', name='{}_lab'.format(USERNAME), vm=[])
+    vms = []
+    for idx in range(size):
+        meta = WINSERVER_META if idx < size * winserver_ratio else OTHER_META
+        vm = ManagedObject('vm-{}'.format(idx),
+                           name='vm{}'.format(idx),
+                           runtime=Data(powerState='poweredOn'),
+                           guest=Data(net=[Data(ipAddress=['192.168.1.{}'.format(idx % 250)])]),
+                           config=Data(annotation=meta),
+                           network=[network])
+        vms.append(vm)
+    network._props['vm'] = vms
+    return ManagedObject('group-v1', childEntity=vms), [network]
+
+
+class FakeVCenter(object):
+    """Just enough of ``vlab_inf_common.vmware.vCenter`` to run both code paths"""
+    def __init__(self, folder, networks):
+        self._folder = folder
+        self._networks = networks
+        self._net_cache = None
+
+    @property
+    def content(self):
+        RoundTrips.hit()
+        session_manager = Data(AcquireCloneTicket=lambda: RoundTrips.hit('ticket'))
+        return Data(about=Data(instanceUuid='some-uuid'),
+                    sessionManager=session_manager,
+                    setting=ManagedObject('setting', setting=[]),
+                    propertyCollector=FakeCollector(self._folder, self._networks))
+
+    @property
+    def networks(self):
+        if self._net_cache is None:
+            # container view create, read the view, destroy the view
+            RoundTrips.hit()
+            RoundTrips.hit()
+            RoundTrips.hit()
+            self._net_cache = {x.name: x for x in self._networks}
+        return self._net_cache
+
+
+class FakeCollector(object):
+    """Serves RetrievePropertiesEx in one round trip, like the real PropertyCollector"""
+    def __init__(self, folder, networks):
+        self._folder = folder
+        self._networks = networks
+
+    def RetrievePropertiesEx(self, specSet, options):
+        RoundTrips.hit()
+        objects = []
+        for vm in self._folder._props['childEntity']:
+            props = dict(vm._props)
+            the_vm = inventory.vim.VirtualMachine(vm._moId)
+            objects.append(Data(obj=the_vm,
+                                propSet=[Data(name='name', val=props['name']),
+                                         Data(name='runtime.powerState', val=props['runtime'].powerState),
+                                         Data(name='config.annotation', val=props['config'].annotation),
+                                         Data(name='guest.net', val=props['guest'].net),
+                                         Data(name='network', val=[inventory.vim.Network(x._moId) for x in props['network']])]))
+        for net in self._networks:
+            objects.append(Data(obj=inventory.vim.Network(net._moId),
+                                propSet=[Data(name='name', val=net._props['name'])]))
+        return Data(objects=objects, token=None)
+
+
+def per_vm_show(vcenter, folder):
+    """The original ``show_winserver`` loop"""
+    found = {}
+    for vm in folder.childEntity:
+        info = virtual_machine.get_info(vcenter, vm, USERNAME)
+        if info['meta']['component'] == 'WinServer':
+            found[vm.name] = info
+    return found
+
+
+def bulk_show(vcenter, folder):
+    """The PropertyCollector based ``show_winserver``"""
+    return inventory.show(vcenter, inventory.vim.Folder(folder._moId), USERNAME, 'WinServer')
+
+
+def measure(func, size):
+    """Count the round trips ``func`` makes for a folder with ``size`` VMs"""
+    folder, networks = make_folder(size)
+    vcenter = FakeVCenter(folder, networks)
+    RoundTrips.count = 0
+    func(vcenter, folder)
+    return RoundTrips.count
+
+
+def fake_tls_handshake(*args, **kwargs):
+    """Fetching the vCenter cert for the console URL is a round trip too"""
+    return RoundTrips.hit('cert')
+
+
+def main():
+    sizes = [1, 5, 10, 20, 40, 80]
+    with patch.object(virtual_machine.ssl, 'get_server_certificate', fake_tls_handshake), \
+         patch.object(inventory.ssl, 'get_server_certificate', fake_tls_handshake), \
+         patch.object(virtual_machine.OpenSSL.crypto, 'load_certificate'), \
+         patch.object(inventory.OpenSSL.crypto, 'load_certificate'):
+        print('{:>12} {:>12} {:>12}'.format('folder size', 'get_info', 'bulk'))
+        for size in sizes:
+            legacy = measure(per_vm_show, size)
+            bulk = measure(bulk_show, size)
+            print('{:>12} {:>12} {:>12}'.format(size, legacy, bulk))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,399 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the admission.py module
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_winserver_api.lib import admission
+
+
+def allow(deploying, waiting, username, count, since):
+    """A ``decide`` function that admits everything"""
+    return ''
+
+
+def refuse(deploying, waiting, username, count, since):
+    """A ``decide`` function that admits nothing"""
+    return 'testing'
+
+
+class LedgerTests(object):
+    """Test cases every ledger must pass; mixed into a TestCase that sets ``self.ledger``"""
+    def test_acquire(self):
+        """``acquire`` takes the lease when ``decide`` allows it"""
+        error = self.ledger.acquire('task-1', 'bob', 2, allow)
+        seen = {}
+        self.ledger.acquire('task-2', 'sam', 1, lambda v, w, x, y, z: seen.update(v) or '')
+
+        self.assertEqual(error, '')
+        self.assertEqual(seen, {'bob': 2})
+
+    def test_acquire_refused(self):
+        """``acquire`` does not take the lease when ``decide`` refuses it"""
+        error = self.ledger.acquire('task-1', 'bob', 1, refuse)
+        seen = {}
+        self.ledger.acquire('task-2', 'sam', 1, lambda v, w, x, y, z: seen.update(v) or '')
+
+        self.assertEqual(error, 'testing')
+        self.assertEqual(seen, {})
+
+    def test_acquire_again(self):
+        """``acquire`` admits a task that already holds a lease without asking ``decide``"""
+        self.ledger.acquire('task-1', 'bob', 1, allow)
+
+        error = self.ledger.acquire('task-1', 'bob', 1, refuse)
+
+        self.assertEqual(error, '')
+
+    def test_release(self):
+        """``release`` stops counting the lease"""
+        self.ledger.acquire('task-1', 'bob', 1, allow)
+        self.ledger.release('task-1')
+        seen = {}
+        self.ledger.acquire('task-2', 'sam', 1, lambda v, w, x, y, z: seen.update(v) or '')
+
+        self.assertEqual(seen, {})
+
+    def test_expires(self):
+        """A lease that's never given back expires"""
+        with patch.object(admission.time, 'time') as fake_time:
+            fake_time.return_value = 100
+            self.ledger.acquire('task-1', 'bob', 1, allow)
+            fake_time.return_value = 100 + self.ledger.ttl + 1
+            seen = {}
+            self.ledger.acquire('task-2', 'sam', 1, lambda v, w, x, y, z: seen.update(v) or '')
+
+        self.assertEqual(seen, {})
+
+    def test_queue(self):
+        """``acquire`` shows a refused task to the others, when asked to keep its place"""
+        with patch.object(admission.time, 'time') as fake_time:
+            fake_time.return_value = 100
+            self.ledger.acquire('task-1', 'bob', 2, refuse, queue=True)
+            fake_time.return_value = 110
+            seen = []
+            self.ledger.acquire('task-2', 'sam', 1, lambda v, w, x, y, z: seen.extend(w) or '')
+
+        self.assertEqual([tuple(x) for x in seen], [('bob', 2, 100)])
+
+    def test_queue_keeps_place(self):
+        """``acquire`` keeps when a task was first queued, across its retries"""
+        with patch.object(admission.time, 'time') as fake_time:
+            fake_time.return_value = 100
+            self.ledger.acquire('task-1', 'bob', 1, refuse, queue=True)
+            fake_time.return_value = 130
+            seen = []
+            self.ledger.acquire('task-1', 'bob', 1, lambda v, w, x, y, z: seen.append(z) or 'testing', queue=True)
+
+        self.assertEqual(seen, [100])
+
+    def test_queue_not_asked(self):
+        """``acquire`` does not queue a refused task unless asked to"""
+        self.ledger.acquire('task-1', 'bob', 1, refuse)
+        seen = []
+        self.ledger.acquire('task-2', 'sam', 1, lambda v, w, x, y, z: seen.extend(w) or '')
+
+        self.assertEqual(seen, [])
+
+    def test_queue_admitted(self):
+        """``acquire`` takes a task out of the queue once it's admitted"""
+        self.ledger.acquire('task-1', 'bob', 1, refuse, queue=True)
+        self.ledger.acquire('task-1', 'bob', 1, allow, queue=True)
+        seen = []
+        self.ledger.acquire('task-2', 'sam', 1, lambda v, w, x, y, z: seen.extend(w) or '')
+
+        self.assertEqual(seen, [])
+
+    def test_queue_expires(self):
+        """A queued task that stops retrying loses its place"""
+        with patch.object(admission.time, 'time') as fake_time:
+            fake_time.return_value = 100
+            self.ledger.acquire('task-1', 'bob', 1, refuse, queue=True)
+            fake_time.return_value = 100 + self.ledger.wait_ttl + 1
+            seen = []
+            self.ledger.acquire('task-2', 'sam', 1, lambda v, w, x, y, z: seen.extend(w) or '')
+
+        self.assertEqual(seen, [])
+
+    def test_release_queued(self):
+        """``release`` gives up the place of a queued task"""
+        self.ledger.acquire('task-1', 'bob', 1, refuse, queue=True)
+        self.ledger.release('task-1')
+        seen = []
+        self.ledger.acquire('task-2', 'sam', 1, lambda v, w, x, y, z: seen.extend(w) or '')
+
+        self.assertEqual(seen, [])
+
+    def test_renew(self):
+        """``renew`` keeps a lease from expiring"""
+        with patch.object(admission.time, 'time') as fake_time:
+            fake_time.return_value = 100
+            self.ledger.acquire('task-1', 'bob', 1, allow)
+            fake_time.return_value = 100 + self.ledger.ttl - 1
+            self.ledger.renew('task-1', 'bob', 1)
+            fake_time.return_value = 100 + self.ledger.ttl + 1
+            seen = {}
+            self.ledger.acquire('task-2', 'sam', 1, lambda v, w, x, y, z: seen.update(v) or '')
+
+        self.assertEqual(seen, {'bob': 1})
+
+    def test_renew_expired(self):
+        """``renew`` takes the lease again if it already expired"""
+        with patch.object(admission.time, 'time') as fake_time:
+            fake_time.return_value = 100
+            self.ledger.acquire('task-1', 'bob', 1, allow)
+            fake_time.return_value = 100 + self.ledger.ttl + 1
+            self.ledger.renew('task-1', 'bob', 1)
+            seen = {}
+            self.ledger.acquire('task-2', 'sam', 1, lambda v, w, x, y, z: seen.update(v) or '')
+
+        self.assertEqual(seen, {'bob': 1})
+
+
+class TestMemoryLedger(LedgerTests, unittest.TestCase):
+    """A set of test cases for the MemoryLedger object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.ledger = admission.MemoryLedger(ttl=60)
+
+
+class TestSqliteLedger(LedgerTests, unittest.TestCase):
+    """A set of test cases for the SqliteLedger object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.directory = tempfile.mkdtemp()
+        self.ledger = admission.SqliteLedger(os.path.join(self.directory, 'admission.db'), ttl=60)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        shutil.rmtree(self.directory)
+
+    def test_shared(self):
+        """SqliteLedger - two ledgers on the same file see each other's leases"""
+        other = admission.SqliteLedger(self.ledger.path, ttl=60)
+        self.ledger.acquire('task-1', 'bob', 1, allow)
+        seen = {}
+        other.acquire('task-2', 'sam', 1, lambda v, w, x, y, z: seen.update(v) or '')
+
+        self.assertEqual(seen, {'bob': 1})
+
+    def test_broken(self):
+        """SqliteLedger - a broken ledger admits everything, instead of breaking creates"""
+        self.ledger.path = os.path.join(self.directory, 'nope', 'admission.db')
+
+        error = self.ledger.acquire('task-1', 'bob', 1, refuse)
+
+        self.assertEqual(error, '')
+
+
+class TestGetLedger(unittest.TestCase):
+    """A set of test cases for the ``get_ledger`` function"""
+    def test_memory(self):
+        """``get_ledger`` supports memory:// URLs"""
+        ledger = admission.get_ledger('memory://', ttl=60)
+
+        self.assertTrue(isinstance(ledger, admission.MemoryLedger))
+
+    def test_unsupported(self):
+        """``get_ledger`` raises ValueError for an unknown URL"""
+        with self.assertRaises(ValueError):
+            admission.get_ledger('redis://localhost', ttl=60)
+
+
+class TestAdmissionControl(unittest.TestCase):
+    """A set of test cases for the AdmissionControl object"""
+    def make_control(self, max_user=3, max_total=8):
+        return admission.AdmissionControl(admission.MemoryLedger(ttl=60),
+                                          max_user=max_user,
+                                          max_total=max_total,
+                                          retry_after=30)
+
+    def test_admit(self):
+        """``admit`` lets a user start deploying"""
+        control = self.make_control()
+
+        self.assertEqual(control.admit('task-1', 'bob'), '')
+
+    def test_user_limit(self):
+        """``admit`` refuses a user who has too many VMs deploying"""
+        control = self.make_control()
+        control.admit('task-1', 'bob', count=3)
+
+        error = control.admit('task-2', 'bob')
+
+        self.assertTrue('the limit is 3' in error)
+
+    def test_user_limit_others(self):
+        """``admit`` does not hold one user's deploys against another user"""
+        control = self.make_control()
+        control.admit('task-1', 'bob', count=3)
+
+        self.assertEqual(control.admit('task-2', 'sam'), '')
+
+    def test_total_limit(self):
+        """``admit`` refuses everyone when too many VMs are deploying overall"""
+        control = self.make_control(max_user=0, max_total=4)
+        control.admit('task-1', 'bob', count=2)
+        control.admit('task-2', 'sam', count=2)
+
+        error = control.admit('task-3', 'pat')
+
+        self.assertTrue('vLab is deploying 4' in error)
+
+    def test_fair_share(self):
+        """``admit`` keeps a user to their share of the slots once vLab is busy"""
+        control = self.make_control(max_user=0, max_total=8)
+        control.admit('task-1', 'bob', count=4)
+        control.admit('task-2', 'sam', count=1)
+
+        error = control.admit('task-3', 'bob')
+
+        self.assertTrue('fair share is 4' in error)
+        self.assertEqual(control.admit('task-4', 'sam'), '')
+
+    def test_fair_share_idle(self):
+        """``admit`` lets a user past their share while vLab isn't busy"""
+        control = self.make_control(max_user=0, max_total=20)
+        control.admit('task-1', 'bob', count=6)
+        control.admit('task-2', 'sam', count=1)
+
+        self.assertEqual(control.admit('task-3', 'bob'), '')
+
+    def test_release(self):
+        """``release`` frees the slots of a finished deploy"""
+        control = self.make_control()
+        control.admit('task-1', 'bob', count=3)
+        control.release('task-1')
+
+        self.assertEqual(control.admit('task-2', 'bob'), '')
+
+    def test_too_big(self):
+        """``admit`` raises ValueError for a request that could never fit"""
+        control = self.make_control()
+
+        with self.assertRaises(ValueError):
+            control.admit('task-1', 'bob', count=4)
+
+    def test_queue_round_robin(self):
+        """``admit`` gives a freed slot to the queued user with the fewest VMs deploying"""
+        control = self.make_control(max_user=0, max_total=2)
+        control.admit('task-1', 'bob')
+        control.admit('task-2', 'bob')
+        control.admit('task-3', 'bob', queue=True)
+        control.admit('task-4', 'sam', queue=True)
+        control.release('task-1')
+
+        error = control.admit('task-3', 'bob', queue=True)
+
+        self.assertTrue('queued ahead of yours' in error)
+        self.assertEqual(control.admit('task-4', 'sam', queue=True), '')
+
+    def test_queue_in_order(self):
+        """``admit`` lets a user's creates go in the order they were queued"""
+        control = self.make_control(max_user=1, max_total=0)
+        control.admit('task-1', 'bob')
+        with patch.object(admission.time, 'time') as fake_time:
+            fake_time.return_value = 100
+            control.admit('task-2', 'bob', queue=True)
+            fake_time.return_value = 101
+            control.admit('task-3', 'bob', queue=True)
+            control.release('task-1')
+
+            error = control.admit('task-3', 'bob', queue=True)
+            admitted = control.admit('task-2', 'bob', queue=True)
+
+        self.assertTrue('1 deploys are queued' in error)
+        self.assertEqual(admitted, '')
+
+    def test_queue_not_blocked(self):
+        """``admit`` doesn't hold a request behind a queued task that cannot go yet anyway"""
+        control = self.make_control(max_user=1, max_total=4)
+        control.admit('task-1', 'bob')
+        control.admit('task-2', 'bob', queue=True)
+
+        self.assertEqual(control.admit('task-3', 'sam'), '')
+
+    def test_queue_no_jumping(self):
+        """``admit`` refuses an API request while a task that's queued ahead could go"""
+        control = self.make_control(max_user=0, max_total=1)
+        control.admit('task-1', 'bob')
+        control.admit('task-2', 'sam', queue=True)
+        control.release('task-1')
+
+        error = control.admit('task-3', 'pat')
+
+        self.assertTrue('queued ahead of yours' in error)
+
+    def test_renew(self):
+        """``renew`` extends the lease of a task"""
+        control = self.make_control()
+        with patch.object(control, 'ledger') as fake_ledger:
+            control.renew('task-1', 'bob', count=2)
+
+        fake_ledger.renew.assert_called_with('task-1', 'bob', 2)
+
+    def test_no_limits(self):
+        """``admit`` does not touch the ledger when there are no limits"""
+        control = self.make_control(max_user=0, max_total=0)
+        with patch.object(control, 'ledger') as fake_ledger:
+            error = control.admit('task-1', 'bob', count=100)
+
+        self.assertEqual(error, '')
+        self.assertFalse(fake_ledger.acquire.called)
+
+
+class TestGetAdmission(unittest.TestCase):
+    """A set of test cases for the ``get_admission`` function"""
+    def tearDown(self):
+        """Runs after every test case"""
+        admission._ADMISSION = None
+
+    @patch.object(admission, 'const')
+    def test_settings(self, fake_const):
+        """``get_admission`` reads the limits from the constants, and is shared"""
+        admission._ADMISSION = None
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        fake_const.VLAB_WINSERVER_ADMISSION_URL = 'sqlite:///{}'.format(os.path.join(directory, 'admission.db'))
+        fake_const.VLAB_WINSERVER_ADMISSION_TTL = 60
+        fake_const.VLAB_WINSERVER_MAX_USER_DEPLOYS = 5
+        fake_const.VLAB_WINSERVER_MAX_DEPLOYS = 20
+        fake_const.VLAB_WINSERVER_ADMISSION_RETRY_AFTER = 30
+        fake_const.VLAB_WINSERVER_ADMISSION_WAIT_TTL = 90
+
+        control = admission.get_admission()
+
+        self.assertEqual((control.max_user, control.max_total), (5, 20))
+        self.assertEqual(control.ledger.wait_ttl, 90)
+
+    @patch.object(admission, 'const')
+    def test_memory_limited(self, fake_const):
+        """``get_admission`` raises RuntimeError for a limit with a ledger each process keeps to itself"""
+        admission._ADMISSION = None
+        fake_const.VLAB_WINSERVER_ADMISSION_URL = 'memory://'
+        fake_const.VLAB_WINSERVER_MAX_USER_DEPLOYS = 5
+        fake_const.VLAB_WINSERVER_MAX_DEPLOYS = 0
+
+        with self.assertRaises(RuntimeError):
+            admission.get_admission()
+
+    @patch.object(admission, 'const')
+    def test_memory_no_limits(self, fake_const):
+        """``get_admission`` allows a memory:// ledger while there are no limits"""
+        admission._ADMISSION = None
+        fake_const.VLAB_WINSERVER_ADMISSION_URL = 'memory://'
+        fake_const.VLAB_WINSERVER_MAX_USER_DEPLOYS = 0
+        fake_const.VLAB_WINSERVER_MAX_DEPLOYS = 0
+
+        control = admission.get_admission()
+
+        self.assertTrue(isinstance(control.ledger, admission.MemoryLedger))
+        self.assertTrue(control is admission.get_admission())
+
+
+if __name__ == '__main__':
+    unittest.main()
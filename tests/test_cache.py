@@ -0,0 +1,72 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in cache.py
+"""
+import unittest
+
+from vlab_winserver_api.lib import cache, metrics
+from vlab_winserver_api.lib.store import MemoryStore
+
+
+class TestInventoryCache(unittest.TestCase):
+    """A set of test cases for the InventoryCache object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        metrics.REGISTRY.clear()
+        self.cache = cache.InventoryCache(MemoryStore(max_size=100, ttl=30))
+
+    def test_miss(self):
+        """InventoryCache - ``get`` returns None when nothing is cached"""
+        self.assertTrue(self.cache.get('bob') is None)
+
+    def test_hit(self):
+        """InventoryCache - ``get`` returns what ``put`` cached"""
+        generation = self.cache.generation('bob')
+        self.cache.put('bob', {'myBox': {}}, generation)
+
+        self.assertEqual(self.cache.get('bob'), {'myBox': {'console': None}})
+
+    def test_no_console(self):
+        """InventoryCache - the single-use console URLs are not cached"""
+        content = {'myBox': {'state': 'poweredOn', 'console': 'https://vcenter/ui/webconsole.html?sessionTicket=abc'}}
+        self.cache.put('bob', content, self.cache.generation('bob'))
+
+        self.assertEqual(self.cache.get('bob'), {'myBox': {'state': 'poweredOn', 'console': None}})
+        self.assertEqual(content['myBox']['console'], 'https://vcenter/ui/webconsole.html?sessionTicket=abc')
+
+    def test_invalidate(self):
+        """InventoryCache - ``invalidate`` forgets the cached inventory"""
+        self.cache.put('bob', {'myBox': {}}, self.cache.generation('bob'))
+        self.cache.invalidate('bob')
+
+        self.assertTrue(self.cache.get('bob') is None)
+
+    def test_stale_put(self):
+        """InventoryCache - a ``put`` that raced an ``invalidate`` is ignored"""
+        generation = self.cache.generation('bob')
+        self.cache.invalidate('bob')
+        self.cache.put('bob', {'deletedBox': {}}, generation)
+
+        self.assertTrue(self.cache.get('bob') is None)
+
+    def test_per_user(self):
+        """InventoryCache - users do not see each other's inventory"""
+        self.cache.put('bob', {'myBox': {}}, self.cache.generation('bob'))
+
+        self.assertTrue(self.cache.get('alice') is None)
+
+    def test_metrics(self):
+        """InventoryCache - hits and misses are recorded"""
+        self.cache.put('bob', {'myBox': {}}, self.cache.generation('bob'))
+        self.cache.get('bob')
+        self.cache.get('alice')
+
+        snapshot = metrics.REGISTRY.snapshot()
+        self.assertEqual(snapshot['counters'], [['winserver_inventory_cache_total', {'result': 'hit'}, 1],
+                                                        ['winserver_inventory_cache_total', {'result': 'miss'}, 1]])
+        self.assertEqual(snapshot['gauges'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
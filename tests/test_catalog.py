@@ -0,0 +1,170 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in catalog.py
+"""
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_winserver_api.lib import catalog
+
+
+OVF = """<?xml version="1.0" encoding="UTF-8"?>
+<Envelope xmlns="http://schemas.dmtf.org/ovf/envelope/1" xmlns:ovf="http://schemas.dmtf.org/ovf/envelope/1">
+  <References>
+    <File ovf:href="disk1.vmdk" ovf:id="file1" ovf:size="1024"/>
+  </References>
+  <DiskSection>
+    <Disk ovf:capacity="40" ovf:capacityAllocationUnits="byte * 2^30" ovf:diskId="vmdisk1" ovf:fileRef="file1"/>
+  </DiskSection>
+  <NetworkSection>
+    <Network ovf:name="VM Network"/>
+  </NetworkSection>
+</Envelope>
+"""
+MANIFEST = "SHA256(disk1.vmdk)= ABCDEF0123\nSHA256(WinServer.ovf)= 0123abcdef\n"
+
+
+def _make_ova(path, members):
+    """Write a tar file with the supplied (name, content) members"""
+    with tarfile.open(path, 'w') as tar:
+        for name, content in members:
+            data = content.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+class TestParseOva(unittest.TestCase):
+    """A set of test cases for reading OVA files"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'WinServer-2016.ova')
+
+    def test_parse_ova(self):
+        """``parse_ova`` reads the networks and disk sizes from the descriptor"""
+        _make_ova(self.path, [('WinServer.ovf', OVF), ('disk1.vmdk', 'not really a disk')])
+
+        output = catalog.parse_ova(self.path)
+
+        self.assertEqual(output['networks'], ['VM Network'])
+        self.assertEqual(output['disks'], [{'name': 'disk1.vmdk', 'capacity': 40 * 2**30, 'size': 1024}])
+
+    def test_parse_ova_manifest(self):
+        """``parse_ova`` reads the checksums from the manifest"""
+        _make_ova(self.path, [('WinServer.ovf', OVF), ('WinServer.mf', MANIFEST), ('disk1.vmdk', 'x')])
+
+        output = catalog.parse_ova(self.path)
+
+        self.assertEqual(output['checksums']['disk1.vmdk'], 'sha256:abcdef0123')
+
+    def test_parse_ova_stops_at_disks(self):
+        """``parse_ova`` does not read the tar headers after the first disk"""
+        _make_ova(self.path, [('WinServer.ovf', OVF), ('disk1.vmdk', 'x'), ('other.mf', MANIFEST)])
+
+        output = catalog.parse_ova(self.path)
+
+        self.assertEqual(output['checksums'], {})
+
+    def test_parse_ova_no_ovf(self):
+        """``parse_ova`` raises ValueError if the OVA has no descriptor"""
+        _make_ova(self.path, [('disk1.vmdk', 'x')])
+
+        with self.assertRaises(ValueError):
+            catalog.parse_ova(self.path)
+
+    def test_parse_ova_not_tar(self):
+        """``parse_ova`` raises ValueError if the file is not a tar"""
+        with open(self.path, 'w') as the_file:
+            the_file.write('not an OVA')
+
+        with self.assertRaises(ValueError):
+            catalog.parse_ova(self.path)
+
+
+class TestImageCatalog(unittest.TestCase):
+    """A set of test cases for the ImageCatalog object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        _make_ova(os.path.join(self.directory, 'WinServer-2016.ova'), [('WinServer.ovf', OVF)])
+        _make_ova(os.path.join(self.directory, 'WinServer-2012R2.ova'), [('WinServer.ovf', OVF)])
+        self.catalog = catalog.ImageCatalog(self.directory)
+
+    def test_images(self):
+        """ImageCatalog - ``images`` returns the version of every OVA"""
+        self.assertEqual(self.catalog.images(), ['2012R2', '2016'])
+
+    def test_get(self):
+        """ImageCatalog - ``get`` returns the details of one version"""
+        output = self.catalog.get('2016')
+
+        self.assertEqual(output['path'], os.path.join(self.directory, 'WinServer-2016.ova'))
+        self.assertEqual(output['networks'], ['VM Network'])
+
+    def test_get_missing(self):
+        """ImageCatalog - ``get`` returns None for an unknown version"""
+        self.assertTrue(self.catalog.get('1999') is None)
+
+    @patch.object(catalog, 'parse_ova', wraps=catalog.parse_ova)
+    def test_cached(self, fake_parse_ova):
+        """ImageCatalog - OVAs are only parsed once if they don't change"""
+        self.catalog.images()
+        self.catalog.images()
+
+        self.assertEqual(fake_parse_ova.call_count, 2)
+
+    @patch.object(catalog, 'parse_ova', wraps=catalog.parse_ova)
+    def test_changed(self, fake_parse_ova):
+        """ImageCatalog - only the OVA that changed gets parsed again"""
+        self.catalog.images()
+        path = os.path.join(self.directory, 'WinServer-2016.ova')
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+        self.catalog.images()
+
+        self.assertEqual(fake_parse_ova.call_count, 3)
+
+    @patch.object(catalog.os, 'scandir', wraps=catalog.os.scandir)
+    def test_max_age(self, fake_scandir):
+        """ImageCatalog - ``max_age`` avoids scanning the directory on every call"""
+        self.catalog.images(max_age=30)
+        self.catalog.images(max_age=30)
+
+        self.assertEqual(fake_scandir.call_count, 1)
+
+    def test_unreadable(self):
+        """ImageCatalog - ``images`` raises OSError if the directory is missing"""
+        the_catalog = catalog.ImageCatalog(os.path.join(self.directory, 'nope'))
+
+        with self.assertRaises(OSError):
+            the_catalog.images()
+
+    def test_removed(self):
+        """ImageCatalog - deleted OVAs are dropped from the catalog"""
+        self.catalog.images()
+        os.remove(os.path.join(self.directory, 'WinServer-2016.ova'))
+
+        self.assertEqual(self.catalog.images(), ['2012R2'])
+
+    def test_ignores_junk(self):
+        """ImageCatalog - files that are not valid OVAs are skipped"""
+        with open(os.path.join(self.directory, 'WinServer-2019.ova'), 'w') as the_file:
+            the_file.write('still copying...')
+        with open(os.path.join(self.directory, 'README.txt'), 'w') as the_file:
+            the_file.write('hello')
+
+        self.assertEqual(self.catalog.images(), ['2012R2', '2016'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,297 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in change_feed.py
+"""
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+
+import ujson
+from pyVmomi import vim, vmodl
+
+from vlab_winserver_api.lib.worker import change_feed
+from benchmarks import fake_vcenter
+
+
+PC = vmodl.query.PropertyCollector
+META = ujson.dumps({'component': 'WinServer', 'created': 1234, 'version': '2016',
+                    'generation': 1, 'configured': False})
+
+
+def _update(version, *object_updates, truncated=False):
+    """Make a scripted ``WaitForUpdatesEx`` result"""
+    return PC.UpdateSet(version=version, truncated=truncated,
+                        filterSet=[PC.FilterUpdate(objectSet=list(object_updates))])
+
+
+def _object(kind, obj, **props):
+    """Make the update for one object, assigning every supplied property"""
+    changes = [PC.Change(name=x.replace('__', '.'), op='assign', val=y) for x, y in props.items()]
+    return PC.ObjectUpdate(kind=kind, obj=obj, changeSet=changes)
+
+
+def _inventory(version='1'):
+    """The full inventory sent after connecting: one user folder with one WinServer"""
+    return _update(version,
+                   _object('enter', vim.Folder('group-v1'), name='bob', parent=vim.Folder('group-v0')),
+                   _object('enter', vim.Network('network-1'), name='bob_frontend'),
+                   _object('enter', vim.VirtualMachine('vm-1'), name='myBox', parent=vim.Folder('group-v1'),
+                           runtime__powerState='poweredOn', config__annotation=META,
+                           network=vim.Network.Array([vim.Network('network-1')])))
+
+
+class TestInventoryModel(unittest.TestCase):
+    """A set of test cases for the InventoryModel object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.model = change_feed.InventoryModel()
+        self.model.apply(_inventory())
+
+    def test_vms(self):
+        """InventoryModel - ``vms`` returns the VMs in a user's folder"""
+        vms = self.model.vms('bob')
+
+        self.assertEqual(len(vms), 1)
+        self.assertEqual(vms[0]['name'], 'myBox')
+        self.assertEqual(vms[0]['network'], ['bob_frontend'])
+
+    def test_vms_other_user(self):
+        """InventoryModel - ``vms`` does not return other users VMs"""
+        self.assertEqual(self.model.vms('alice'), [])
+
+    def test_modify(self):
+        """InventoryModel - a modify only changes the reported properties"""
+        self.model.apply(_update('2', _object('modify', vim.VirtualMachine('vm-1'), runtime__powerState='poweredOff')))
+
+        vm = self.model.vms('bob')[0]
+
+        self.assertEqual(vm['runtime.powerState'], 'poweredOff')
+        self.assertEqual(vm['name'], 'myBox')
+
+    def test_leave(self):
+        """InventoryModel - a deleted VM leaves the model"""
+        self.model.apply(_update('2', PC.ObjectUpdate(kind='leave', obj=vim.VirtualMachine('vm-1'))))
+
+        self.assertEqual(self.model.vms('bob'), [])
+
+    def test_remove(self):
+        """InventoryModel - a removed property is dropped"""
+        change = PC.Change(name='config.annotation', op='remove')
+        self.model.apply(_update('2', PC.ObjectUpdate(kind='modify', obj=vim.VirtualMachine('vm-1'), changeSet=[change])))
+
+        self.assertFalse('config.annotation' in self.model.vms('bob')[0])
+
+    def test_version(self):
+        """InventoryModel - ``apply`` records the version to wait from"""
+        self.assertEqual(self.model.version, '1')
+
+    def test_reset(self):
+        """InventoryModel - ``reset`` forgets everything"""
+        self.model.reset()
+
+        self.assertEqual(self.model.vms('bob'), [])
+        self.assertEqual(self.model.version, '')
+
+    def test_show(self):
+        """InventoryModel - ``show`` returns the same format as ``inventory.show``"""
+        console = MagicMock()
+        console.url.return_value = 'https://some-console'
+
+        output = self.model.show('bob', 'WinServer', console)
+
+        self.assertEqual(output['myBox']['state'], 'poweredOn')
+        self.assertEqual(output['myBox']['networks'], ['frontend'])
+        self.assertEqual(output['myBox']['moid'], 'vm-1')
+        self.assertEqual(output['myBox']['meta']['version'], '2016')
+
+    def test_show_component(self):
+        """InventoryModel - ``show`` skips VMs of other components"""
+        self.assertEqual(self.model.show('bob', 'OneFS', MagicMock()), {})
+
+
+class TestChangeFeed(unittest.TestCase):
+    """A set of test cases for the ChangeFeed object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.fake_vcenter = MagicMock()
+        self.fake_vcenter.get_vm_folder.return_value = vim.Folder('group-v0')
+        self.fake_collector = self.fake_vcenter.content.propertyCollector.CreatePropertyCollector.return_value
+        self.feed = change_feed.ChangeFeed(connect=lambda: self.fake_vcenter, wait=5)
+        close_patcher = patch.object(change_feed.session, '_close')
+        close_patcher.start()
+        self.addCleanup(close_patcher.stop)
+
+    def _script(self, *results):
+        """Make ``WaitForUpdatesEx`` return/raise each result, then stop the feed"""
+        results = list(results)
+        seen = []
+
+        def wait_for_updates(version, options):
+            seen.append(version)
+            if not results:
+                self.feed.stop()
+                return None
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        self.fake_collector.WaitForUpdatesEx.side_effect = wait_for_updates
+        return seen
+
+    def test_follow(self):
+        """ChangeFeed - ``follow`` waits from the version of the last update"""
+        seen = self._script(_inventory('1'), None, _update('2'))
+
+        self.feed.follow()
+
+        self.assertEqual(seen, ['', '1', '1', '2'])
+
+    def test_follow_truncated(self):
+        """ChangeFeed - the model is only ready once the full inventory arrives"""
+        ready = []
+        self._script(_update('1', truncated=True), _inventory('2'))
+        self.feed.model.apply = MagicMock(side_effect=lambda x: ready.append(self.feed.model.ready))
+
+        self.feed.follow()
+
+        self.assertEqual(ready, [False, False])
+
+    def test_follow_resync(self):
+        """ChangeFeed - an invalid version triggers a full resync"""
+        seen = self._script(_inventory('1'), vmodl.query.InvalidCollectorVersion(), _inventory('1'))
+
+        self.feed.follow()
+
+        self.assertEqual(seen, ['', '1', '', '1'])
+
+    def test_follow_not_ready_after(self):
+        """ChangeFeed - the model is not used once the feed stops"""
+        self._script(_inventory('1'))
+
+        self.feed.follow()
+
+        self.assertFalse(self.feed.model.ready)
+
+    def test_follow_cleans_up(self):
+        """ChangeFeed - ``follow`` destroys its collector when the session breaks"""
+        self._script(ConnectionError('testing'))
+
+        with self.assertRaises(ConnectionError):
+            self.feed.follow()
+
+        self.assertTrue(self.fake_collector.DestroyPropertyCollector.called)
+
+    def test_run_reconnects(self):
+        """ChangeFeed - ``run`` reconnects after the session breaks"""
+        connects = []
+
+        def connect():
+            connects.append(1)
+            return self.fake_vcenter
+        self.feed._connect = connect
+        # don't actually sleep between reconnects
+        self.feed._stop.wait = MagicMock()
+        self._script(ConnectionError('testing'), _inventory('1'))
+
+        self.feed.run()
+
+        self.assertEqual(len(connects), 2)
+
+    @patch.object(change_feed.inventory, 'ConsoleUrl')
+    def test_show(self, fake_ConsoleUrl):
+        """ChangeFeed - ``show`` answers from the model while it's in sync"""
+        self.feed._vcenter = self.fake_vcenter
+        self.feed.model.apply(_inventory())
+        self.feed.model.ready = True
+        self.feed.model.heartbeat = change_feed.time.time()
+
+        output = self.feed.show('bob', 'WinServer')
+
+        self.assertEqual(list(output.keys()), ['myBox'])
+
+    def test_show_syncing(self):
+        """ChangeFeed - ``show`` returns None while the model is not in sync"""
+        self.feed._vcenter = self.fake_vcenter
+        self.feed.model.apply(_inventory())
+
+        self.assertTrue(self.feed.show('bob', 'WinServer') is None)
+
+    def test_show_stale(self):
+        """ChangeFeed - ``show`` returns None if vCenter stopped answering"""
+        self.feed._vcenter = self.fake_vcenter
+        self.feed.model.apply(_inventory())
+        self.feed.model.ready = True
+        self.feed.model.heartbeat = change_feed.time.time() - 60
+
+        self.assertTrue(self.feed.show('bob', 'WinServer') is None)
+
+
+class TestChangeFeedFakeServer(unittest.TestCase):
+    """Runs the ChangeFeed against the simulated vCenter the benchmarks use"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.server = fake_vcenter.FakeServer()
+        folder = self.server.add_folder('bob')
+        self.server.add_vm(folder, 'myBox', fake_vcenter.meta('WinServer'))
+        self.feed = change_feed.ChangeFeed(connect=self.server.connect, wait=1)
+        close_patcher = patch.object(change_feed.session, '_close')
+        close_patcher.start()
+        self.addCleanup(close_patcher.stop)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.feed.stop()
+        self.feed._thread.join(5)
+
+    def wait_until(self, check):
+        """Give the feed thread up to 5 seconds to catch up"""
+        deadline = time.time() + 5
+        while not check() and time.time() < deadline:
+            time.sleep(0.01)
+        return check()
+
+    def test_sync(self):
+        """ChangeFeed - syncs the VMs under ``INF_VCENTER_TOP_LVL_DIR``"""
+        self.feed.start()
+
+        self.assertTrue(self.wait_until(lambda: self.feed.model.ready))
+        self.assertEqual([x['name'] for x in self.feed.model.vms('bob')], ['myBox'])
+
+    def test_changes(self):
+        """ChangeFeed - picks up a VM created after the sync"""
+        self.feed.start()
+        self.wait_until(lambda: self.feed.model.ready)
+
+        self.server.add_vm(self.server.folders['bob'], 'otherBox', fake_vcenter.meta('WinServer'))
+
+        self.assertTrue(self.wait_until(lambda: len(self.feed.model.vms('bob')) == 2))
+
+
+class TestGetFeed(unittest.TestCase):
+    """A set of test cases for the ``get_feed`` function"""
+
+    @patch.object(change_feed, 'const')
+    def test_disabled(self, fake_const):
+        """``get_feed`` returns None when the change feed is disabled"""
+        fake_const.VLAB_WINSERVER_CHANGE_FEED = 'false'
+
+        self.assertTrue(change_feed.get_feed() is None)
+
+    @patch.object(change_feed.ChangeFeed, 'start')
+    @patch.object(change_feed, 'const')
+    def test_enabled(self, fake_const, fake_start):
+        """``get_feed`` starts one feed per process"""
+        fake_const.VLAB_WINSERVER_CHANGE_FEED = 'true'
+        fake_const.VLAB_WINSERVER_CHANGE_FEED_WAIT = 30
+
+        feed1 = change_feed.get_feed()
+        feed2 = change_feed.get_feed()
+
+        self.assertTrue(feed1 is feed2)
+        self.assertTrue(fake_start.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
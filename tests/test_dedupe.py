@@ -0,0 +1,115 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the dedupe.py module
+"""
+import unittest
+from unittest.mock import patch
+
+from vlab_winserver_api.lib import dedupe
+from vlab_winserver_api.lib.store import MemoryStore
+
+
+class TestDeduplicator(unittest.TestCase):
+    """A set of test cases for the Deduplicator object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.deduplicator = dedupe.Deduplicator(MemoryStore(max_size=100, ttl=60), ttl=60)
+
+    def test_replay(self):
+        """``replay`` returns the task of an earlier request with the same key and body"""
+        self.deduplicator.remember('bob', 'abc', 'print1', 'task-1')
+
+        self.assertEqual(self.deduplicator.replay('bob', 'abc', 'print1'), 'task-1')
+
+    def test_replay_other_body(self):
+        """``replay`` ignores an earlier request with the same key, but a different body"""
+        self.deduplicator.remember('bob', 'abc', 'print1', 'task-1')
+
+        self.assertTrue(self.deduplicator.replay('bob', 'abc', 'print2') is None)
+
+    def test_replay_other_user(self):
+        """``replay`` never returns the task of another user"""
+        self.deduplicator.remember('bob', 'abc', 'print1', 'task-1')
+
+        self.assertTrue(self.deduplicator.replay('sam', 'abc', 'print1') is None)
+
+    def test_no_key(self):
+        """``remember`` and ``replay`` do nothing without an idempotency key"""
+        self.deduplicator.remember('bob', '', 'print1', 'task-1')
+
+        self.assertTrue(self.deduplicator.replay('bob', '', 'print1') is None)
+
+    def test_claim(self):
+        """``claim`` returns None when nothing else is working on the VM"""
+        self.assertTrue(self.deduplicator.claim('create', 'bob', 'box', 'task-1') is None)
+
+    def test_claim_in_flight(self):
+        """``claim`` returns the task already working on the VM"""
+        self.deduplicator.claim('create', 'bob', 'box', 'task-1')
+
+        self.assertEqual(self.deduplicator.claim('create', 'bob', 'box', 'task-2'), 'task-1')
+
+    def test_claim_other_action(self):
+        """``claim`` keeps the claims of different actions apart"""
+        self.deduplicator.claim('create', 'bob', 'box', 'task-1')
+
+        self.assertTrue(self.deduplicator.claim('delete', 'bob', 'box', 'task-2') is None)
+
+    def test_claim_finished(self):
+        """``claim`` takes over the claim of a task that's finished"""
+        self.deduplicator.claim('create', 'bob', 'box', 'task-1')
+
+        self.assertTrue(self.deduplicator.claim('create', 'bob', 'box', 'task-2', finished=lambda x: True) is None)
+        self.assertEqual(self.deduplicator.claim('create', 'bob', 'box', 'task-3'), 'task-2')
+
+    def test_finish(self):
+        """``finish`` gives the claim back"""
+        self.deduplicator.claim('create', 'bob', 'box', 'task-1')
+        self.deduplicator.finish('create', 'bob', 'box', 'task-1')
+
+        self.assertTrue(self.deduplicator.claim('create', 'bob', 'box', 'task-2') is None)
+
+    def test_finish_other_task(self):
+        """``finish`` leaves the claim of another task alone"""
+        self.deduplicator.claim('create', 'bob', 'box', 'task-1')
+        self.deduplicator.finish('create', 'bob', 'box', 'task-2')
+
+        self.assertEqual(self.deduplicator.claim('create', 'bob', 'box', 'task-3'), 'task-1')
+
+
+class TestFingerprint(unittest.TestCase):
+    """A set of test cases for the ``fingerprint`` function"""
+    def test_key_order(self):
+        """``fingerprint`` doesn't depend on the order of the keys in the body"""
+        first = dedupe.fingerprint('POST', '/api', {'name': 'box', 'image': '2016'})
+        second = dedupe.fingerprint('POST', '/api', {'image': '2016', 'name': 'box'})
+
+        self.assertEqual(first, second)
+
+    def test_end_point(self):
+        """``fingerprint`` tells apart the same body sent to different end points"""
+        first = dedupe.fingerprint('POST', '/api', {'name': 'box'})
+        second = dedupe.fingerprint('DELETE', '/api', {'name': 'box'})
+
+        self.assertNotEqual(first, second)
+
+
+class TestGetDeduplicator(unittest.TestCase):
+    """A set of test cases for the ``get_deduplicator`` function"""
+    def tearDown(self):
+        """Runs after every test case"""
+        dedupe._DEDUPLICATOR = None
+
+    @patch.object(dedupe, 'const')
+    def test_shared(self, fake_const):
+        """``get_deduplicator`` returns the same object every call"""
+        dedupe._DEDUPLICATOR = None
+        fake_const.VLAB_WINSERVER_CACHE_URL = 'memory://'
+        fake_const.VLAB_WINSERVER_IDEMPOTENCY_TTL = 60
+        fake_const.VLAB_WINSERVER_CACHE_SIZE = 10
+
+        self.assertTrue(dedupe.get_deduplicator() is dedupe.get_deduplicator())
+
+
+if __name__ == '__main__':
+    unittest.main()
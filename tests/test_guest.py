@@ -0,0 +1,159 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in guest.py
+"""
+import datetime
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_winserver_api.lib.worker import guest
+
+
+class FakeGuest(object):
+    """Simulates a WinServer booting, running unattend.xml, then rebooting.
+
+    :param reboot_at: Seconds after deploy when the unattend reboot happens
+    :param tools_at: Seconds after deploy when VMware Tools is up after the reboot
+    :param creds_at: Seconds after deploy when the Administrator login works
+    """
+    def __init__(self, reboot_at=200, tools_at=230, creds_at=260):
+        self.now = 0
+        self.polls = 0
+        self.reboot_at = reboot_at
+        self.tools_at = tools_at
+        self.creds_at = creds_at
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def properties(self, vcenter, the_vm, properties):
+        self.polls += 1
+        rebooted = self.now >= self.reboot_at
+        tools_up = (not rebooted and self.now >= 30) or self.now >= self.tools_at
+        return {'runtime.bootTime': 'second-boot' if rebooted else 'first-boot',
+                'guest.toolsRunningStatus': 'guestToolsRunning' if tools_up else 'guestToolsNotRunning',
+                'guestHeartbeatStatus': 'green' if tools_up else 'gray'}
+
+    def validate(self, vm, auth):
+        if self.now < self.creds_at:
+            raise guest.vim.fault.InvalidGuestLogin()
+
+
+class TestGuestReadiness(unittest.TestCase):
+    """A set of test cases for the GuestReadiness object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.fake_guest = FakeGuest()
+        self.vcenter = MagicMock()
+        auth_manager = self.vcenter.content.guestOperationsManager.authManager
+        auth_manager.ValidateCredentialsInGuest.side_effect = self.fake_guest.validate
+        patcher = patch.object(guest.inventory, 'retrieve_properties', self.fake_guest.properties)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.readiness = guest.GuestReadiness(self.vcenter, MagicMock(), 'first-boot',
+                                              user='Administrator', password='a')
+
+    def test_not_ready_before_reboot(self):
+        """GuestReadiness - the guest is not ready before the unattend reboot, even if tools are up"""
+        self.fake_guest.now = 100
+
+        self.assertFalse(self.readiness.check())
+        self.assertFalse(self.readiness.rebooted)
+
+    def test_not_ready_tools_down(self):
+        """GuestReadiness - the guest is not ready while tools restart after the reboot"""
+        self.fake_guest.now = 210
+
+        self.assertFalse(self.readiness.check())
+        self.assertTrue(self.readiness.rebooted)
+
+    def test_not_ready_bad_creds(self):
+        """GuestReadiness - the guest is not ready until the credentials work"""
+        self.fake_guest.now = 240
+
+        self.assertFalse(self.readiness.check())
+
+    def test_ready(self):
+        """GuestReadiness - the guest is ready after the reboot, once the creds work"""
+        self.fake_guest.now = 260
+
+        self.assertTrue(self.readiness.check())
+
+    def test_wait_for_guest(self):
+        """``wait_for_guest`` returns shortly after the guest is ready"""
+        guest.wait_for_guest(self.readiness, MagicMock(), timeout=1200,
+                             sleep=self.fake_guest.sleep, clock=self.fake_guest.clock)
+
+        # ready at 260s; the backoff is capped, so no more than one max-poll late
+        self.assertTrue(self.fake_guest.now >= 260)
+        self.assertTrue(self.fake_guest.now <= 260 + guest.const.VLAB_WINSERVER_GUEST_POLL_MAX)
+
+    def test_wait_for_guest_fast(self):
+        """``wait_for_guest`` does not wait a fixed amount of time for a fast guest"""
+        self.fake_guest.reboot_at = 40
+        self.fake_guest.tools_at = 45
+        self.fake_guest.creds_at = 50
+
+        guest.wait_for_guest(self.readiness, MagicMock(), timeout=1200,
+                             sleep=self.fake_guest.sleep, clock=self.fake_guest.clock)
+
+        self.assertTrue(self.fake_guest.now < 100)
+
+    def test_wait_for_guest_backoff(self):
+        """``wait_for_guest`` backs off instead of polling vCenter every few seconds"""
+        guest.wait_for_guest(self.readiness, MagicMock(), timeout=1200,
+                             sleep=self.fake_guest.sleep, clock=self.fake_guest.clock)
+
+        self.assertTrue(self.fake_guest.polls < 260 / guest.const.VLAB_WINSERVER_GUEST_POLL_MIN)
+
+    def test_wait_for_guest_timeout(self):
+        """``wait_for_guest`` raises RuntimeError if the guest never becomes ready"""
+        self.fake_guest.creds_at = 99999
+
+        with self.assertRaises(RuntimeError):
+            guest.wait_for_guest(self.readiness, MagicMock(), timeout=600,
+                                 sleep=self.fake_guest.sleep, clock=self.fake_guest.clock)
+
+        self.assertEqual(self.fake_guest.now, 600)
+
+    def test_boot_time_datetime(self):
+        """``boot_time`` returns a string, so it can be passed between tasks"""
+        with patch.object(guest.inventory, 'retrieve_properties') as fake_retrieve_properties:
+            fake_retrieve_properties.return_value = {'runtime.bootTime': datetime.datetime(2020, 1, 2, 3, 4, 5)}
+            output = guest.boot_time(self.vcenter, MagicMock())
+
+        self.assertEqual(output, '2020-01-02T03:04:05')
+
+    def test_boot_time(self):
+        """``boot_time`` returns the boot time of the VM"""
+        output = guest.boot_time(self.vcenter, MagicMock())
+
+        self.assertEqual(output, 'first-boot')
+
+    def test_boot_time_not_set(self):
+        """``boot_time`` reads again until vCenter sets the boot time"""
+        with patch.object(guest.inventory, 'retrieve_properties') as fake_retrieve_properties:
+            fake_retrieve_properties.side_effect = [{'runtime.bootTime': None},
+                                                    {'runtime.bootTime': None},
+                                                    {'runtime.bootTime': 'first-boot'}]
+            output = guest.boot_time(self.vcenter, MagicMock(), sleep=self.fake_guest.sleep,
+                                     clock=self.fake_guest.clock)
+
+        self.assertEqual(output, 'first-boot')
+        self.assertEqual(self.fake_guest.now, 2)
+
+    def test_boot_time_timeout(self):
+        """``boot_time`` raises RuntimeError if vCenter never sets the boot time"""
+        with patch.object(guest.inventory, 'retrieve_properties') as fake_retrieve_properties:
+            fake_retrieve_properties.return_value = {'runtime.bootTime': None}
+            with self.assertRaises(RuntimeError):
+                guest.boot_time(self.vcenter, MagicMock(), timeout=10,
+                                sleep=self.fake_guest.sleep, clock=self.fake_guest.clock)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,257 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in inventory.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+import ujson
+
+from vlab_winserver_api.lib.worker import inventory
+
+
+def _prop(name, val):
+    """Make a fake vmodl.DynamicProperty"""
+    prop = MagicMock()
+    prop.name = name
+    prop.val = val
+    return prop
+
+
+def _object_content(obj, **props):
+    """Make a fake vmodl.query.PropertyCollector.ObjectContent"""
+    content = MagicMock()
+    content.obj = obj
+    content.propSet = [_prop(x.replace('__', '.'), y) for x, y in props.items()]
+    return content
+
+
+def _nic(*ips):
+    """Make a fake vim.vm.GuestInfo.NicInfo"""
+    nic = MagicMock()
+    nic.ipAddress = list(ips)
+    return nic
+
+
+class TestInventory(unittest.TestCase):
+    """A set of test cases for inventory.py"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.folder = inventory.vim.Folder('group-v1')
+        self.vcenter = MagicMock()
+        self.collector = self.vcenter.content.propertyCollector
+        self.meta = {'component': 'WinServer',
+                     'created': 1234,
+                     'version': '2016',
+                     'configured': False,
+                     'generation': 1}
+        network = inventory.vim.Network('network-1')
+        self.objects = [_object_content(inventory.vim.VirtualMachine('vm-1'),
+                                        name='myWinServer',
+                                        runtime__powerState='poweredOn',
+                                        config__annotation=ujson.dumps(self.meta),
+                                        guest__net=[_nic('192.168.1.2', 'fe80::1')],
+                                        network=[network]),
+                        _object_content(inventory.vim.VirtualMachine('vm-2'),
+                                        name='someOtherVM',
+                                        runtime__powerState='poweredOff',
+                                        config__annotation='not json',
+                                        guest__net=[],
+                                        network=[]),
+                        _object_content(network, name='bob_someLAN')]
+        result = MagicMock()
+        result.objects = self.objects
+        result.token = None
+        self.collector.RetrievePropertiesEx.return_value = result
+
+    def test_retrieve_vms(self):
+        """``retrieve_vms`` returns the properties of every VM in the folder"""
+        output = inventory.retrieve_vms(self.vcenter, self.folder)
+        names = [x['name'] for x in output]
+        expected = ['myWinServer', 'someOtherVM']
+
+        self.assertEqual(names, expected)
+
+    def test_retrieve_vms_network_names(self):
+        """``retrieve_vms`` replaces network objects with their names"""
+        output = inventory.retrieve_vms(self.vcenter, self.folder)
+        expected = ['bob_someLAN']
+
+        self.assertEqual(output[0]['network'], expected)
+
+    def test_retrieve_vms_one_call(self):
+        """``retrieve_vms`` makes one PropertyCollector call regardless of folder size"""
+        inventory.retrieve_vms(self.vcenter, self.folder)
+
+        self.assertEqual(self.collector.RetrievePropertiesEx.call_count, 1)
+        self.assertEqual(self.collector.ContinueRetrievePropertiesEx.call_count, 0)
+
+    def test_retrieve_vms_paged(self):
+        """``retrieve_vms`` follows the continuation token for large folders"""
+        first = MagicMock()
+        first.objects = self.objects[:1]
+        first.token = 'someToken'
+        second = MagicMock()
+        second.objects = self.objects[1:]
+        second.token = None
+        self.collector.RetrievePropertiesEx.return_value = first
+        self.collector.ContinueRetrievePropertiesEx.return_value = second
+
+        output = inventory.retrieve_vms(self.vcenter, self.folder)
+
+        self.assertEqual(len(output), 2)
+
+    def test_retrieve_vms_empty(self):
+        """``retrieve_vms`` returns an empty list for an empty folder"""
+        self.collector.RetrievePropertiesEx.return_value = None
+
+        output = inventory.retrieve_vms(self.vcenter, self.folder)
+
+        self.assertEqual(output, [])
+
+    def test_get_meta(self):
+        """``get_meta`` parses the JSON in the VM notes"""
+        output = inventory.get_meta(ujson.dumps(self.meta))
+
+        self.assertEqual(output, self.meta)
+
+    def test_get_meta_unknown(self):
+        """``get_meta`` returns 'Unknown' meta data for VMs without valid notes"""
+        output = inventory.get_meta(None)
+
+        self.assertEqual(output['component'], 'Unknown')
+
+    @patch.object(inventory, 'ConsoleUrl')
+    def test_show(self, fake_ConsoleUrl):
+        """``show`` only returns the VMs of the requested component"""
+        fake_ConsoleUrl.return_value.url.return_value = 'https://some-url'
+
+        output = inventory.show(self.vcenter, self.folder, 'bob', component='WinServer')
+        expected = {'myWinServer': {'state': 'poweredOn',
+                                    'console': 'https://some-url',
+                                    'ips': ['192.168.1.2'],
+                                    'networks': ['someLAN'],
+                                    'moid': 'vm-1',
+                                    'meta': self.meta}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(inventory, 'ConsoleUrl')
+    def test_show_nothing(self, fake_ConsoleUrl):
+        """``show`` skips the console lookup when no VMs match"""
+        output = inventory.show(self.vcenter, self.folder, 'bob', component='CentOS')
+
+        self.assertEqual(output, {})
+        self.assertFalse(fake_ConsoleUrl.called)
+
+    @patch.object(inventory.OpenSSL.crypto, 'load_certificate')
+    @patch.object(inventory.ssl, 'get_server_certificate')
+    def test_console_url(self, fake_get_server_certificate, fake_load_certificate):
+        """``ConsoleUrl`` only fetches the vCenter TLS cert once"""
+        fake_load_certificate.return_value.digest.return_value = b'AA:BB'
+        self.vcenter.content.sessionManager.AcquireCloneTicket.return_value = 'someTicket'
+        console = inventory.ConsoleUrl(self.vcenter)
+
+        url1 = console.url(inventory.vim.VirtualMachine('vm-1'), 'vm1')
+        url2 = console.url(inventory.vim.VirtualMachine('vm-2'), 'vm2')
+
+        self.assertEqual(fake_get_server_certificate.call_count, 1)
+        self.assertTrue('vmId=vm-1' in url1)
+        self.assertTrue('sessionTicket=someTicket' in url2)
+
+
+class TestFindVM(unittest.TestCase):
+    """A set of test cases for looking up a VM by name"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        inventory._FOLDERS.clear()
+        self.vcenter = MagicMock()
+        self.vcenter.get_by_name.return_value = inventory.vim.Folder('group-v1')
+        self.the_vm = inventory.vim.VirtualMachine('vm-1')
+        self.vcenter.content.searchIndex.FindChild.return_value = self.the_vm
+        result = MagicMock()
+        result.objects = [_object_content(self.the_vm, config__annotation=ujson.dumps({'component': 'WinServer'}))]
+        self.vcenter.content.propertyCollector.RetrievePropertiesEx.return_value = result
+
+    def tearDown(self):
+        """Runs after every test case"""
+        inventory._FOLDERS.clear()
+
+    def test_user_folder_cached(self):
+        """``user_folder`` only scans for the user's folder once"""
+        inventory.user_folder(self.vcenter, 'bob')
+        folder = inventory.user_folder(self.vcenter, 'bob')
+
+        self.assertEqual(self.vcenter.get_by_name.call_count, 1)
+        self.assertEqual(folder._moId, 'group-v1')
+
+    def test_forget_folder(self):
+        """``forget_folder`` forces the next lookup to scan for the folder"""
+        inventory.user_folder(self.vcenter, 'bob')
+        inventory.forget_folder('bob')
+        inventory.user_folder(self.vcenter, 'bob')
+
+        self.assertEqual(self.vcenter.get_by_name.call_count, 2)
+
+    def test_find_vm(self):
+        """``find_vm`` returns the VM with the supplied name"""
+        output = inventory.find_vm(self.vcenter, 'bob', 'myWinServer', component='WinServer')
+
+        self.assertTrue(output is self.the_vm)
+
+    def test_find_vm_server_side(self):
+        """``find_vm`` searches by name in vCenter rather than scanning the folder"""
+        inventory.find_vm(self.vcenter, 'bob', 'myWinServer', component='WinServer')
+
+        the_kwargs = self.vcenter.content.searchIndex.FindChild.call_args[1]
+
+        self.assertEqual(the_kwargs['name'], 'myWinServer')
+
+    def test_find_vm_missing(self):
+        """``find_vm`` raises ValueError when no VM has the supplied name"""
+        self.vcenter.content.searchIndex.FindChild.return_value = None
+
+        with self.assertRaises(ValueError):
+            inventory.find_vm(self.vcenter, 'bob', 'myWinServer', component='WinServer')
+
+    def test_find_vm_wrong_component(self):
+        """``find_vm`` raises ValueError when the VM is a different component"""
+        with self.assertRaises(ValueError):
+            inventory.find_vm(self.vcenter, 'bob', 'myWinServer', component='CentOS')
+
+    def test_find_vm_not_a_vm(self):
+        """``find_vm`` raises ValueError when the name matches a folder"""
+        self.vcenter.content.searchIndex.FindChild.return_value = inventory.vim.Folder('group-v2')
+
+        with self.assertRaises(ValueError):
+            inventory.find_vm(self.vcenter, 'bob', 'myWinServer', component='WinServer')
+
+    def test_name_taken(self):
+        """``name_taken`` is True when the user has anything by that name, whatever the component"""
+        output = inventory.name_taken(self.vcenter, 'bob', 'myWinServer')
+
+        self.assertTrue(output)
+
+    def test_name_free(self):
+        """``name_taken`` is False when the user has nothing by that name"""
+        self.vcenter.content.searchIndex.FindChild.return_value = None
+
+        output = inventory.name_taken(self.vcenter, 'bob', 'myWinServer')
+
+        self.assertFalse(output)
+
+    def test_find_vm_stale_folder(self):
+        """``find_vm`` looks up the folder again if the cached one was deleted"""
+        self.vcenter.content.searchIndex.FindChild.side_effect = [inventory.vmodl.fault.ManagedObjectNotFound(),
+                                                                  self.the_vm]
+
+        output = inventory.find_vm(self.vcenter, 'bob', 'myWinServer', component='WinServer')
+
+        self.assertTrue(output is self.the_vm)
+        self.assertEqual(self.vcenter.get_by_name.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in metrics.py
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from vlab_winserver_api.lib import metrics
+
+
+class TestRegistry(unittest.TestCase):
+    """A set of test cases for the Registry object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.registry = metrics.Registry()
+
+    def test_inc(self):
+        """Registry - ``inc`` adds to a counter"""
+        self.registry.inc('hits', image='2016')
+        self.registry.inc('hits', 2, image='2016')
+
+        output = self.registry.snapshot()['counters']
+        expected = [['hits', {'image': '2016'}, 3]]
+
+        self.assertEqual(output, expected)
+
+    def test_inc_labels(self):
+        """Registry - counters with different labels are different counters"""
+        self.registry.inc('hits', image='2016')
+        self.registry.inc('hits', image='2012R2')
+
+        output = self.registry.snapshot()['counters']
+
+        self.assertEqual(len(output), 2)
+
+    def test_set(self):
+        """Registry - ``set`` replaces the value of a gauge"""
+        self.registry.set('ready', 1)
+        self.registry.set('ready', 4)
+
+        output = self.registry.snapshot()['gauges']
+        expected = [['ready', {}, 4]]
+
+        self.assertEqual(output, expected)
+
+    def test_observe(self):
+        """Registry - ``observe`` tracks the count, sum and max"""
+        self.registry.observe('latency', 2)
+        self.registry.observe('latency', 5)
+
+        output = self.registry.snapshot()['observations']
+        expected = [['latency', {}, [2, 7, 5]]]
+
+        self.assertEqual(output, expected)
+
+    def test_clear(self):
+        """Registry - ``clear`` forgets every metric"""
+        self.registry.inc('hits')
+        self.registry.clear()
+
+        output = self.registry.snapshot()
+        expected = {'counters': [], 'gauges': [], 'observations': []}
+
+        self.assertEqual(output, expected)
+
+
+class TestDumpCollect(unittest.TestCase):
+    """A set of test cases for sharing metrics between worker processes"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_dump(self):
+        """``dump`` writes one file per process"""
+        registry = metrics.Registry()
+        registry.inc('hits')
+
+        metrics.dump(registry, self.directory)
+
+        expected = ['{}-{}.json'.format(metrics.socket.gethostname(), os.getpid())]
+
+        self.assertEqual(os.listdir(self.directory), expected)
+
+    @patch.object(metrics, '_alive', return_value=True)
+    @patch.object(metrics.os, 'getpid')
+    def test_collect(self, fake_getpid, fake_alive):
+        """``collect`` adds up the counters and observations of every process"""
+        for pid in (1, 2):
+            fake_getpid.return_value = pid
+            registry = metrics.Registry()
+            registry.inc('hits', image='2016')
+            registry.observe('latency', pid)
+            metrics.dump(registry, self.directory)
+
+        output = metrics.collect(self.directory)
+
+        self.assertEqual(output['counters'], [['hits', {'image': '2016'}, 2]])
+        self.assertEqual(output['observations'], [['latency', {}, [2, 3, 2]]])
+
+    def test_collect_bad_file(self):
+        """``collect`` ignores files it cannot parse"""
+        with open(os.path.join(self.directory, '1.json'), 'w') as the_file:
+            the_file.write('not json')
+
+        output = metrics.collect(self.directory)
+        expected = {'counters': [], 'gauges': [], 'observations': []}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(metrics.os, 'getpid')
+    def test_collect_dead_process(self, fake_getpid):
+        """``collect`` deletes the file of a process that's gone, and stops counting it"""
+        fake_getpid.return_value = 1234
+        registry = metrics.Registry()
+        registry.inc('hits')
+        metrics.dump(registry, self.directory)
+
+        with patch.object(metrics, '_alive', return_value=False):
+            output = metrics.collect(self.directory)
+
+        self.assertEqual(output['counters'], [])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    @patch.object(metrics, '_alive', return_value=True)
+    def test_collect_old_file(self, fake_alive):
+        """``collect`` deletes a file nobody has written in ``VLAB_WINSERVER_METRICS_TTL`` seconds"""
+        registry = metrics.Registry()
+        registry.inc('hits')
+        metrics.dump(registry, self.directory)
+        path = os.path.join(self.directory, os.listdir(self.directory)[0])
+        old = time.time() - metrics.const.VLAB_WINSERVER_METRICS_TTL - 1
+        os.utime(path, (old, old))
+
+        output = metrics.collect(self.directory)
+
+        self.assertEqual(output['counters'], [])
+        self.assertFalse(os.path.exists(path))
+
+    def test_collect_alive(self):
+        """``collect`` keeps the file of a process that's still running"""
+        registry = metrics.Registry()
+        registry.inc('hits')
+        metrics.dump(registry, self.directory)
+
+        output = metrics.collect(self.directory)
+
+        self.assertEqual(output['counters'], [['hits', {}, 1]])
+
+    def test_collect_nothing(self):
+        """``collect`` works before any process has written metrics"""
+        output = metrics.collect(os.path.join(self.directory, 'nope'))
+        expected = {'counters': [], 'gauges': [], 'observations': []}
+
+        self.assertEqual(output, expected)
+
+
+class TestRender(unittest.TestCase):
+    """A set of test cases for the ``render`` function"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.registry = metrics.Registry()
+
+    def test_render_counter(self):
+        """``render`` formats counters with their type and labels"""
+        self.registry.inc('winserver_tasks_total', task='winserver.show', result='success')
+
+        output = metrics.render(self.registry.snapshot())
+        expected = '# TYPE winserver_tasks_total counter\n' \
+                   'winserver_tasks_total{result="success",task="winserver.show"} 1.0\n'
+
+        self.assertEqual(output, expected)
+
+    def test_render_observation(self):
+        """``render`` formats observations as a summary, plus a max gauge"""
+        self.registry.observe('latency', 2)
+        self.registry.observe('latency', 5)
+
+        output = metrics.render(self.registry.snapshot())
+
+        self.assertTrue('# TYPE latency summary\nlatency_count 2.0\nlatency_sum 7.0\n' in output)
+        self.assertTrue('# TYPE latency_max gauge\nlatency_max 5.0\n' in output)
+
+    def test_render_escapes(self):
+        """``render`` escapes quotes in label values, and bad characters in names"""
+        self.registry.set('pool.ready', 1, image='a"b')
+
+        output = metrics.render(self.registry.snapshot())
+
+        self.assertTrue('pool_ready{image="a\\"b"} 1.0' in output)
+
+    def test_stamp_sent(self):
+        """``stamp_sent`` records when a task was queued in the message headers"""
+        headers = {}
+
+        metrics.stamp_sent(headers=headers)
+
+        self.assertTrue(isinstance(headers['winserver_sent_at'], float))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the metrics API end point
+"""
+import unittest
+from unittest.mock import patch
+
+from flask import Flask
+
+from vlab_winserver_api.lib.views import metrics
+
+
+class TestMetricsView(unittest.TestCase):
+    """A set of test cases for the MetricsView object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        app = Flask(__name__)
+        metrics.MetricsView.register(app)
+        metrics.track_requests(app)
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        metrics.REGISTRY.clear()
+        self.addCleanup(metrics.REGISTRY.clear)
+
+    @patch.object(metrics.metrics, 'collect')
+    @patch.object(metrics.metrics, 'dump')
+    def test_metrics(self, fake_dump, fake_collect):
+        """MetricsView - GET on /metrics returns the Prometheus text format"""
+        fake_collect.return_value = {'counters': [['hits', {}, 1]], 'gauges': [], 'observations': []}
+
+        resp = self.app.get('/metrics')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b'# TYPE hits counter\nhits 1.0\n')
+        self.assertTrue(resp.headers['Content-Type'].startswith('text/plain'))
+
+    @patch.object(metrics.metrics, 'dump')
+    def test_track_requests(self, fake_dump):
+        """``track_requests`` counts requests by verb, route and status"""
+        self.app.get('/metrics')
+
+        counters = metrics.REGISTRY.snapshot()['counters']
+        expected = [['winserver_http_requests_total', {'route': '/metrics', 'status': 200, 'verb': 'GET'}, 1]]
+
+        self.assertEqual(counters, expected)
+
+    @patch.object(metrics.metrics, 'dump')
+    def test_track_requests_unmatched(self, fake_dump):
+        """``track_requests`` does not turn unknown URLs into labels"""
+        self.app.get('/no/such/thing/bob')
+
+        labels = metrics.REGISTRY.snapshot()['counters'][0][1]
+
+        self.assertEqual(labels['route'], 'unmatched')
+
+
+if __name__ == '__main__':
+    unittest.main()
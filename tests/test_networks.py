@@ -0,0 +1,161 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in networks.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock, PropertyMock
+
+from vlab_winserver_api.lib.worker import networks
+
+
+class TestChangeTask(unittest.TestCase):
+    """A set of test cases for the ``change_task`` function"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.nic = networks.vim.vm.device.VirtualE1000e()
+        self.nic.deviceInfo = networks.vim.Description(label='Network adapter 1', summary='')
+        self.the_vm = MagicMock()
+        self.the_vm.config.hardware.device = [self.nic]
+        self.network = MagicMock(spec=networks.vim.dvs.DistributedVirtualPortgroup)
+        self.network.key = 'dvportgroup-1'
+        self.network.config.distributedVirtualSwitch.uuid = 'some-uuid'
+
+    def test_change_task(self):
+        """``change_task`` returns the reconfigure task without waiting on it"""
+        output = networks.change_task(self.the_vm, self.network)
+
+        self.assertTrue(output is self.the_vm.ReconfigVM_Task.return_value)
+
+    def test_change_task_backing(self):
+        """``change_task`` connects the NIC to the distributed portgroup"""
+        networks.change_task(self.the_vm, self.network)
+        spec = self.the_vm.ReconfigVM_Task.call_args[1]['spec']
+        backing = spec.deviceChange[0].device.backing
+
+        self.assertEqual(backing.port.portgroupKey, 'dvportgroup-1')
+        self.assertEqual(backing.port.switchUuid, 'some-uuid')
+
+    def test_change_task_standard(self):
+        """``change_task`` connects the NIC to a standard portgroup"""
+        network = networks.vim.Network('network-1')
+        with patch.object(networks.vim.Network, 'name', create=True, new='someLAN'):
+            networks.change_task(self.the_vm, network)
+        spec = self.the_vm.ReconfigVM_Task.call_args[1]['spec']
+        backing = spec.deviceChange[0].device.backing
+
+        self.assertTrue(backing.network is network)
+        self.assertEqual(backing.deviceName, 'someLAN')
+
+    def test_change_task_no_nic(self):
+        """``change_task`` raises RuntimeError if the VM has no such NIC"""
+        with self.assertRaises(RuntimeError):
+            networks.change_task(self.the_vm, self.network, adapter_label='Network adapter 2')
+
+
+class TestNetworkResolver(unittest.TestCase):
+    """A set of test cases for the NetworkResolver object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.vcenter = MagicMock()
+        self.found = [(networks.vim.Network('network-1'), {'name': 'bob_frontend'}),
+                      (networks.vim.dvs.DistributedVirtualPortgroup('dvportgroup-1'), {'name': 'bob_backend'})]
+        patcher = patch.object(networks, '_retrieve_networks', side_effect=lambda vcenter: list(self.found))
+        self.fake_retrieve_networks = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.resolver = networks.NetworkResolver(ttl=300)
+
+    def test_resolve(self):
+        """NetworkResolver - ``resolve`` finds standard portgroups"""
+        output = self.resolver.resolve(self.vcenter, 'bob_frontend')
+
+        self.assertTrue(isinstance(output, networks.vim.Network))
+        self.assertEqual(output._moId, 'network-1')
+
+    def test_resolve_dvs(self):
+        """NetworkResolver - ``resolve`` finds distributed portgroups"""
+        output = self.resolver.resolve(self.vcenter, 'bob_backend')
+
+        self.assertTrue(isinstance(output, networks.vim.dvs.DistributedVirtualPortgroup))
+        self.assertEqual(output._moId, 'dvportgroup-1')
+
+    def test_resolve_cached(self):
+        """NetworkResolver - ``resolve`` only reads the networks from vCenter once"""
+        self.resolver.resolve(self.vcenter, 'bob_frontend')
+        self.resolver.resolve(self.vcenter, 'bob_backend')
+
+        self.assertEqual(self.fake_retrieve_networks.call_count, 1)
+
+    def test_resolve_expired(self):
+        """NetworkResolver - ``resolve`` reloads the networks after the TTL"""
+        resolver = networks.NetworkResolver(ttl=0)
+        resolver.resolve(self.vcenter, 'bob_frontend')
+        resolver.resolve(self.vcenter, 'bob_frontend')
+
+        self.assertEqual(self.fake_retrieve_networks.call_count, 2)
+
+    def test_resolve_new_network(self):
+        """NetworkResolver - ``resolve`` reloads the networks to find one made after the last load"""
+        self.resolver.resolve(self.vcenter, 'bob_frontend')
+        self.found.append((networks.vim.Network('network-2'), {'name': 'bob_newLAN'}))
+
+        output = self.resolver.resolve(self.vcenter, 'bob_newLAN')
+
+        self.assertEqual(output._moId, 'network-2')
+
+    def test_resolve_missing(self):
+        """NetworkResolver - ``resolve`` raises KeyError for an unknown network"""
+        with self.assertRaises(KeyError):
+            self.resolver.resolve(self.vcenter, 'bob_nope')
+
+    def test_invalidate(self):
+        """NetworkResolver - ``invalidate`` makes the next lookup read from vCenter"""
+        self.resolver.resolve(self.vcenter, 'bob_frontend')
+        self.resolver.invalidate()
+        self.resolver.resolve(self.vcenter, 'bob_frontend')
+
+        self.assertEqual(self.fake_retrieve_networks.call_count, 2)
+
+    @patch.object(networks, '_current_name')
+    def test_resolve_check(self, fake_current_name):
+        """NetworkResolver - ``resolve`` with check=True returns a cached network that still exists"""
+        fake_current_name.return_value = 'bob_frontend'
+        self.resolver.resolve(self.vcenter, 'bob_frontend')
+
+        output = self.resolver.resolve(self.vcenter, 'bob_frontend', check=True)
+
+        self.assertEqual(output._moId, 'network-1')
+        self.assertEqual(self.fake_retrieve_networks.call_count, 1)
+
+    @patch.object(networks, '_current_name')
+    def test_resolve_check_deleted(self, fake_current_name):
+        """NetworkResolver - ``resolve`` with check=True reloads when the cached network was deleted and made again"""
+        fake_current_name.return_value = None
+        self.resolver.resolve(self.vcenter, 'bob_frontend')
+        self.found[0] = (networks.vim.Network('network-9'), {'name': 'bob_frontend'})
+
+        output = self.resolver.resolve(self.vcenter, 'bob_frontend', check=True)
+
+        self.assertEqual(output._moId, 'network-9')
+        self.assertEqual(self.fake_retrieve_networks.call_count, 2)
+
+    def test_current_name_deleted(self):
+        """``_current_name`` returns None for a network vCenter no longer has"""
+        network = MagicMock()
+        type(network).name = PropertyMock(side_effect=networks.vmodl.fault.ManagedObjectNotFound())
+
+        self.assertTrue(networks._current_name(network) is None)
+
+    @patch.object(networks, 'REGISTRY')
+    def test_metrics(self, fake_REGISTRY):
+        """NetworkResolver - records the hit ratio, and how long lookups take"""
+        self.resolver.resolve(self.vcenter, 'bob_frontend')
+        self.resolver.resolve(self.vcenter, 'bob_frontend')
+
+        fake_REGISTRY.set.assert_called_with('winserver_network_lookup_hit_ratio', 0.5)
+        self.assertEqual(fake_REGISTRY.observe.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
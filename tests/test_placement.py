@@ -0,0 +1,306 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the placement.py module
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_winserver_api.lib.worker import placement
+
+
+GB = placement.GB
+
+
+def make_datastores():
+    """Synthetic capacity data; ds2 has the most room"""
+    return [placement.Datastore('ds1', 'datastore-1', free=500 * GB, capacity=1000 * GB),
+            placement.Datastore('ds2', 'datastore-2', free=800 * GB, capacity=1000 * GB),
+            placement.Datastore('ds3', 'datastore-3', free=300 * GB, capacity=1000 * GB)]
+
+
+def make_engine(policy=None, pools=None):
+    policy = policy if policy else placement.BalancedPolicy(reserve=20 * GB)
+    engine = placement.PlacementEngine(datastores=['ds1', 'ds2', 'ds3'],
+                                       pools=pools if pools else ['Resources'],
+                                       policy=policy,
+                                       ttl=60)
+    engine.update(make_datastores())
+    return engine
+
+
+class TestPolicies(unittest.TestCase):
+    """A set of test cases for the placement policies"""
+    def test_balanced_free_space(self):
+        """``BalancedPolicy`` favors the datastore with more free space"""
+        policy = placement.BalancedPolicy(reserve=20 * GB)
+        roomy, tight = make_datastores()[1], make_datastores()[2]
+
+        self.assertTrue(policy.score(roomy) > policy.score(tight))
+
+    def test_balanced_in_flight(self):
+        """``BalancedPolicy`` avoids a datastore that's busy with other deploys"""
+        policy = placement.BalancedPolicy(reserve=20 * GB)
+        busy, idle = make_datastores()[1], make_datastores()[0]
+        busy.in_flight = 3
+
+        self.assertTrue(policy.score(idle) > policy.score(busy))
+
+    def test_balanced_latency(self):
+        """``BalancedPolicy`` avoids a datastore where deploys have been slow"""
+        policy = placement.BalancedPolicy(reserve=20 * GB, latency_scale=60)
+        slow, fast = make_datastores()[1], make_datastores()[0]
+        slow.latency = 300
+        fast.latency = 30
+
+        self.assertTrue(policy.score(fast) > policy.score(slow))
+
+    def test_most_free(self):
+        """``MostFreePolicy`` ignores latency"""
+        policy = placement.MostFreePolicy(reserve=20 * GB)
+        slow, fast = make_datastores()[1], make_datastores()[0]
+        slow.latency = 300
+
+        self.assertTrue(policy.score(slow) > policy.score(fast))
+
+    def test_get_policy(self):
+        """``get_policy`` makes a policy by name"""
+        policy = placement.get_policy('Most-Free', reserve=1)
+
+        self.assertTrue(isinstance(policy, placement.MostFreePolicy))
+
+    def test_get_policy_unknown(self):
+        """``get_policy`` raises ValueError for an unknown policy"""
+        with self.assertRaises(ValueError):
+            placement.get_policy('random', reserve=1)
+
+
+class TestPlacementEngine(unittest.TestCase):
+    """A set of test cases for the PlacementEngine object"""
+    def test_choose(self):
+        """``choose`` picks the best datastore, and counts the deploy"""
+        engine = make_engine()
+
+        datastore, pool = engine.choose()
+
+        self.assertEqual(datastore.name, 'ds2')
+        self.assertEqual(pool, 'Resources')
+        self.assertEqual(datastore.in_flight, 1)
+
+    def test_choose_spreads(self):
+        """``choose`` spreads a burst of deploys across the datastores"""
+        engine = make_engine()
+
+        picked = {engine.choose()[0].name for _ in range(6)}
+
+        self.assertEqual(picked, {'ds1', 'ds2', 'ds3'})
+
+    def test_choose_most_free(self):
+        """``choose`` with ``MostFreePolicy`` keeps using the emptiest datastore"""
+        engine = make_engine(policy=placement.MostFreePolicy(reserve=20 * GB))
+
+        picked = [engine.choose()[0].name for _ in range(3)]
+
+        self.assertEqual(picked, ['ds2', 'ds2', 'ds2'])
+
+    def test_choose_maintenance(self):
+        """``choose`` skips datastores in maintenance mode"""
+        engine = make_engine()
+        datastores = make_datastores()
+        datastores[1].maintenance = 'inMaintenance'
+        engine.update(datastores)
+
+        datastore, _ = engine.choose()
+
+        self.assertEqual(datastore.name, 'ds1')
+
+    def test_choose_inaccessible(self):
+        """``choose`` skips datastores the hosts cannot reach"""
+        engine = make_engine()
+        datastores = make_datastores()
+        datastores[1].accessible = False
+        engine.update(datastores)
+
+        datastore, _ = engine.choose()
+
+        self.assertEqual(datastore.name, 'ds1')
+
+    def test_choose_full(self):
+        """``choose`` raises RuntimeError when no datastore has room left"""
+        engine = make_engine(policy=placement.BalancedPolicy(reserve=450 * GB))
+        engine.choose()
+        engine.choose()
+
+        with self.assertRaises(RuntimeError):
+            engine.choose()
+
+    def test_choose_pools(self):
+        """``choose`` uses the resource pool with the fewest running deploys"""
+        engine = make_engine(pools=['pool-a', 'pool-b'])
+
+        pools = [engine.choose()[1] for _ in range(4)]
+
+        self.assertEqual(sorted(pools), ['pool-a', 'pool-a', 'pool-b', 'pool-b'])
+
+    def test_release(self):
+        """``release`` stops counting a finished deploy, and records how long it took"""
+        engine = make_engine()
+        datastore, pool = engine.choose()
+
+        engine.release(datastore, pool, seconds=90)
+
+        self.assertEqual(datastore.in_flight, 0)
+        self.assertEqual(datastore.latency, 90)
+
+    def test_release_average(self):
+        """``release`` keeps a moving average of the deploy latency"""
+        engine = make_engine()
+        datastore, pool = engine.choose()
+        engine.release(datastore, pool, seconds=100)
+        engine.choose()
+
+        engine.release(datastore, pool, seconds=200)
+
+        self.assertEqual(datastore.latency, 100 + placement.LATENCY_WEIGHT * 100)
+
+    def test_release_failed(self):
+        """``release`` doesn't let a deploy that failed fast make the datastore look fast"""
+        engine = make_engine()
+        datastore, pool = engine.choose()
+
+        engine.release(datastore, pool, seconds=None)
+
+        self.assertEqual(datastore.latency, 0)
+
+    def test_update_keeps_counts(self):
+        """``update`` keeps the running deploys and latency when the free space is reloaded"""
+        engine = make_engine()
+        datastore, pool = engine.choose()
+        engine.update(make_datastores())
+
+        engine.release(datastore, pool, seconds=30)
+        reloaded, _ = engine.choose()
+
+        self.assertEqual(reloaded.name, 'ds2')
+        self.assertEqual(reloaded.in_flight, 1)
+        self.assertEqual(reloaded.latency, 30)
+
+    @patch.object(placement, '_retrieve_datastores')
+    def test_place(self, fake_retrieve_datastores):
+        """``place`` yields the chosen datastore as a vCenter object"""
+        fake_retrieve_datastores.return_value = make_datastores()
+        engine = placement.PlacementEngine(['ds1', 'ds2', 'ds3'], ['Resources'],
+                                           placement.BalancedPolicy(reserve=20 * GB), ttl=60)
+
+        with engine.place(MagicMock()) as target:
+            pass
+
+        self.assertEqual(target.datastore._moId, 'datastore-2')
+        self.assertEqual(target.pool, 'Resources')
+
+    @patch.object(placement, '_retrieve_datastores')
+    def test_place_ttl(self, fake_retrieve_datastores):
+        """``place`` only reads the free space from vCenter once per TTL"""
+        fake_retrieve_datastores.return_value = make_datastores()
+        engine = placement.PlacementEngine(['ds1', 'ds2', 'ds3'], ['Resources'],
+                                           placement.BalancedPolicy(reserve=20 * GB), ttl=60)
+
+        for _ in range(3):
+            with engine.place(MagicMock()):
+                pass
+
+        self.assertEqual(fake_retrieve_datastores.call_count, 1)
+
+    @patch.object(placement, '_retrieve_datastores')
+    def test_place_error(self, fake_retrieve_datastores):
+        """``place`` stops counting a deploy that failed"""
+        fake_retrieve_datastores.return_value = make_datastores()
+        engine = placement.PlacementEngine(['ds1', 'ds2', 'ds3'], ['Resources'],
+                                           placement.BalancedPolicy(reserve=20 * GB), ttl=60)
+
+        with self.assertRaises(RuntimeError):
+            with engine.place(MagicMock()):
+                raise RuntimeError('testing')
+        datastore, _ = engine.choose()
+
+        self.assertEqual(datastore.name, 'ds2')
+        self.assertEqual(datastore.in_flight, 1)
+        self.assertEqual(datastore.latency, 0)
+
+
+class TestRetrieveDatastores(unittest.TestCase):
+    """A set of test cases for the ``_retrieve_datastores`` function"""
+    def make_object(self, obj, **props):
+        found = MagicMock()
+        found.obj = obj
+        found.propSet = []
+        for name, value in props.items():
+            prop = MagicMock()
+            prop.name = name
+            prop.val = value
+            found.propSet.append(prop)
+        return found
+
+    def setUp(self):
+        """Runs before every test case"""
+        vim = placement.vim
+        cluster = vim.StoragePod('group-p1')
+        objects = [self.make_object(cluster, name='fast-storage'),
+                   self.make_object(vim.Datastore('datastore-1'), name='ds1', parent=cluster,
+                                    **{'summary.freeSpace': 5, 'summary.capacity': 10, 'summary.accessible': True}),
+                   self.make_object(vim.Datastore('datastore-2'), name='ds2', parent=vim.Folder('group-s1'),
+                                    **{'summary.freeSpace': 7, 'summary.capacity': 10, 'summary.accessible': True}),
+                   self.make_object(vim.Datastore('datastore-3'), name='ds3', parent=vim.Folder('group-s1'),
+                                    **{'summary.freeSpace': 1, 'summary.capacity': 10, 'summary.accessible': True})]
+        self.vcenter = MagicMock()
+        self.fake_stub = MagicMock()
+        self.vcenter.content.viewManager.CreateContainerView.return_value = vim.view.ContainerView('session[1]', stub=self.fake_stub)
+        result = self.vcenter.content.propertyCollector.RetrievePropertiesEx.return_value
+        result.objects = objects
+        result.token = None
+
+    def test_by_name(self):
+        """``_retrieve_datastores`` includes the named datastores"""
+        found = placement._retrieve_datastores(self.vcenter, ['ds2'])
+
+        self.assertEqual([(x.name, x.free, x.capacity) for x in found], [('ds2', 7, 10)])
+
+    def test_cluster(self):
+        """``_retrieve_datastores`` includes every datastore in a named datastore cluster"""
+        found = placement._retrieve_datastores(self.vcenter, ['fast-storage', 'ds3'])
+
+        self.assertEqual(sorted(x.name for x in found), ['ds1', 'ds3'])
+
+    def test_destroys_view(self):
+        """``_retrieve_datastores`` cleans up the container view"""
+        placement._retrieve_datastores(self.vcenter, ['ds2'])
+
+        info = self.fake_stub.InvokeMethod.call_args[0][1]
+
+        self.assertEqual(info.name, 'Destroy')
+
+
+class TestGetEngine(unittest.TestCase):
+    """A set of test cases for the ``get_engine`` function"""
+    def tearDown(self):
+        """Runs after every test case"""
+        placement._ENGINE = None
+
+    @patch.object(placement, 'const')
+    def test_settings(self, fake_const):
+        """``get_engine`` reads the candidates and policy from the constants"""
+        placement._ENGINE = None
+        fake_const.VLAB_WINSERVER_DATASTORES = 'ds1, ds2'
+        fake_const.VLAB_WINSERVER_RESOURCE_POOLS = 'Resources'
+        fake_const.VLAB_WINSERVER_PLACEMENT_POLICY = 'most-free'
+        fake_const.VLAB_WINSERVER_PLACEMENT_RESERVE = 10
+        fake_const.VLAB_WINSERVER_PLACEMENT_TTL = 60
+
+        engine = placement.get_engine()
+
+        self.assertEqual(engine.datastores, ['ds1', 'ds2'])
+        self.assertEqual(engine.policy.reserve, 10 * GB)
+        self.assertTrue(engine is placement.get_engine())
+
+
+if __name__ == '__main__':
+    unittest.main()
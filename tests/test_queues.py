@@ -0,0 +1,76 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the queues.py module
+"""
+import unittest
+
+from celery import Celery
+
+from vlab_winserver_api.lib import const, queues
+from vlab_winserver_api.lib.worker import tasks
+
+
+class TestRoutes(unittest.TestCase):
+    """A set of test cases for the ``routes`` function"""
+    def test_every_task(self):
+        """``routes`` has a queue for every task the worker runs"""
+        names = {x for x in tasks.app.tasks.keys() if x.startswith('winserver.')}
+        routes = queues.routes()
+
+        self.assertEqual(names, set(routes.keys()))
+
+    def test_reads(self):
+        """``routes`` keeps the tasks that only read from vCenter off the provisioning queue"""
+        routes = queues.routes()
+
+        for name in ('winserver.show', 'winserver.image', 'winserver.pool'):
+            self.assertEqual(routes[name]['queue'], const.VLAB_WINSERVER_READ_QUEUE)
+
+    def test_provisioning(self):
+        """``routes`` puts the tasks that change VMs on the provisioning queue"""
+        routes = queues.routes()
+
+        for name in ('winserver.create', 'winserver.create.finalize', 'winserver.delete', 'winserver.modify_networks'):
+            self.assertEqual(routes[name]['queue'], const.VLAB_WINSERVER_PROVISION_QUEUE)
+
+    def test_priorities(self):
+        """``routes`` finishes creates in flight before starting new ones, and refills the pool last"""
+        routes = queues.routes()
+
+        self.assertTrue(routes['winserver.create.finalize']['priority'] > routes['winserver.create']['priority'])
+        self.assertTrue(routes['winserver.create']['priority'] > routes['winserver.pool.refill']['priority'])
+
+    def test_priorities_in_range(self):
+        """``routes`` only uses priorities the queues support"""
+        for route in queues.routes().values():
+            self.assertTrue(0 <= route['priority'] <= queues.MAX_PRIORITY)
+
+
+class TestConfigure(unittest.TestCase):
+    """A set of test cases for the ``configure`` function"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.celery_app = Celery('test', broker='memory://')
+        queues.configure(self.celery_app)
+
+    def test_queues(self):
+        """``configure`` declares both queues, with priorities"""
+        names = [x.name for x in self.celery_app.conf.task_queues]
+
+        self.assertEqual(names, [const.VLAB_WINSERVER_READ_QUEUE, const.VLAB_WINSERVER_PROVISION_QUEUE])
+        self.assertEqual(self.celery_app.conf.task_queue_max_priority, queues.MAX_PRIORITY)
+
+    def test_route(self):
+        """``configure`` makes sending a task by name go to its queue"""
+        route = self.celery_app.amqp.router.route({}, 'winserver.show')
+
+        self.assertEqual(route['queue'].name, const.VLAB_WINSERVER_READ_QUEUE)
+        self.assertEqual(route['priority'], queues.READ_TASKS['winserver.show'])
+
+    def test_prefetch(self):
+        """``configure`` stops workers from hoarding tasks"""
+        self.assertEqual(self.celery_app.conf.worker_prefetch_multiplier, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
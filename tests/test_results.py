@@ -0,0 +1,144 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the results.py module
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from celery import Celery
+
+from vlab_winserver_api.lib import results
+
+
+class TestSqliteBackend(unittest.TestCase):
+    """A set of test cases for the SqliteBackend object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.directory = tempfile.mkdtemp()
+        self.url = 'sqlite:///{}'.format(os.path.join(self.directory, 'results.db'))
+        self.app = Celery('testing', backend=results.backend_url(self.url), set_as_current=False)
+        self.app.conf.result_expires = 60
+        self.backend = self.app.backend
+
+    def tearDown(self):
+        """Runs after every test case"""
+        shutil.rmtree(self.directory)
+
+    def test_backend(self):
+        """``backend_url`` makes Celery use the SqliteBackend"""
+        self.assertTrue(isinstance(self.backend, results.SqliteBackend))
+
+    def test_bad_url(self):
+        """SqliteBackend raises ValueError for a URL that isn't sqlite:///"""
+        with self.assertRaises(ValueError):
+            results.SqliteBackend(app=self.app, url='redis://localhost')
+
+    def test_set_get(self):
+        """SqliteBackend - ``get`` returns what ``set`` stored"""
+        self.backend.set(b'some-key', '{"worked": true}')
+
+        self.assertEqual(self.backend.get(b'some-key'), b'{"worked": true}')
+
+    def test_get_missing(self):
+        """SqliteBackend - ``get`` returns None for an unknown key"""
+        self.assertTrue(self.backend.get(b'some-key') is None)
+
+    def test_mget(self):
+        """SqliteBackend - ``mget`` returns the values in the order of the keys"""
+        self.backend.set(b'a', 'one')
+        self.backend.set(b'c', 'three')
+
+        self.assertEqual(self.backend.mget([b'c', b'b', b'a']), [b'three', None, b'one'])
+
+    def test_compressed(self):
+        """SqliteBackend - big results are stored compressed, and read back whole"""
+        value = '{"vms": "%s"}' % ('x' * 10000)
+        self.backend.set(b'big', value)
+
+        conn = self.backend._connect()
+        try:
+            stored, compressed = conn.execute('SELECT value, compressed FROM results WHERE key = ?', ('big',)).fetchone()
+        finally:
+            conn.close()
+
+        self.assertTrue(compressed)
+        self.assertTrue(len(stored) < len(value))
+        self.assertEqual(self.backend.get(b'big'), value.encode())
+
+    def test_expires(self):
+        """SqliteBackend - ``get`` ignores an expired result"""
+        with patch.object(results.time, 'time') as fake_time:
+            fake_time.return_value = 100
+            self.backend.set(b'some-key', 'old')
+            fake_time.return_value = 100 + self.backend.expires + 1
+            value = self.backend.get(b'some-key')
+
+        self.assertTrue(value is None)
+
+    def test_cleanup(self):
+        """SqliteBackend - ``cleanup`` deletes the expired results"""
+        with patch.object(results.time, 'time') as fake_time:
+            fake_time.return_value = 100
+            self.backend.set(b'some-key', 'old')
+            fake_time.return_value = 100 + self.backend.expires + 1
+            self.backend.cleanup()
+
+        conn = self.backend._connect()
+        try:
+            rows = conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        finally:
+            conn.close()
+
+        self.assertEqual(rows, 0)
+
+    def test_delete(self):
+        """SqliteBackend - ``delete`` removes a result"""
+        self.backend.set(b'some-key', 'value')
+        self.backend.delete(b'some-key')
+
+        self.assertTrue(self.backend.get(b'some-key') is None)
+
+    def test_task_result(self):
+        """SqliteBackend - another process on the same file sees the result of a task"""
+        self.backend.store_result('task-1', {'content': {'box': {}}, 'error': None}, 'SUCCESS')
+        other = Celery('testing', backend=results.backend_url(self.url), set_as_current=False)
+
+        result = other.AsyncResult('task-1')
+
+        self.assertEqual(result.status, 'SUCCESS')
+        self.assertEqual(result.result, {'content': {'box': {}}, 'error': None})
+
+
+class TestBackendUrl(unittest.TestCase):
+    """A set of test cases for the ``backend_url`` function"""
+    def test_sqlite(self):
+        """``backend_url`` points sqlite:/// URLs at the SqliteBackend"""
+        url = results.backend_url('sqlite:////tmp/results.db')
+
+        self.assertEqual(url, 'vlab_winserver_api.lib.results:SqliteBackend+sqlite:////tmp/results.db')
+
+    def test_other(self):
+        """``backend_url`` leaves other URLs for Celery to handle"""
+        self.assertEqual(results.backend_url('redis://localhost/0'), 'redis://localhost/0')
+
+
+class TestConfigure(unittest.TestCase):
+    """A set of test cases for the ``configure`` function"""
+    @patch.object(results, 'const')
+    def test_configure(self, fake_const):
+        """``configure`` sets the result backend and expiry from the constants"""
+        fake_const.VLAB_WINSERVER_RESULT_BACKEND = 'rpc://'
+        fake_const.VLAB_WINSERVER_RESULT_TTL = 300
+        app = Celery('testing', set_as_current=False)
+
+        results.configure(app)
+
+        self.assertEqual(app.conf.result_backend, 'rpc://')
+        self.assertEqual(app.conf.result_expires, 300)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,230 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in session.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_winserver_api.lib.worker import session
+
+
+class TestSessionPool(unittest.TestCase):
+    """A set of test cases for the SessionPool object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.factory = MagicMock()
+        self.factory.side_effect = lambda: MagicMock()
+        self.pool = session.SessionPool(max_size=2, timeout=1, keepalive=300, factory=self.factory)
+        # don't actually spawn the keepalive thread in tests
+        self.pool._start_pinger = MagicMock()
+
+    def test_reuses_session(self):
+        """SessionPool - logs in once for back-to-back tasks"""
+        with self.pool.session() as vcenter1:
+            pass
+        with self.pool.session() as vcenter2:
+            pass
+
+        self.assertTrue(vcenter1 is vcenter2)
+        self.assertEqual(self.factory.call_count, 1)
+
+    def test_concurrent_sessions(self):
+        """SessionPool - hands out different sessions to concurrent users"""
+        vcenter1 = self.pool.checkout()
+        vcenter2 = self.pool.checkout()
+
+        self.assertFalse(vcenter1 is vcenter2)
+
+    def test_max_size(self):
+        """SessionPool - raises RuntimeError when every session is checked out"""
+        self.pool.checkout()
+        self.pool.checkout()
+
+        with self.assertRaises(RuntimeError):
+            self.pool.checkout()
+
+    def test_factory_error_frees_slot(self):
+        """SessionPool - a failed login does not leak a slot in the pool"""
+        self.factory.side_effect = [RuntimeError('testing'), RuntimeError('testing'), RuntimeError('testing'), MagicMock()]
+        for _ in range(3):
+            with self.assertRaises(RuntimeError):
+                self.pool.checkout()
+
+        vcenter = self.pool.checkout()
+
+        self.assertTrue(vcenter is not None)
+
+    def test_discard_on_auth_error(self):
+        """SessionPool - a session that hits NotAuthenticated is not reused"""
+        with self.assertRaises(session.vim.fault.NotAuthenticated):
+            with self.pool.session() as vcenter1:
+                raise session.vim.fault.NotAuthenticated()
+        with self.pool.session() as vcenter2:
+            pass
+
+        self.assertFalse(vcenter1 is vcenter2)
+        self.assertTrue(vcenter1.close.called)
+
+    def test_keeps_session_on_value_error(self):
+        """SessionPool - errors unrelated to the session do not force a new login"""
+        with self.assertRaises(ValueError):
+            with self.pool.session() as vcenter1:
+                raise ValueError('testing')
+        with self.pool.session() as vcenter2:
+            pass
+
+        self.assertTrue(vcenter1 is vcenter2)
+
+    def test_resets_session(self):
+        """SessionPool - a reused session is reset, so it does not hand back a stale network list"""
+        with self.pool.session() as vcenter:
+            pass
+        vcenter.reset.reset_mock()
+        with self.pool.session() as vcenter:
+            pass
+
+        self.assertEqual(vcenter.reset.call_count, 1)
+
+    @patch.object(session.time, 'time')
+    def test_relogin_expired(self, fake_time):
+        """SessionPool - an idle session that vCenter expired gets replaced"""
+        fake_time.side_effect = [100, 1000, 1000]
+        with self.pool.session() as vcenter1:
+            vcenter1.content.sessionManager.currentSession = None
+        with self.pool.session() as vcenter2:
+            pass
+
+        self.assertFalse(vcenter1 is vcenter2)
+        self.assertEqual(self.factory.call_count, 2)
+
+    @patch.object(session.time, 'time')
+    def test_validates_idle(self, fake_time):
+        """SessionPool - an idle session that's still valid gets reused"""
+        fake_time.side_effect = [100, 1000, 1000]
+        with self.pool.session() as vcenter1:
+            vcenter1.content.sessionManager.currentSession = 'someSession'
+        with self.pool.session() as vcenter2:
+            pass
+
+        self.assertTrue(vcenter1 is vcenter2)
+
+    @patch.object(session, '_is_alive')
+    @patch.object(session.time, 'time')
+    def test_validate_error(self, fake_time, fake_is_alive):
+        """SessionPool - an idle session that fails validation is closed, not leaked"""
+        fake_time.side_effect = [100, 1000]
+        fake_is_alive.side_effect = TypeError('testing')
+        with self.pool.session() as vcenter:
+            pass
+
+        with self.assertRaises(TypeError):
+            self.pool.checkout()
+
+        self.assertTrue(vcenter.close.called)
+        self.assertEqual(self.pool.idle, 0)
+        # the slot was given back too
+        self.assertEqual(len([self.pool.checkout(), self.pool.checkout()]), 2)
+
+    @patch.object(session.time, 'time')
+    def test_ping(self, fake_time):
+        """SessionPool - ``ping`` drops idle sessions that vCenter expired"""
+        fake_time.side_effect = [100, 100, 1000, 1000]
+        vcenter1 = self.pool.checkout()
+        vcenter2 = self.pool.checkout()
+        vcenter1.content.sessionManager.currentSession = 'someSession'
+        vcenter2.content.sessionManager.currentSession = None
+        self.pool.checkin(vcenter1)
+        self.pool.checkin(vcenter2)
+
+        self.pool.ping()
+
+        self.assertEqual(self.pool.idle, 1)
+        self.assertTrue(vcenter2.close.called)
+
+    @patch.object(session, '_is_alive')
+    @patch.object(session.time, 'time')
+    def test_ping_error(self, fake_time, fake_is_alive):
+        """SessionPool - ``ping`` closes idle sessions it fails to check"""
+        # logging reads the clock too
+        fake_time.side_effect = [100, 100] + [1000] * 10
+        fake_is_alive.side_effect = TypeError('testing')
+        vcenter1 = self.pool.checkout()
+        vcenter2 = self.pool.checkout()
+        self.pool.checkin(vcenter1)
+        self.pool.checkin(vcenter2)
+
+        self.pool.ping()
+
+        self.assertEqual(self.pool.idle, 0)
+        self.assertTrue(vcenter1.close.called)
+        self.assertTrue(vcenter2.close.called)
+
+    def test_close(self):
+        """SessionPool - ``close`` logs out of every idle session"""
+        with self.pool.session() as vcenter:
+            pass
+
+        self.pool.close()
+
+        self.assertTrue(vcenter.close.called)
+        self.assertEqual(self.pool.idle, 0)
+
+
+class TestGetPool(unittest.TestCase):
+    """A set of test cases for the ``get_pool`` function"""
+
+    @patch.object(session, '_POOL', None)
+    def test_get_pool(self):
+        """``get_pool`` returns the same pool within a process"""
+        pool1 = session.get_pool()
+        pool2 = session.get_pool()
+
+        self.assertTrue(pool1 is pool2)
+
+    @patch.object(session.os, 'getpid')
+    @patch.object(session, '_POOL', None)
+    def test_get_pool_forked(self, fake_getpid):
+        """``get_pool`` makes a new pool in a forked child process"""
+        fake_getpid.side_effect = [1, 2, 2]
+        pool1 = session.get_pool()
+        pool2 = session.get_pool()
+
+        self.assertFalse(pool1 is pool2)
+
+
+class TestCountCalls(unittest.TestCase):
+    """A set of test cases for the ``count_calls`` function"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.stub = MagicMock()
+        self.invoke_method = self.stub.InvokeMethod
+        self.info = MagicMock()
+        self.info.name = 'RetrievePropertiesEx'
+        session.count_calls(self.stub)
+
+    @patch.object(session, 'REGISTRY')
+    def test_count_calls(self, fake_REGISTRY):
+        """``count_calls`` records every round trip by method"""
+        output = self.stub.InvokeMethod('mo', self.info, [])
+
+        self.assertTrue(output is self.invoke_method.return_value)
+        fake_REGISTRY.inc.assert_called_with('winserver_vcenter_calls_total', kind='method',
+                                             method='RetrievePropertiesEx', result='ok')
+        self.assertTrue(fake_REGISTRY.observe.called)
+
+    @patch.object(session, 'REGISTRY')
+    def test_count_calls_error(self, fake_REGISTRY):
+        """``count_calls`` records the round trips that fail"""
+        self.invoke_method.side_effect = RuntimeError('testing')
+
+        with self.assertRaises(RuntimeError):
+            self.stub.InvokeMethod('mo', self.info, [])
+
+        fake_REGISTRY.inc.assert_called_with('winserver_vcenter_calls_total', kind='method',
+                                             method='RetrievePropertiesEx', result='error')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in store.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_winserver_api.lib import store
+
+
+class TestMemoryStore(unittest.TestCase):
+    """A set of test cases for the MemoryStore object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.store = store.MemoryStore(max_size=2, ttl=30)
+
+    def test_get_set(self):
+        """MemoryStore - ``get`` returns what ``set`` stored"""
+        self.store.set('foo', {'bar': 1})
+
+        self.assertEqual(self.store.get('foo'), {'bar': 1})
+
+    def test_get_missing(self):
+        """MemoryStore - ``get`` returns None for an unknown key"""
+        self.assertTrue(self.store.get('foo') is None)
+
+    def test_delete(self):
+        """MemoryStore - ``delete`` removes a key"""
+        self.store.set('foo', 1)
+        self.store.delete('foo')
+
+        self.assertTrue(self.store.get('foo') is None)
+
+    def test_lru(self):
+        """MemoryStore - the least recently used key is evicted"""
+        self.store.set('a', 1)
+        self.store.set('b', 2)
+        self.store.get('a')
+        self.store.set('c', 3)
+
+        self.assertTrue(self.store.get('b') is None)
+        self.assertEqual(self.store.get('a'), 1)
+
+    def test_setdefault(self):
+        """MemoryStore - ``setdefault`` keeps the value a key already has"""
+        first = self.store.setdefault('foo', 1)
+        second = self.store.setdefault('foo', 2)
+
+        self.assertEqual((first, second), (1, 1))
+
+    @patch.object(store.time, 'time')
+    def test_setdefault_expired(self, fake_time):
+        """MemoryStore - ``setdefault`` replaces an expired value"""
+        fake_time.return_value = 100
+        self.store.setdefault('foo', 1, ttl=5)
+        fake_time.return_value = 106
+
+        self.assertEqual(self.store.setdefault('foo', 2), 2)
+
+    @patch.object(store.time, 'time')
+    def test_expires(self, fake_time):
+        """MemoryStore - keys expire after the TTL"""
+        fake_time.return_value = 100
+        self.store.set('foo', 1, ttl=5)
+        fake_time.return_value = 106
+
+        self.assertTrue(self.store.get('foo') is None)
+
+
+class TestSqliteStore(unittest.TestCase):
+    """A set of test cases for the SqliteStore object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'cache.db')
+        self.store = store.SqliteStore(self.path, ttl=30)
+
+    def test_get_set(self):
+        """SqliteStore - ``get`` returns what ``set`` stored"""
+        self.store.set('foo', {'bar': [1, 2]})
+
+        self.assertEqual(self.store.get('foo'), {'bar': [1, 2]})
+
+    def test_shared(self):
+        """SqliteStore - stores using the same file share keys"""
+        self.store.set('foo', 1)
+        other = store.SqliteStore(self.path, ttl=30)
+
+        self.assertEqual(other.get('foo'), 1)
+
+    def test_delete(self):
+        """SqliteStore - ``delete`` removes a key"""
+        self.store.set('foo', 1)
+        self.store.delete('foo')
+
+        self.assertTrue(self.store.get('foo') is None)
+
+    def test_setdefault(self):
+        """SqliteStore - ``setdefault`` keeps the value another store on the same file set"""
+        other = store.SqliteStore(self.path, ttl=30)
+        first = self.store.setdefault('foo', 'task-1')
+        second = other.setdefault('foo', 'task-2')
+
+        self.assertEqual((first, second), ('task-1', 'task-1'))
+
+    @patch.object(store.time, 'time')
+    def test_setdefault_expired(self, fake_time):
+        """SqliteStore - ``setdefault`` replaces an expired value"""
+        fake_time.return_value = 100
+        self.store.setdefault('foo', 1, ttl=5)
+        fake_time.return_value = 106
+
+        self.assertEqual(self.store.setdefault('foo', 2), 2)
+
+    @patch.object(store.time, 'time')
+    def test_expires(self, fake_time):
+        """SqliteStore - keys expire after the TTL"""
+        fake_time.return_value = 100
+        self.store.set('foo', 1, ttl=5)
+        fake_time.return_value = 106
+
+        self.assertTrue(self.store.get('foo') is None)
+
+    def test_broken(self):
+        """SqliteStore - a store that cannot be opened acts empty"""
+        broken = store.SqliteStore(os.path.join(self.directory, 'nope', 'cache.db'), ttl=30)
+        broken.set('foo', 1)
+
+        self.assertTrue(broken.get('foo') is None)
+
+
+class TestGetStore(unittest.TestCase):
+    """A set of test cases for the ``get_store`` function"""
+
+    def test_memory(self):
+        """``get_store`` returns a MemoryStore for memory://"""
+        self.assertTrue(isinstance(store.get_store('memory://', ttl=1, max_size=1), store.MemoryStore))
+
+    def test_sqlite(self):
+        """``get_store`` returns a SqliteStore for sqlite:///"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        url = 'sqlite:///{}'.format(os.path.join(directory, 'cache.db'))
+
+        self.assertTrue(isinstance(store.get_store(url, ttl=1, max_size=1), store.SqliteStore))
+
+    def test_unsupported(self):
+        """``get_store`` raises ValueError for an unknown URL"""
+        with self.assertRaises(ValueError):
+            store.get_store('redis://localhost', ttl=1, max_size=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
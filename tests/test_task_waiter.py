@@ -0,0 +1,149 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in task_waiter.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_winserver_api.lib.worker import task_waiter
+
+
+def _prop(name, val):
+    """Make a fake vmodl.query.PropertyCollector.Change"""
+    prop = MagicMock()
+    prop.name = name
+    prop.val = val
+    return prop
+
+
+def _task_update(version, moid, state, error=None, result=None):
+    """Make a fake ``WaitForUpdatesEx`` result reporting the state of one task"""
+    update_set = MagicMock()
+    update_set.version = version
+    object_update = MagicMock()
+    object_update.obj = task_waiter.vim.Task(moid)
+    object_update.changeSet = [_prop('info.state', state), _prop('info.error', error), _prop('info.result', result)]
+    update_set.filterSet = [MagicMock(objectSet=[object_update])]
+    return update_set
+
+
+class TestTaskWaiter(unittest.TestCase):
+    """A set of test cases for the TaskWaiter object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.vcenter = MagicMock()
+        self.collector = self.vcenter.content.propertyCollector.CreatePropertyCollector.return_value
+        self.waiter = task_waiter.TaskWaiter(self.vcenter, timeout=60)
+        self.waiter.add('box1', task_waiter.vim.Task('task-1'))
+        self.waiter.add('box2', task_waiter.vim.Task('task-2'))
+
+    def test_wait(self):
+        """TaskWaiter - ``wait`` returns once every task is done"""
+        self.collector.WaitForUpdatesEx.side_effect = [_task_update('1', 'task-1', 'running'),
+                                                       None,
+                                                       _task_update('2', 'task-1', 'success'),
+                                                       _task_update('3', 'task-2', 'success')]
+
+        output = self.waiter.wait()
+
+        self.assertEqual(output, {'box1': None, 'box2': None})
+        self.assertEqual(self.collector.WaitForUpdatesEx.call_args[1]['version'], '2')
+
+    def test_wait_error(self):
+        """TaskWaiter - ``wait`` returns the fault of a task that failed"""
+        fault = task_waiter.vim.fault.InvalidPowerState()
+        self.collector.WaitForUpdatesEx.side_effect = [_task_update('1', 'task-1', 'error', fault),
+                                                       _task_update('2', 'task-2', 'success')]
+
+        output = self.waiter.wait()
+
+        self.assertTrue(output['box1'] is fault)
+
+    def test_wait_one_filter(self):
+        """TaskWaiter - ``wait`` watches every task with one filter, and cleans it up"""
+        self.collector.WaitForUpdatesEx.side_effect = [_task_update('1', 'task-1', 'success'),
+                                                       _task_update('2', 'task-2', 'success')]
+
+        self.waiter.wait()
+
+        self.assertEqual(self.collector.CreateFilter.call_count, 1)
+        self.assertTrue(self.collector.DestroyPropertyCollector.called)
+
+    def test_wait_nothing(self):
+        """TaskWaiter - ``wait`` does not talk to vCenter when there's nothing to wait on"""
+        waiter = task_waiter.TaskWaiter(self.vcenter)
+
+        self.assertEqual(waiter.wait(), {})
+        self.assertFalse(self.vcenter.content.propertyCollector.CreatePropertyCollector.called)
+
+    def test_result(self):
+        """TaskWaiter - ``result`` returns what the task returned"""
+        self.collector.WaitForUpdatesEx.side_effect = [_task_update('1', 'task-1', 'success', result='someVM'),
+                                                       _task_update('2', 'task-2', 'success')]
+
+        self.waiter.wait()
+
+        self.assertEqual(self.waiter.result('box1'), 'someVM')
+
+    @patch.object(task_waiter.vim.Task, 'CancelTask', create=True)
+    @patch.object(task_waiter.time, 'time')
+    def test_timeout(self, fake_time, fake_CancelTask):
+        """TaskWaiter - tasks that don't finish in time fail with Timedout"""
+        fake_time.side_effect = [100, 100, 100, 200]
+        self.collector.WaitForUpdatesEx.side_effect = [_task_update('1', 'task-1', 'success'), None]
+
+        output = self.waiter.wait()
+
+        self.assertTrue(output['box1'] is None)
+        self.assertTrue(isinstance(output['box2'], task_waiter.vim.fault.Timedout))
+        self.assertEqual(fake_CancelTask.call_count, 1)
+
+    @patch.object(task_waiter.vim.Task, 'CancelTask', create=True)
+    def test_cancel(self, fake_CancelTask):
+        """TaskWaiter - ``cancel`` stops the wait, and fails the unfinished tasks"""
+        self.collector.WaitForUpdatesEx.side_effect = lambda version, options: self.waiter.cancel()
+
+        output = self.waiter.wait()
+
+        self.assertTrue(isinstance(output['box1'], task_waiter.vim.fault.Timedout))
+        self.assertTrue(isinstance(output['box2'], task_waiter.vim.fault.Timedout))
+
+    def test_wait_slice(self):
+        """TaskWaiter - a single WaitForUpdatesEx call never blocks for long, so ``cancel`` works"""
+        self.collector.WaitForUpdatesEx.side_effect = [_task_update('1', 'task-1', 'success'),
+                                                       _task_update('2', 'task-2', 'success')]
+
+        self.waiter.wait()
+        options = self.collector.WaitForUpdatesEx.call_args[1]['options']
+
+        self.assertEqual(options.maxWaitSeconds, task_waiter.WAIT_SLICE)
+
+
+class TestWaitForTask(unittest.TestCase):
+    """A set of test cases for the ``wait_for_task`` function"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.vcenter = MagicMock()
+        self.collector = self.vcenter.content.propertyCollector.CreatePropertyCollector.return_value
+
+    def test_wait_for_task(self):
+        """``wait_for_task`` returns the result of the task, like ``consume_task``"""
+        self.collector.WaitForUpdatesEx.side_effect = [_task_update('1', 'task-1', 'success', result='someVM')]
+
+        output = task_waiter.wait_for_task(self.vcenter, task_waiter.vim.Task('task-1'))
+
+        self.assertEqual(output, 'someVM')
+
+    def test_wait_for_task_error(self):
+        """``wait_for_task`` raises RuntimeError if the task fails, like ``consume_task``"""
+        fault = task_waiter.vim.fault.DuplicateName(msg='testing')
+        self.collector.WaitForUpdatesEx.side_effect = [_task_update('1', 'task-1', 'error', fault)]
+
+        with self.assertRaises(RuntimeError):
+            task_waiter.wait_for_task(self.vcenter, task_waiter.vim.Task('task-1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,9 +5,15 @@ A suite of tests for the functions in tasks.py
 import unittest
 from unittest.mock import patch, MagicMock
 
+from celery.exceptions import Retry
+
 from vlab_winserver_api.lib.worker import tasks
 
 
+# The bulk phases fan out with the real thread pool, even when vmware is mocked
+FAN_OUT = tasks.vmware.fan_out
+
+
 class TestTasks(unittest.TestCase):
     """A set of test cases for tasks.py"""
     @classmethod
@@ -21,10 +27,10 @@ class TestTasks(unittest.TestCase):
     @patch.object(tasks, 'vmware')
     def test_show_ok(self, fake_vmware):
         """``show`` returns a dictionary when everything works as expected"""
-        fake_vmware.show_winserver.return_value = {'worked': True}
+        fake_vmware.show_winserver.return_value = {'myBox': {'console': 'https://some-url'}}
 
         output = tasks.show(username='bob', txn_id='myId')
-        expected = {'content' : {'worked': True}, 'error': None, 'params': {}}
+        expected = {'content' : {'myBox': {'console': 'https://some-url'}}, 'error': None, 'params': {}}
 
         self.assertEqual(output, expected)
 
@@ -38,10 +44,33 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'get_cache')
     @patch.object(tasks, 'vmware')
-    def test_create_ok(self, fake_vmware):
-        """``create`` returns a dictionary when everything works as expected"""
-        fake_vmware.create_winserver.return_value = {'worked': True}
+    def test_show_fills_cache(self, fake_vmware, fake_get_cache):
+        """``show`` caches the inventory under the generation read before calling vCenter"""
+        fake_vmware.show_winserver.return_value = {'worked': True}
+        fake_get_cache.return_value.generation.return_value = 'gen1'
+
+        tasks.show(username='bob', txn_id='myId')
+
+        fake_get_cache.return_value.put.assert_called_with('bob', {'worked': True}, 'gen1')
+
+    @patch.object(tasks, 'get_cache')
+    @patch.object(tasks, 'vmware')
+    def test_show_error_not_cached(self, fake_vmware, fake_get_cache):
+        """``show`` does not cache the inventory when the lookup fails"""
+        fake_vmware.show_winserver.side_effect = [ValueError("testing")]
+
+        tasks.show(username='bob', txn_id='myId')
+
+        self.assertFalse(fake_get_cache.return_value.put.called)
+
+    @patch.object(tasks.create, 'replace')
+    @patch.object(tasks, 'vmware')
+    def test_create_ok(self, fake_vmware, fake_replace):
+        """``create`` replaces itself with the remaining phases after deploying the VM"""
+        fake_vmware.claim_winserver.return_value = None
+        fake_vmware.deploy_winserver.return_value = {'moid': 'vm-1', 'boot-time': 'someTime'}
 
         output = tasks.create(username='bob',
                               machine_name='winserverBox',
@@ -49,14 +78,90 @@ class TestTasks(unittest.TestCase):
                               network='someLAN',
                               ip_config=self.ip_config,
                               txn_id='myId')
-        expected = {'content' : {'worked': True}, 'error': None, 'params': {}}
+        phases = [x.task for x in fake_replace.call_args[0][0].tasks]
+        expected = ['winserver.create.wait_for_guest', 'winserver.create.configure_ip', 'winserver.create.finalize']
+
+        self.assertTrue(output is fake_replace.return_value)
+        self.assertEqual(phases, expected)
+
+    @patch.object(tasks.create, 'replace')
+    @patch.object(tasks, 'vmware')
+    def test_create_warm_pool(self, fake_vmware, fake_replace):
+        """``create`` does not deploy a VM when one is claimed from the warm pool"""
+        fake_vmware.claim_winserver.return_value = {'moid': 'vm-1', 'boot-time': 'someTime'}
+
+        tasks.create(username='bob',
+                     machine_name='winserverBox',
+                     image='0.0.1',
+                     network='someLAN',
+                     ip_config=self.ip_config,
+                     txn_id='myId')
+        state = fake_replace.call_args[0][0].tasks[0].args[0]
+
+        self.assertFalse(fake_vmware.deploy_winserver.called)
+        self.assertTrue(state['warm'])
+
+    @patch.object(tasks, 'admission')
+    @patch.object(tasks, 'vmware')
+    def test_create_too_busy(self, fake_vmware, fake_admission):
+        """``create`` waits its turn in the queue while a deploy limit is hit"""
+        fake_admission.get_admission.return_value.admit.return_value = 'testing'
+        fake_admission.get_admission.return_value.retry_after = 30
+
+        with self.assertRaises(Retry):
+            tasks.create(username='bob',
+                         machine_name='winserverBox',
+                         image='0.0.1',
+                         network='someLAN',
+                         ip_config=self.ip_config,
+                         txn_id='myId')
+
+        self.assertFalse(fake_vmware.deploy_winserver.called)
+
+    @patch.object(tasks, 'admission')
+    @patch.object(tasks, 'vmware')
+    def test_create_error_releases(self, fake_vmware, fake_admission):
+        """``create`` gives back its deploy lease when the deploy fails"""
+        fake_admission.get_admission.return_value.admit.return_value = ''
+        fake_vmware.claim_winserver.return_value = None
+        fake_vmware.deploy_winserver.side_effect = [ValueError("testing")]
+
+        tasks.create(username='bob',
+                     machine_name='winserverBox',
+                     image='0.0.1',
+                     network='someLAN',
+                     ip_config=self.ip_config,
+                     txn_id='myId')
+
+        self.assertTrue(fake_admission.get_admission.return_value.release.called)
+
+    @patch.object(tasks, 'vmware')
+    def test_refill_pool(self, fake_vmware):
+        """``refill_pool`` tops off the warm pool"""
+        tasks.refill_pool()
+
+        self.assertTrue(fake_vmware.refill_pool.called)
+
+    @patch.object(tasks.metrics, 'collect')
+    @patch.object(tasks, 'vmware')
+    def test_pool(self, fake_vmware, fake_collect):
+        """``pool`` returns the size of the pool and the metrics"""
+        fake_vmware.pool_status.return_value = {'2016': {'size': 2, 'ready': 1, 'warming': 1}}
+        fake_collect.return_value = {'counters': []}
+
+        output = tasks.pool(txn_id='myId')
+        expected = {'content': {'pool': {'2016': {'size': 2, 'ready': 1, 'warming': 1}},
+                                'metrics': {'counters': []}},
+                    'error': None,
+                    'params': {}}
 
         self.assertEqual(output, expected)
 
     @patch.object(tasks, 'vmware')
     def test_create_value_error(self, fake_vmware):
         """``create`` sets the error in the dictionary to the ValueError message"""
-        fake_vmware.create_winserver.side_effect = [ValueError("testing")]
+        fake_vmware.claim_winserver.return_value = None
+        fake_vmware.deploy_winserver.side_effect = [ValueError("testing")]
 
         output = tasks.create(username='bob',
                               machine_name='winserverBox',
@@ -78,6 +183,16 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'get_cache')
+    @patch.object(tasks, 'vmware')
+    def test_delete_invalidates(self, fake_vmware, fake_get_cache):
+        """``delete`` invalidates the cached inventory, even if the delete fails"""
+        fake_vmware.delete_winserver.side_effect = [ValueError("testing")]
+
+        tasks.delete(username='bob', machine_name='winserverBox', txn_id='myId')
+
+        fake_get_cache.return_value.invalidate.assert_called_with('bob')
+
     @patch.object(tasks, 'vmware')
     def test_delete_value_error(self, fake_vmware):
         """``delete`` sets the error in the dictionary to the ValueError message"""
@@ -93,9 +208,10 @@ class TestTasks(unittest.TestCase):
     def test_image(self, fake_vmware):
         """``image`` returns a dictionary when everything works as expected"""
         fake_vmware.list_images.return_value = ['2016', '2012R2']
+        fake_vmware.list_templates.return_value = ['2016']
 
         output = tasks.image(txn_id='myId')
-        expected = {'content' : {'image' : ['2016', '2012R2']}, 'error': None, 'params' : {}}
+        expected = {'content' : {'image' : ['2016', '2012R2'], 'templates': ['2016']}, 'error': None, 'params' : {}}
 
         self.assertEqual(output, expected)
 
@@ -124,5 +240,452 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+class TestTaskMetrics(unittest.TestCase):
+    """A set of test cases for the Celery signal handlers that record metrics"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.task = MagicMock()
+        self.task.name = 'winserver.show'
+        self.task.request.eta = None
+        self.task.request.winserver_sent_at = tasks.time.time() - 3
+        patcher = patch.object(tasks, 'REGISTRY')
+        self.fake_REGISTRY = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(tasks.metrics, 'dump')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_queue_wait(self):
+        """``start_timer`` records how long the task sat in the queue"""
+        tasks.start_timer(task=self.task)
+
+        name, waited = self.fake_REGISTRY.observe.call_args[0]
+
+        self.assertEqual(name, 'winserver_task_queue_seconds')
+        self.assertTrue(3 <= waited < 4)
+
+    def test_queue_wait_countdown(self):
+        """``start_timer`` does not count the countdown of a retry as time in the queue"""
+        self.task.request.eta = '2000-01-01T00:00:00+00:00'
+        self.task.request.winserver_sent_at = tasks.time.time()
+        with patch.object(tasks, 'maybe_iso8601') as fake_maybe_iso8601:
+            fake_maybe_iso8601.return_value.timestamp.return_value = tasks.time.time() + 60
+            tasks.start_timer(task=self.task)
+
+        waited = self.fake_REGISTRY.observe.call_args[0][1]
+
+        self.assertEqual(waited, 0)
+
+    def test_task_duration(self):
+        """``dump_metrics`` records how long the task took, by name and phase"""
+        self.task.request.winserver_started = tasks.time.time()
+        self.task.request.winserver_phase = 'deploy'
+
+        tasks.dump_metrics(task=self.task, retval={'error': None}, state='SUCCESS')
+
+        the_args, the_kwargs = self.fake_REGISTRY.observe.call_args
+
+        self.assertEqual(the_args[0], 'winserver_task_seconds')
+        self.assertEqual(the_kwargs, {'task': 'winserver.show', 'phase': 'deploy'})
+        self.fake_REGISTRY.inc.assert_called_with('winserver_tasks_total', task='winserver.show', result='success')
+
+    def test_task_error(self):
+        """``dump_metrics`` counts a task that returned an error as an error"""
+        tasks.dump_metrics(task=self.task, retval={'error': 'testing'}, state='SUCCESS')
+
+        self.fake_REGISTRY.inc.assert_called_with('winserver_tasks_total', task='winserver.show', result='error')
+
+    def test_task_exception(self):
+        """``count_failure`` counts the tasks that raised"""
+        tasks.count_failure(sender=self.task)
+
+        self.fake_REGISTRY.inc.assert_called_with('winserver_task_exceptions_total', task='winserver.show')
+
+
+class TestDeleteMany(unittest.TestCase):
+    """A set of test cases for the ``delete_many`` task"""
+
+    @patch.object(tasks, 'vmware')
+    def test_delete_many(self, fake_vmware):
+        """``delete_many`` returns the report of every VM"""
+        fake_vmware.delete_many.return_value = {'box1': {'deleted': True}}
+
+        output = tasks.delete_many(username='bob', machine_names=['box1'], txn_id='myId')
+        expected = {'content': {'box1': {'deleted': True}}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_delete_many_errors(self, fake_vmware):
+        """``delete_many`` sets the error to every VM that was not deleted"""
+        fake_vmware.delete_many.return_value = {'box1': {'deleted': True}, 'box2': {'error': 'testing'}}
+
+        output = tasks.delete_many(username='bob', machine_names=['box1', 'box2'], txn_id='myId')
+
+        self.assertEqual(output['error'], 'box2: testing')
+
+    @patch.object(tasks, 'get_cache')
+    @patch.object(tasks, 'vmware')
+    def test_delete_many_invalidates(self, fake_vmware, fake_get_cache):
+        """``delete_many`` invalidates the cached inventory"""
+        fake_vmware.delete_many.return_value = {}
+
+        tasks.delete_many(username='bob', machine_names=None, txn_id='myId')
+
+        fake_get_cache.return_value.invalidate.assert_called_with('bob')
+
+
+class TestModifyNetworks(unittest.TestCase):
+    """A set of test cases for the ``modify_networks`` task"""
+
+    @patch.object(tasks, 'get_cache')
+    @patch.object(tasks, 'vmware')
+    def test_modify_networks(self, fake_vmware, fake_get_cache):
+        """``modify_networks`` returns the report of every VM, and invalidates the cache"""
+        fake_vmware.update_networks.return_value = {'box1': {'network': 'bob_lan2'}}
+
+        output = tasks.modify_networks(username='bob', changes={'box1': 'bob_lan2'}, txn_id='myId')
+        expected = {'content': {'box1': {'network': 'bob_lan2'}}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+        fake_get_cache.return_value.invalidate.assert_called_with('bob')
+
+    @patch.object(tasks, 'get_cache')
+    @patch.object(tasks, 'vmware')
+    def test_modify_networks_errors(self, fake_vmware, fake_get_cache):
+        """``modify_networks`` sets the error to every VM that was not moved"""
+        fake_vmware.update_networks.return_value = {'box1': {'network': 'bob_lan2'}, 'box2': {'error': 'testing'}}
+
+        output = tasks.modify_networks(username='bob', changes={'box1': 'bob_lan2', 'box2': 'bob_lan2'}, txn_id='myId')
+
+        self.assertEqual(output['error'], 'box2: testing')
+
+
+class TestReleaseDeploy(unittest.TestCase):
+    """A set of test cases for the ``release_deploy`` signal handler"""
+    def setUp(self):
+        """Runs before every test case"""
+        patcher = patch.object(tasks, 'admission')
+        self.fake_admission = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(tasks, 'dedupe')
+        self.fake_dedupe = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_create(self):
+        """``release_deploy`` gives back the lease of a create that raised"""
+        tasks.release_deploy(sender=tasks.create, task_id='task-1', args=['bob', 'box', '2016', 'someLAN', {}, 'myId'])
+
+        self.fake_admission.get_admission.return_value.release.assert_called_with('task-1')
+        self.fake_dedupe.get_deduplicator.return_value.finish.assert_called_with('create', 'bob', 'box', 'task-1')
+
+    def test_phase(self):
+        """``release_deploy`` gives back the lease a create phase runs under"""
+        tasks.release_deploy(sender=tasks.finalize, task_id='phase-1',
+                             args=[{'task-id': 'task-1', 'username': 'bob', 'machine-name': 'box'}])
+
+        self.fake_admission.get_admission.return_value.release.assert_called_with('task-1')
+        self.fake_dedupe.get_deduplicator.return_value.finish.assert_called_with('create', 'bob', 'box', 'task-1')
+
+    def test_bulk_phase(self):
+        """``release_deploy`` gives back the lease a bulk create phase runs under"""
+        tasks.release_deploy(sender=tasks.finalize_many, task_id='phase-1', args=[{'task-id': 'task-1'}])
+
+        self.fake_admission.get_admission.return_value.release.assert_called_with('task-1')
+
+    def test_other(self):
+        """``release_deploy`` ignores the tasks that don't deploy VMs"""
+        tasks.release_deploy(sender=tasks.delete, task_id='task-1', args=['bob', 'box', 'myId'])
+
+        self.assertFalse(self.fake_admission.get_admission.return_value.release.called)
+
+
+class TestCreatePhases(unittest.TestCase):
+    """A set of test cases for the phases of the ``create`` task"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.state = {'username': 'bob',
+                      'machine-name': 'winserverBox',
+                      'image': '2016',
+                      'ip-config': {'static-ip': '192.168.1.2',
+                                    'default-gateway': '192.168.1.1',
+                                    'netmask': '255.255.255.0',
+                                    'dns': ['192.168.1.1']},
+                      'txn-id': 'myId',
+                      'task-id': None,
+                      'moid': 'vm-1',
+                      'boot-time': 'someTime',
+                      'deadline': tasks.time.time() + 600,
+                      'meta-set': False,
+                      'resp': {'content' : {}, 'error': None, 'params': {}},
+                     }
+
+    @patch.object(tasks, 'vmware')
+    def test_wait_for_guest_ready(self, fake_vmware):
+        """``wait_for_guest`` passes the state along once the guest is ready"""
+        fake_vmware.guest_ready.return_value = True
+
+        output = tasks.wait_for_guest(self.state)
+
+        self.assertEqual(output, self.state)
+
+    @patch.object(tasks, 'vmware')
+    def test_wait_for_guest_timing(self, fake_vmware):
+        """``wait_for_guest`` records how long the guest took to be ready, retries included"""
+        fake_vmware.guest_ready.return_value = True
+        self.state['deployed-at'] = tasks.time.time() - 60
+
+        output = tasks.wait_for_guest(self.state)
+        seconds = output['resp']['params']['timings']['wait-for-guest']['seconds']
+
+        self.assertTrue(60 <= seconds < 61)
+
+    @patch.object(tasks, 'vmware')
+    def test_wait_for_guest_retry(self, fake_vmware):
+        """``wait_for_guest`` reschedules itself instead of blocking"""
+        fake_vmware.guest_ready.return_value = False
+
+        with self.assertRaises(Retry):
+            tasks.wait_for_guest(self.state)
+
+    @patch.object(tasks, 'admission')
+    @patch.object(tasks, 'vmware')
+    def test_wait_for_guest_renews(self, fake_vmware, fake_admission):
+        """``wait_for_guest`` keeps the deploy lease from expiring while it waits"""
+        fake_vmware.guest_ready.return_value = False
+
+        with self.assertRaises(Retry):
+            tasks.wait_for_guest(self.state)
+
+        fake_admission.get_admission.return_value.renew.assert_called_with(None, 'bob')
+
+    @patch.object(tasks, 'vmware')
+    def test_wait_for_guest_deadline(self, fake_vmware):
+        """``wait_for_guest`` gives up once the deadline passes"""
+        fake_vmware.guest_ready.return_value = False
+        self.state['deadline'] = 0
+
+        with self.assertRaises(RuntimeError):
+            tasks.wait_for_guest(self.state)
+
+    @patch.object(tasks, 'vmware')
+    def test_wait_for_guest_warm(self, fake_vmware):
+        """``wait_for_guest`` does not wait on a VM from the warm pool"""
+        self.state['warm'] = True
+
+        tasks.wait_for_guest(self.state)
+
+        self.assertFalse(fake_vmware.guest_ready.called)
+
+    @patch.object(tasks, 'vmware')
+    def test_wait_for_guest_dhcp(self, fake_vmware):
+        """``wait_for_guest`` does not wait on the guest if it'll use DHCP"""
+        self.state['ip-config']['static-ip'] = ''
+
+        tasks.wait_for_guest(self.state)
+
+        self.assertFalse(fake_vmware.guest_ready.called)
+
+    @patch.object(tasks, 'vmware')
+    def test_configure_ip(self, fake_vmware):
+        """``configure_ip`` sets the static IP"""
+        tasks.configure_ip(self.state)
+
+        self.assertTrue(fake_vmware.configure_ip.called)
+
+    @patch.object(tasks, 'vmware')
+    def test_configure_ip_dhcp(self, fake_vmware):
+        """``configure_ip`` does nothing if the VM will use DHCP"""
+        self.state['ip-config']['static-ip'] = ''
+
+        tasks.configure_ip(self.state)
+
+        self.assertFalse(fake_vmware.configure_ip.called)
+
+    @patch.object(tasks, 'vmware')
+    def test_configure_ip_value_error(self, fake_vmware):
+        """``configure_ip`` records the ValueError message in the response"""
+        fake_vmware.configure_ip.side_effect = ValueError('testing')
+
+        output = tasks.configure_ip(self.state)
+
+        self.assertEqual(output['resp']['error'], 'testing')
+
+    @patch.object(tasks, 'vmware')
+    def test_finalize(self, fake_vmware):
+        """``finalize`` returns the same response as the old, single-phase ``create``"""
+        fake_vmware.finalize_winserver.return_value = {'winserverBox': {'ips': ['192.168.1.2']}}
+
+        output = tasks.finalize(self.state)
+        expected = {'content' : {'winserverBox': {'ips': ['192.168.1.2']}}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_finalize_timings(self, fake_vmware):
+        """``finalize`` returns the timings of every phase in the params"""
+        self.state['resp']['params']['timings'] = {'deploy.upload': {'seconds': 1.0, 'count': 1}}
+
+        def finalize_winserver(*args, **kwargs):
+            with tasks.timing.span('finalize.get-info'):
+                return {'winserverBox': {'ips': ['192.168.1.2']}}
+        fake_vmware.finalize_winserver.side_effect = finalize_winserver
+
+        output = tasks.finalize(self.state)
+
+        self.assertEqual(sorted(output['params']['timings'].keys()), ['deploy.upload', 'finalize.get-info'])
+
+    @patch.object(tasks, 'vmware')
+    def test_finalize_no_ip(self, fake_vmware):
+        """``finalize`` reschedules itself until the VM has an IP"""
+        fake_vmware.finalize_winserver.return_value = {'winserverBox': {'ips': []}}
+
+        with self.assertRaises(Retry):
+            tasks.finalize(self.state)
+
+    @patch.object(tasks, 'vmware')
+    def test_finalize_error(self, fake_vmware):
+        """``finalize`` returns the error from an earlier phase"""
+        self.state['resp']['error'] = 'testing'
+
+        output = tasks.finalize(self.state)
+
+        self.assertEqual(output['error'], 'testing')
+        self.assertFalse(fake_vmware.finalize_winserver.called)
+
+    @patch.object(tasks, 'admission')
+    @patch.object(tasks, 'vmware')
+    def test_finalize_releases(self, fake_vmware, fake_admission):
+        """``finalize`` gives back the deploy lease of the create"""
+        self.state['task-id'] = 'task-1'
+        self.state['resp']['error'] = 'testing'
+
+        tasks.finalize(self.state)
+
+        fake_admission.get_admission.return_value.release.assert_called_with('task-1')
+
+
+class TestCreateMany(unittest.TestCase):
+    """A set of test cases for the ``create_many`` task, and its phases"""
+    def setUp(self):
+        """Runs before every test case"""
+        dhcp = {'static-ip': '', 'default-gateway': '192.168.1.1', 'netmask': '255.255.255.0', 'dns': ['192.168.1.1']}
+        static = dict(dhcp)
+        static['static-ip'] = '192.168.1.2'
+        self.ip_configs = [dhcp, static]
+        self.state = {'username': 'bob',
+                      'image': '2016',
+                      'txn-id': 'myId',
+                      'task-id': None,
+                      'deadline': tasks.time.time() + 600,
+                      'machines': {
+                        'box1': {'moid': 'vm-1', 'boot-time': 'someTime', 'warm': False, 'ip-config': dhcp,
+                                 'phase': 'deploy', 'error': None, 'meta-set': False, 'info': None},
+                        'box2': {'moid': 'vm-2', 'boot-time': 'someTime', 'warm': False, 'ip-config': static,
+                                 'phase': 'deploy', 'error': None, 'meta-set': False, 'info': None},
+                      }
+                     }
+
+    @patch.object(tasks.create_many, 'replace')
+    @patch.object(tasks, 'vmware')
+    def test_create_many(self, fake_vmware, fake_replace):
+        """``create_many`` deploys every VM, then hands off to the bulk phases"""
+        fake_vmware.deploy_many.return_value = {'box1': {'moid': 'vm-1', 'boot-time': 'someTime', 'warm': False},
+                                                'box2': {'error': 'testing'}}
+
+        tasks.create_many('bob', ['box1', 'box2'], '2016', 'bob_frontend', self.ip_configs, 'myId')
+        state = fake_replace.call_args[0][0].tasks[0].args[0]
+
+        self.assertEqual(state['machines']['box1']['phase'], 'deploy')
+        self.assertEqual(state['machines']['box2']['error'], 'testing')
+
+    @patch.object(tasks, 'vmware')
+    def test_wait_for_guests(self, fake_vmware):
+        """``wait_for_guests`` only waits on the VMs getting a static IP"""
+        fake_vmware.fan_out.side_effect = FAN_OUT
+        fake_vmware.guest_ready.return_value = True
+
+        tasks.wait_for_guests(self.state)
+
+        self.assertEqual(fake_vmware.guest_ready.call_count, 1)
+
+    @patch.object(tasks, 'vmware')
+    def test_wait_for_guests_retry(self, fake_vmware):
+        """``wait_for_guests`` reschedules itself while a guest is not ready"""
+        fake_vmware.fan_out.side_effect = FAN_OUT
+        fake_vmware.guest_ready.return_value = False
+
+        with self.assertRaises(Retry):
+            tasks.wait_for_guests(self.state)
+
+    @patch.object(tasks, 'admission')
+    @patch.object(tasks, 'vmware')
+    def test_wait_for_guests_renews(self, fake_vmware, fake_admission):
+        """``wait_for_guests`` keeps the deploy lease of every VM from expiring while it waits"""
+        fake_vmware.fan_out.side_effect = FAN_OUT
+        fake_vmware.guest_ready.return_value = False
+
+        with self.assertRaises(Retry):
+            tasks.wait_for_guests(self.state)
+
+        fake_admission.get_admission.return_value.renew.assert_called_with(None, 'bob', count=2)
+
+    @patch.object(tasks, 'vmware')
+    def test_wait_for_guests_deadline(self, fake_vmware):
+        """``wait_for_guests`` fails only the VMs still waiting once the deadline passes"""
+        fake_vmware.fan_out.side_effect = FAN_OUT
+        fake_vmware.guest_ready.return_value = False
+        self.state['deadline'] = 0
+
+        output = tasks.wait_for_guests(self.state)
+
+        self.assertTrue(output['machines']['box2']['error'])
+        self.assertFalse(output['machines']['box1']['error'])
+
+    @patch.object(tasks, 'vmware')
+    def test_configure_ips_error(self, fake_vmware):
+        """``configure_ips`` records a failed VM without failing the others"""
+        fake_vmware.fan_out.side_effect = FAN_OUT
+        fake_vmware.configure_ip.side_effect = ValueError('testing')
+
+        output = tasks.configure_ips(self.state)
+
+        self.assertEqual(output['machines']['box2']['error'], 'testing')
+        self.assertEqual(output['machines']['box1']['phase'], 'deploy')
+
+    @patch.object(tasks, 'vmware')
+    def test_finalize_many(self, fake_vmware):
+        """``finalize_many`` returns the info of every VM"""
+        fake_vmware.fan_out.side_effect = FAN_OUT
+        fake_vmware.finalize_winserver.side_effect = lambda username, moid, image, set_meta: {moid: {'ips': ['1.2.3.4']}}
+
+        output = tasks.finalize_many(self.state)
+        expected = {'content': {'vm-1': {'ips': ['1.2.3.4']}, 'vm-2': {'ips': ['1.2.3.4']}}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_finalize_many_errors(self, fake_vmware):
+        """``finalize_many`` reports every VM that failed"""
+        fake_vmware.fan_out.side_effect = FAN_OUT
+        fake_vmware.finalize_winserver.side_effect = lambda username, moid, image, set_meta: {moid: {'ips': ['1.2.3.4']}}
+        self.state['machines']['box2']['error'] = 'testing'
+
+        output = tasks.finalize_many(self.state)
+
+        self.assertEqual(output['error'], 'box2: testing')
+        self.assertEqual(list(output['content'].keys()), ['vm-1'])
+
+    @patch.object(tasks, 'vmware')
+    def test_finalize_many_retry(self, fake_vmware):
+        """``finalize_many`` reschedules itself until every VM has an IP"""
+        fake_vmware.fan_out.side_effect = FAN_OUT
+        fake_vmware.finalize_winserver.side_effect = lambda username, moid, image, set_meta: {moid: {'ips': []}}
+
+        with self.assertRaises(Retry):
+            tasks.finalize_many(self.state)
+
+
 if __name__ == '__main__':
     unittest.main()
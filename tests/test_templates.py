@@ -0,0 +1,277 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in templates.py
+"""
+import datetime
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_winserver_api.lib import dedupe
+from vlab_winserver_api.lib.store import MemoryStore
+from vlab_winserver_api.lib.worker import templates
+
+
+class TestTemplates(unittest.TestCase):
+    """A set of test cases for templates.py"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.vcenter = MagicMock()
+        self.vcenter.networks = {'someLAN': templates.vim.Network('network-1')}
+        self.vcenter.resource_pools = {templates.const.INF_VCENTER_RESORUCE_POOL: templates.vim.ResourcePool('resgroup-1')}
+        self.the_template = templates.vim.VirtualMachine('vm-100')
+        self.vcenter.content.searchIndex.FindChild.return_value = self.the_template
+        self.snapshot = MagicMock()
+        self.entry = {'path': '/images/WinServer-2016.ova', 'networks': ['VM Network']}
+        patcher = patch.object(templates.inventory, 'user_folder')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(templates.networks, 'resolve', side_effect=lambda vcenter, name: vcenter.networks[name])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(templates.placement, 'get_engine')
+        self.fake_engine = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.target = templates.placement.Placement(templates.vim.Datastore('datastore-2'),
+                                                    templates.const.INF_VCENTER_RESORUCE_POOL)
+        self.fake_engine.place.return_value.__enter__.return_value = self.target
+        self.deduplicator = dedupe.Deduplicator(MemoryStore(max_size=100, ttl=60), ttl=60)
+        patcher = patch.object(templates.dedupe, 'get_deduplicator', return_value=self.deduplicator)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_template_name(self):
+        """``template_name`` includes the image version"""
+        self.assertEqual(templates.template_name('2016'), 'WinServer-2016-template')
+
+    @patch.object(templates, 'const')
+    def test_enabled(self, fake_const):
+        """``enabled`` is True when the deploy mode is linked-clone"""
+        fake_const.VLAB_WINSERVER_DEPLOY_MODE = 'Linked-Clone'
+
+        self.assertTrue(templates.enabled())
+
+    def test_enabled_default(self):
+        """``enabled`` defaults to False, i.e. upload the OVA"""
+        self.assertFalse(templates.enabled())
+
+    @patch.object(templates.inventory, 'retrieve_vms')
+    def test_ready_templates(self, fake_retrieve_vms):
+        """``ready_templates`` only returns the versions with a snapshot"""
+        fake_retrieve_vms.return_value = [{'name': 'WinServer-2016-template', 'snapshot': self.snapshot},
+                                          {'name': 'WinServer-2012R2-template', 'snapshot': None},
+                                          {'name': 'WinServer-2019-template'},
+                                          {'name': 'someOtherVM', 'snapshot': self.snapshot}]
+
+        output = templates.ready_templates(self.vcenter)
+
+        self.assertEqual(output, ['2016'])
+
+    @patch.object(templates.inventory, 'retrieve_properties')
+    def test_find_template(self, fake_retrieve_properties):
+        """``find_template`` returns the template VM and its snapshot"""
+        fake_retrieve_properties.return_value = {'snapshot': self.snapshot}
+
+        the_template, snapshot = templates.find_template(self.vcenter, '2016')
+
+        self.assertTrue(the_template is self.the_template)
+        self.assertTrue(snapshot is self.snapshot.currentSnapshot)
+
+    @patch.object(templates.inventory, 'retrieve_properties')
+    def test_find_template_not_ready(self, fake_retrieve_properties):
+        """``find_template`` returns no snapshot for a template that's still being imported"""
+        fake_retrieve_properties.return_value = {}
+
+        output = templates.find_template(self.vcenter, '2016')
+
+        self.assertEqual(output, (self.the_template, None))
+
+    def test_find_template_missing(self):
+        """``find_template`` returns (None, None) if there's no template"""
+        self.vcenter.content.searchIndex.FindChild.return_value = None
+
+        output = templates.find_template(self.vcenter, '2016')
+
+        self.assertEqual(output, (None, None))
+
+    @patch.object(templates.networks, 'change_task')
+    @patch.object(templates, 'wait_for_task')
+    def test_clone(self, fake_wait_for_task, fake_change_task):
+        """``clone`` makes a linked clone, so only a delta disk gets created"""
+        the_template = MagicMock()
+        snapshot = templates.vim.vm.Snapshot('snapshot-1')
+
+        templates.clone(self.vcenter, the_template, snapshot, 'bob', 'myWinServer',
+                        self.vcenter.networks['someLAN'], MagicMock())
+        spec = the_template.CloneVM_Task.call_args[1]['spec']
+
+        self.assertEqual(spec.location.diskMoveType, 'createNewChildDiskBacking')
+        self.assertTrue(spec.snapshot is snapshot)
+
+    @patch.object(templates.networks, 'change_task')
+    @patch.object(templates, 'wait_for_task')
+    def test_clone_placement(self, fake_wait_for_task, fake_change_task):
+        """``clone`` puts the new VM on the datastore and resource pool the placement engine picked"""
+        the_template = MagicMock()
+
+        templates.clone(self.vcenter, the_template, templates.vim.vm.Snapshot('snapshot-1'), 'bob',
+                        'myWinServer', self.vcenter.networks['someLAN'], MagicMock())
+        spec = the_template.CloneVM_Task.call_args[1]['spec']
+
+        self.assertEqual(spec.location.datastore._moId, 'datastore-2')
+        self.assertEqual(spec.location.pool._moId, 'resgroup-1')
+
+    @patch.object(templates.networks, 'change_task')
+    @patch.object(templates, 'wait_for_task')
+    def test_clone_network(self, fake_wait_for_task, fake_change_task):
+        """``clone`` connects the new VM to the requested network before powering it on"""
+        output = templates.clone(self.vcenter, MagicMock(), templates.vim.vm.Snapshot('snapshot-1'), 'bob',
+                                 'myWinServer', self.vcenter.networks['someLAN'], MagicMock())
+
+        self.assertTrue(fake_change_task.call_args[0][1] is self.vcenter.networks['someLAN'])
+        self.assertTrue(output.PowerOnVM_Task.called)
+
+    @patch.object(templates, 'clone')
+    @patch.object(templates, 'import_template')
+    @patch.object(templates, 'Ova')
+    @patch.object(templates, 'find_template')
+    def test_deploy(self, fake_find_template, fake_Ova, fake_import_template, fake_clone):
+        """``deploy`` does not touch the OVA when the template is ready"""
+        fake_find_template.return_value = (self.the_template, self.snapshot)
+
+        templates.deploy(self.vcenter, self.entry, 'bob', 'myWinServer',
+                         '2016', 'someLAN', MagicMock())
+
+        self.assertFalse(fake_Ova.called)
+        self.assertFalse(fake_import_template.called)
+        self.assertTrue(fake_clone.called)
+
+    @patch.object(templates, 'clone')
+    @patch.object(templates, 'import_template')
+    @patch.object(templates, 'Ova')
+    @patch.object(templates, 'find_template')
+    def test_deploy_imports(self, fake_find_template, fake_Ova, fake_import_template, fake_clone):
+        """``deploy`` imports the template the first time a version is deployed"""
+        fake_find_template.return_value = (None, None)
+        fake_import_template.return_value = (self.the_template, self.snapshot)
+
+        templates.deploy(self.vcenter, self.entry, 'bob', 'myWinServer',
+                         '2016', 'someLAN', MagicMock())
+        network_map = fake_import_template.call_args[0][2][0]
+
+        self.assertEqual(network_map.name, 'VM Network')
+        self.assertTrue(fake_Ova.return_value.close.called)
+        self.assertTrue(fake_clone.called)
+
+    @patch.object(templates, 'clone')
+    @patch.object(templates, 'import_template')
+    @patch.object(templates, 'Ova')
+    @patch.object(templates, 'find_template')
+    def test_deploy_import_releases(self, fake_find_template, fake_Ova, fake_import_template, fake_clone):
+        """``deploy`` gives back the claim on the import once it's done"""
+        fake_find_template.return_value = (None, None)
+        fake_import_template.return_value = (self.the_template, self.snapshot)
+
+        templates.deploy(self.vcenter, self.entry, 'bob', 'myWinServer',
+                         '2016', 'someLAN', MagicMock())
+
+        self.assertTrue(self.deduplicator.claim('import', templates.const.VLAB_WINSERVER_TEMPLATE_DIR, '2016', 'other') is None)
+
+    @patch.object(templates, 'clone')
+    @patch.object(templates, 'import_template')
+    @patch.object(templates, 'Ova')
+    @patch.object(templates, 'find_template')
+    def test_deploy_concurrent_import(self, fake_find_template, fake_Ova, fake_import_template, fake_clone):
+        """``deploy`` returns None instead of importing a template another deploy is importing"""
+        fake_find_template.return_value = (None, None)
+        self.deduplicator.claim('import', templates.const.VLAB_WINSERVER_TEMPLATE_DIR, '2016', 'other-deploy')
+
+        output = templates.deploy(self.vcenter, self.entry, 'bob', 'myWinServer',
+                                  '2016', 'someLAN', MagicMock())
+
+        self.assertTrue(output is None)
+        self.assertFalse(fake_import_template.called)
+        self.assertFalse(fake_clone.called)
+
+    @patch.object(templates, 'clone')
+    @patch.object(templates, 'import_template')
+    @patch.object(templates, 'Ova')
+    @patch.object(templates, 'find_template')
+    def test_deploy_import_duplicate(self, fake_find_template, fake_Ova, fake_import_template, fake_clone):
+        """``deploy`` returns None if another worker created the template first"""
+        fake_find_template.return_value = (None, None)
+        fake_import_template.side_effect = templates.vim.fault.DuplicateName()
+
+        output = templates.deploy(self.vcenter, self.entry, 'bob', 'myWinServer',
+                                  '2016', 'someLAN', MagicMock())
+
+        self.assertTrue(output is None)
+        self.assertFalse(fake_clone.called)
+
+    @patch.object(templates, 'wait_for_task')
+    @patch.object(templates.inventory, 'retrieve_properties')
+    @patch.object(templates, 'clone')
+    @patch.object(templates, 'import_template')
+    @patch.object(templates, 'Ova')
+    @patch.object(templates, 'find_template')
+    def test_deploy_partial_import(self, fake_find_template, fake_Ova, fake_import_template, fake_clone,
+                                   fake_retrieve_properties, fake_wait_for_task):
+        """``deploy`` destroys and imports again a template left by an import that died"""
+        partial = MagicMock()
+        fake_find_template.return_value = (partial, None)
+        created = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=1)
+        fake_retrieve_properties.return_value = {'config.createDate': created}
+        fake_import_template.return_value = (self.the_template, self.snapshot)
+
+        templates.deploy(self.vcenter, self.entry, 'bob', 'myWinServer',
+                         '2016', 'someLAN', MagicMock())
+
+        self.assertTrue(partial.Destroy_Task.called)
+        self.assertTrue(fake_import_template.called)
+        self.assertTrue(fake_clone.called)
+
+    @patch.object(templates.inventory, 'retrieve_properties')
+    @patch.object(templates, 'clone')
+    @patch.object(templates, 'import_template')
+    @patch.object(templates, 'Ova')
+    @patch.object(templates, 'find_template')
+    def test_deploy_partial_import_recent(self, fake_find_template, fake_Ova, fake_import_template, fake_clone,
+                                          fake_retrieve_properties):
+        """``deploy`` leaves alone a template without a snapshot that's still being imported"""
+        partial = MagicMock()
+        fake_find_template.return_value = (partial, None)
+        fake_retrieve_properties.return_value = {'config.createDate': datetime.datetime.now(datetime.timezone.utc)}
+
+        output = templates.deploy(self.vcenter, self.entry, 'bob', 'myWinServer',
+                                  '2016', 'someLAN', MagicMock())
+
+        self.assertTrue(output is None)
+        self.assertFalse(partial.Destroy_Task.called)
+        self.assertFalse(fake_import_template.called)
+
+    @patch.object(templates, 'wait_for_task')
+    @patch.object(templates, 'import_template')
+    @patch.object(templates, 'Ova')
+    @patch.object(templates, 'find_template')
+    def test_deploy_import_fails(self, fake_find_template, fake_Ova, fake_import_template, fake_wait_for_task):
+        """``deploy`` destroys what a failed import left behind"""
+        partial = MagicMock()
+        fake_find_template.side_effect = [(None, None), (partial, None)]
+        fake_import_template.side_effect = RuntimeError('testing')
+
+        with self.assertRaises(RuntimeError):
+            templates.deploy(self.vcenter, self.entry, 'bob', 'myWinServer',
+                             '2016', 'someLAN', MagicMock())
+
+        self.assertTrue(partial.Destroy_Task.called)
+
+    @patch.object(templates, 'find_template')
+    def test_deploy_bad_network(self, fake_find_template):
+        """``deploy`` raises ValueError for a network that doesn't exist"""
+        with self.assertRaises(ValueError):
+            templates.deploy(self.vcenter, self.entry, 'bob', 'myWinServer',
+                             '2016', 'noSuchLAN', MagicMock())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in timing.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_winserver_api.lib.worker import timing
+
+
+class TestTiming(unittest.TestCase):
+    """A set of test cases for timing.py"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.logger = MagicMock()
+        self.target = {}
+        patcher = patch.object(timing, 'REGISTRY')
+        self.fake_REGISTRY = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_span(self):
+        """``span`` totals the time of a block into the target"""
+        with timing.recording(self.logger, self.target):
+            with timing.span('deploy.upload'):
+                pass
+
+        self.assertEqual(self.target['timings']['deploy.upload']['count'], 1)
+
+    def test_span_repeated(self):
+        """``span`` adds up the time of steps that run many times"""
+        with timing.recording(self.logger, self.target):
+            for _ in range(3):
+                with timing.span('wait-for-guest.check'):
+                    pass
+
+        self.assertEqual(self.target['timings']['wait-for-guest.check']['count'], 3)
+
+    def test_span_not_recording(self):
+        """``span`` does nothing outside of ``recording``"""
+        with timing.span('deploy.upload'):
+            pass
+
+        self.assertFalse(self.fake_REGISTRY.observe.called)
+
+    def test_span_error(self):
+        """``span`` still records a step that raised"""
+        with self.assertRaises(RuntimeError):
+            with timing.recording(self.logger, self.target):
+                with timing.span('deploy.upload'):
+                    raise RuntimeError('testing')
+
+        self.assertTrue('deploy.upload' in self.target['timings'])
+
+    def test_span_logged(self):
+        """``span`` logs each step as JSON"""
+        with timing.recording(self.logger, self.target) as timings:
+            timings.add('deploy.upload', 1.23456)
+
+        self.logger.info.assert_called_with('{"span":"deploy.upload","seconds":1.235}')
+
+    def test_span_metrics(self):
+        """``span`` records each step in the metrics"""
+        with timing.recording(self.logger, self.target) as timings:
+            timings.add('deploy.upload', 2)
+
+        self.fake_REGISTRY.observe.assert_called_with('winserver_span_seconds', 2, span='deploy.upload')
+
+    def test_no_spans(self):
+        """``recording`` leaves the target alone if nothing was timed"""
+        with timing.recording(self.logger, self.target):
+            pass
+
+        self.assertEqual(self.target, {})
+
+    def test_nested(self):
+        """``recording`` restores the outer recording when it exits"""
+        outer = {}
+        with timing.recording(self.logger, outer):
+            with timing.recording(self.logger, self.target):
+                pass
+            with timing.span('show.inventory'):
+                pass
+
+        self.assertTrue('show.inventory' in outer['timings'])
+
+
+if __name__ == '__main__':
+    unittest.main()
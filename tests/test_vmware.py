@@ -8,6 +8,22 @@ from unittest.mock import patch, MagicMock
 from vlab_winserver_api.lib.worker import vmware
 
 
+class FakeWaiter(object):
+    """Stands in for TaskWaiter; every task works unless it's in ``faults``"""
+    batches = []
+    faults = {}
+
+    def __init__(self, vcenter, timeout=None):
+        self.keys = []
+
+    def add(self, key, the_task):
+        self.keys.append(key)
+
+    def wait(self):
+        FakeWaiter.batches.append(sorted(self.keys))
+        return {x: FakeWaiter.faults.get(x, None) for x in self.keys}
+
+
 class TestVMware(unittest.TestCase):
     """A set of test cases for the vmware.py module"""
 
@@ -18,23 +34,38 @@ class TestVMware(unittest.TestCase):
                          'netmask': '255.255.255.0',
                          'dns': ["192.168.1.1"]
                         }
-
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_show_gateway(self, fake_vCenter, fake_consume_task, fake_get_info):
+        cls.entry = {'path': '/images/WinServer-1.0.0.ova', 'networks': ['someLAN']}
+        cls.catalog_patcher = patch.object(vmware.catalog, 'get_catalog')
+        cls.fake_catalog = cls.catalog_patcher.start().return_value
+        cls.fake_catalog.get.return_value = cls.entry
+        FakeWaiter.batches = []
+        FakeWaiter.faults = {}
+        # look networks up in the fake vCenter, instead of the resolver index
+        cls.resolve_patcher = patch.object(vmware.networks, 'resolve',
+                                           side_effect=lambda vcenter, name: vcenter.networks[name])
+        cls.resolve_patcher.start()
+        # By default, the user has no VM by the name being deployed
+        cls.name_taken_patcher = patch.object(vmware.inventory, 'name_taken', return_value=False)
+        cls.fake_name_taken = cls.name_taken_patcher.start()
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.catalog_patcher.stop()
+        self.resolve_patcher.stop()
+        self.name_taken_patcher.stop()
+
+    @patch.object(vmware.inventory, 'user_folder')
+    @patch.object(vmware.inventory, 'show')
+    @patch.object(vmware, 'wait_for_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_show_gateway(self, fake_vCenter, fake_wait_for_task, fake_show, fake_user_folder):
         """``winserver`` returns a dictionary when everything works as expected"""
-        fake_vm = MagicMock()
-        fake_vm.name = 'WinServer'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta' : {'component' : "WinServer",
-                                                'created': 1234,
-                                                'version': "2012R2",
-                                                'configured': False,
-                                                'generation': 1,
-                                                }}
+        fake_show.return_value = {'WinServer': {'meta' : {'component' : "WinServer",
+                                                          'created': 1234,
+                                                          'version': "2012R2",
+                                                          'configured': False,
+                                                          'generation': 1,
+                                                          }}}
 
         output = vmware.show_winserver(username='alice')
         expected = {'WinServer': {'meta' : {'component' : "WinServer",
@@ -46,43 +77,75 @@ class TestVMware(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'power')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_delete_winserver(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info):
+    @patch.object(vmware.inventory, 'user_folder')
+    @patch.object(vmware.inventory, 'show')
+    @patch.object(vmware, 'vcenter_session')
+    def test_show_winserver_component(self, fake_vCenter, fake_show, fake_user_folder):
+        """``show_winserver`` only asks the inventory for WinServer VMs"""
+        vmware.show_winserver(username='alice')
+
+        the_kwargs = fake_show.call_args[1]
+
+        self.assertEqual(the_kwargs['component'], 'WinServer')
+
+    @patch.object(vmware.change_feed, 'get_feed')
+    @patch.object(vmware, 'vcenter_session')
+    def test_show_winserver_feed(self, fake_vCenter, fake_get_feed):
+        """``show_winserver`` answers from the change feed when it's in sync"""
+        fake_get_feed.return_value.show.return_value = {'myBox': {}}
+
+        output = vmware.show_winserver(username='alice')
+
+        self.assertEqual(output, {'myBox': {}})
+        self.assertFalse(fake_vCenter.called)
+
+    @patch.object(vmware.change_feed, 'get_feed')
+    @patch.object(vmware.inventory, 'user_folder')
+    @patch.object(vmware.inventory, 'show')
+    @patch.object(vmware, 'vcenter_session')
+    def test_show_winserver_feed_syncing(self, fake_vCenter, fake_show, fake_user_folder, fake_get_feed):
+        """``show_winserver`` asks vCenter while the change feed is (re)syncing"""
+        fake_get_feed.return_value.show.return_value = None
+        fake_show.return_value = {'myBox': {}}
+
+        output = vmware.show_winserver(username='alice')
+
+        self.assertEqual(output, {'myBox': {}})
+        self.assertTrue(fake_vCenter.called)
+
+    @patch.object(vmware.inventory, 'find_vm')
+    @patch.object(vmware, 'power_off')
+    @patch.object(vmware, 'wait_for_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_winserver(self, fake_vCenter, fake_wait_for_task, fake_power, fake_find_vm):
         """``delete_winserver`` returns None when everything works as expected"""
         fake_logger = MagicMock()
-        fake_vm = MagicMock()
-        fake_vm.name = 'WinServerBox'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta' : {'component' : "WinServer",
-                                                'created': 1234,
-                                                'version': "2012R2",
-                                                'configured': False,
-                                                'generation': 1,
-                                                }}
 
         output = vmware.delete_winserver(username='bob', machine_name='WinServerBox', logger=fake_logger)
         expected = None
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'power')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_delete_winserver_value_error(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info):
+    @patch.object(vmware.inventory, 'find_vm')
+    @patch.object(vmware, 'power_off')
+    @patch.object(vmware, 'wait_for_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_winserver_destroys(self, fake_vCenter, fake_wait_for_task, fake_power, fake_find_vm):
+        """``delete_winserver`` destroys the VM found by name"""
+        fake_logger = MagicMock()
+
+        vmware.delete_winserver(username='bob', machine_name='WinServerBox', logger=fake_logger)
+
+        self.assertTrue(fake_find_vm.return_value.Destroy_Task.called)
+
+    @patch.object(vmware.inventory, 'find_vm')
+    @patch.object(vmware, 'power_off')
+    @patch.object(vmware, 'wait_for_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_winserver_value_error(self, fake_vCenter, fake_wait_for_task, fake_power, fake_find_vm):
         """``delete_winserver`` raises ValueError when unable to find requested vm for deletion"""
         fake_logger = MagicMock()
-        fake_vm = MagicMock()
-        fake_vm.name = 'win10'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'note' : 'WinServer=1.0.0'}
+        fake_find_vm.side_effect = ValueError('testing')
 
         with self.assertRaises(ValueError):
             vmware.delete_winserver(username='bob', machine_name='myOtherWinServerBox', logger=fake_logger)
@@ -91,9 +154,9 @@ class TestVMware(unittest.TestCase):
     @patch.object(vmware, 'Ova')
     @patch.object(vmware.virtual_machine, 'get_info')
     @patch.object(vmware.virtual_machine, 'deploy_from_ova')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_create_winserver(self, fake_vCenter, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_Ova, fake_set_meta):
+    @patch.object(vmware, 'wait_for_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_winserver(self, fake_vCenter, fake_wait_for_task, fake_deploy_from_ova, fake_get_info, fake_Ova, fake_set_meta):
         """``create_winserver`` returns a dictionary upon success"""
         fake_logger = MagicMock()
         fake_deploy_from_ova.return_value.name = 'WinServerBox'
@@ -111,15 +174,16 @@ class TestVMware(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware.time, 'sleep')
+    @patch.object(vmware, 'guest')
+    @patch.object(vmware.virtual_machine, 'config_static_ip')
     @patch.object(vmware.virtual_machine, 'set_meta')
     @patch.object(vmware, 'Ova')
     @patch.object(vmware.virtual_machine, 'get_info')
     @patch.object(vmware.virtual_machine, 'deploy_from_ova')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_create_winserver_static_ip(self, fake_vCenter, fake_consume_task,
-            fake_deploy_from_ova, fake_get_info, fake_Ova, fake_set_meta, fake_sleep):
+    @patch.object(vmware, 'wait_for_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_winserver_static_ip(self, fake_vCenter, fake_wait_for_task,
+            fake_deploy_from_ova, fake_get_info, fake_Ova, fake_set_meta, fake_config_static_ip, fake_guest):
         """``create_winserver`` sets a static IP when provided with one"""
         fake_logger = MagicMock()
         fake_deploy_from_ova.return_value.name = 'WinServerBox'
@@ -137,13 +201,64 @@ class TestVMware(unittest.TestCase):
         expected = {'WinServerBox': {'worked': True}}
 
         self.assertEqual(output, expected)
+        self.assertTrue(fake_config_static_ip.called)
+
+    @patch.object(vmware, 'guest')
+    @patch.object(vmware.virtual_machine, 'config_static_ip')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, 'Ova')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware, 'wait_for_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_winserver_waits_for_guest(self, fake_vCenter, fake_wait_for_task,
+            fake_deploy_from_ova, fake_get_info, fake_Ova, fake_set_meta, fake_config_static_ip, fake_guest):
+        """``create_winserver`` waits for the guest to be ready before setting a static IP"""
+        fake_logger = MagicMock()
+        fake_deploy_from_ova.return_value.name = 'WinServerBox'
+        fake_Ova.return_value.networks = ['someLAN']
+        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        self.ip_config['static-ip'] = '192.168.1.34'
 
+        vmware.create_winserver(username='alice',
+                                machine_name='WinServerBox',
+                                image='1.0.0',
+                                network='someLAN',
+                                ip_config=self.ip_config,
+                                logger=fake_logger)
+
+        self.assertTrue(fake_guest.wait_for_guest.called)
+
+    @patch.object(vmware, 'guest')
+    @patch.object(vmware.virtual_machine, 'set_meta')
     @patch.object(vmware, 'Ova')
     @patch.object(vmware.virtual_machine, 'get_info')
     @patch.object(vmware.virtual_machine, 'deploy_from_ova')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_create_winserver_invalid_network(self, fake_vCenter, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_Ova):
+    @patch.object(vmware, 'wait_for_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_winserver_dhcp_no_wait(self, fake_vCenter, fake_wait_for_task,
+            fake_deploy_from_ova, fake_get_info, fake_Ova, fake_set_meta, fake_guest):
+        """``create_winserver`` does not wait on the guest reboot when using DHCP"""
+        fake_logger = MagicMock()
+        fake_deploy_from_ova.return_value.name = 'WinServerBox'
+        fake_Ova.return_value.networks = ['someLAN']
+        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+
+        vmware.create_winserver(username='alice',
+                                machine_name='WinServerBox',
+                                image='1.0.0',
+                                network='someLAN',
+                                ip_config=self.ip_config,
+                                logger=fake_logger)
+
+        self.assertFalse(fake_guest.wait_for_guest.called)
+
+    @patch.object(vmware, 'Ova')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware, 'wait_for_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_winserver_invalid_network(self, fake_vCenter, fake_wait_for_task, fake_deploy_from_ova, fake_get_info, fake_Ova):
         """``create_winserver`` raises ValueError if supplied with a non-existing network"""
         fake_logger = MagicMock()
         fake_get_info.return_value = {'worked': True}
@@ -158,12 +273,46 @@ class TestVMware(unittest.TestCase):
                                   ip_config=self.ip_config,
                                   logger=fake_logger)
 
+    @patch.object(vmware, 'Ova')
+    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware, 'vcenter_session')
+    def test_deploy_winserver_not_in_catalog(self, fake_vCenter, fake_deploy_from_ova, fake_Ova):
+        """``deploy_winserver`` rejects an unknown version without opening an OVA"""
+        self.fake_catalog.get.return_value = None
+
+        with self.assertRaises(ValueError):
+            vmware.deploy_winserver(username='alice',
+                                    machine_name='WinServerBox',
+                                    image='1.0.0',
+                                    network='someLAN',
+                                    logger=MagicMock())
+
+        self.assertFalse(fake_Ova.called)
+
+    @patch.object(vmware, 'guest')
+    @patch.object(vmware, 'Ova')
+    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware, 'vcenter_session')
+    def test_deploy_winserver_catalog_networks(self, fake_vCenter, fake_deploy_from_ova, fake_Ova, fake_guest):
+        """``deploy_winserver`` maps the OVA network from the catalog, not by parsing the OVA"""
+        self.entry['networks'] = ['OVA Network']
+        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+
+        vmware.deploy_winserver(username='alice',
+                                machine_name='WinServerBox',
+                                image='1.0.0',
+                                network='someLAN',
+                                logger=MagicMock())
+        network_map = fake_deploy_from_ova.call_args[0][2][0]
+
+        self.assertEqual(network_map.name, 'OVA Network')
+
     @patch.object(vmware, 'Ova')
     @patch.object(vmware.virtual_machine, 'get_info')
     @patch.object(vmware.virtual_machine, 'deploy_from_ova')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_create_winserver_bad_image(self, fake_vCenter, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_Ova):
+    @patch.object(vmware, 'wait_for_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_winserver_bad_image(self, fake_vCenter, fake_wait_for_task, fake_deploy_from_ova, fake_get_info, fake_Ova):
         """``create_winserver`` raises ValueError if supplied with a non-existing version/image to deploy"""
         fake_logger = MagicMock()
         fake_get_info.return_value = {'worked': True}
@@ -178,10 +327,354 @@ class TestVMware(unittest.TestCase):
                                   ip_config=self.ip_config,
                                   logger=fake_logger)
 
-    @patch.object(vmware.os, 'listdir')
-    def test_list_images(self, fake_listdir):
+    @patch.object(vmware, 'guest')
+    @patch.object(vmware, 'Ova')
+    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware, 'vcenter_session')
+    def test_deploy_winserver(self, fake_vCenter, fake_deploy_from_ova, fake_Ova, fake_guest):
+        """``deploy_winserver`` returns the moid and boot time of the new VM"""
+        fake_deploy_from_ova.return_value = vmware.vim.VirtualMachine('vm-1')
+        fake_guest.boot_time.return_value = 'someTime'
+        fake_Ova.return_value.networks = ['someLAN']
+        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+
+        output = vmware.deploy_winserver(username='alice',
+                                         machine_name='WinServerBox',
+                                         image='1.0.0',
+                                         network='someLAN',
+                                         logger=MagicMock())
+        expected = {'moid': 'vm-1', 'boot-time': 'someTime'}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(vmware, 'Ova')
+    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware, 'vcenter_session')
+    def test_deploy_winserver_name_taken(self, fake_vCenter, fake_deploy_from_ova, fake_Ova):
+        """``deploy_winserver`` raises ValueError before uploading the OVA if the name is taken"""
+        self.fake_name_taken.return_value = True
+
+        with self.assertRaises(ValueError):
+            vmware.deploy_winserver(username='alice',
+                                    machine_name='WinServerBox',
+                                    image='1.0.0',
+                                    network='someLAN',
+                                    logger=MagicMock())
+
+        self.assertFalse(fake_Ova.called)
+        self.assertFalse(fake_deploy_from_ova.called)
+
+    @patch.object(vmware, 'guest')
+    @patch.object(vmware, 'vcenter_session')
+    def test_guest_ready(self, fake_vCenter, fake_guest):
+        """``guest_ready`` checks the guest once, without blocking"""
+        fake_guest.GuestReadiness.return_value.check.return_value = False
+
+        output = vmware.guest_ready('vm-1', 'someTime')
+
+        self.assertFalse(output)
+        self.assertFalse(fake_guest.wait_for_guest.called)
+
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, 'vcenter_session')
+    def test_finalize_winserver(self, fake_vCenter, fake_set_meta, fake_get_info):
+        """``finalize_winserver`` sets the meta data, and returns info about the VM"""
+        fake_get_info.return_value = {'worked': True}
+
+        output = vmware.finalize_winserver('alice', 'vm-1', '1.0.0', set_meta=True)
+
+        self.assertTrue(fake_set_meta.called)
+        self.assertEqual(list(output.values()), [{'worked': True}])
+
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, 'vcenter_session')
+    def test_finalize_winserver_meta_set(self, fake_vCenter, fake_set_meta, fake_get_info):
+        """``finalize_winserver`` does not set the meta data twice"""
+        vmware.finalize_winserver('alice', 'vm-1', '1.0.0', set_meta=False)
+
+        self.assertFalse(fake_set_meta.called)
+
+    @patch.object(vmware.guest, 'boot_time')
+    @patch.object(vmware, 'templates')
+    @patch.object(vmware, 'Ova')
+    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware, 'vcenter_session')
+    def test_deploy_winserver_linked_clone(self, fake_vCenter, fake_deploy_from_ova, fake_Ova, fake_templates, fake_boot_time):
+        """``deploy_winserver`` makes a linked clone instead of uploading the OVA, when enabled"""
+        fake_templates.enabled.return_value = True
+        fake_templates.deploy.return_value = vmware.vim.VirtualMachine('vm-1')
+
+        vmware.deploy_winserver(username='alice',
+                                machine_name='WinServerBox',
+                                image='1.0.0',
+                                network='someLAN',
+                                logger=MagicMock())
+
+        self.assertTrue(fake_templates.deploy.called)
+        self.assertFalse(fake_Ova.called)
+        self.assertFalse(fake_deploy_from_ova.called)
+
+    @patch.object(vmware.guest, 'boot_time')
+    @patch.object(vmware, 'templates')
+    @patch.object(vmware, 'Ova')
+    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware, 'vcenter_session')
+    def test_deploy_winserver_template_importing(self, fake_vCenter, fake_deploy_from_ova, fake_Ova, fake_templates, fake_boot_time):
+        """``deploy_winserver`` uploads the OVA while another deploy imports the template"""
+        fake_templates.enabled.return_value = True
+        fake_templates.deploy.return_value = None
+        fake_deploy_from_ova.return_value = vmware.vim.VirtualMachine('vm-1')
+        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+
+        vmware.deploy_winserver(username='alice',
+                                machine_name='WinServerBox',
+                                image='1.0.0',
+                                network='someLAN',
+                                logger=MagicMock())
+
+        self.assertTrue(fake_deploy_from_ova.called)
+
+    @patch.object(vmware, 'templates')
+    @patch.object(vmware, 'vcenter_session')
+    def test_list_templates(self, fake_vCenter, fake_templates):
+        """``list_templates`` returns the versions with a ready template"""
+        fake_templates.ready_templates.return_value = ['2016']
+
+        output = vmware.list_templates()
+
+        self.assertEqual(output, ['2016'])
+
+    @patch.object(vmware, 'templates')
+    @patch.object(vmware, 'vcenter_session')
+    def test_list_templates_disabled(self, fake_vCenter, fake_templates):
+        """``list_templates`` does not talk to vCenter unless linked clones are enabled"""
+        fake_templates.enabled.return_value = False
+
+        output = vmware.list_templates()
+
+        self.assertEqual(output, [])
+        self.assertFalse(fake_vCenter.called)
+
+    @patch.object(vmware, 'warm_pool')
+    @patch.object(vmware, 'vcenter_session')
+    def test_claim_winserver_disabled(self, fake_vCenter, fake_warm_pool):
+        """``claim_winserver`` does not talk to vCenter if the image has no warm pool"""
+        fake_warm_pool.enabled.return_value = False
+
+        output = vmware.claim_winserver('alice', 'WinServerBox', '1.0.0', 'someLAN', MagicMock())
+
+        self.assertTrue(output is None)
+        self.assertFalse(fake_vCenter.called)
+
+    @patch.object(vmware, 'guest')
+    @patch.object(vmware, 'warm_pool')
+    @patch.object(vmware, 'vcenter_session')
+    def test_claim_winserver(self, fake_vCenter, fake_warm_pool, fake_guest):
+        """``claim_winserver`` returns the same info as ``deploy_winserver``"""
+        fake_warm_pool.claim.return_value = vmware.vim.VirtualMachine('vm-1')
+        fake_guest.boot_time.return_value = 'someTime'
+        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+
+        output = vmware.claim_winserver('alice', 'WinServerBox', '1.0.0', 'someLAN', MagicMock())
+        expected = {'moid': 'vm-1', 'boot-time': 'someTime'}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(vmware, 'warm_pool')
+    @patch.object(vmware, 'vcenter_session')
+    def test_claim_winserver_name_taken(self, fake_vCenter, fake_warm_pool):
+        """``claim_winserver`` does not take a VM from the pool if the name is taken"""
+        self.fake_name_taken.return_value = True
+
+        with self.assertRaises(ValueError):
+            vmware.claim_winserver('alice', 'WinServerBox', '1.0.0', 'someLAN', MagicMock())
+
+        self.assertFalse(fake_warm_pool.claim.called)
+
+    @patch.object(vmware, 'warm_pool')
+    @patch.object(vmware, 'vcenter_session')
+    def test_claim_winserver_bad_network(self, fake_vCenter, fake_warm_pool):
+        """``claim_winserver`` raises ValueError for a network that doesn't exist"""
+        fake_vCenter.return_value.__enter__.return_value.networks = {}
+
+        with self.assertRaises(ValueError):
+            vmware.claim_winserver('alice', 'WinServerBox', '1.0.0', 'someLAN', MagicMock())
+
+    @patch.object(vmware, 'TaskWaiter', new=FakeWaiter)
+    @patch.object(vmware.inventory, 'retrieve_vms')
+    @patch.object(vmware.inventory, 'user_folder')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_many(self, fake_vCenter, fake_user_folder, fake_retrieve_vms):
+        """``delete_many`` powers off and destroys the VMs in batches"""
+        box1, box2 = MagicMock(), MagicMock()
+        meta = '{"component": "WinServer"}'
+        fake_retrieve_vms.return_value = [{'name': 'box1', 'vm': box1, 'runtime.powerState': 'poweredOn', 'config.annotation': meta},
+                                          {'name': 'box2', 'vm': box2, 'runtime.powerState': 'poweredOff', 'config.annotation': meta}]
+        output = vmware.delete_many('alice', ['box1', 'box2'], MagicMock())
+
+        self.assertEqual(output, {'box1': {'deleted': True}, 'box2': {'deleted': True}})
+        self.assertEqual(FakeWaiter.batches, [['box1'], ['box1', 'box2']])
+        self.assertFalse(box2.PowerOffVM_Task.called)
+
+    @patch.object(vmware, 'TaskWaiter', new=FakeWaiter)
+    @patch.object(vmware.inventory, 'retrieve_vms')
+    @patch.object(vmware.inventory, 'user_folder')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_many_all(self, fake_vCenter, fake_user_folder, fake_retrieve_vms):
+        """``delete_many`` deletes only the WinServers when no names are supplied"""
+        fake_retrieve_vms.return_value = [{'name': 'box1', 'vm': MagicMock(), 'config.annotation': '{"component": "WinServer"}'},
+                                          {'name': 'gateway', 'vm': MagicMock(), 'config.annotation': '{"component": "defaultGateway"}'}]
+
+        output = vmware.delete_many('alice', None, MagicMock())
+
+        self.assertEqual(output, {'box1': {'deleted': True}})
+
+    @patch.object(vmware, 'TaskWaiter', new=FakeWaiter)
+    @patch.object(vmware.inventory, 'retrieve_vms')
+    @patch.object(vmware.inventory, 'user_folder')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_many_errors(self, fake_vCenter, fake_user_folder, fake_retrieve_vms):
+        """``delete_many`` reports the VMs it could not find or delete"""
+        box1 = MagicMock()
+        fake_retrieve_vms.return_value = [{'name': 'box1', 'vm': box1, 'runtime.powerState': 'poweredOn',
+                                           'config.annotation': '{"component": "WinServer"}'}]
+        FakeWaiter.faults = {'box1': vmware.vim.fault.TaskInProgress(msg='busy')}
+
+        output = vmware.delete_many('alice', ['box1', 'nope'], MagicMock())
+
+        self.assertEqual(output['box1'], {'error': 'busy'})
+        self.assertEqual(output['nope'], {'error': 'No WinServer named nope found'})
+        self.assertFalse(box1.Destroy_Task.called)
+
+    @patch.object(vmware, 'TaskWaiter', new=FakeWaiter)
+    @patch.object(vmware.networks, 'change_task')
+    @patch.object(vmware.inventory, 'retrieve_vms')
+    @patch.object(vmware.inventory, 'user_folder')
+    @patch.object(vmware, 'vcenter_session')
+    def test_update_networks(self, fake_vcenter_session, fake_user_folder, fake_retrieve_vms, fake_change_task):
+        """``update_networks`` starts every NIC change before waiting on them together"""
+        meta = '{"component": "WinServer"}'
+        fake_retrieve_vms.return_value = [{'name': 'box1', 'vm': MagicMock(), 'config.annotation': meta},
+                                          {'name': 'box2', 'vm': MagicMock(), 'config.annotation': meta}]
+        fake_vcenter = fake_vcenter_session.return_value.__enter__.return_value
+        fake_vcenter.networks = {'bob_lan2': MagicMock()}
+
+        output = vmware.update_networks('bob', {'box1': 'bob_lan2', 'box2': 'bob_lan2'}, MagicMock())
+
+        self.assertEqual(output, {'box1': {'network': 'bob_lan2'}, 'box2': {'network': 'bob_lan2'}})
+        self.assertEqual(FakeWaiter.batches, [['box1', 'box2']])
+        self.assertEqual(fake_change_task.call_count, 2)
+
+    @patch.object(vmware, 'TaskWaiter', new=FakeWaiter)
+    @patch.object(vmware.networks, 'change_task')
+    @patch.object(vmware.inventory, 'retrieve_vms')
+    @patch.object(vmware.inventory, 'user_folder')
+    @patch.object(vmware, 'vcenter_session')
+    def test_update_networks_errors(self, fake_vcenter_session, fake_user_folder, fake_retrieve_vms, fake_change_task):
+        """``update_networks`` reports the VMs it could not find or move"""
+        meta = '{"component": "WinServer"}'
+        fake_retrieve_vms.return_value = [{'name': 'box1', 'vm': MagicMock(), 'config.annotation': meta},
+                                          {'name': 'box2', 'vm': MagicMock(), 'config.annotation': meta}]
+        fake_vcenter = fake_vcenter_session.return_value.__enter__.return_value
+        fake_vcenter.networks = {'bob_lan2': MagicMock()}
+        FakeWaiter.faults = {'box1': vmware.vim.fault.TaskInProgress(msg='busy')}
+
+        output = vmware.update_networks('bob', {'box1': 'bob_lan2', 'box2': 'bob_nope', 'box3': 'bob_lan2'}, MagicMock())
+
+        self.assertEqual(output['box1'], {'error': 'busy'})
+        self.assertEqual(output['box2'], {'error': 'No network named bob_nope found'})
+        self.assertEqual(output['box3'], {'error': 'No WinServer named box3 found'})
+
+    @patch.object(vmware, 'TaskWaiter', new=FakeWaiter)
+    @patch.object(vmware.inventory, 'retrieve_properties')
+    def test_power_off(self, fake_retrieve_properties):
+        """``power_off`` ignores a VM that's already off"""
+        fake_retrieve_properties.return_value = {'runtime.powerState': 'poweredOn'}
+        FakeWaiter.faults = {'power-off': vmware.vim.fault.InvalidPowerState()}
+
+        vmware.power_off(MagicMock(), MagicMock())
+
+    @patch.object(vmware, 'TaskWaiter', new=FakeWaiter)
+    @patch.object(vmware.inventory, 'retrieve_properties')
+    def test_power_off_error(self, fake_retrieve_properties):
+        """``power_off`` raises RuntimeError if the VM would not power off"""
+        fake_retrieve_properties.return_value = {'runtime.powerState': 'poweredOn'}
+        FakeWaiter.faults = {'power-off': vmware.vim.fault.TaskInProgress(msg='busy')}
+
+        with self.assertRaises(RuntimeError):
+            vmware.power_off(MagicMock(), MagicMock())
+
+    @patch.object(vmware, 'TaskWaiter')
+    @patch.object(vmware.inventory, 'retrieve_properties')
+    def test_power_off_already(self, fake_retrieve_properties, fake_TaskWaiter):
+        """``power_off`` does nothing to a VM that's off"""
+        fake_retrieve_properties.return_value = {'runtime.powerState': 'poweredOff'}
+
+        vmware.power_off(MagicMock(), MagicMock())
+
+        self.assertFalse(fake_TaskWaiter.called)
+
+    def test_fan_out(self):
+        """``fan_out`` returns the result of every call"""
+        output = vmware.fan_out(lambda x: x * 2, [1, 2, 3])
+
+        self.assertEqual(output, {1: 2, 2: 4, 3: 6})
+
+    def test_fan_out_errors(self):
+        """``fan_out`` returns the exception of a call that failed"""
+        def func(x):
+            if x == 2:
+                raise ValueError('testing')
+            return x
+        output = vmware.fan_out(func, [1, 2])
+
+        self.assertTrue(isinstance(output[2], ValueError))
+        self.assertEqual(output[1], 1)
+
+    @patch.object(vmware, 'deploy_winserver')
+    @patch.object(vmware, 'claim_winserver')
+    def test_deploy_many(self, fake_claim_winserver, fake_deploy_winserver):
+        """``deploy_many`` records a VM that failed to deploy without failing the others"""
+        def deploy(username, machine_name, image, network, logger):
+            if machine_name == 'box2':
+                raise ValueError('testing')
+            return {'moid': machine_name}
+        fake_claim_winserver.return_value = None
+        fake_deploy_winserver.side_effect = deploy
+
+        output = vmware.deploy_many('alice', ['box1', 'box2'], '2016', 'someLAN', MagicMock())
+
+        self.assertEqual(output['box1'], {'moid': 'box1', 'warm': False})
+        self.assertTrue('error' in output['box2'])
+
+    @patch.object(vmware, 'templates')
+    @patch.object(vmware, 'fan_out')
+    def test_deploy_many_linked_clone(self, fake_fan_out, fake_templates):
+        """``deploy_many`` deploys one linked clone before the rest, so the template is only imported once"""
+        fake_templates.enabled.return_value = True
+        fake_fan_out.side_effect = lambda func, items: {x: {'moid': x} for x in items}
+
+        vmware.deploy_many('alice', ['box1', 'box2', 'box3'], '2016', 'someLAN', MagicMock())
+        batches = [x[0][1] for x in fake_fan_out.call_args_list]
+
+        self.assertEqual(batches, [['box1'], ['box2', 'box3']])
+
+    @patch.object(vmware, 'warm_pool')
+    @patch.object(vmware, 'vcenter_session')
+    def test_refill_pool(self, fake_vCenter, fake_warm_pool):
+        """``refill_pool`` deploys pool VMs the same way as user VMs"""
+        fake_warm_pool.pool_sizes.return_value = {'2016': 1}
+
+        vmware.refill_pool(MagicMock())
+        deploy = fake_warm_pool.refill.call_args[0][1]
+
+        self.assertTrue(deploy is vmware._deploy)
+
+    def test_list_images(self):
         """``list_images`` - Returns a list of available WinServer versions that can be deployed"""
-        fake_listdir.return_value = ['WinServer-2016.ova', 'WinServer-2012R2.ova']
+        self.fake_catalog.images.return_value = ['2016', '2012R2']
 
         output = vmware.list_images()
         expected = ['2016', '2012R2']
@@ -204,20 +697,13 @@ class TestVMware(unittest.TestCase):
         self.assertEqual(output, expected)
 
 
-    @patch.object(vmware.virtual_machine, 'change_network')
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_update_network(self, fake_vCenter, fake_consume_task, fake_get_info, fake_change_network):
+    @patch.object(vmware.networks, 'change_task')
+    @patch.object(vmware.inventory, 'find_vm')
+    @patch.object(vmware, 'wait_for_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_update_network(self, fake_vCenter, fake_wait_for_task, fake_find_vm, fake_change_network):
         """``update_network`` Returns None upon success"""
-        fake_logger = MagicMock()
-        fake_vm = MagicMock()
-        fake_vm.name = 'myWinSer'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
         fake_vCenter.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
-        fake_get_info.return_value = {'meta': {'component' : 'WinServer'}}
 
         result = vmware.update_network(username='pat',
                                        machine_name='myWinSer',
@@ -225,40 +711,27 @@ class TestVMware(unittest.TestCase):
 
         self.assertTrue(result is None)
 
-    @patch.object(vmware.virtual_machine, 'change_network')
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_update_network_no_vm(self, fake_vCenter, fake_consume_task, fake_get_info, fake_change_network):
+    @patch.object(vmware.networks, 'change_task')
+    @patch.object(vmware.inventory, 'find_vm')
+    @patch.object(vmware, 'wait_for_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_update_network_no_vm(self, fake_vCenter, fake_wait_for_task, fake_find_vm, fake_change_network):
         """``update_network`` Raises ValueError if the supplied VM doesn't exist"""
-        fake_logger = MagicMock()
-        fake_vm = MagicMock()
-        fake_vm.name = 'myWinSer'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
         fake_vCenter.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
-        fake_get_info.return_value = {'meta': {'component' : 'WinServer'}}
+        fake_find_vm.side_effect = ValueError('testing')
 
         with self.assertRaises(ValueError):
             vmware.update_network(username='pat',
                                   machine_name='SomeOtherMachine',
                                   new_network='wootTown')
 
-    @patch.object(vmware.virtual_machine, 'change_network')
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_update_network_no_network(self, fake_vCenter, fake_consume_task, fake_get_info, fake_change_network):
+    @patch.object(vmware.networks, 'change_task')
+    @patch.object(vmware.inventory, 'find_vm')
+    @patch.object(vmware, 'wait_for_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_update_network_no_network(self, fake_vCenter, fake_wait_for_task, fake_find_vm, fake_change_network):
         """``update_network`` Raises ValueError if the supplied new network doesn't exist"""
-        fake_logger = MagicMock()
-        fake_vm = MagicMock()
-        fake_vm.name = 'myWinSer'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
         fake_vCenter.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
-        fake_get_info.return_value = {'meta': {'component' : 'WinServer'}}
 
         with self.assertRaises(ValueError):
             vmware.update_network(username='pat',
@@ -0,0 +1,274 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in warm_pool.py
+"""
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+
+import ujson
+
+from vlab_winserver_api.lib import dedupe
+from vlab_winserver_api.lib.store import MemoryStore
+from vlab_winserver_api.lib.worker import warm_pool
+
+
+def _pool_vm(name, ready, **extra):
+    """Make the props ``pool_vms`` would return"""
+    meta = {'component': warm_pool.COMPONENT, 'version': '2016',
+            'created': time.time(), 'boot-time': 'first-boot', 'ready': ready}
+    meta.update(extra)
+    return {'name': name,
+            'vm': MagicMock(),
+            'config.changeVersion': '2020-01-01T00:00:00.000Z',
+            'config.annotation': ujson.dumps(meta)}
+
+
+class TestWarmPool(unittest.TestCase):
+    """A set of test cases for warm_pool.py"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.vcenter = MagicMock()
+        self.fake_const = MagicMock()
+        self.fake_const.VLAB_WINSERVER_WARM_POOL = '2016:2, 2012R2'
+        self.fake_const.VLAB_WINSERVER_GUEST_TIMEOUT = 1200
+        self.fake_const.VLAB_WINSERVER_POOL_REFILL_TTL = 1800
+        self.fake_const.VLAB_WINSERVER_POOL_CLAIM_TIMEOUT = 600
+        self.retrieve_vms = MagicMock()
+        self.deduplicator = dedupe.Deduplicator(MemoryStore(max_size=100, ttl=60), ttl=60)
+        for patcher in [patch.object(warm_pool, 'const', self.fake_const),
+                        patch.object(warm_pool.dedupe, 'get_deduplicator', return_value=self.deduplicator),
+                        patch.object(warm_pool.inventory, 'retrieve_vms', self.retrieve_vms),
+                        patch.object(warm_pool.inventory, 'user_folder'),
+                        patch.object(warm_pool.networks, 'change_task'),
+                        patch.object(warm_pool, 'TaskWaiter'),
+                        patch.object(warm_pool, 'wait_for_task'),
+                        patch.object(warm_pool, 'REGISTRY')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_pool_sizes(self):
+        """``pool_sizes`` parses the size of the pool per image version"""
+        output = warm_pool.pool_sizes()
+        expected = {'2016': 2, '2012R2': 1}
+
+        self.assertEqual(output, expected)
+
+    def test_pool_sizes_empty(self):
+        """``pool_sizes`` returns an empty dict when there's no pool"""
+        self.fake_const.VLAB_WINSERVER_WARM_POOL = ''
+
+        self.assertEqual(warm_pool.pool_sizes(), {})
+
+    def test_check_settings(self):
+        """``check_settings`` accepts a pool whose refill lock every worker shares"""
+        self.fake_const.VLAB_WINSERVER_CACHE_URL = 'sqlite:////var/cache/vlab/winserver.db'
+
+        warm_pool.check_settings()
+
+    def test_check_settings_memory(self):
+        """``check_settings`` refuses a pool whose refill lock is per-process"""
+        self.fake_const.VLAB_WINSERVER_CACHE_URL = 'memory://'
+
+        with self.assertRaises(RuntimeError):
+            warm_pool.check_settings()
+
+    def test_check_settings_no_pool(self):
+        """``check_settings`` doesn't care about the store when there's no pool"""
+        self.fake_const.VLAB_WINSERVER_WARM_POOL = ''
+        self.fake_const.VLAB_WINSERVER_CACHE_URL = 'memory://'
+
+        warm_pool.check_settings()
+
+    def test_enabled(self):
+        """``enabled`` is only True for image versions with a pool"""
+        self.assertTrue(warm_pool.enabled('2016'))
+        self.assertFalse(warm_pool.enabled('2019'))
+
+    def test_pool_vms(self):
+        """``pool_vms`` only returns the VMs of the requested image version"""
+        self.retrieve_vms.return_value = [_pool_vm('WinServer-2016-pool-aaa', True),
+                                          _pool_vm('WinServer-2012R2-pool-bbb', True)]
+
+        output = warm_pool.pool_vms(self.vcenter, '2016')
+
+        self.assertEqual([x['name'] for x in output], ['WinServer-2016-pool-aaa'])
+
+    def test_pool_vms_renamed(self):
+        """``pool_vms`` finds a claimed VM that was renamed, but never moved to the user's folder"""
+        self.retrieve_vms.return_value = [_pool_vm('myWinServer', False, claimed='bob')]
+
+        output = warm_pool.pool_vms(self.vcenter, '2016')
+
+        self.assertEqual([x['name'] for x in output], ['myWinServer'])
+
+    def test_status(self):
+        """``status`` counts the ready and warming VMs of every image"""
+        self.retrieve_vms.return_value = [_pool_vm('WinServer-2016-pool-aaa', True),
+                                          _pool_vm('WinServer-2016-pool-bbb', False)]
+
+        output = warm_pool.status(self.vcenter)
+
+        self.assertEqual(output['2016'], {'size': 2, 'ready': 1, 'warming': 1})
+        self.assertEqual(output['2012R2'], {'size': 1, 'ready': 0, 'warming': 0})
+
+    def test_claim(self):
+        """``claim`` moves a ready VM into the user's folder, with the requested name"""
+        pool_vm = _pool_vm('WinServer-2016-pool-aaa', True)
+        self.retrieve_vms.return_value = [pool_vm]
+
+        output = warm_pool.claim(self.vcenter, 'bob', 'myWinServer', '2016', MagicMock(), MagicMock())
+
+        self.assertTrue(output is pool_vm['vm'])
+        pool_vm['vm'].Rename_Task.assert_called_with(newName='myWinServer')
+        self.assertTrue(warm_pool.inventory.user_folder.return_value.MoveIntoFolder_Task.called)
+        self.assertTrue(warm_pool.networks.change_task.called)
+
+    def test_claim_compare_and_swap(self):
+        """``claim`` only takes a VM if nobody changed it since it was read"""
+        pool_vm = _pool_vm('WinServer-2016-pool-aaa', True)
+        self.retrieve_vms.return_value = [pool_vm]
+
+        warm_pool.claim(self.vcenter, 'bob', 'myWinServer', '2016', MagicMock(), MagicMock())
+        spec = pool_vm['vm'].ReconfigVM_Task.call_args[0][0]
+
+        self.assertEqual(spec.changeVersion, '2020-01-01T00:00:00.000Z')
+        self.assertEqual(ujson.loads(spec.annotation)['claimed'], 'bob')
+
+    def test_claim_lost_race(self):
+        """``claim`` tries the next VM if another worker claimed the first one"""
+        first = _pool_vm('WinServer-2016-pool-aaa', True)
+        second = _pool_vm('WinServer-2016-pool-bbb', True)
+        self.retrieve_vms.return_value = [first, second]
+        warm_pool.wait_for_task.side_effect = [RuntimeError('ConcurrentAccess'), None, None, None, None]
+
+        output = warm_pool.claim(self.vcenter, 'bob', 'myWinServer', '2016', MagicMock(), MagicMock())
+
+        self.assertTrue(output is second['vm'])
+
+    def test_claim_skips_warming(self):
+        """``claim`` never hands out a VM that's still running unattend.xml"""
+        self.retrieve_vms.return_value = [_pool_vm('WinServer-2016-pool-aaa', False)]
+
+        output = warm_pool.claim(self.vcenter, 'bob', 'myWinServer', '2016', MagicMock(), MagicMock())
+
+        self.assertTrue(output is None)
+        warm_pool.REGISTRY.inc.assert_called_with('winserver_pool_claims_total', result='miss', image='2016')
+
+    def test_claim_handover_fails(self):
+        """``claim`` destroys a claimed VM it cannot hand over"""
+        pool_vm = _pool_vm('WinServer-2016-pool-aaa', True)
+        self.retrieve_vms.return_value = [pool_vm]
+        warm_pool.wait_for_task.side_effect = [None, RuntimeError('DuplicateName'), None]
+
+        output = warm_pool.claim(self.vcenter, 'bob', 'myWinServer', '2016', MagicMock(), MagicMock())
+
+        self.assertTrue(output is None)
+        self.assertTrue(pool_vm['vm'].Destroy_Task.called)
+
+    @patch.object(warm_pool.virtual_machine, 'set_meta')
+    @patch.object(warm_pool.guest, 'boot_time')
+    def test_refill(self, fake_boot_time, fake_set_meta):
+        """``refill`` deploys one VM per refill, until the pool is full"""
+        self.fake_const.VLAB_WINSERVER_WARM_POOL = '2016:3'
+        self.retrieve_vms.return_value = [_pool_vm('WinServer-2016-pool-aaa', True)]
+        fake_deploy = MagicMock()
+
+        warm_pool.refill(self.vcenter, fake_deploy, MagicMock())
+        meta = fake_set_meta.call_args[0][1]
+
+        self.assertEqual(fake_deploy.call_count, 1)
+        self.assertEqual(meta['component'], warm_pool.COMPONENT)
+        self.assertFalse(meta['ready'])
+
+    @patch.object(warm_pool.virtual_machine, 'set_meta')
+    @patch.object(warm_pool.guest, 'GuestReadiness')
+    def test_refill_promotes(self, fake_GuestReadiness, fake_set_meta):
+        """``refill`` marks a pool VM ready once the guest has rebooted"""
+        self.fake_const.VLAB_WINSERVER_WARM_POOL = '2016:1'
+        self.retrieve_vms.return_value = [_pool_vm('WinServer-2016-pool-aaa', False)]
+        fake_GuestReadiness.return_value.check.return_value = True
+
+        warm_pool.refill(self.vcenter, MagicMock(), MagicMock())
+
+        self.assertTrue(fake_set_meta.call_args[0][1]['ready'])
+        self.assertTrue(warm_pool.REGISTRY.observe.called)
+
+    @patch.object(warm_pool.virtual_machine, 'set_meta')
+    @patch.object(warm_pool.guest, 'boot_time')
+    @patch.object(warm_pool.guest, 'GuestReadiness')
+    def test_refill_destroys_stuck(self, fake_GuestReadiness, fake_boot_time, fake_set_meta):
+        """``refill`` destroys pool VMs that never became ready, and replaces them"""
+        self.fake_const.VLAB_WINSERVER_WARM_POOL = '2016:1'
+        stuck = _pool_vm('WinServer-2016-pool-aaa', False, created=0)
+        self.retrieve_vms.return_value = [stuck]
+        fake_GuestReadiness.return_value.check.return_value = False
+        fake_deploy = MagicMock()
+
+        warm_pool.refill(self.vcenter, fake_deploy, MagicMock())
+
+        self.assertTrue(stuck['vm'].Destroy_Task.called)
+        self.assertTrue(fake_deploy.called)
+
+    @patch.object(warm_pool.guest, 'GuestReadiness')
+    def test_refill_skips_claimed(self, fake_GuestReadiness):
+        """``refill`` leaves a VM alone once it's been claimed"""
+        self.fake_const.VLAB_WINSERVER_WARM_POOL = '2016:1'
+        self.retrieve_vms.return_value = [_pool_vm('WinServer-2016-pool-aaa', False, claimed='bob')]
+
+        warm_pool.refill(self.vcenter, MagicMock(), MagicMock())
+
+        self.assertFalse(fake_GuestReadiness.called)
+
+    @patch.object(warm_pool.guest, 'GuestReadiness')
+    def test_refill_destroys_abandoned_claim(self, fake_GuestReadiness):
+        """``refill`` destroys a claimed VM that was never handed over, and replaces it"""
+        self.fake_const.VLAB_WINSERVER_WARM_POOL = '2016:1'
+        abandoned = _pool_vm('WinServer-2016-pool-aaa', False, claimed='bob', **{'claimed-at': time.time() - 601})
+        self.retrieve_vms.return_value = [abandoned]
+        fake_deploy = MagicMock()
+
+        with patch.object(warm_pool.virtual_machine, 'set_meta'), patch.object(warm_pool.guest, 'boot_time'):
+            warm_pool.refill(self.vcenter, fake_deploy, MagicMock())
+
+        self.assertTrue(abandoned['vm'].Destroy_Task.called)
+        self.assertTrue(fake_deploy.called)
+
+    @patch.object(warm_pool.guest, 'GuestReadiness')
+    def test_refill_keeps_recent_claim(self, fake_GuestReadiness):
+        """``refill`` leaves a claimed VM alone while it's being handed over"""
+        self.fake_const.VLAB_WINSERVER_WARM_POOL = '2016:1'
+        claimed = _pool_vm('WinServer-2016-pool-aaa', False, claimed='bob', **{'claimed-at': time.time()})
+        self.retrieve_vms.return_value = [claimed]
+        fake_deploy = MagicMock()
+
+        warm_pool.refill(self.vcenter, fake_deploy, MagicMock())
+
+        self.assertFalse(claimed['vm'].Destroy_Task.called)
+        self.assertFalse(fake_deploy.called)
+
+    def test_refill_single_flight(self):
+        """``refill`` does nothing while another refill is running"""
+        self.deduplicator.claim('refill', self.fake_const.VLAB_WINSERVER_POOL_DIR, 'pool', 'other-refill')
+        fake_deploy = MagicMock()
+
+        warm_pool.refill(self.vcenter, fake_deploy, MagicMock())
+
+        self.assertFalse(self.retrieve_vms.called)
+        self.assertFalse(fake_deploy.called)
+
+    @patch.object(warm_pool.virtual_machine, 'set_meta')
+    @patch.object(warm_pool.guest, 'boot_time')
+    def test_refill_releases(self, fake_boot_time, fake_set_meta):
+        """``refill`` lets the next refill run once it's done"""
+        self.fake_const.VLAB_WINSERVER_WARM_POOL = '2016:1'
+        self.retrieve_vms.return_value = []
+
+        warm_pool.refill(self.vcenter, MagicMock(), MagicMock())
+
+        self.assertTrue(self.deduplicator.claim('refill', self.fake_const.VLAB_WINSERVER_POOL_DIR, 'pool', 'next') is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,15 +2,19 @@
 """
 A suite of tests for the winserver object
 """
+import threading
 import unittest
 from unittest.mock import patch, MagicMock
 
 import ujson
 from flask import Flask
+from kombu.exceptions import OperationalError
 from vlab_api_common import flask_common
 from vlab_api_common.http_auth import generate_v2_test_token
 
 
+from vlab_winserver_api.lib import dedupe
+from vlab_winserver_api.lib.store import MemoryStore
 from vlab_winserver_api.lib.views import winserver
 
 
@@ -33,6 +37,26 @@ class TestWinServerView(unittest.TestCase):
         cls.fake_task = MagicMock()
         cls.fake_task.id = 'asdf-asdf-asdf'
         app.celery_app.send_task.return_value = cls.fake_task
+        cls.fake_result = MagicMock()
+        app.celery_app.AsyncResult.return_value = cls.fake_result
+        # By default, the API cannot read the images dir
+        cls.catalog_patcher = patch.object(winserver.catalog, 'get_catalog')
+        cls.fake_catalog = cls.catalog_patcher.start().return_value
+        cls.fake_catalog.images.side_effect = FileNotFoundError('/images')
+        # By default, the inventory cache is empty
+        cls.cache_patcher = patch.object(winserver, 'get_cache')
+        cls.fake_cache = cls.cache_patcher.start().return_value
+        cls.fake_cache.get.return_value = None
+        # Every test starts without any requests in flight
+        cls.deduplicator = dedupe.Deduplicator(MemoryStore(max_size=100, ttl=60), ttl=60)
+        cls.dedupe_patcher = patch.object(winserver.dedupe, 'get_deduplicator', return_value=cls.deduplicator)
+        cls.dedupe_patcher.start()
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.catalog_patcher.stop()
+        self.cache_patcher.stop()
+        self.dedupe_patcher.stop()
 
     def test_v1_deprecated(self):
         """WinServerView - GET on /api/1/inf/winserver returns an HTTP 404"""
@@ -64,6 +88,24 @@ class TestWinServerView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    def test_get_cached(self):
+        """WinServerView - GET on /api/2/inf/winserver answers from the cache without a task"""
+        self.fake_cache.get.return_value = {'myBox': {'state': 'poweredOn'}}
+        resp = self.app.get('/api/2/inf/winserver',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], {'myBox': {'state': 'poweredOn'}})
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
+    def test_get_cached_async(self):
+        """WinServerView - GET on /api/2/inf/winserver?async=true ignores the cache"""
+        self.fake_cache.get.return_value = {'myBox': {'state': 'poweredOn'}}
+        resp = self.app.get('/api/2/inf/winserver?async=true',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+
     def test_post_task(self):
         """WinServerView - POST on /api/2/inf/winserver returns a task-id"""
         resp = self.app.post('/api/2/inf/winserver',
@@ -111,6 +153,17 @@ class TestWinServerView(unittest.TestCase):
 
         self.assertEqual(status, expected)
 
+    def test_post_bad_name(self):
+        """WinServerView - POST on /api/2/inf/winserver rejects names deploy_from_ova would"""
+        resp = self.app.post('/api/2/inf/winserver',
+                             headers={'X-Auth': self.token},
+                             json={'network': "someLAN",
+                                   'name': "my_box!",
+                                   'image': "someVersion"})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertTrue('Invalid machine name' in resp.json['error'])
+
     def test_post_task_link(self):
         """WinServerView - POST on /api/2/inf/winserver sets the Link header"""
         resp = self.app.post('/api/2/inf/winserver',
@@ -124,6 +177,187 @@ class TestWinServerView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    def test_post_task_id(self):
+        """WinServerView - POST on /api/2/inf/winserver queues the task under the id it was admitted with"""
+        with patch.object(winserver.admission, 'get_admission') as fake_get_admission:
+            fake_get_admission.return_value.admit.return_value = ''
+            self.app.post('/api/2/inf/winserver',
+                          headers={'X-Auth': self.token},
+                          json={'network': "someLAN",
+                                'name': "myWinServerBox",
+                                'image': "someVersion"})
+
+        admitted = fake_get_admission.return_value.admit.call_args[0][0]
+        sent = self.app.application.celery_app.send_task.call_args[1]['task_id']
+
+        self.assertEqual(admitted, sent)
+
+    def test_post_too_busy(self):
+        """WinServerView - POST on /api/2/inf/winserver returns HTTP 429 when a deploy limit is hit"""
+        with patch.object(winserver.admission, 'get_admission') as fake_get_admission:
+            fake_get_admission.return_value.admit.return_value = 'You have 3 WinServers deploying; the limit is 3'
+            fake_get_admission.return_value.retry_after = 30
+            resp = self.app.post('/api/2/inf/winserver',
+                                 headers={'X-Auth': self.token},
+                                 json={'network': "someLAN",
+                                       'name': "myWinServerBox",
+                                       'image': "someVersion"})
+
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], '30')
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
+    def test_post_retry(self):
+        """WinServerView - POST on /api/2/inf/winserver with a reused Idempotency-Key returns the first task-id"""
+        for _ in range(2):
+            resp = self.app.post('/api/2/inf/winserver',
+                                 headers={'X-Auth': self.token, 'Idempotency-Key': 'abc'},
+                                 json={'network': "someLAN",
+                                       'name': "myWinServerBox",
+                                       'image': "someVersion"})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['content']['task-id'], 'asdf-asdf-asdf')
+        self.assertEqual(self.app.application.celery_app.send_task.call_count, 1)
+
+    def test_post_retry_request_id(self):
+        """WinServerView - POST on /api/2/inf/winserver treats a reused X-REQUEST-ID as a retry"""
+        self.deduplicator.remember('bob', 'txn-1', winserver.dedupe.fingerprint('POST', '/api/2/inf/winserver',
+                                                                                {'network': "someLAN",
+                                                                                 'name': "myWinServerBox",
+                                                                                 'image': "someVersion"}),
+                                   'first-task')
+        resp = self.app.post('/api/2/inf/winserver',
+                             headers={'X-Auth': self.token, 'X-REQUEST-ID': 'txn-1'},
+                             json={'network': "someLAN",
+                                   'name': "myWinServerBox",
+                                   'image': "someVersion"})
+
+        self.assertEqual(resp.json['content']['task-id'], 'first-task')
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
+    def test_post_key_different_body(self):
+        """WinServerView - POST on /api/2/inf/winserver does not replay a reused key with a different body"""
+        for name in ('box1', 'box2'):
+            self.app.post('/api/2/inf/winserver',
+                          headers={'X-Auth': self.token, 'Idempotency-Key': 'abc'},
+                          json={'network': "someLAN", 'name': name, 'image': "someVersion"})
+
+        self.assertEqual(self.app.application.celery_app.send_task.call_count, 2)
+
+    def test_post_in_flight(self):
+        """WinServerView - POST on /api/2/inf/winserver returns the task-id of a create of the same VM in flight"""
+        self.deduplicator.claim('create', 'bob', 'myWinServerBox', 'first-task')
+        resp = self.app.post('/api/2/inf/winserver',
+                             headers={'X-Auth': self.token},
+                             json={'network': "someLAN",
+                                   'name': "myWinServerBox",
+                                   'image': "someVersion"})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['content']['task-id'], 'first-task')
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
+    def test_post_in_flight_done(self):
+        """WinServerView - POST on /api/2/inf/winserver ignores a claim whose task already finished"""
+        self.deduplicator.claim('create', 'bob', 'myWinServerBox', 'first-task')
+        self.fake_result.status = 'SUCCESS'
+        resp = self.app.post('/api/2/inf/winserver',
+                             headers={'X-Auth': self.token},
+                             json={'network': "someLAN",
+                                   'name': "myWinServerBox",
+                                   'image': "someVersion"})
+
+        self.assertEqual(resp.json['content']['task-id'], 'asdf-asdf-asdf')
+
+    def test_post_too_busy_unclaims(self):
+        """WinServerView - POST on /api/2/inf/winserver does not hold the VM name when a deploy limit is hit"""
+        with patch.object(winserver.admission, 'get_admission') as fake_get_admission:
+            fake_get_admission.return_value.admit.return_value = 'testing'
+            fake_get_admission.return_value.retry_after = 30
+            self.app.post('/api/2/inf/winserver',
+                          headers={'X-Auth': self.token},
+                          json={'network': "someLAN", 'name': "myWinServerBox", 'image': "someVersion"})
+
+        self.assertTrue(self.deduplicator.claim('create', 'bob', 'myWinServerBox', 'task-2') is None)
+
+    def test_post_not_sent(self):
+        """WinServerView - POST on /api/2/inf/winserver returns HTTP 503, and holds nothing, when the task cannot be sent"""
+        self.app.application.celery_app.send_task.side_effect = OperationalError('testing')
+        with patch.object(winserver.admission, 'get_admission') as fake_get_admission:
+            fake_get_admission.return_value.admit.return_value = ''
+            resp = self.app.post('/api/2/inf/winserver',
+                                 headers={'X-Auth': self.token, 'Idempotency-Key': 'abc'},
+                                 json={'network': "someLAN", 'name': "myWinServerBox", 'image': "someVersion"})
+
+        sent = self.app.application.celery_app.send_task.call_args[1]['task_id']
+
+        self.assertEqual(resp.status_code, 503)
+        fake_get_admission.return_value.release.assert_called_with(sent)
+        self.assertTrue(self.deduplicator.claim('create', 'bob', 'myWinServerBox', 'task-2') is None)
+
+    def test_post_not_sent_retry(self):
+        """WinServerView - POST on /api/2/inf/winserver queues the retry of a request whose task was never sent"""
+        self.app.application.celery_app.send_task.side_effect = [OperationalError('testing'), self.fake_task]
+        for _ in range(2):
+            resp = self.app.post('/api/2/inf/winserver',
+                                 headers={'X-Auth': self.token, 'Idempotency-Key': 'abc'},
+                                 json={'network': "someLAN", 'name': "myWinServerBox", 'image': "someVersion"})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(self.app.application.celery_app.send_task.call_count, 2)
+
+    def test_post_send_bug(self):
+        """WinServerView - POST on /api/2/inf/winserver gives back the claim, and raises, when sending the task hits a bug"""
+        self.app.application.celery_app.send_task.side_effect = TypeError('testing')
+        with self.assertRaises(TypeError):
+            self.app.post('/api/2/inf/winserver',
+                          headers={'X-Auth': self.token},
+                          json={'network': "someLAN", 'name': "myWinServerBox", 'image': "someVersion"})
+
+        self.assertTrue(self.deduplicator.claim('create', 'bob', 'myWinServerBox', 'task-2') is None)
+
+    def test_delete_not_sent(self):
+        """WinServerView - DELETE on /api/2/inf/winserver returns HTTP 503, and holds nothing, when the task cannot be sent"""
+        self.app.application.celery_app.send_task.side_effect = OperationalError('testing')
+        resp = self.app.delete('/api/2/inf/winserver',
+                               headers={'X-Auth': self.token},
+                               json={'name': "myWinServerBox"})
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertTrue(self.deduplicator.claim('delete', 'bob', 'myWinServerBox', 'task-2') is None)
+
+    def test_bulk_not_sent(self):
+        """WinServerView - POST on ./bulk returns HTTP 503, and gives back the deploy lease, when the task cannot be sent"""
+        self.app.application.celery_app.send_task.side_effect = OperationalError('testing')
+        with patch.object(winserver.admission, 'get_admission') as fake_get_admission:
+            fake_get_admission.return_value.admit.return_value = ''
+            resp = self.app.post('/api/2/inf/winserver/bulk',
+                                 headers={'X-Auth': self.token},
+                                 json={'names': ['box1', 'box2'], 'image': '2016', 'network': 'frontend'})
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertTrue(fake_get_admission.return_value.release.called)
+
+    def test_delete_in_flight(self):
+        """WinServerView - DELETE on /api/2/inf/winserver returns the task-id of a delete of the same VM in flight"""
+        self.deduplicator.claim('delete', 'bob', 'myWinServerBox', 'first-task')
+        resp = self.app.delete('/api/2/inf/winserver',
+                               headers={'X-Auth': self.token},
+                               json={'name': "myWinServerBox"})
+
+        self.assertEqual(resp.json['content']['task-id'], 'first-task')
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
+    def test_bulk_retry(self):
+        """WinServerView - POST on ./bulk with a reused Idempotency-Key queues one task"""
+        for _ in range(2):
+            self.app.post('/api/2/inf/winserver/bulk',
+                          headers={'X-Auth': self.token, 'Idempotency-Key': 'abc'},
+                          json={'names': ['box1', 'box2'], 'image': '2016', 'network': 'frontend'})
+
+        self.assertEqual(self.app.application.celery_app.send_task.call_count, 1)
+
     def test_delete_task(self):
         """WinServerView - DELETE on /api/2/inf/winserver returns a task-id"""
         resp = self.app.delete('/api/2/inf/winserver',
@@ -135,6 +369,14 @@ class TestWinServerView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    def test_delete_invalidates(self):
+        """WinServerView - DELETE on /api/2/inf/winserver invalidates the cached inventory"""
+        self.app.delete('/api/2/inf/winserver',
+                        headers={'X-Auth': self.token},
+                        json={'name' : 'myWinServerBox'})
+
+        self.fake_cache.invalidate.assert_called_with('bob')
+
     def test_delete_task_link(self):
         """WinServerView - DELETE on /api/2/inf/winserver sets the Link header"""
         resp = self.app.delete('/api/2/inf/winserver',
@@ -166,6 +408,518 @@ class TestWinServerView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    def test_image_sync(self):
+        """WinServerView - GET on the ./image end point answers directly when the images are readable"""
+        self.fake_catalog.images.side_effect = None
+        self.fake_catalog.images.return_value = ['2012R2', '2016']
+        resp = self.app.get('/api/2/inf/winserver/image',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], {'image': ['2012R2', '2016']})
+
+    def test_image_sync_no_task(self):
+        """WinServerView - GET on the ./image end point does not make a task when answering directly"""
+        self.fake_catalog.images.side_effect = None
+        self.fake_catalog.images.return_value = ['2016']
+        resp = self.app.get('/api/2/inf/winserver/image',
+                            headers={'X-Auth': self.token})
+
+        self.assertFalse('task-id' in resp.json['content'])
+
+    def test_image_etag(self):
+        """WinServerView - GET on the ./image end point returns HTTP 304 if the list has not changed"""
+        self.fake_catalog.images.side_effect = None
+        self.fake_catalog.images.return_value = ['2016']
+        first = self.app.get('/api/2/inf/winserver/image',
+                             headers={'X-Auth': self.token})
+        resp = self.app.get('/api/2/inf/winserver/image',
+                            headers={'X-Auth': self.token, 'If-None-Match': first.headers['ETag']})
+
+        self.assertEqual(resp.status_code, 304)
+
+    def test_image_etag_changed(self):
+        """WinServerView - GET on the ./image end point returns the new list if it changed"""
+        self.fake_catalog.images.side_effect = None
+        self.fake_catalog.images.return_value = ['2016']
+        first = self.app.get('/api/2/inf/winserver/image',
+                             headers={'X-Auth': self.token})
+        self.fake_catalog.images.return_value = ['2016', '2019']
+        resp = self.app.get('/api/2/inf/winserver/image',
+                            headers={'X-Auth': self.token, 'If-None-Match': first.headers['ETag']})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], {'image': ['2016', '2019']})
+
+    def test_image_async(self):
+        """WinServerView - GET on the ./image end point supports the task-based API via ?async=true"""
+        self.fake_catalog.images.side_effect = None
+        self.fake_catalog.images.return_value = ['2016']
+        resp = self.app.get('/api/2/inf/winserver/image?async=true',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['content']['task-id'], 'asdf-asdf-asdf')
+
+    def test_pool(self):
+        """WinServerView - GET on the ./pool end point returns the a task-id"""
+        resp = self.app.get('/api/2/inf/winserver/pool',
+                            headers={'X-Auth': self.token})
+
+        task_id = resp.json['content']['task-id']
+        expected = 'asdf-asdf-asdf'
+
+        self.assertEqual(task_id, expected)
+
+    def test_bulk(self):
+        """WinServerView - POST on ./bulk returns one task-id"""
+        resp = self.app.post('/api/2/inf/winserver/bulk',
+                             headers={'X-Auth': self.token},
+                             json={'names': ['box1', 'box2'], 'image': '2016', 'network': 'frontend'})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['content']['task-id'], 'asdf-asdf-asdf')
+
+    def test_bulk_name_prefix(self):
+        """WinServerView - POST on ./bulk supports a name prefix and count"""
+        self.app.post('/api/2/inf/winserver/bulk',
+                      headers={'X-Auth': self.token},
+                      json={'name-prefix': 'lab', 'count': 3, 'image': '2016', 'network': 'frontend'})
+
+        the_args = self.app.application.celery_app.send_task.call_args[0][1]
+
+        self.assertEqual(the_args[1], ['lab1', 'lab2', 'lab3'])
+        self.assertEqual(the_args[3], 'bob_frontend')
+
+    def test_bulk_static_ips(self):
+        """WinServerView - POST on ./bulk gives each VM its own static IP"""
+        self.app.post('/api/2/inf/winserver/bulk',
+                      headers={'X-Auth': self.token},
+                      json={'names': ['box1', 'box2'], 'image': '2016', 'network': 'frontend',
+                            'static-ips': ['192.168.1.2', '192.168.1.3']})
+
+        ip_configs = self.app.application.celery_app.send_task.call_args[0][1][4]
+
+        self.assertEqual([x['static-ip'] for x in ip_configs], ['192.168.1.2', '192.168.1.3'])
+
+    def test_bulk_bad_static_ip(self):
+        """WinServerView - POST on ./bulk checks every static IP before making a task"""
+        resp = self.app.post('/api/2/inf/winserver/bulk',
+                             headers={'X-Auth': self.token},
+                             json={'names': ['box1', 'box2'], 'image': '2016', 'network': 'frontend',
+                                   'static-ips': ['192.168.1.2', '10.1.1.3']})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
+    def test_bulk_static_ip_count(self):
+        """WinServerView - POST on ./bulk requires one static IP per VM"""
+        resp = self.app.post('/api/2/inf/winserver/bulk',
+                             headers={'X-Auth': self.token},
+                             json={'names': ['box1', 'box2'], 'image': '2016', 'network': 'frontend',
+                                   'static-ips': ['192.168.1.2']})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_bulk_shared_static_ip(self):
+        """WinServerView - POST on ./bulk rejects one static IP for many VMs"""
+        resp = self.app.post('/api/2/inf/winserver/bulk',
+                             headers={'X-Auth': self.token},
+                             json={'names': ['box1', 'box2'], 'image': '2016', 'network': 'frontend',
+                                   'ip-config': {'static-ip': '192.168.1.2'}})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_bulk_duplicate_names(self):
+        """WinServerView - POST on ./bulk rejects duplicate names"""
+        resp = self.app.post('/api/2/inf/winserver/bulk',
+                             headers={'X-Auth': self.token},
+                             json={'names': ['box1', 'box1'], 'image': '2016', 'network': 'frontend'})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_bulk_bad_name(self):
+        """WinServerView - POST on ./bulk rejects a bad name before queueing any create"""
+        resp = self.app.post('/api/2/inf/winserver/bulk',
+                             headers={'X-Auth': self.token},
+                             json={'names': ['box1', 'box_2'], 'image': '2016', 'network': 'frontend'})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertTrue('box_2' in resp.json['error'])
+
+    def test_bulk_too_many(self):
+        """WinServerView - POST on ./bulk limits how many VMs one call creates"""
+        resp = self.app.post('/api/2/inf/winserver/bulk',
+                             headers={'X-Auth': self.token},
+                             json={'name-prefix': 'lab', 'count': 5000, 'image': '2016', 'network': 'frontend'})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_bulk_too_busy(self):
+        """WinServerView - POST on ./bulk returns HTTP 429 when a deploy limit is hit"""
+        with patch.object(winserver.admission, 'get_admission') as fake_get_admission:
+            fake_get_admission.return_value.admit.return_value = 'vLab is deploying 40 WinServers; the limit is 40'
+            fake_get_admission.return_value.retry_after = 30
+            resp = self.app.post('/api/2/inf/winserver/bulk',
+                                 headers={'X-Auth': self.token},
+                                 json={'names': ['box1', 'box2'], 'image': '2016', 'network': 'frontend'})
+
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(fake_get_admission.return_value.admit.call_args[1], {'count': 2})
+
+    def test_bulk_over_limit(self):
+        """WinServerView - POST on ./bulk returns HTTP 400 when the bulk could never fit the deploy limits"""
+        with patch.object(winserver.admission, 'get_admission') as fake_get_admission:
+            fake_get_admission.return_value.admit.side_effect = ValueError('Cannot deploy more than 1 WinServers at once')
+            resp = self.app.post('/api/2/inf/winserver/bulk',
+                                 headers={'X-Auth': self.token},
+                                 json={'names': ['box1', 'box2'], 'image': '2016', 'network': 'frontend'})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_bulk_no_names(self):
+        """WinServerView - POST on ./bulk requires names, or a prefix and count"""
+        resp = self.app.post('/api/2/inf/winserver/bulk',
+                             headers={'X-Auth': self.token},
+                             json={'name-prefix': 'lab', 'image': '2016', 'network': 'frontend'})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_bulk_bad_image(self):
+        """WinServerView - POST on ./bulk rejects an image that's not in the catalog"""
+        self.fake_catalog.get.return_value = None
+        resp = self.app.post('/api/2/inf/winserver/bulk',
+                             headers={'X-Auth': self.token},
+                             json={'names': ['box1'], 'image': '1999', 'network': 'frontend'})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_modify_network(self):
+        """WinServerView - PUT on ./network returns a task-id"""
+        resp = self.app.put('/api/2/inf/winserver/network',
+                            headers={'X-Auth': self.token},
+                            json={'name': 'box1', 'new_network': 'lan2'})
+
+        the_args = self.app.application.celery_app.send_task.call_args[0]
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(the_args, ('winserver.modify_networks', ['bob', {'box1': 'bob_lan2'}, 'noId']))
+        self.assertTrue('Link' in resp.headers)
+
+    def test_modify_network_many(self):
+        """WinServerView - PUT on ./network moves many WinServers with one task"""
+        self.app.put('/api/2/inf/winserver/network',
+                     headers={'X-Auth': self.token},
+                     json={'changes': [{'name': 'box1', 'new_network': 'lan2'},
+                                       {'name': 'box2', 'new_network': 'lan3'}]})
+
+        changes = self.app.application.celery_app.send_task.call_args[0][1][1]
+
+        self.assertEqual(changes, {'box1': 'bob_lan2', 'box2': 'bob_lan3'})
+
+    def test_modify_network_invalidates(self):
+        """WinServerView - PUT on ./network invalidates the cached inventory"""
+        self.app.put('/api/2/inf/winserver/network',
+                     headers={'X-Auth': self.token},
+                     json={'name': 'box1', 'new_network': 'lan2'})
+
+        self.fake_cache.invalidate.assert_called_with('bob')
+
+    def test_modify_network_both(self):
+        """WinServerView - PUT on ./network does not accept changes and name together"""
+        resp = self.app.put('/api/2/inf/winserver/network',
+                            headers={'X-Auth': self.token},
+                            json={'name': 'box1', 'new_network': 'lan2',
+                                  'changes': [{'name': 'box2', 'new_network': 'lan2'}]})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_modify_network_duplicate(self):
+        """WinServerView - PUT on ./network does not accept the same name twice"""
+        resp = self.app.put('/api/2/inf/winserver/network',
+                            headers={'X-Auth': self.token},
+                            json={'changes': [{'name': 'box1', 'new_network': 'lan2'},
+                                              {'name': 'box1', 'new_network': 'lan3'}]})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_modify_network_nothing(self):
+        """WinServerView - PUT on ./network requires at least one change"""
+        resp = self.app.put('/api/2/inf/winserver/network',
+                            headers={'X-Auth': self.token},
+                            json={'changes': []})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_bulk_delete(self):
+        """WinServerView - DELETE on ./bulk returns one task-id"""
+        resp = self.app.delete('/api/2/inf/winserver/bulk',
+                               headers={'X-Auth': self.token},
+                               json={'names': ['box1', 'box2']})
+
+        the_args = self.app.application.celery_app.send_task.call_args[0]
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(the_args, ('winserver.delete_many', ['bob', ['box1', 'box2'], 'noId']))
+
+    def test_bulk_delete_all(self):
+        """WinServerView - DELETE on ./bulk with all=true deletes every WinServer"""
+        self.app.delete('/api/2/inf/winserver/bulk',
+                        headers={'X-Auth': self.token},
+                        json={'all': True})
+
+        machine_names = self.app.application.celery_app.send_task.call_args[0][1][1]
+
+        self.assertTrue(machine_names is None)
+
+    def test_bulk_delete_nothing(self):
+        """WinServerView - DELETE on ./bulk requires names, or all"""
+        resp = self.app.delete('/api/2/inf/winserver/bulk',
+                               headers={'X-Auth': self.token},
+                               json={'names': []})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_bulk_delete_both(self):
+        """WinServerView - DELETE on ./bulk rejects names and all together"""
+        resp = self.app.delete('/api/2/inf/winserver/bulk',
+                               headers={'X-Auth': self.token},
+                               json={'names': ['box1'], 'all': True})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_task_machines(self):
+        """WinServerView - GET on ./task reports the phase of every VM of a bulk create"""
+        self.fake_result.status = 'PROGRESS'
+        self.fake_result.info = {'phase': 'finalize', 'machines': {'box1': 'done', 'box2': 'configure-ip'}}
+        resp = self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.json['content']['machines'], {'box1': 'done', 'box2': 'configure-ip'})
+
+    def test_task_phase(self):
+        """WinServerView - GET on ./task reports the phase of a multi-phase task"""
+        self.fake_result.status = 'PROGRESS'
+        self.fake_result.info = {'phase': 'wait-for-guest'}
+        resp = self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        phase = resp.json['content']['phase']
+        expected = 'wait-for-guest'
+
+        self.assertEqual(phase, expected)
+        self.assertEqual(resp.status_code, 202)
+
+    def test_task_pending(self):
+        """WinServerView - GET on ./task returns HTTP 202 while the task is queued"""
+        self.fake_result.status = 'PENDING'
+        resp = self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertFalse('phase' in resp.json['content'])
+
+    def test_task_success(self):
+        """WinServerView - GET on ./task returns the task result once complete"""
+        self.fake_result.status = 'SUCCESS'
+        self.fake_result.result = {'content': {'myWinServer': {}}, 'error': None, 'params': {}}
+        resp = self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], {'myWinServer': {}})
+
+    def test_task_error(self):
+        """WinServerView - GET on ./task returns HTTP 400 if the task had bad input"""
+        self.fake_result.status = 'SUCCESS'
+        self.fake_result.result = {'content': {}, 'error': 'some error', 'params': {}}
+        resp = self.app.get('/api/2/inf/winserver/task?task-id=asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json['error'], 'some error')
+
+    def test_task_failure(self):
+        """WinServerView - GET on ./task returns HTTP 500 if the task blew up"""
+        self.fake_result.status = 'FAILURE'
+        resp = self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 500)
+
+    def test_task_no_id(self):
+        """WinServerView - GET on ./task without a task id returns HTTP 400"""
+        resp = self.app.get('/api/2/inf/winserver/task',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def make_results(self, *phases):
+        """Make the result backend report each phase in turn, then the task done"""
+        results = []
+        for phase in phases:
+            result = MagicMock()
+            result.status = 'PROGRESS'
+            result.info = {'phase': phase}
+            results.append(result)
+        done = MagicMock()
+        done.status = 'SUCCESS'
+        done.result = {'content': {'myWinServer': {}}, 'error': None, 'params': {}}
+        results.append(done)
+        self.app.application.celery_app.AsyncResult.side_effect = results
+
+    def test_task_etag(self):
+        """WinServerView - GET on ./task returns an ETag of the status"""
+        self.fake_result.status = 'PENDING'
+        resp = self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertTrue(resp.headers.get('ETag'))
+
+    @patch.object(winserver, 'time')
+    def test_task_wait(self, fake_time):
+        """WinServerView - GET on ./task?wait=N holds the request until the phase changes"""
+        fake_time.time.return_value = 100
+        self.make_results('deploy', 'deploy', 'configure-ip')
+        resp = self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf?wait=30',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['content']['phase'], 'configure-ip')
+        self.assertEqual(fake_time.sleep.call_count, 2)
+
+    @patch.object(winserver, 'time')
+    def test_task_wait_timeout(self, fake_time):
+        """WinServerView - GET on ./task?wait=N returns the same status once N seconds pass"""
+        fake_time.time.side_effect = [100, 100, 131]
+        self.fake_result.status = 'PENDING'
+        resp = self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf?wait=30',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['content']['status'], 'PENDING')
+        self.assertEqual(fake_time.sleep.call_count, 1)
+
+    @patch.object(winserver, 'time')
+    def test_task_wait_etag(self, fake_time):
+        """WinServerView - GET on ./task?wait=N answers right away if the status differs from If-None-Match"""
+        self.fake_result.status = 'PENDING'
+        resp = self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf?wait=30',
+                            headers={'X-Auth': self.token, 'If-None-Match': '"some-old-status"'})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertFalse(fake_time.sleep.called)
+
+    @patch.object(winserver, 'time')
+    def test_task_wait_done(self, fake_time):
+        """WinServerView - GET on ./task?wait=N does not wait on a finished task"""
+        self.fake_result.status = 'SUCCESS'
+        self.fake_result.result = {'content': {'myWinServer': {}}, 'error': None, 'params': {}}
+        resp = self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf?wait=30',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(fake_time.sleep.called)
+
+    def test_task_wait_bad(self):
+        """WinServerView - GET on ./task?wait=N returns HTTP 400 if N isn't a number"""
+        resp = self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf?wait=soon',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
+    @patch.object(winserver, 'time')
+    def test_task_stream(self, fake_time):
+        """WinServerView - GET on ./task with Accept: text/event-stream sends every change, then the result"""
+        fake_time.time.return_value = 100
+        self.make_results('deploy', 'deploy', 'configure-ip')
+        resp = self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token, 'Accept': 'text/event-stream'})
+
+        events = [x for x in resp.get_data(as_text=True).split('\n\n') if x]
+        names = [x.split('\n')[1] for x in events]
+
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        self.assertEqual(names, ['event: status', 'event: status', 'event: result'])
+
+    @patch.object(winserver, 'time')
+    def test_task_stream_resume(self, fake_time):
+        """WinServerView - GET on ./task with Last-Event-ID skips the status the client already has"""
+        fake_time.time.return_value = 100
+        self.make_results('deploy')
+        seen = winserver._status_etag({'user': 'bob', 'content': {'status': 'PROGRESS', 'phase': 'deploy'}})
+        resp = self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token, 'Accept': 'text/event-stream', 'Last-Event-ID': seen})
+
+        events = [x for x in resp.get_data(as_text=True).split('\n\n') if x]
+
+        self.assertEqual(len(events), 1)
+        self.assertTrue('event: result' in events[0])
+
+    def test_task_stream_finished(self):
+        """WinServerView - GET on ./task with the Last-Event-ID of the result returns HTTP 204"""
+        self.fake_result.status = 'SUCCESS'
+        self.fake_result.result = {'content': {'myWinServer': {}}, 'error': None, 'params': {}}
+        seen = winserver._status_etag(self.fake_result.result)
+        resp = self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token, 'Accept': 'text/event-stream', 'Last-Event-ID': seen})
+
+        self.assertEqual(resp.status_code, 204)
+
+
+    @patch.object(winserver, '_WAITERS', new_callable=lambda: threading.BoundedSemaphore(1))
+    @patch.object(winserver, 'time')
+    def test_task_wait_frees_slot(self, fake_time, fake_waiters):
+        """WinServerView - GET on ./task?wait=N gives back its waiter slot once it answers"""
+        fake_time.time.return_value = 100
+        self.make_results('deploy', 'configure-ip')
+        self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf?wait=30',
+                     headers={'X-Auth': self.token})
+
+        self.assertTrue(fake_waiters.acquire(blocking=False))
+
+    @patch.object(winserver, '_WAITERS', new_callable=lambda: threading.BoundedSemaphore(0))
+    @patch.object(winserver, 'time')
+    def test_task_wait_busy(self, fake_time, fake_waiters):
+        """WinServerView - GET on ./task?wait=N answers right away with Retry-After when too many requests wait"""
+        fake_time.time.return_value = 100
+        self.fake_result.status = 'PENDING'
+        resp = self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf?wait=30',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.headers['Retry-After'], '5')
+        self.assertFalse(fake_time.sleep.called)
+
+    @patch.object(winserver, '_WAITERS', new_callable=lambda: threading.BoundedSemaphore(0))
+    @patch.object(winserver, 'time')
+    def test_task_stream_busy(self, fake_time, fake_waiters):
+        """WinServerView - GET on ./task with Accept: text/event-stream sends the status and a retry when too many requests wait"""
+        self.fake_result.status = 'PENDING'
+        resp = self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token, 'Accept': 'text/event-stream'})
+
+        events = [x for x in resp.get_data(as_text=True).split('\n\n') if x]
+
+        self.assertTrue('event: status' in events[0])
+        self.assertEqual(events[1], 'retry: 5000')
+        self.assertFalse(fake_time.sleep.called)
+
+    @patch.object(winserver, '_WAITERS', new_callable=lambda: threading.BoundedSemaphore(1))
+    @patch.object(winserver, 'time')
+    def test_task_stream_frees_slot(self, fake_time, fake_waiters):
+        """WinServerView - GET on ./task with Accept: text/event-stream gives back its waiter slot once the stream closes"""
+        fake_time.time.return_value = 100
+        self.make_results('deploy')
+        resp = self.app.get('/api/2/inf/winserver/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token, 'Accept': 'text/event-stream'})
+        held = not fake_waiters.acquire(blocking=False)
+        resp.get_data()
+        resp.close()
+
+        self.assertTrue(held)
+        self.assertTrue(fake_waiters.acquire(blocking=False))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,16 +1,25 @@
 # -*- coding: UTF-8 -*-
 from flask import Flask
 from celery import Celery
+from celery.signals import before_task_publish
 
-from vlab_winserver_api.lib import const
-from vlab_winserver_api.lib.views import HealthView, WinServerView
+from vlab_winserver_api.lib import const, metrics, queues, results, admission
+from vlab_winserver_api.lib.views import HealthView, MetricsView, WinServerView, track_requests
 
 app = Flask(__name__)
-app.celery_app = Celery('winserver', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
+app.celery_app = Celery('winserver', broker=const.VLAB_MESSAGE_BROKER)
 app.celery_app.conf.broker_heartbeat = 0 #https://github.com/celery/celery/issues/4895
+queues.configure(app.celery_app)
+results.configure(app.celery_app)
+
+before_task_publish.connect(metrics.stamp_sent)
+# Fail now on bad deploy limit settings, instead of on the first create
+admission.get_admission()
 
 HealthView.register(app)
+MetricsView.register(app)
 WinServerView.register(app)
+track_requests(app)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,466 @@
+# -*- coding: UTF-8 -*-
+"""
+Limits how many WinServers are deploying at once, per user and overall.
+
+Every ``winserver.create`` and ``winserver.create_many`` holds a lease, keyed
+by the task id the client polls, for as long as its VMs are deploying. The API
+takes the lease before queueing the task, and answers HTTP 429 with a
+``Retry-After`` header when a limit is hit. The worker takes it again when the
+task starts (a no-op if the API already has), so a task sent some other way
+waits its turn too, and it gives the lease back once the create finishes.
+
+Three limits apply:
+
+- ``VLAB_WINSERVER_MAX_USER_DEPLOYS`` caps the VMs one user has deploying.
+- ``VLAB_WINSERVER_MAX_DEPLOYS`` caps the VMs deploying overall.
+- Fair share: once more than half of ``VLAB_WINSERVER_MAX_DEPLOYS`` is in use,
+  nobody gets more than an equal split of it between the users deploying. So a
+  user who got in early cannot keep the last slots from everyone else.
+
+A task the worker refused joins a queue, and keeps its place in it while it
+retries. A freed slot goes to the task at the front: each user's creates go in
+the order they were queued, and between users the one with the fewest VMs
+deploying goes first (the longest waiting, on a tie). So a user with 100
+creates queued gets one slot in turn with everyone else, instead of every slot
+that frees up. A create refused by the API isn't queued, since the client
+might not come back, but it still cannot jump the queue. A queued task that
+hasn't retried in ``VLAB_WINSERVER_ADMISSION_WAIT_TTL`` seconds loses its place.
+
+Setting a limit to 0 turns it off. The leases live in
+``VLAB_WINSERVER_ADMISSION_URL``, which must be a ``sqlite:///`` file the API
+and the worker share. With ``memory://``, the API would keep every lease it
+took until it expired, because only the worker gives them back; a user at
+their limit would get HTTP 429 long after their creates finished. So the API
+and the worker refuse to start with a limit set and a ``memory://`` ledger
+(see ``get_admission``). A lease that's never given back (i.e. the worker
+was killed) expires after ``VLAB_WINSERVER_ADMISSION_TTL`` seconds; the create
+phases renew it every time they reschedule.
+"""
+import time
+import sqlite3
+import threading
+
+from vlab_api_common import get_logger
+
+from vlab_winserver_api.lib import const
+from vlab_winserver_api.lib.metrics import REGISTRY
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_WINSERVER_LOG_LEVEL)
+
+
+class MemoryLedger(object):
+    """Keeps the leases in the current process
+
+    :param ttl: How many seconds a lease lives unless it's given back
+    :type ttl: Integer
+
+    :param wait_ttl: Optional - How many seconds a queued task keeps its place without retrying
+    :type wait_ttl: Integer
+    """
+    def __init__(self, ttl, wait_ttl=None):
+        self.ttl = ttl
+        self.wait_ttl = wait_ttl if wait_ttl else ttl
+        self._lock = threading.Lock()
+        self._leases = {}
+        self._waiting = {}
+
+    def acquire(self, task_id, username, count, decide, queue=False):
+        """Take a lease, if ``decide`` allows it
+
+        :Returns: String - why the lease was refused, or an empty string
+
+        :param task_id: The id of the task that deploys the VMs
+        :type task_id: String
+
+        :param username: The user who owns the VMs
+        :type username: String
+
+        :param count: How many VMs the task deploys
+        :type count: Integer
+
+        :param decide: Called with the VMs each user has deploying, the other queued tasks, the user, the count, and when the task was queued
+        :type decide: Function
+
+        :param queue: Optional - Keep the task's place in the queue if it's refused
+        :type queue: Boolean
+        """
+        now = time.time()
+        with self._lock:
+            for expired in [x for x, y in self._leases.items() if y[2] < now]:
+                del self._leases[expired]
+            for expired in [x for x, y in self._waiting.items() if y[3] < now]:
+                del self._waiting[expired]
+            if task_id in self._leases:
+                owner, leased, _ = self._leases[task_id]
+                self._leases[task_id] = (owner, leased, now + self.ttl)
+                return ''
+            deploying = {}
+            for owner, leased, _ in self._leases.values():
+                deploying[owner] = deploying.get(owner, 0) + leased
+            since = self._waiting[task_id][2] if task_id in self._waiting else now
+            waiting = [(y[0], y[1], y[2]) for x, y in self._waiting.items() if x != task_id]
+            error = decide(deploying, waiting, username, count, since)
+            if not error:
+                self._leases[task_id] = (username, count, now + self.ttl)
+                self._waiting.pop(task_id, None)
+            elif queue:
+                self._waiting[task_id] = (username, count, since, now + self.wait_ttl)
+            return error
+
+    def renew(self, task_id, username, count):
+        """Extend a lease; it's taken again if it already expired
+
+        :Returns: None
+
+        :param task_id: The id of the task that deploys the VMs
+        :type task_id: String
+
+        :param username: The user who owns the VMs
+        :type username: String
+
+        :param count: How many VMs the task deploys
+        :type count: Integer
+        """
+        with self._lock:
+            self._leases[task_id] = (username, count, time.time() + self.ttl)
+
+    def release(self, task_id):
+        """Give a lease back, or give up a place in the queue
+
+        :Returns: None
+
+        :param task_id: The id of the task that deploys the VMs
+        :type task_id: String
+        """
+        with self._lock:
+            self._leases.pop(task_id, None)
+            self._waiting.pop(task_id, None)
+
+
+class SqliteLedger(object):
+    """Keeps the leases in a SQLite file, so the API and the workers share them
+
+    :param path: The location of the SQLite database file
+    :type path: String
+
+    :param ttl: How many seconds a lease lives unless it's given back
+    :type ttl: Integer
+
+    :param wait_ttl: Optional - How many seconds a queued task keeps its place without retrying
+    :type wait_ttl: Integer
+    """
+    def __init__(self, path, ttl, wait_ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self.wait_ttl = wait_ttl if wait_ttl else ttl
+        try:
+            conn = self._connect()
+            try:
+                conn.execute('CREATE TABLE IF NOT EXISTS leases (task_id TEXT PRIMARY KEY, username TEXT, count INTEGER, expires REAL)')
+                conn.execute('CREATE TABLE IF NOT EXISTS waiting (task_id TEXT PRIMARY KEY, username TEXT, count INTEGER, since REAL, expires REAL)')
+            finally:
+                conn.close()
+        except sqlite3.Error as doh:
+            logger.error('Admission ledger {} failed: {}'.format(self.path, doh))
+
+    def _connect(self):
+        """Open a connection per call, so the ledger survives a fork
+
+        :Returns: sqlite3.Connection
+        """
+        # isolation_level=None lets acquire take the write lock up front with BEGIN IMMEDIATE
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    def acquire(self, task_id, username, count, decide, queue=False):
+        """Take a lease, if ``decide`` allows it
+
+        Counting the leases and adding the new one happen in one transaction,
+        so two processes cannot both take the last slot.
+
+        :Returns: String - why the lease was refused, or an empty string
+
+        :param task_id: The id of the task that deploys the VMs
+        :type task_id: String
+
+        :param username: The user who owns the VMs
+        :type username: String
+
+        :param count: How many VMs the task deploys
+        :type count: Integer
+
+        :param decide: Called with the VMs each user has deploying, the other queued tasks, the user, the count, and when the task was queued
+        :type decide: Function
+
+        :param queue: Optional - Keep the task's place in the queue if it's refused
+        :type queue: Boolean
+        """
+        now = time.time()
+        error = ''
+        try:
+            conn = self._connect()
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    conn.execute('DELETE FROM leases WHERE expires < ?', (now,))
+                    conn.execute('DELETE FROM waiting WHERE expires < ?', (now,))
+                    renewed = conn.execute('UPDATE leases SET expires = ? WHERE task_id = ?', (now + self.ttl, task_id))
+                    if not renewed.rowcount:
+                        rows = conn.execute('SELECT username, SUM(count) FROM leases GROUP BY username').fetchall()
+                        queued = conn.execute('SELECT since FROM waiting WHERE task_id = ?', (task_id,)).fetchone()
+                        since = queued[0] if queued else now
+                        waiting = conn.execute('SELECT username, count, since FROM waiting WHERE task_id != ?', (task_id,)).fetchall()
+                        error = decide(dict(rows), waiting, username, count, since)
+                        if not error:
+                            conn.execute('INSERT INTO leases (task_id, username, count, expires) VALUES (?, ?, ?, ?)',
+                                         (task_id, username, count, now + self.ttl))
+                            conn.execute('DELETE FROM waiting WHERE task_id = ?', (task_id,))
+                        elif queue:
+                            conn.execute('INSERT OR REPLACE INTO waiting (task_id, username, count, since, expires) VALUES (?, ?, ?, ?, ?)',
+                                         (task_id, username, count, since, now + self.wait_ttl))
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+            finally:
+                conn.close()
+        except sqlite3.Error as doh:
+            # Like the stores, a broken ledger must not break creating VMs
+            logger.error('Admission ledger {} failed: {}'.format(self.path, doh))
+            error = ''
+        return error
+
+    def renew(self, task_id, username, count):
+        """Extend a lease; it's taken again if it already expired
+
+        :Returns: None
+
+        :param task_id: The id of the task that deploys the VMs
+        :type task_id: String
+
+        :param username: The user who owns the VMs
+        :type username: String
+
+        :param count: How many VMs the task deploys
+        :type count: Integer
+        """
+        try:
+            conn = self._connect()
+            try:
+                conn.execute('INSERT OR REPLACE INTO leases (task_id, username, count, expires) VALUES (?, ?, ?, ?)',
+                             (task_id, username, count, time.time() + self.ttl))
+            finally:
+                conn.close()
+        except sqlite3.Error as doh:
+            logger.error('Admission ledger {} failed: {}'.format(self.path, doh))
+
+    def release(self, task_id):
+        """Give a lease back, or give up a place in the queue
+
+        :Returns: None
+
+        :param task_id: The id of the task that deploys the VMs
+        :type task_id: String
+        """
+        try:
+            conn = self._connect()
+            try:
+                conn.execute('DELETE FROM leases WHERE task_id = ?', (task_id,))
+                conn.execute('DELETE FROM waiting WHERE task_id = ?', (task_id,))
+            finally:
+                conn.close()
+        except sqlite3.Error as doh:
+            logger.error('Admission ledger {} failed: {}'.format(self.path, doh))
+
+
+def get_ledger(url, ttl, wait_ttl=None):
+    """Make a ledger from a URL like ``memory://`` or ``sqlite:////path/to/file.db``
+
+    :Returns: MemoryLedger or SqliteLedger
+
+    :Raises: ValueError for an unsupported URL
+
+    :param url: Where to keep the leases
+    :type url: String
+
+    :param ttl: How many seconds a lease lives unless it's given back
+    :type ttl: Integer
+
+    :param wait_ttl: Optional - How many seconds a queued task keeps its place without retrying
+    :type wait_ttl: Integer
+    """
+    if url.startswith('memory://'):
+        return MemoryLedger(ttl, wait_ttl=wait_ttl)
+    elif url.startswith('sqlite:///'):
+        return SqliteLedger(url[len('sqlite:///'):], ttl, wait_ttl=wait_ttl)
+    raise ValueError('Unsupported admission URL: {}'.format(url))
+
+
+class AdmissionControl(object):
+    """Decides if a user may start deploying more VMs
+
+    :param ledger: Where the leases are kept
+    :type ledger: MemoryLedger
+
+    :param max_user: The most VMs one user can have deploying; 0 means no limit
+    :type max_user: Integer
+
+    :param max_total: The most VMs that can be deploying overall; 0 means no limit
+    :type max_total: Integer
+
+    :param retry_after: The seconds a refused client is told to wait
+    :type retry_after: Integer
+    """
+    def __init__(self, ledger, max_user, max_total, retry_after):
+        self.ledger = ledger
+        self.max_user = max_user
+        self.max_total = max_total
+        self.retry_after = retry_after
+
+    def check(self, count):
+        """Make sure a request could ever be admitted
+
+        :Returns: None
+
+        :Raises: ValueError if the request is bigger than a limit
+
+        :param count: How many VMs the request deploys
+        :type count: Integer
+        """
+        limit = min(x for x in (self.max_user, self.max_total, count) if x)
+        if count > limit:
+            raise ValueError('Cannot deploy more than {} WinServers at once'.format(limit))
+
+    def admit(self, task_id, username, count=1, queue=False):
+        """Take a lease for a task, unless a limit is hit or others are queued
+        ahead of it; taking it again is a no-op
+
+        :Returns: String - why the task must wait, or an empty string
+
+        :Raises: ValueError if the request is bigger than a limit
+
+        :param task_id: The id of the task that deploys the VMs
+        :type task_id: String
+
+        :param username: The user who owns the VMs
+        :type username: String
+
+        :param count: How many VMs the task deploys
+        :type count: Integer
+
+        :param queue: Optional - Keep the task's place in the queue if it must wait; for a task that retries
+        :type queue: Boolean
+        """
+        self.check(count)
+        if not (self.max_user or self.max_total):
+            return ''
+        error = self.ledger.acquire(task_id, username, count, self._decide, queue=queue)
+        REGISTRY.inc('winserver_admission_total', result='refused' if error else 'admitted')
+        return error
+
+    def renew(self, task_id, username, count=1):
+        """Keep the lease of a task whose VMs are still deploying from expiring
+
+        :Returns: None
+
+        :param task_id: The id of the task that deploys the VMs
+        :type task_id: String
+
+        :param username: The user who owns the VMs
+        :type username: String
+
+        :param count: How many VMs the task deploys
+        :type count: Integer
+        """
+        if self.max_user or self.max_total:
+            self.ledger.renew(task_id, username, count)
+
+    def release(self, task_id):
+        """Give back the lease of a task, once its VMs are deployed or have failed
+
+        :Returns: None
+
+        :param task_id: The id of the task that deploys the VMs
+        :type task_id: String
+        """
+        if self.max_user or self.max_total:
+            self.ledger.release(task_id)
+
+    def _decide(self, deploying, waiting, username, count, since):
+        """Apply the limits to the VMs currently deploying, then let the tasks
+        queued ahead of this one go first
+
+        :Returns: String - why the request must wait, or an empty string
+
+        :param deploying: The user -> how many VMs they have deploying
+        :type deploying: Dictionary
+
+        :param waiting: The user, count, and time queued of the other tasks in the queue
+        :type waiting: List
+
+        :param since: When the task joined the queue; now if it isn't queued
+        :type since: Float
+        """
+        error = self._limits(deploying, username, count)
+        if error:
+            return error
+        place = (deploying.get(username, 0), since)
+        ahead = 0
+        for other, other_count, other_since in waiting:
+            if other == username:
+                # A user's own creates go in order
+                if other_since < since:
+                    ahead += 1
+            elif (deploying.get(other, 0), other_since) < place and not self._limits(deploying, other, other_count):
+                ahead += 1
+        if ahead:
+            return '{} deploys are queued ahead of yours'.format(ahead)
+        return ''
+
+    def _limits(self, deploying, username, count):
+        """Check a request against the per-user, overall, and fair share limits
+
+        :Returns: String - why the request must wait, or an empty string
+
+        :param deploying: The user -> how many VMs they have deploying
+        :type deploying: Dictionary
+        """
+        mine = deploying.get(username, 0)
+        total = sum(deploying.values())
+        if self.max_user and mine + count > self.max_user:
+            return 'You have {} WinServers deploying; the limit is {}'.format(mine, self.max_user)
+        if self.max_total:
+            if total + count > self.max_total:
+                return 'vLab is deploying {} WinServers; the limit is {}'.format(total, self.max_total)
+            users = len(set(deploying.keys()) | {username})
+            share = max(count, self.max_total // users)
+            if total + count > self.max_total // 2 and mine + count > share:
+                return 'You have {} WinServers deploying; your fair share is {} while vLab is busy'.format(mine, share)
+        return ''
+
+
+_ADMISSION = None
+_ADMISSION_LOCK = threading.Lock()
+
+
+def get_admission():
+    """Obtain the admission control set by the constants, shared by the whole process
+
+    :Returns: AdmissionControl
+
+    :Raises: RuntimeError if a limit is set, but the ledger is not shared between processes
+    """
+    global _ADMISSION
+    with _ADMISSION_LOCK:
+        if _ADMISSION is None:
+            limited = const.VLAB_WINSERVER_MAX_USER_DEPLOYS or const.VLAB_WINSERVER_MAX_DEPLOYS
+            if limited and const.VLAB_WINSERVER_ADMISSION_URL.startswith('memory://'):
+                raise RuntimeError('Deploy limits need a shared ledger; set VLAB_WINSERVER_ADMISSION_URL to a sqlite:/// file on a volume the API and the workers share')
+            ledger = get_ledger(const.VLAB_WINSERVER_ADMISSION_URL,
+                                ttl=const.VLAB_WINSERVER_ADMISSION_TTL,
+                                wait_ttl=const.VLAB_WINSERVER_ADMISSION_WAIT_TTL)
+            _ADMISSION = AdmissionControl(ledger,
+                                          max_user=const.VLAB_WINSERVER_MAX_USER_DEPLOYS,
+                                          max_total=const.VLAB_WINSERVER_MAX_DEPLOYS,
+                                          retry_after=const.VLAB_WINSERVER_ADMISSION_RETRY_AFTER)
+        return _ADMISSION
@@ -0,0 +1,131 @@
+# -*- coding: UTF-8 -*-
+"""
+A per-user cache of the ``winserver.show`` output.
+
+The ``winserver.show`` task fills the cache, and the tasks that change a user's
+VMs invalidate it. The API reads it, and answers ``GET /api/2/inf/winserver``
+without queueing a task on a hit.
+
+Invalidating replaces the user's generation token. Every entry records the
+generation it was read under, and it only counts as a hit while that
+generation is current. So a slow ``show`` that races a create or delete can
+never put stale data back into the cache.
+
+The console URLs are left out, since each one holds a single-use clone ticket;
+a hit has ``console`` set to None, and a ``show`` task mints fresh ones.
+
+The worker fills the cache and the API reads it, so ``VLAB_WINSERVER_CACHE_URL``
+must be a ``sqlite:///`` file on a volume they share. With ``memory://`` the
+API never gets a hit. The hit ratio is
+``winserver_inventory_cache_total{result="hit"}`` over the sum of both results.
+"""
+import uuid
+import threading
+
+from vlab_winserver_api.lib import const
+from vlab_winserver_api.lib.metrics import REGISTRY
+from vlab_winserver_api.lib.store import get_store
+
+
+class InventoryCache(object):
+    """Caches what VMs a user has
+
+    :param store: Where to keep the cached data
+    :type store: vlab_winserver_api.lib.store.MemoryStore
+    """
+    def __init__(self, store):
+        self._store = store
+
+    def generation(self, username):
+        """Obtain the current generation of a user's inventory; call before
+        reading the inventory from vCenter, and pass the result to ``put``
+
+        :Returns: String
+
+        :param username: The user who owns the VMs
+        :type username: String
+        """
+        generation = self._store.get(_generation_key(username))
+        if generation is None:
+            generation = uuid.uuid4().hex
+            self._store.set(_generation_key(username), generation, ttl=const.VLAB_WINSERVER_CACHE_TTL * 10)
+        return generation
+
+    def get(self, username):
+        """Obtain the cached inventory of a user
+
+        :Returns: Dictionary, or None on a miss
+
+        :param username: The user who owns the VMs
+        :type username: String
+        """
+        entry = self._store.get(_inventory_key(username))
+        generation = self._store.get(_generation_key(username))
+        if entry is not None and generation is not None and entry['generation'] == generation:
+            self._record(hit=True)
+            return entry['content']
+        self._record(hit=False)
+        return None
+
+    def put(self, username, content, generation):
+        """Cache the inventory of a user
+
+        :Returns: None
+
+        :param username: The user who owns the VMs
+        :type username: String
+
+        :param content: The output of ``winserver.show``
+        :type content: Dictionary
+
+        :param generation: The value of ``generation`` before the inventory was read
+        :type generation: String
+        """
+        # A console URL holds a single-use ticket, so it must not be handed out twice
+        content = {x: dict(y, console=None) for x, y in content.items()}
+        self._store.set(_inventory_key(username), {'generation': generation, 'content': content})
+
+    def invalidate(self, username):
+        """Forget the cached inventory of a user, i.e. after they create a VM
+
+        :Returns: None
+
+        :param username: The user who owns the VMs
+        :type username: String
+        """
+        self._store.set(_generation_key(username), uuid.uuid4().hex, ttl=const.VLAB_WINSERVER_CACHE_TTL * 10)
+        self._store.delete(_inventory_key(username))
+
+    def _record(self, hit):
+        """Count the hits and misses
+
+        :Returns: None
+        """
+        REGISTRY.inc('winserver_inventory_cache_total', result='hit' if hit else 'miss')
+
+
+def _inventory_key(username):
+    return 'inventory:{}'.format(username)
+
+
+def _generation_key(username):
+    return 'inventory-generation:{}'.format(username)
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_cache():
+    """Obtain the inventory cache set by ``VLAB_WINSERVER_CACHE_URL``, shared by the whole process
+
+    :Returns: InventoryCache
+    """
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            store = get_store(const.VLAB_WINSERVER_CACHE_URL,
+                              ttl=const.VLAB_WINSERVER_CACHE_TTL,
+                              max_size=const.VLAB_WINSERVER_CACHE_SIZE)
+            _CACHE = InventoryCache(store)
+        return _CACHE
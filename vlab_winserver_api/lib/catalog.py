@@ -0,0 +1,211 @@
+# -*- coding: UTF-8 -*-
+"""
+An index of the WinServer OVAs in ``VLAB_WINSERVER_IMAGES_DIR``.
+
+Opening an OVA with ``vlab_inf_common.vmware.Ova`` walks every tar header in a
+file that's tens of GB. The OVF spec puts the descriptor (and the optional
+manifest) before the disks, so the catalog only reads the first few members of
+each OVA, and only re-reads an OVA when its mtime or size changes.
+"""
+import os
+import re
+import time
+import tarfile
+import threading
+import xml.etree.ElementTree as ET
+
+from vlab_winserver_api.lib import const
+
+
+OVF_NS = '{http://schemas.dmtf.org/ovf/envelope/1}'
+MANIFEST_LINE = re.compile(r'^(?P<algo>\w+)\((?P<name>[^)]+)\)\s*=\s*(?P<digest>[0-9a-fA-F]+)$')
+
+
+def convert_name(name, to_version=False):
+    """This function centralizes converting between the name of the OVA, and the
+    version of software it contains.
+
+    The naming convention of the OVA files is ``WinServer-<version>.ova`` i.e. WinServer-2012R2.ova
+
+    :param name: The thing to covert
+    :type name: String
+
+    :param to_version: Set to True to covert the name of an OVA to the version
+    :type to_version: Boolean
+    """
+    if to_version:
+        return name.split('-')[-1].replace('.ova', '')
+    else:
+        return 'WinServer-{}.ova'.format(name)
+
+
+def parse_ova(path):
+    """Read the descriptor and manifest of an OVA, without reading the disks
+
+    :Returns: Dictionary
+
+    :Raises: ValueError if the file is not an OVA
+
+    :param path: The location of the OVA file
+    :type path: String
+    """
+    ovf = None
+    checksums = {}
+    try:
+        with tarfile.open(path) as tar:
+            for member in tar:
+                if member.name.endswith('.ovf'):
+                    ovf = tar.extractfile(member).read().decode()
+                elif member.name.endswith('.mf'):
+                    checksums = _parse_manifest(tar.extractfile(member).read().decode())
+                elif member.name.endswith('.vmdk') and ovf is not None:
+                    # Disks come after the descriptor and manifest; no need to
+                    # seek through GBs of tar headers.
+                    break
+    except tarfile.TarError as doh:
+        raise ValueError('Unable to read OVA {}: {}'.format(path, doh))
+    if ovf is None:
+        raise ValueError('No OVF descriptor found in {}'.format(path))
+    networks, disks = _parse_ovf(ovf)
+    return {'networks': networks, 'disks': disks, 'checksums': checksums, 'ovf': ovf}
+
+
+def _parse_ovf(ovf):
+    """Pull the network names and disk sizes out of an OVF descriptor
+
+    :Returns: Tuple - (List of network names, List of disk dictionaries)
+    """
+    root = ET.fromstring(ovf)
+    networks = [x.get('{}name'.format(OVF_NS)) for x in root.iter('{}Network'.format(OVF_NS))]
+    files = {x.get('{}id'.format(OVF_NS)): x for x in root.iter('{}File'.format(OVF_NS))}
+    disks = []
+    for disk in root.iter('{}Disk'.format(OVF_NS)):
+        the_file = files.get(disk.get('{}fileRef'.format(OVF_NS)), None)
+        units = disk.get('{}capacityAllocationUnits'.format(OVF_NS), 'byte')
+        disks.append({'name': the_file.get('{}href'.format(OVF_NS)) if the_file is not None else None,
+                      'capacity': int(disk.get('{}capacity'.format(OVF_NS), 0)) * _unit_multiplier(units),
+                      'size': int(the_file.get('{}size'.format(OVF_NS), 0)) if the_file is not None else 0})
+    return networks, disks
+
+
+def _unit_multiplier(units):
+    """Convert OVF allocation units, i.e. ``byte * 2^30``, into a number
+
+    :Returns: Integer
+    """
+    match = re.match(r'^byte\s*\*\s*2\^(\d+)$', units.strip())
+    if match:
+        return 2 ** int(match.group(1))
+    return 1
+
+
+def _parse_manifest(manifest):
+    """Parse the ``SHA256(disk.vmdk)= <digest>`` lines of an OVA manifest
+
+    :Returns: Dictionary
+    """
+    checksums = {}
+    for line in manifest.splitlines():
+        match = MANIFEST_LINE.match(line.strip())
+        if match:
+            checksums[match.group('name')] = '{}:{}'.format(match.group('algo').lower(), match.group('digest').lower())
+    return checksums
+
+
+class ImageCatalog(object):
+    """Caches the parsed descriptor of every OVA in a directory
+
+    :param directory: The directory of OVA files
+    :type directory: String
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        # file name -> ((mtime, size), entry or None if the OVA is unreadable)
+        self._entries = {}
+        self._refreshed = 0
+
+    def refresh(self, max_age=0):
+        """Re-read any OVA that's new or changed, and forget deleted ones
+
+        :Returns: None
+
+        :Raises: OSError if the directory cannot be read
+
+        :param max_age: Skip scanning the directory if it was scanned less than this many seconds ago
+        :type max_age: Integer
+        """
+        if max_age and time.time() - self._refreshed < max_age:
+            return
+        seen = set()
+        with os.scandir(self.directory) as files:
+            for the_file in files:
+                if not the_file.name.endswith('.ova'):
+                    continue
+                seen.add(the_file.name)
+                stat = the_file.stat()
+                stamp = (stat.st_mtime, stat.st_size)
+                with self._lock:
+                    cached = self._entries.get(the_file.name, None)
+                if cached is not None and cached[0] == stamp:
+                    continue
+                try:
+                    entry = parse_ova(the_file.path)
+                except ValueError:
+                    # i.e. an OVA that's still being copied into the directory;
+                    # remember it's bad until the mtime or size changes
+                    entry = None
+                else:
+                    entry['version'] = convert_name(the_file.name, to_version=True)
+                    entry['path'] = the_file.path
+                with self._lock:
+                    self._entries[the_file.name] = (stamp, entry)
+        with self._lock:
+            for name in set(self._entries.keys()) - seen:
+                self._entries.pop(name)
+        self._refreshed = time.time()
+
+    def images(self, max_age=0):
+        """Obtain the versions of WinServer that can be deployed
+
+        :Returns: List
+
+        :Raises: OSError if the directory cannot be read
+
+        :param max_age: How stale, in seconds, the list can be
+        :type max_age: Integer
+        """
+        self.refresh(max_age=max_age)
+        with self._lock:
+            return sorted(x[1]['version'] for x in self._entries.values() if x[1] is not None)
+
+    def get(self, image):
+        """Obtain the details of one version of WinServer
+
+        :Returns: Dictionary, or None if there's no OVA for that version
+
+        :param image: The image/version of WinServer
+        :type image: String
+        """
+        self.refresh()
+        with self._lock:
+            cached = self._entries.get(convert_name(image), None)
+        if cached is None:
+            return None
+        return cached[1]
+
+
+_CATALOG = None
+_CATALOG_LOCK = threading.Lock()
+
+
+def get_catalog():
+    """Obtain the catalog of ``VLAB_WINSERVER_IMAGES_DIR``, shared by the whole process
+
+    :Returns: ImageCatalog
+    """
+    global _CATALOG
+    with _CATALOG_LOCK:
+        if _CATALOG is None:
+            _CATALOG = ImageCatalog(const.VLAB_WINSERVER_IMAGES_DIR)
+        return _CATALOG
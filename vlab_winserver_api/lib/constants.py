@@ -21,9 +21,58 @@ DEFINED = OrderedDict([
             ('INF_VCENTER_TOP_LVL_DIR', environ.get('INF_VCENTER_TOP_LVL_DIR', 'vlab')),
             ('INF_VCENTER_VERIFY_CERT', environ.get('INF_VCENTER_VERIFY_CERT', False)),
             ('VLAB_MESSAGE_BROKER', environ.get('VLAB_MESSAGE_BROKER', 'winserver-broker')),
+            ('VLAB_WINSERVER_READ_QUEUE', environ.get('VLAB_WINSERVER_READ_QUEUE', 'winserver-read')),
+            ('VLAB_WINSERVER_PROVISION_QUEUE', environ.get('VLAB_WINSERVER_PROVISION_QUEUE', 'winserver-provision')),
+            ('VLAB_WINSERVER_RESULT_BACKEND', environ.get('VLAB_WINSERVER_RESULT_BACKEND', 'rpc://')),
+            ('VLAB_WINSERVER_RESULT_TTL', int(environ.get('VLAB_WINSERVER_RESULT_TTL', 86400))),
+            ('VLAB_WINSERVER_TASK_MAX_WAIT', int(environ.get('VLAB_WINSERVER_TASK_MAX_WAIT', 30))),
+            ('VLAB_WINSERVER_TASK_POLL_INTERVAL', float(environ.get('VLAB_WINSERVER_TASK_POLL_INTERVAL', 1))),
+            ('VLAB_WINSERVER_TASK_STREAM_SECONDS', int(environ.get('VLAB_WINSERVER_TASK_STREAM_SECONDS', 60))),
+            ('VLAB_WINSERVER_TASK_MAX_WAITERS', int(environ.get('VLAB_WINSERVER_TASK_MAX_WAITERS', 16))),
+            ('VLAB_WINSERVER_TASK_RETRY_AFTER', int(environ.get('VLAB_WINSERVER_TASK_RETRY_AFTER', 5))),
             ('VLAB_URL', environ.get('VLAB_URL', 'https://localhost')),
             ('VLAB_WINSERVER_IMAGES_DIR', environ.get('VLAB_WINSERVER_IMAGES_DIR', '/images')),
             ('VLAB_VERIFY_TOKEN', environ.get('VLAB_VERIFY_TOKEN', False)),
+            ('VLAB_WINSERVER_VCENTER_POOL_SIZE', int(environ.get('VLAB_WINSERVER_VCENTER_POOL_SIZE', 4))),
+            ('VLAB_WINSERVER_VCENTER_POOL_TIMEOUT', int(environ.get('VLAB_WINSERVER_VCENTER_POOL_TIMEOUT', 600))),
+            ('VLAB_WINSERVER_VCENTER_KEEPALIVE', int(environ.get('VLAB_WINSERVER_VCENTER_KEEPALIVE', 300))),
+            ('VLAB_WINSERVER_TASK_TIMEOUT', int(environ.get('VLAB_WINSERVER_TASK_TIMEOUT', 600))),
+            ('VLAB_WINSERVER_GUEST_TIMEOUT', int(environ.get('VLAB_WINSERVER_GUEST_TIMEOUT', 1200))),
+            ('VLAB_WINSERVER_BOOT_TIME_TIMEOUT', int(environ.get('VLAB_WINSERVER_BOOT_TIME_TIMEOUT', 60))),
+            ('VLAB_WINSERVER_GUEST_POLL_MIN', int(environ.get('VLAB_WINSERVER_GUEST_POLL_MIN', 5))),
+            ('VLAB_WINSERVER_GUEST_POLL_MAX', int(environ.get('VLAB_WINSERVER_GUEST_POLL_MAX', 30))),
+            ('VLAB_WINSERVER_DEPLOY_MODE', environ.get('VLAB_WINSERVER_DEPLOY_MODE', 'ova')),
+            ('VLAB_WINSERVER_TEMPLATE_DIR', environ.get('VLAB_WINSERVER_TEMPLATE_DIR', 'winserver-templates')),
+            ('VLAB_WINSERVER_TEMPLATE_IMPORT_TIMEOUT', int(environ.get('VLAB_WINSERVER_TEMPLATE_IMPORT_TIMEOUT', environ.get('VLAB_WINSERVER_GUEST_TIMEOUT', 1200)))),
+            ('VLAB_WINSERVER_WARM_POOL', environ.get('VLAB_WINSERVER_WARM_POOL', '')),
+            ('VLAB_WINSERVER_POOL_DIR', environ.get('VLAB_WINSERVER_POOL_DIR', 'winserver-pool')),
+            ('VLAB_WINSERVER_POOL_NETWORK', environ.get('VLAB_WINSERVER_POOL_NETWORK', 'winserver-pool')),
+            ('VLAB_WINSERVER_POOL_REFILL_INTERVAL', int(environ.get('VLAB_WINSERVER_POOL_REFILL_INTERVAL', 60))),
+            ('VLAB_WINSERVER_POOL_REFILL_TTL', int(environ.get('VLAB_WINSERVER_POOL_REFILL_TTL', 1800))),
+            ('VLAB_WINSERVER_POOL_CLAIM_TIMEOUT', int(environ.get('VLAB_WINSERVER_POOL_CLAIM_TIMEOUT', 600))),
+            ('VLAB_WINSERVER_IMAGE_CACHE_TTL', int(environ.get('VLAB_WINSERVER_IMAGE_CACHE_TTL', 30))),
+            ('VLAB_WINSERVER_CACHE_URL', environ.get('VLAB_WINSERVER_CACHE_URL', 'memory://')),
+            ('VLAB_WINSERVER_CACHE_TTL', int(environ.get('VLAB_WINSERVER_CACHE_TTL', 30))),
+            ('VLAB_WINSERVER_CACHE_SIZE', int(environ.get('VLAB_WINSERVER_CACHE_SIZE', 1000))),
+            ('VLAB_WINSERVER_DATASTORES', environ.get('VLAB_WINSERVER_DATASTORES', environ.get('INF_VCENTER_DATASTORE', 'VM-Storage'))),
+            ('VLAB_WINSERVER_RESOURCE_POOLS', environ.get('VLAB_WINSERVER_RESOURCE_POOLS', environ.get('INF_VCENTER_RESORUCE_POOL', 'Resources'))),
+            ('VLAB_WINSERVER_PLACEMENT_POLICY', environ.get('VLAB_WINSERVER_PLACEMENT_POLICY', 'balanced')),
+            ('VLAB_WINSERVER_PLACEMENT_RESERVE', int(environ.get('VLAB_WINSERVER_PLACEMENT_RESERVE', 20))),
+            ('VLAB_WINSERVER_PLACEMENT_TTL', int(environ.get('VLAB_WINSERVER_PLACEMENT_TTL', 60))),
+            ('VLAB_WINSERVER_NETWORK_CACHE_TTL', int(environ.get('VLAB_WINSERVER_NETWORK_CACHE_TTL', 300))),
+            ('VLAB_WINSERVER_CHANGE_FEED', environ.get('VLAB_WINSERVER_CHANGE_FEED', 'false')),
+            ('VLAB_WINSERVER_CHANGE_FEED_WAIT', int(environ.get('VLAB_WINSERVER_CHANGE_FEED_WAIT', 30))),
+            ('VLAB_WINSERVER_BULK_MAX', int(environ.get('VLAB_WINSERVER_BULK_MAX', 50))),
+            ('VLAB_WINSERVER_BULK_CONCURRENCY', int(environ.get('VLAB_WINSERVER_BULK_CONCURRENCY', 4))),
+            ('VLAB_WINSERVER_MAX_USER_DEPLOYS', int(environ.get('VLAB_WINSERVER_MAX_USER_DEPLOYS', 0))),
+            ('VLAB_WINSERVER_MAX_DEPLOYS', int(environ.get('VLAB_WINSERVER_MAX_DEPLOYS', 0))),
+            ('VLAB_WINSERVER_ADMISSION_URL', environ.get('VLAB_WINSERVER_ADMISSION_URL', environ.get('VLAB_WINSERVER_CACHE_URL', 'memory://'))),
+            ('VLAB_WINSERVER_ADMISSION_TTL', int(environ.get('VLAB_WINSERVER_ADMISSION_TTL', 3600))),
+            ('VLAB_WINSERVER_ADMISSION_RETRY_AFTER', int(environ.get('VLAB_WINSERVER_ADMISSION_RETRY_AFTER', 30))),
+            ('VLAB_WINSERVER_ADMISSION_WAIT_TTL', int(environ.get('VLAB_WINSERVER_ADMISSION_WAIT_TTL', 120))),
+            ('VLAB_WINSERVER_IDEMPOTENCY_TTL', int(environ.get('VLAB_WINSERVER_IDEMPOTENCY_TTL', 3600))),
+            ('VLAB_WINSERVER_METRICS_DIR', environ.get('VLAB_WINSERVER_METRICS_DIR', '/tmp/vlab-winserver-metrics')),
+            ('VLAB_WINSERVER_METRICS_TTL', int(environ.get('VLAB_WINSERVER_METRICS_TTL', 86400))),
           ])
 
 Constants = namedtuple('Constants', list(DEFINED.keys()))
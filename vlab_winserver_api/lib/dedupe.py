@@ -0,0 +1,187 @@
+# -*- coding: UTF-8 -*-
+"""
+Stops a retried request from queueing the same work twice.
+
+Clients retry ``POST /api/2/inf/winserver`` when it times out, and every retry
+used to queue another deploy of the same VM. That deploy only failed on the
+name collision after the whole OVA was uploaded. Two checks catch the retries:
+
+- An idempotency key: a request that reuses the ``Idempotency-Key`` (or
+  ``X-REQUEST-ID``) header of an earlier one, with the same body, gets the
+  task id of the earlier request back.
+- A claim per VM: while a create (or delete) of a VM is in flight, another
+  create (or delete) of it gets the task id of the one in flight.
+
+The task gives the claim back when it finishes. A claim whose task the result
+backend reports as done, or that's older than ``VLAB_WINSERVER_IDEMPOTENCY_TTL``
+seconds, no longer counts. Both live in ``VLAB_WINSERVER_CACHE_URL``, so the
+API and the worker must share a ``sqlite:///`` store for the worker to give
+claims back.
+"""
+import hashlib
+import threading
+
+import ujson
+
+from vlab_winserver_api.lib import const
+from vlab_winserver_api.lib.metrics import REGISTRY
+from vlab_winserver_api.lib.store import get_store
+
+
+class Deduplicator(object):
+    """Remembers which task is handling a request, or a VM
+
+    :param store: Where to keep the task ids
+    :type store: vlab_winserver_api.lib.store.MemoryStore
+
+    :param ttl: How many seconds to remember a request, or a claim
+    :type ttl: Integer
+    """
+    def __init__(self, store, ttl):
+        self._store = store
+        self.ttl = ttl
+
+    def replay(self, username, key, fingerprint):
+        """Find the task of an earlier request with the same idempotency key and body
+
+        :Returns: String - the task id, or None if this isn't a retry
+
+        :param username: The user who sent the request
+        :type username: String
+
+        :param key: The idempotency key the client supplied; empty if none
+        :type key: String
+
+        :param fingerprint: Identifies the end point and body of the request; see ``fingerprint``
+        :type fingerprint: String
+        """
+        if not key:
+            return None
+        entry = self._store.get(_request_key(username, key))
+        if entry is None or entry['fingerprint'] != fingerprint:
+            # The same key with a different body is a different request
+            return None
+        REGISTRY.inc('winserver_deduplicated_total', reason='idempotency-key')
+        return entry['task-id']
+
+    def remember(self, username, key, fingerprint, task_id):
+        """Record the task queued for a request, so a retry gets the same task
+
+        :Returns: None
+
+        :param username: The user who sent the request
+        :type username: String
+
+        :param key: The idempotency key the client supplied; empty if none
+        :type key: String
+
+        :param fingerprint: Identifies the end point and body of the request; see ``fingerprint``
+        :type fingerprint: String
+
+        :param task_id: The id of the task queued for the request
+        :type task_id: String
+        """
+        if key:
+            self._store.set(_request_key(username, key), {'fingerprint': fingerprint, 'task-id': task_id}, ttl=self.ttl)
+
+    def claim(self, action, username, machine_name, task_id, finished=None, ttl=None):
+        """Mark a VM as having a task in flight, unless it already does
+
+        :Returns: String - the id of the task already in flight, or None if the claim is ours
+
+        :param action: What the task does to the VM, i.e. ``create``
+        :type action: String
+
+        :param username: The user who owns the VM
+        :type username: String
+
+        :param machine_name: The name of the VM
+        :type machine_name: String
+
+        :param task_id: The id of the task about to be queued
+        :type task_id: String
+
+        :param finished: Optional - Called with a task id; returns True if that task is done
+        :type finished: Function
+
+        :param ttl: Optional - How many seconds the claim lasts if it's never given back
+        :type ttl: Integer
+        """
+        key = _claim_key(action, username, machine_name)
+        ttl = ttl if ttl else self.ttl
+        owner = self._store.setdefault(key, task_id, ttl=ttl)
+        if owner == task_id:
+            return None
+        if finished is not None and finished(owner):
+            # The task finished, but never gave the claim back
+            self._store.set(key, task_id, ttl=ttl)
+            return None
+        REGISTRY.inc('winserver_deduplicated_total', reason='in-flight')
+        return owner
+
+    def finish(self, action, username, machine_name, task_id):
+        """Give back the claim on a VM, once the task is done with it
+
+        :Returns: None
+
+        :param action: What the task did to the VM, i.e. ``create``
+        :type action: String
+
+        :param username: The user who owns the VM
+        :type username: String
+
+        :param machine_name: The name of the VM
+        :type machine_name: String
+
+        :param task_id: The id of the task that held the claim
+        :type task_id: String
+        """
+        key = _claim_key(action, username, machine_name)
+        if self._store.get(key) == task_id:
+            self._store.delete(key)
+
+
+def fingerprint(method, path, body):
+    """Identify a request by its end point and body, so reusing an idempotency
+    key for a different request isn't mistaken for a retry
+
+    :Returns: String
+
+    :param method: The HTTP verb
+    :type method: String
+
+    :param path: The URL path of the end point
+    :type path: String
+
+    :param body: The API params supplied by the user
+    :type body: Dictionary
+    """
+    data = '{} {} {}'.format(method, path, ujson.dumps(body, sort_keys=True))
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def _request_key(username, key):
+    return 'request:{}:{}'.format(username, key)
+
+
+def _claim_key(action, username, machine_name):
+    return 'claim:{}:{}:{}'.format(action, username, machine_name)
+
+
+_DEDUPLICATOR = None
+_DEDUPLICATOR_LOCK = threading.Lock()
+
+
+def get_deduplicator():
+    """Obtain the deduplicator set by ``VLAB_WINSERVER_CACHE_URL``, shared by the whole process
+
+    :Returns: Deduplicator
+    """
+    global _DEDUPLICATOR
+    with _DEDUPLICATOR_LOCK:
+        if _DEDUPLICATOR is None:
+            store = get_store(const.VLAB_WINSERVER_CACHE_URL,
+                              ttl=const.VLAB_WINSERVER_IDEMPOTENCY_TTL,
+                              max_size=const.VLAB_WINSERVER_CACHE_SIZE)
+            _DEDUPLICATOR = Deduplicator(store, ttl=const.VLAB_WINSERVER_IDEMPOTENCY_TTL)
+        return _DEDUPLICATOR
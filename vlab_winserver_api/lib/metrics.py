@@ -0,0 +1,277 @@
+# -*- coding: UTF-8 -*-
+"""
+Simple in-process counters, gauges and observations.
+
+Celery runs tasks in several worker processes, so every process keeps its own
+registry and writes it to ``VLAB_WINSERVER_METRICS_DIR`` as
+``<hostname>-<pid>.json``; the hostname keeps containers that share the
+directory from overwriting each other.
+Calling ``collect`` merges those files into one view of the whole worker, and
+``render`` formats that view for Prometheus. It also deletes the files of
+processes that are gone: a pid that no longer runs on this host, or a file no
+process has written in ``VLAB_WINSERVER_METRICS_TTL`` seconds (i.e. from a
+container that was replaced). Their counters drop out of the totals, which
+Prometheus treats like a restart.
+
+Labels must come from a small, fixed set of values (a task name, an HTTP
+verb, a vCenter method), never from user input like a username. Every label
+value is a separate time series.
+"""
+import os
+import re
+import glob
+import socket
+import time
+import threading
+
+import ujson
+
+from vlab_winserver_api.lib import const
+
+
+class Registry(object):
+    """Holds the metrics of one process; safe to use from many threads"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._observations = {}
+
+    def inc(self, name, amount=1, **labels):
+        """Add to a counter
+
+        :Returns: None
+
+        :param name: The name of the metric
+        :type name: String
+
+        :param amount: How much to add to the counter
+        :type amount: Integer or Float
+        """
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        """Record the current value of something, like the size of a pool
+
+        :Returns: None
+
+        :param name: The name of the metric
+        :type name: String
+
+        :param value: The current value
+        :type value: Integer or Float
+        """
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        """Record one sample of something, like how long a task took
+
+        :Returns: None
+
+        :param name: The name of the metric
+        :type name: String
+
+        :param value: The sample
+        :type value: Integer or Float
+        """
+        key = _key(name, labels)
+        with self._lock:
+            count, total, biggest = self._observations.get(key, (0, 0, value))
+            self._observations[key] = (count + 1, total + value, max(biggest, value))
+
+    def snapshot(self):
+        """Obtain every metric in a JSON friendly format
+
+        :Returns: Dictionary
+        """
+        with self._lock:
+            counters = [[x[0], dict(x[1]), y] for x, y in self._counters.items()]
+            gauges = [[x[0], dict(x[1]), y] for x, y in self._gauges.items()]
+            observations = [[x[0], dict(x[1]), list(y)] for x, y in self._observations.items()]
+        return {'counters': counters, 'gauges': gauges, 'observations': observations}
+
+    def clear(self):
+        """Forget every metric
+
+        :Returns: None
+        """
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._observations.clear()
+
+
+def _key(name, labels):
+    """Metrics with the same name and labels are the same metric
+
+    :Returns: Tuple
+    """
+    return (name, tuple(sorted(labels.items())))
+
+
+def dump(registry=None, directory=None):
+    """Write the metrics of this process to disk, so ``collect`` can see them
+
+    :Returns: None
+
+    :param registry: The metrics to write. Defaults to ``REGISTRY``
+    :type registry: Registry
+
+    :param directory: Where to write the metrics. Defaults to ``VLAB_WINSERVER_METRICS_DIR``
+    :type directory: String
+    """
+    registry = registry or REGISTRY
+    directory = directory or const.VLAB_WINSERVER_METRICS_DIR
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '{}-{}.json'.format(socket.gethostname(), os.getpid()))
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as the_file:
+        the_file.write(ujson.dumps(registry.snapshot()))
+    # rename is atomic, so readers never see a partial file
+    os.rename(tmp_path, path)
+
+
+def collect(directory=None):
+    """Merge the metrics written by every process
+
+    Counters and observations are summed. Gauges describe the whole system, not
+    one process, so the most recently written value wins.
+
+    :Returns: Dictionary
+
+    :param directory: Where the metrics were written. Defaults to ``VLAB_WINSERVER_METRICS_DIR``
+    :type directory: String
+    """
+    directory = directory or const.VLAB_WINSERVER_METRICS_DIR
+    paths = sorted(glob.glob(os.path.join(directory, '*.json')), key=_mtime)
+    merged = Registry()
+    for path in paths:
+        if _is_stale(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path) as the_file:
+                snapshot = ujson.load(the_file)
+        except (OSError, ValueError):
+            # the process exited and its file got cleaned up, or a bad write
+            continue
+        for name, labels, value in snapshot.get('counters', []):
+            merged.inc(name, value, **labels)
+        for name, labels, value in snapshot.get('gauges', []):
+            merged.set(name, value, **labels)
+        for name, labels, (count, total, biggest) in snapshot.get('observations', []):
+            key = _key(name, labels)
+            old_count, old_total, old_biggest = merged._observations.get(key, (0, 0, biggest))
+            merged._observations[key] = (old_count + count, old_total + total, max(old_biggest, biggest))
+    return merged.snapshot()
+
+
+def render(snapshot):
+    """Format metrics in the Prometheus text exposition format
+
+    Observations become a summary (``_count`` and ``_sum``) plus a ``_max`` gauge.
+
+    :Returns: String
+
+    :param snapshot: The metrics, i.e. the output of ``collect``
+    :type snapshot: Dictionary
+    """
+    families = {}
+    for name, labels, value in snapshot.get('counters', []):
+        families.setdefault((name, 'counter'), []).append((name, labels, value))
+    for name, labels, value in snapshot.get('gauges', []):
+        families.setdefault((name, 'gauge'), []).append((name, labels, value))
+    for name, labels, (count, total, biggest) in snapshot.get('observations', []):
+        families.setdefault((name, 'summary'), []).extend([('{}_count'.format(name), labels, count),
+                                                           ('{}_sum'.format(name), labels, total)])
+        families.setdefault(('{}_max'.format(name), 'gauge'), []).append(('{}_max'.format(name), labels, biggest))
+    lines = []
+    for (name, kind), samples in sorted(families.items()):
+        lines.append('# TYPE {} {}'.format(_metric_name(name), kind))
+        for sample_name, labels, value in sorted(samples, key=lambda x: (x[0], sorted(x[1].items()))):
+            lines.append('{}{} {}'.format(_metric_name(sample_name), _format_labels(labels), float(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def _metric_name(name):
+    """Replace the characters Prometheus does not allow in a metric name
+
+    :Returns: String
+    """
+    return re.sub(r'[^a-zA-Z0-9_:]', '_', name)
+
+
+def _format_labels(labels):
+    """Format labels like ``{verb="GET",status="200"}``
+
+    :Returns: String
+    """
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in sorted(labels.items()):
+        value = '{}'.format(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('{}="{}"'.format(_metric_name(key), value))
+    return '{{{}}}'.format(','.join(pairs))
+
+
+def stamp_sent(headers=None, **kwargs):
+    """Record when a task was queued; connect to Celery's ``before_task_publish``
+    signal wherever tasks get sent, so the worker can measure how long they waited
+
+    :Returns: None
+    """
+    if headers is not None:
+        headers['winserver_sent_at'] = time.time()
+
+
+def _is_stale(path):
+    """Check if the process that wrote a metrics file is gone
+
+    :Returns: Boolean
+
+    :param path: A file written by ``dump``
+    :type path: String
+    """
+    if time.time() - _mtime(path) > const.VLAB_WINSERVER_METRICS_TTL:
+        return True
+    hostname, _, pid = os.path.basename(path)[:-len('.json')].rpartition('-')
+    if hostname != socket.gethostname() or not pid.isdigit():
+        # Only processes on this host can be checked
+        return False
+    return not _alive(int(pid))
+
+
+def _alive(pid):
+    """Check if a process is running on this host
+
+    :Returns: Boolean
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It exists, but belongs to another user
+        return True
+    return True
+
+
+def _mtime(path):
+    """Sort key for ``collect``; deleted files sort first, and get skipped
+
+    :Returns: Float
+    """
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+
+REGISTRY = Registry()
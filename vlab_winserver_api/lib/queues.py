@@ -0,0 +1,79 @@
+# -*- coding: UTF-8 -*-
+"""
+Which Celery queue, and at what priority, every task is sent to.
+
+Answering ``winserver.show`` takes under a second, but creating a WinServer
+can take half an hour. When both share a queue, a burst of creates leaves the
+shows waiting behind them. So the tasks are split by how long they take:
+
+- ``VLAB_WINSERVER_READ_QUEUE`` holds the tasks that only read from vCenter.
+- ``VLAB_WINSERVER_PROVISION_QUEUE`` holds the tasks that change VMs.
+
+Give each queue its own workers (``celery worker -Q <queue>``) so reads never
+wait on a free provisioning worker; see the README. A worker started without
+``-Q`` consumes both queues.
+
+Within a queue, a higher priority goes first (RabbitMQ only honors priorities
+on queues declared with ``x-max-priority``). Finishing a create that's in
+flight beats starting a new one, and refilling the warm pool goes last.
+"""
+from kombu import Queue
+
+from vlab_winserver_api.lib import const
+
+
+MAX_PRIORITY = 9
+DEFAULT_PRIORITY = 5
+
+READ_TASKS = {
+    'winserver.show': 9,
+    'winserver.image': 8,
+    'winserver.pool': 8,
+}
+PROVISION_TASKS = {
+    'winserver.delete': 7,
+    'winserver.delete_many': 7,
+    'winserver.modify_network': 7,
+    'winserver.modify_networks': 7,
+    'winserver.create.wait_for_guest': 6,
+    'winserver.create.configure_ip': 6,
+    'winserver.create.finalize': 6,
+    'winserver.create_many.wait_for_guests': 6,
+    'winserver.create_many.configure_ips': 6,
+    'winserver.create_many.finalize': 6,
+    'winserver.create': 4,
+    'winserver.create_many': 4,
+    'winserver.pool.refill': 1,
+}
+
+
+def routes():
+    """Map every task name to its queue and priority, in the format of ``task_routes``
+
+    :Returns: Dictionary
+    """
+    task_routes = {}
+    for queue, priorities in ((const.VLAB_WINSERVER_READ_QUEUE, READ_TASKS),
+                              (const.VLAB_WINSERVER_PROVISION_QUEUE, PROVISION_TASKS)):
+        for name, priority in priorities.items():
+            task_routes[name] = {'queue': queue, 'routing_key': queue, 'priority': priority}
+    return task_routes
+
+
+def configure(celery_app):
+    """Set the queues and routes of a Celery app; the API and the worker must agree
+
+    :Returns: None
+
+    :param celery_app: The app that sends or runs the tasks
+    :type celery_app: celery.Celery
+    """
+    celery_app.conf.task_queues = [Queue(const.VLAB_WINSERVER_READ_QUEUE, routing_key=const.VLAB_WINSERVER_READ_QUEUE),
+                                   Queue(const.VLAB_WINSERVER_PROVISION_QUEUE, routing_key=const.VLAB_WINSERVER_PROVISION_QUEUE)]
+    celery_app.conf.task_default_queue = const.VLAB_WINSERVER_PROVISION_QUEUE
+    celery_app.conf.task_routes = routes()
+    celery_app.conf.task_queue_max_priority = MAX_PRIORITY
+    celery_app.conf.task_default_priority = DEFAULT_PRIORITY
+    # A worker that prefetches a pile of creates holds them back from other
+    # workers, and they'd skip the priority ordering of the queue.
+    celery_app.conf.worker_prefetch_multiplier = 1
@@ -0,0 +1,172 @@
+# -*- coding: UTF-8 -*-
+"""
+Where the API finds the results of the tasks it queued.
+
+With ``rpc://``, a result is sent back to the API process that queued the
+task. Another uWSGI worker answering the status poll never sees it, and a
+restart loses it. So a deployment should send the results to a store every
+process can read, picked with ``VLAB_WINSERVER_RESULT_BACKEND``:
+
+- ``sqlite:////some/path.db`` keeps the results in a SQLite file (see
+  ``SqliteBackend``). The path must be on a volume that the API and every
+  worker mount; a file only one container can see just hides the results
+  from the others.
+- Any other URL goes to Celery as is, i.e. ``redis://`` or ``file:///``.
+
+Without it, the default stays ``rpc://``.
+
+Results expire after ``VLAB_WINSERVER_RESULT_TTL`` seconds. Celery beat runs
+the daily ``celery.backend_cleanup`` task that deletes them.
+"""
+import time
+import zlib
+import sqlite3
+
+from celery.backends.base import KeyValueStoreBackend
+from kombu.utils.encoding import bytes_to_str, str_to_bytes
+
+from vlab_winserver_api.lib import const
+
+
+SQLITE_BACKEND = 'vlab_winserver_api.lib.results:SqliteBackend'
+
+
+class SqliteBackend(KeyValueStoreBackend):
+    """A Celery result backend that keeps the results in a SQLite file
+
+    Checking the status of a task is one lookup by primary key, and the file
+    is in WAL mode, so polling never blocks a worker that's saving a result.
+    Big results, like the ``show`` of a user with dozens of VMs, are stored
+    compressed.
+
+    :param url: The location of the SQLite database file, i.e. ``sqlite:////var/cache/vlab/results.db``
+    :type url: String
+    """
+    # Results smaller than this many bytes don't shrink enough to be worth compressing
+    COMPRESS_OVER = 1024
+
+    def __init__(self, url=None, *args, **kwargs):
+        super(SqliteBackend, self).__init__(url=url, *args, **kwargs)
+        if not url or not url.startswith('sqlite:///'):
+            raise ValueError('Unsupported result backend URL: {}'.format(url))
+        self.path = url[len('sqlite:///'):]
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, compressed INTEGER, expires REAL)')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        """Open a connection per call, so the backend survives a fork
+
+        :Returns: sqlite3.Connection
+        """
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, key):
+        """Obtain one stored result
+
+        :Returns: Bytes, or None if the key is missing or expired
+
+        :param key: The name of the result, i.e. ``celery-task-meta-<task id>``
+        :type key: Bytes
+        """
+        return self.mget([key])[0]
+
+    def mget(self, keys):
+        """Obtain many stored results with one query
+
+        :Returns: List - the value of each key, in order; None for the missing ones
+
+        :param keys: The names of the results
+        :type keys: List
+        """
+        keys = [bytes_to_str(x) for x in keys]
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT key, value, compressed FROM results WHERE key IN ({}) AND (expires IS NULL OR expires >= ?)'.format(', '.join('?' * len(keys))),
+                                keys + [time.time()]).fetchall()
+        finally:
+            conn.close()
+        found = {x: zlib.decompress(y) if compressed else bytes(y) for x, y, compressed in rows}
+        return [found.get(x, None) for x in keys]
+
+    def set(self, key, value):
+        """Store a result, replacing the last one stored under the key
+
+        :Returns: None
+
+        :param key: The name of the result
+        :type key: Bytes
+
+        :param value: The encoded result
+        :type value: String or Bytes
+        """
+        value = str_to_bytes(value)
+        compressed = len(value) > self.COMPRESS_OVER
+        if compressed:
+            value = zlib.compress(value)
+        expires = time.time() + self.expires if self.expires else None
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO results (key, value, compressed, expires) VALUES (?, ?, ?, ?)',
+                             (bytes_to_str(key), sqlite3.Binary(value), int(compressed), expires))
+        finally:
+            conn.close()
+
+    def delete(self, key):
+        """Remove a stored result
+
+        :Returns: None
+
+        :param key: The name of the result
+        :type key: Bytes
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM results WHERE key = ?', (bytes_to_str(key),))
+        finally:
+            conn.close()
+
+    def cleanup(self):
+        """Delete the expired results; ran daily by Celery beat
+
+        :Returns: None
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM results WHERE expires < ?', (time.time(),))
+        finally:
+            conn.close()
+
+
+def backend_url(url):
+    """Translate a ``VLAB_WINSERVER_RESULT_BACKEND`` URL into a Celery ``result_backend``
+
+    :Returns: String
+
+    :param url: Where to keep the task results
+    :type url: String
+    """
+    if url.startswith('sqlite:///'):
+        # Celery reads "<class>+<url>" as: make a <class>, and pass it <url>
+        return '{}+{}'.format(SQLITE_BACKEND, url)
+    return url
+
+
+def configure(celery_app):
+    """Set where a Celery app keeps the task results; the API and the worker must agree
+
+    :Returns: None
+
+    :param celery_app: The app that sends or runs the tasks
+    :type celery_app: celery.Celery
+    """
+    celery_app.conf.result_backend = backend_url(const.VLAB_WINSERVER_RESULT_BACKEND)
+    celery_app.conf.result_expires = const.VLAB_WINSERVER_RESULT_TTL
+    celery_app.conf.result_serializer = 'json'
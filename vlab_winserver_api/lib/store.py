@@ -0,0 +1,245 @@
+# -*- coding: UTF-8 -*-
+"""
+Small key/value stores with expiring keys, shared by the API and the worker.
+
+Pick one with ``VLAB_WINSERVER_CACHE_URL``:
+
+- ``memory://`` keeps an LRU in the current process. The API and the worker
+  don't see each other's keys.
+- ``sqlite:////some/path.db`` keeps the keys in a SQLite file. The API and the
+  worker share the keys when they mount the same volume.
+
+Values must be JSON serializable. A store that fails acts like an empty
+store, so a broken cache never breaks a request.
+"""
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import ujson
+from vlab_api_common import get_logger
+
+from vlab_winserver_api.lib import const
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_WINSERVER_LOG_LEVEL)
+
+
+class MemoryStore(object):
+    """An in-process LRU, where every key also expires
+
+    :param max_size: The most keys to hold before evicting the least recently used
+    :type max_size: Integer
+
+    :param ttl: The default number of seconds a key lives
+    :type ttl: Integer
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        """Obtain the value of a key
+
+        :Returns: The value, or None if the key is missing or expired
+
+        :param key: The name of the value
+        :type key: String
+        """
+        with self._lock:
+            item = self._data.get(key, None)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store a value
+
+        :Returns: None
+
+        :param key: The name of the value
+        :type key: String
+
+        :param value: The thing to store
+        :type value: Object
+
+        :param ttl: How many seconds to keep the key. Defaults to the store TTL.
+        :type ttl: Integer
+        """
+        expires = time.time() + (ttl or self.ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def setdefault(self, key, value, ttl=None):
+        """Store a value, unless the key already has one; checking and storing are atomic
+
+        :Returns: The value the key now has
+
+        :param key: The name of the value
+        :type key: String
+
+        :param value: The thing to store
+        :type value: Object
+
+        :param ttl: How many seconds to keep the key. Defaults to the store TTL.
+        :type ttl: Integer
+        """
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key, None)
+            if item is not None and item[0] >= now:
+                return item[1]
+            self._data[key] = (now + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+            return value
+
+    def delete(self, key):
+        """Remove a key
+
+        :Returns: None
+
+        :param key: The name of the value
+        :type key: String
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class SqliteStore(object):
+    """Keys in a SQLite file, so many processes (or containers) can share them
+
+    :param path: The location of the SQLite database file
+    :type path: String
+
+    :param ttl: The default number of seconds a key lives
+    :type ttl: Integer
+    """
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._execute('CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+
+    def _execute(self, sql, params=()):
+        """Run one statement in its own connection, so the store survives a fork
+
+        :Returns: List
+        """
+        try:
+            conn = sqlite3.connect(self.path, timeout=5)
+            try:
+                with conn:
+                    return conn.execute(sql, params).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as doh:
+            logger.error('Store {} failed: {}'.format(self.path, doh))
+            return []
+
+    def get(self, key):
+        """Obtain the value of a key
+
+        :Returns: The value, or None if the key is missing or expired
+
+        :param key: The name of the value
+        :type key: String
+        """
+        rows = self._execute('SELECT value FROM store WHERE key = ? AND expires >= ?', (key, time.time()))
+        if not rows:
+            return None
+        return ujson.loads(rows[0][0])
+
+    def set(self, key, value, ttl=None):
+        """Store a value
+
+        :Returns: None
+
+        :param key: The name of the value
+        :type key: String
+
+        :param value: The thing to store
+        :type value: Object
+
+        :param ttl: How many seconds to keep the key. Defaults to the store TTL.
+        :type ttl: Integer
+        """
+        now = time.time()
+        self._execute('INSERT OR REPLACE INTO store (key, value, expires) VALUES (?, ?, ?)',
+                      (key, ujson.dumps(value), now + (ttl or self.ttl)))
+        self._execute('DELETE FROM store WHERE expires < ?', (now,))
+
+    def setdefault(self, key, value, ttl=None):
+        """Store a value, unless the key already has one; checking and storing
+        happen in one transaction, so only one process wins
+
+        :Returns: The value the key now has
+
+        :param key: The name of the value
+        :type key: String
+
+        :param value: The thing to store
+        :type value: Object
+
+        :param ttl: How many seconds to keep the key. Defaults to the store TTL.
+        :type ttl: Integer
+        """
+        now = time.time()
+        try:
+            conn = sqlite3.connect(self.path, timeout=5)
+            try:
+                with conn:
+                    conn.execute('DELETE FROM store WHERE key = ? AND expires < ?', (key, now))
+                    conn.execute('INSERT OR IGNORE INTO store (key, value, expires) VALUES (?, ?, ?)',
+                                 (key, ujson.dumps(value), now + (ttl or self.ttl)))
+                    rows = conn.execute('SELECT value FROM store WHERE key = ?', (key,)).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as doh:
+            logger.error('Store {} failed: {}'.format(self.path, doh))
+            return value
+        return ujson.loads(rows[0][0])
+
+    def delete(self, key):
+        """Remove a key
+
+        :Returns: None
+
+        :param key: The name of the value
+        :type key: String
+        """
+        self._execute('DELETE FROM store WHERE key = ?', (key,))
+
+
+def get_store(url, ttl, max_size):
+    """Make a store from a URL like ``memory://`` or ``sqlite:////path/to/file.db``
+
+    :Returns: MemoryStore or SqliteStore
+
+    :Raises: ValueError for an unsupported URL
+
+    :param url: Which store to use
+    :type url: String
+
+    :param ttl: The default number of seconds a key lives
+    :type ttl: Integer
+
+    :param max_size: The most keys an in-memory store holds
+    :type max_size: Integer
+    """
+    if url.startswith('memory://'):
+        return MemoryStore(max_size, ttl)
+    elif url.startswith('sqlite:///'):
+        return SqliteStore(url[len('sqlite:///'):], ttl)
+    raise ValueError('Unsupported store URL: {}'.format(url))
@@ -1,3 +1,4 @@
 # -*- coding: UTF-8 -*-
 from .healthcheck import HealthView
+from .metrics import MetricsView, track_requests
 from .winserver import WinServerView
@@ -0,0 +1,81 @@
+# -*- coding: UTF-8 -*-
+"""
+Exposes the metrics of the API and the worker to Prometheus
+"""
+import time
+import threading
+
+from flask import g, request
+from flask_classy import FlaskView, Response
+
+from vlab_winserver_api.lib import metrics
+from vlab_winserver_api.lib.metrics import REGISTRY
+
+
+# Most seconds between writing the request metrics of this process to disk
+DUMP_INTERVAL = 5
+
+_LAST_DUMP = 0
+_DUMP_LOCK = threading.Lock()
+
+
+class MetricsView(FlaskView):
+    """
+    End point for Prometheus to scrape
+
+    Merges what every API and worker process wrote to
+    ``VLAB_WINSERVER_METRICS_DIR``, so one scrape covers the whole service when
+    the API and worker share that directory.
+    """
+    route_base = '/metrics'
+    trailing_slash = False
+
+    def get(self):
+        """End point for Prometheus"""
+        _dump(force=True)
+        response = Response(metrics.render(metrics.collect()))
+        response.status_code = 200
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return response
+
+
+def track_requests(app):
+    """Count the requests of a Flask app, and record how long they took, by verb and route
+
+    The route is the URL rule (i.e. ``/api/2/inf/winserver/task/<tid>``), not
+    the URL, so a task id or username never becomes a label.
+
+    :Returns: None
+
+    :param app: The application to instrument
+    :type app: flask.Flask
+    """
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.time()
+
+    @app.after_request
+    def record_request(response):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REGISTRY.inc('winserver_http_requests_total', verb=request.method, route=route, status=response.status_code)
+        started = g.get('metrics_start', None)
+        if started is not None:
+            REGISTRY.observe('winserver_http_request_seconds', time.time() - started, verb=request.method, route=route)
+        _dump()
+        return response
+
+
+def _dump(force=False):
+    """Write the metrics of this process to disk, at most once every ``DUMP_INTERVAL`` seconds
+
+    :Returns: None
+    """
+    global _LAST_DUMP
+    with _DUMP_LOCK:
+        if not force and time.time() - _LAST_DUMP < DUMP_INTERVAL:
+            return
+        _LAST_DUMP = time.time()
+    try:
+        metrics.dump()
+    except OSError:
+        pass
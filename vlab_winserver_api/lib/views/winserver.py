@@ -2,19 +2,36 @@
 """
 Defines the RESTful API for managing instances of Microsoft Server
 """
+import re
+import time
+import uuid
+import hashlib
+import threading
+
 import ujson
+from celery.states import READY_STATES
 from flask import current_app
+from kombu.exceptions import OperationalError
 from flask_classy import request, route, Response
+from werkzeug.datastructures import ETags
 from vlab_inf_common.views import MachineView
 from vlab_inf_common.vmware import vCenter, vim
 from vlab_inf_common.input_validators import network_config_ok
 from vlab_api_common import describe, get_logger, requires, validate_input
 
 
-from vlab_winserver_api.lib import const
+from vlab_winserver_api.lib import const, catalog, admission, dedupe
+from vlab_winserver_api.lib.cache import get_cache
 
 
 logger = get_logger(__name__, loglevel=const.VLAB_WINSERVER_LOG_LEVEL)
+# Seconds between comments sent on a quiet event stream
+_KEEPALIVE = 15
+# The long-polls and event streams this process holds open; each one holds a uWSGI thread
+_WAITERS = threading.BoundedSemaphore(const.VLAB_WINSERVER_TASK_MAX_WAITERS)
+# The rule deploy_from_ova enforces; checked here so every create path (OVA,
+# linked clone and warm pool) holds names to it before a task is queued
+_HOSTNAME_REGEX = re.compile(r'^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$')
 
 
 class WinServerView(MachineView):
@@ -76,21 +93,130 @@ class WinServerView(MachineView):
                      },
                      "required": ["name"]
                     }
+    BULK_POST_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                        "type": "object",
+                        "description": "Create many identical WinServers at once",
+                        "properties": {
+                            "names": {
+                                "description": "The names to give the WinServer instances",
+                                "type": "array",
+                                "items": {"type": "string"}
+                            },
+                            "name-prefix": {
+                                "description": "Instead of names, create count instances named <prefix>1, <prefix>2, etc",
+                                "type": "string"
+                            },
+                            "count": {
+                                "description": "How many instances to create with name-prefix",
+                                "type": "integer",
+                                "minimum": 1
+                            },
+                            "image": {
+                                "description": "The image/version of WinServer to create",
+                                "type": "string"
+                            },
+                            "network": {
+                                "description": "The network to hook the WinServer instances up to",
+                                "type": "string"
+                            },
+                            "ip-config": {
+                                "description": "The gateway, netmask and DNS servers shared by every instance that gets a static IP",
+                                "type": "object"
+                            },
+                            "static-ips": {
+                                "description": "Supply to have static IPs configured; one IPv4 address per instance, in order",
+                                "type": "array",
+                                "items": {"type": "string"}
+                            },
+                        },
+                        "required": ["image", "network"]
+                       }
+    BULK_DELETE_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                          "description": "Destroy many WinServers at once",
+                          "type": "object",
+                          "properties": {
+                             "names": {
+                                 "description": "The names of the WinServer instances to destroy",
+                                 "type": "array",
+                                 "items": {"type": "string"}
+                             },
+                             "all": {
+                                 "description": "Set to true to destroy every WinServer you own",
+                                 "type": "boolean"
+                             }
+                          }
+                         }
+    NETWORK_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                      "type": "object",
+                      "description": "Move one, or many WinServers to a different network",
+                      "properties": {
+                         "name": {
+                            "description": "The name of the WinServer instance",
+                            "type": "string"
+                         },
+                         "new_network": {
+                            "description": "The name of the network to connect the WinServer to",
+                            "type": "string"
+                         },
+                         "changes": {
+                            "description": "Instead of name and new_network, move many WinServers at once",
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "name": {"type": "string"},
+                                    "new_network": {"type": "string"}
+                                },
+                                "required": ["name", "new_network"]
+                            }
+                         }
+                      }
+                     }
     GET_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
                   "description": "Display the WinServer instances you own"
                  }
     IMAGES_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
                      "description": "View available versions of WinServer that can be created"
                     }
+    POOL_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                   "description": "View the size of the warm pool, and the hit/miss counts"
+                  }
+    TASK_ARGS = {"$schema": "http://json-schema.org/draft-04/schema#",
+                 "type": "object",
+                 "properties": {
+                    "task-id": {
+                        "description": "The Task Id. Optionally index the URL with the task id",
+                        "type": "string"
+                    },
+                    "wait": {
+                        "description": "Seconds to hold the request until the status changes; send the last ETag as If-None-Match",
+                        "type": "number",
+                        "minimum": 0,
+                        "maximum": const.VLAB_WINSERVER_TASK_MAX_WAIT
+                    }
+                 },
+                 "required": ["task-id"]
+                }
 
 
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
     @describe(post=POST_SCHEMA, delete=DELETE_SCHEMA, get=GET_SCHEMA)
     def get(self, *args, **kwargs):
-        """Display the WinServer instances you own"""
+        """Display the WinServer instances you own
+
+        Answers from the inventory cache when it can, without console URLs;
+        supply ``?async=true`` to always get a task-id, and fresh console URLs.
+        """
         username = kwargs['token']['username']
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
         resp_data = {'user' : username}
+        if not _wants_async():
+            cached = get_cache().get(username)
+            if cached is not None:
+                resp_data['content'] = cached
+                resp = Response(ujson.dumps(resp_data))
+                resp.status_code = 200
+                return resp
         task = current_app.celery_app.send_task('winserver.show', [username, txn_id])
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
@@ -101,7 +227,12 @@ class WinServerView(MachineView):
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
     @validate_input(schema=POST_SCHEMA)
     def post(self, *args, **kwargs):
-        """Create a WinServer"""
+        """Create a WinServer
+
+        A retry of a request (same ``Idempotency-Key`` or ``X-REQUEST-ID``, and
+        body), or a create of a WinServer that's already being created, gets
+        the task-id of the create in flight instead of queueing another.
+        """
         username = kwargs['token']['username']
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
         resp_data = {'user' : username}
@@ -110,41 +241,277 @@ class WinServerView(MachineView):
         image = body['image']
         network = '{}_{}'.format(username, body['network'])
         ip_config, error = _get_ip_config(body.get('ip-config', {}))
+        error = _name_error(machine_name) or error
+        if error:
+            resp_data['error'] = error
+            resp = Response(ujson.dumps(resp_data))
+            resp.status_code = 400
+            return resp
+        key, fingerprint = _idempotency_key(), dedupe.fingerprint(request.method, request.path, body)
+        deduplicator = dedupe.get_deduplicator()
+        replayed = deduplicator.replay(username, key, fingerprint)
+        if replayed is not None:
+            return _accepted(resp_data, self.route_base, replayed)
+        task_id = str(uuid.uuid4())
+        in_flight = deduplicator.claim('create', username, machine_name, task_id, finished=_task_done)
+        if in_flight is not None:
+            return _accepted(resp_data, self.route_base, in_flight)
+        error = admission.get_admission().admit(task_id, username)
+        if error:
+            deduplicator.finish('create', username, machine_name, task_id)
+            return _too_busy(resp_data, error)
+        get_cache().invalidate(username)
+        try:
+            task = current_app.celery_app.send_task('winserver.create', [username, machine_name, image, network, ip_config, txn_id],
+                                                    task_id=task_id)
+        except Exception as doh:
+            # The task never ran, so nothing else would give these back
+            deduplicator.finish('create', username, machine_name, task_id)
+            admission.get_admission().release(task_id)
+            if not isinstance(doh, OperationalError):
+                raise
+            return _not_queued(resp_data, doh)
+        deduplicator.remember(username, key, fingerprint, task.id)
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/bulk', methods=["POST"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=BULK_POST_SCHEMA)
+    def bulk(self, *args, **kwargs):
+        """Create many WinServers with one task; a retry of a request gets the same task-id"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        body = kwargs['body']
+        image = body['image']
+        network = '{}_{}'.format(username, body['network'])
+        machine_names, ip_configs, error = _get_bulk_config(body)
         if error:
             resp_data['error'] = error
             resp = Response(ujson.dumps(resp_data))
             resp.status_code = 400
+            return resp
+        try:
+            found = catalog.get_catalog().get(image)
+        except OSError:
+            # The API cannot read the images dir; let the worker check
+            found = True
+        if not found:
+            resp_data['error'] = 'Invalid version of Windows Server supplied: {}'.format(image)
+            resp = Response(ujson.dumps(resp_data))
+            resp.status_code = 400
+            return resp
+        key, fingerprint = _idempotency_key(), dedupe.fingerprint(request.method, request.path, body)
+        deduplicator = dedupe.get_deduplicator()
+        replayed = deduplicator.replay(username, key, fingerprint)
+        if replayed is not None:
+            return _accepted(resp_data, self.route_base, replayed)
+        task_id = str(uuid.uuid4())
+        try:
+            error = admission.get_admission().admit(task_id, username, count=len(machine_names))
+        except ValueError as doh:
+            resp_data['error'] = '{}'.format(doh)
+            resp = Response(ujson.dumps(resp_data))
+            resp.status_code = 400
+            return resp
+        if error:
+            return _too_busy(resp_data, error)
+        get_cache().invalidate(username)
+        try:
+            task = current_app.celery_app.send_task('winserver.create_many', [username, machine_names, image, network, ip_configs, txn_id],
+                                                    task_id=task_id)
+        except Exception as doh:
+            admission.get_admission().release(task_id)
+            if not isinstance(doh, OperationalError):
+                raise
+            return _not_queued(resp_data, doh)
+        deduplicator.remember(username, key, fingerprint, task.id)
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/bulk', methods=["DELETE"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=BULK_DELETE_SCHEMA)
+    def bulk_delete(self, *args, **kwargs):
+        """Destroy many WinServers with one task; a retry of a request gets the same task-id"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        body = kwargs['body']
+        if body.get('all', False) and 'names' in body:
+            resp_data['error'] = 'Supply names or all, not both'
+        elif body.get('all', False):
+            machine_names = None
+        elif body.get('names', []):
+            machine_names = body['names']
         else:
-            task = current_app.celery_app.send_task('winserver.create', [username, machine_name, image, network, ip_config, txn_id])
-            resp_data['content'] = {'task-id': task.id}
+            resp_data['error'] = 'Must supply names, or all'
+        if 'error' in resp_data:
             resp = Response(ujson.dumps(resp_data))
-            resp.status_code = 202
-            resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+            resp.status_code = 400
+            return resp
+        key, fingerprint = _idempotency_key(), dedupe.fingerprint(request.method, request.path, body)
+        deduplicator = dedupe.get_deduplicator()
+        replayed = deduplicator.replay(username, key, fingerprint)
+        if replayed is not None:
+            return _accepted(resp_data, self.route_base, replayed)
+        get_cache().invalidate(username)
+        task = current_app.celery_app.send_task('winserver.delete_many', [username, machine_names, txn_id])
+        deduplicator.remember(username, key, fingerprint, task.id)
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/network', methods=["PUT"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=NETWORK_SCHEMA)
+    @describe(put=NETWORK_SCHEMA)
+    def modify_network(self, *args, **kwargs):
+        """Change the network one, or many WinServers are connected to with one task"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        changes, error = _get_network_changes(username, kwargs['body'])
+        if error:
+            resp_data['error'] = error
+            resp = Response(ujson.dumps(resp_data))
+            resp.status_code = 400
+            return resp
+        get_cache().invalidate(username)
+        task = current_app.celery_app.send_task('winserver.modify_networks', [username, changes, txn_id])
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
         return resp
 
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
     @validate_input(schema=DELETE_SCHEMA)
     def delete(self, *args, **kwargs):
-        """Destroy a WinServer"""
+        """Destroy a WinServer
+
+        Like creating one, a retry or a second delete of the same WinServer
+        gets the task-id of the delete in flight.
+        """
         username = kwargs['token']['username']
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
         resp_data = {'user' : username}
         machine_name = kwargs['body']['name']
-        task = current_app.celery_app.send_task('winserver.delete', [username, machine_name, txn_id])
+        key, fingerprint = _idempotency_key(), dedupe.fingerprint(request.method, request.path, kwargs['body'])
+        deduplicator = dedupe.get_deduplicator()
+        replayed = deduplicator.replay(username, key, fingerprint)
+        if replayed is not None:
+            return _accepted(resp_data, self.route_base, replayed)
+        task_id = str(uuid.uuid4())
+        in_flight = deduplicator.claim('delete', username, machine_name, task_id, finished=_task_done)
+        if in_flight is not None:
+            return _accepted(resp_data, self.route_base, in_flight)
+        get_cache().invalidate(username)
+        try:
+            task = current_app.celery_app.send_task('winserver.delete', [username, machine_name, txn_id], task_id=task_id)
+        except Exception as doh:
+            deduplicator.finish('delete', username, machine_name, task_id)
+            if not isinstance(doh, OperationalError):
+                raise
+            return _not_queued(resp_data, doh)
+        deduplicator.remember(username, key, fingerprint, task.id)
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
         resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
         return resp
 
+    @route('/task', methods=["GET"])
+    @route('/task/<tid>', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @describe(get_args=TASK_ARGS)
+    def handle_task(self, *args, **kwargs):
+        """End point for checking the status of Celery tasks
+
+        Works like the ``MachineView`` end point, but also reports which phase
+        a multi-phase task (i.e. creating a WinServer) is in. Instead of asking
+        every second, a client can:
+
+        - Supply ``?wait=N`` to hold the request for up to N seconds, until the
+          status differs from the ``ETag`` sent as ``If-None-Match`` (or from
+          the status when the request arrived).
+        - Send ``Accept: text/event-stream`` to get every change of status as a
+          server-sent event, until the task is done.
+
+        Only ``VLAB_WINSERVER_TASK_MAX_WAITERS`` requests wait at once. Past
+        that, the status is returned right away with a ``Retry-After`` header.
+        """
+        username = kwargs['token']['username']
+        resp = {'user': username, 'content' : {}}
+        if request.args.get('task-id', None) and kwargs.get('tid', None):
+            resp['error'] = 'task-id supplied in URL and as param'
+            return ujson.dumps(resp), 400
+
+        task_id = request.args.get('task-id', kwargs.get('tid', None))
+        if task_id is None:
+            resp['error'] = "no task id provided"
+            return ujson.dumps(resp), 400
+        try:
+            wait = min(max(float(request.args.get('wait', 0)), 0), const.VLAB_WINSERVER_TASK_MAX_WAIT)
+        except ValueError:
+            resp['error'] = 'wait must be a number of seconds'
+            return ujson.dumps(resp), 400
+
+        celery_app = current_app.celery_app
+        if request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream':
+            return _stream_status(celery_app, task_id, username, request.headers.get('Last-Event-ID', ''))
+        waiting = wait > 0 and _WAITERS.acquire(blocking=False)
+        try:
+            body, status = _wait_for_change(celery_app, task_id, username, wait if waiting else 0, request.if_none_match)
+        finally:
+            if waiting:
+                _WAITERS.release()
+        resp = Response(ujson.dumps(body))
+        resp.status_code = status
+        resp.set_etag(_status_etag(body))
+        if wait > 0 and not waiting and status == 202:
+            # Too many requests are waiting already; answer now, and say when to ask again
+            resp.headers['Retry-After'] = '{}'.format(const.VLAB_WINSERVER_TASK_RETRY_AFTER)
+        return resp
+
     @route('/image', methods=["GET"])
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
     @describe(get=IMAGES_SCHEMA)
     def image(self, *args, **kwargs):
-        """Show available versions of WinServer that can be deployed"""
+        """Show available versions of WinServer that can be deployed
+
+        Answered straight from the image catalog when the API can read
+        ``VLAB_WINSERVER_IMAGES_DIR``. Supply ``?async=true`` (or run the API
+        without the images mounted) to get a task-id like before.
+        """
         username = kwargs['token']['username']
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
         resp_data = {'user' : username}
+        if not _wants_async():
+            try:
+                images = catalog.get_catalog().images(max_age=const.VLAB_WINSERVER_IMAGE_CACHE_TTL)
+            except OSError as doh:
+                logger.info('Unable to read image catalog, falling back to a task: {}'.format(doh))
+            else:
+                etag = hashlib.sha1(ujson.dumps(images).encode()).hexdigest()
+                if request.if_none_match.contains(etag):
+                    resp = Response()
+                    resp.status_code = 304
+                else:
+                    resp_data['content'] = {'image': images}
+                    resp = Response(ujson.dumps(resp_data))
+                    resp.status_code = 200
+                resp.set_etag(etag)
+                return resp
         task = current_app.celery_app.send_task('winserver.image', [txn_id])
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
@@ -152,6 +519,359 @@ class WinServerView(MachineView):
         resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
         return resp
 
+    @route('/pool', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @describe(get=POOL_SCHEMA)
+    def pool(self, *args, **kwargs):
+        """Show the state of the warm pool of pre-deployed WinServer VMs"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        task = current_app.celery_app.send_task('winserver.pool', [txn_id])
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+
+def _wants_async():
+    """Check if the client asked for a task-id instead of a direct answer
+
+    :Returns: Boolean
+    """
+    return request.args.get('async', '').lower() in ('true', '1', 'yes')
+
+
+def _idempotency_key():
+    """Obtain the key a client retries a request with; ``Idempotency-Key``,
+    falling back to ``X-REQUEST-ID``
+
+    :Returns: String - empty if the client supplied neither
+    """
+    key = request.headers.get('Idempotency-Key', '')
+    if not key:
+        key = request.headers.get('X-REQUEST-ID', '')
+    return key
+
+
+def _task_done(task_id):
+    """Check if the result backend says a task is finished
+
+    :Returns: Boolean
+
+    :param task_id: The id of the task
+    :type task_id: String
+    """
+    return current_app.celery_app.AsyncResult(task_id).status in READY_STATES
+
+
+def _accepted(resp_data, route_base, task_id):
+    """Answer with the task-id of a task that's already queued
+
+    :Returns: flask.Response
+
+    :param resp_data: The body of the response, so far
+    :type resp_data: Dictionary
+
+    :param route_base: The URL path of the end point
+    :type route_base: String
+
+    :param task_id: The id of the task
+    :type task_id: String
+    """
+    resp_data['content'] = {'task-id': task_id}
+    resp = Response(ujson.dumps(resp_data))
+    resp.status_code = 202
+    resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, route_base, task_id))
+    return resp
+
+
+def _too_busy(resp_data, error):
+    """Tell a client that hit a deploy limit when to try again
+
+    :Returns: flask.Response
+
+    :param resp_data: The body of the response, so far
+    :type resp_data: Dictionary
+
+    :param error: Which limit was hit
+    :type error: String
+    """
+    resp_data['error'] = error
+    resp = Response(ujson.dumps(resp_data))
+    resp.status_code = 429
+    resp.headers.add('Retry-After', '{}'.format(admission.get_admission().retry_after))
+    return resp
+
+
+def _not_queued(resp_data, error):
+    """Tell a client the task could not be queued, i.e. the broker is down
+
+    :Returns: flask.Response
+
+    :param resp_data: The body of the response, so far
+    :type resp_data: Dictionary
+
+    :param error: Why sending the task failed
+    :type error: kombu.exceptions.OperationalError
+    """
+    logger.error('Unable to queue task: {}'.format(error))
+    resp_data['error'] = 'Unable to queue the task; try again later'
+    resp = Response(ujson.dumps(resp_data))
+    resp.status_code = 503
+    return resp
+
+
+def _task_status(celery_app, task_id, username):
+    """Look up a task in the result backend, and make the body of a status response
+
+    :Returns: Tuple - (Dictionary body, Integer HTTP status code)
+
+    :param celery_app: The app the task was sent with
+    :type celery_app: celery.Celery
+
+    :param task_id: The id of the task
+    :type task_id: String
+
+    :param username: The user asking
+    :type username: String
+    """
+    resp = {'user': username, 'content' : {}}
+    result = celery_app.AsyncResult(task_id)
+    resp['content']['status'] = result.status
+    if result.status == 'SUCCESS':
+        # All Celery Tasks MUST return a dictionary that has an "error" key.
+        if result.result['error']:
+            resp.update(result.result)
+            return resp, 400
+        return result.result, 200
+    elif result.status == 'FAILURE':
+        return resp, 500
+    elif result.status == 'PROGRESS':
+        resp['content']['phase'] = result.info.get('phase', None)
+        if 'machines' in result.info:
+            resp['content']['machines'] = result.info['machines']
+    return resp, 202
+
+
+def _status_etag(body):
+    """Identify a status, so a client can ask to wait until it changes
+
+    :Returns: String
+
+    :param body: The body of a status response
+    :type body: Dictionary
+    """
+    return hashlib.sha1(ujson.dumps(body, sort_keys=True).encode()).hexdigest()
+
+
+def _wait_for_change(celery_app, task_id, username, wait, if_none_match):
+    """Hold a status request until the status changes, the task is done, or ``wait`` runs out
+
+    The result backend is checked every ``VLAB_WINSERVER_TASK_POLL_INTERVAL``
+    seconds from inside the API, which is far cheaper than a client making a
+    whole new request each time.
+
+    :Returns: Tuple - (Dictionary body, Integer HTTP status code)
+
+    :param celery_app: The app the task was sent with
+    :type celery_app: celery.Celery
+
+    :param task_id: The id of the task
+    :type task_id: String
+
+    :param username: The user asking
+    :type username: String
+
+    :param wait: The most seconds to hold the request
+    :type wait: Float
+
+    :param if_none_match: The ETags of the statuses the client already has
+    :type if_none_match: werkzeug.datastructures.ETags
+    """
+    body, status = _task_status(celery_app, task_id, username)
+    if not if_none_match:
+        # Without an ETag, wait for a change from the status right now
+        if_none_match = ETags([_status_etag(body)])
+    deadline = time.time() + wait
+    while status == 202 and if_none_match.contains(_status_etag(body)):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(const.VLAB_WINSERVER_TASK_POLL_INTERVAL, remaining))
+        body, status = _task_status(celery_app, task_id, username)
+    return body, status
+
+
+def _stream_status(celery_app, task_id, username, last_event_id):
+    """Send every change of a task's status as a server-sent event
+
+    Each change is a ``status`` event, and the end is a ``result`` event with
+    the body a plain GET would return. The stream closes after the result, or
+    after ``VLAB_WINSERVER_TASK_STREAM_SECONDS``; an ``EventSource`` then
+    reconnects with ``Last-Event-ID``, and only gets what it hasn't seen. When
+    too many requests are waiting already, the stream sends the current status
+    and closes, telling the ``EventSource`` to reconnect in
+    ``VLAB_WINSERVER_TASK_RETRY_AFTER`` seconds.
+
+    :Returns: flask.Response
+
+    :param celery_app: The app the task was sent with
+    :type celery_app: celery.Celery
+
+    :param task_id: The id of the task
+    :type task_id: String
+
+    :param username: The user asking
+    :type username: String
+
+    :param last_event_id: The id of the last event the client got; empty if none
+    :type last_event_id: String
+    """
+    body, status = _task_status(celery_app, task_id, username)
+    if status != 202 and _status_etag(body) == last_event_id:
+        # The client already has the result; HTTP 204 stops an EventSource reconnecting
+        resp = Response()
+        resp.status_code = 204
+        return resp
+    if not _WAITERS.acquire(blocking=False):
+        events = ['retry: {}\n\n'.format(const.VLAB_WINSERVER_TASK_RETRY_AFTER * 1000)]
+        if _status_etag(body) != last_event_id:
+            events.insert(0, _event(body, status))
+        resp = Response(''.join(events), mimetype='text/event-stream')
+        resp.headers['Cache-Control'] = 'no-cache'
+        resp.headers['Retry-After'] = '{}'.format(const.VLAB_WINSERVER_TASK_RETRY_AFTER)
+        return resp
+
+    def events(body, status):
+        started = time.time()
+        sent_at = started
+        sent = last_event_id
+        while True:
+            tag = _status_etag(body)
+            if tag != sent:
+                yield _event(body, status)
+                sent = tag
+                sent_at = time.time()
+            if status != 202 or time.time() - started >= const.VLAB_WINSERVER_TASK_STREAM_SECONDS:
+                return
+            if time.time() - sent_at >= _KEEPALIVE:
+                # Stops proxies from closing a quiet stream
+                yield ': keepalive\n\n'
+                sent_at = time.time()
+            time.sleep(const.VLAB_WINSERVER_TASK_POLL_INTERVAL)
+            body, status = _task_status(celery_app, task_id, username)
+
+    resp = Response(events(body, status), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    # Runs once the stream ends, or the client goes away
+    resp.call_on_close(_WAITERS.release)
+    return resp
+
+
+def _event(body, status):
+    """Format a task status as a server-sent event, identified by its ETag
+
+    :Returns: String
+
+    :param body: The body of a status response
+    :type body: Dictionary
+
+    :param status: The HTTP status code of the response
+    :type status: Integer
+    """
+    name = 'status' if status == 202 else 'result'
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(_status_etag(body), name, ujson.dumps(body))
+
+
+def _name_error(machine_name):
+    """Check a machine name against the rule deploy_from_ova enforces
+
+    :Returns: String - the error, or an empty string if the name is OK
+
+    :param machine_name: The name to give the new WinServer
+    :type machine_name: String
+    """
+    if _HOSTNAME_REGEX.match(machine_name):
+        return ''
+    return 'Invalid machine name. Names can only contain characters a-z, A-Z, 0-9, periods (".") and dashes ("-"). Supplied: {}'.format(machine_name)
+
+
+def _get_bulk_config(body):
+    """Work out the names and IP configs of a bulk create, and check them all up front
+
+    :Returns: Tuple - (List of names, List of IP configs, error String)
+
+    :param body: The API params supplied by the user
+    :type body: Dictionary
+    """
+    if 'names' in body and 'name-prefix' in body:
+        return [], [], 'Supply names or name-prefix, not both'
+    elif 'names' in body:
+        machine_names = body['names']
+    elif 'name-prefix' in body and 'count' in body:
+        machine_names = ['{}{}'.format(body['name-prefix'], x) for x in range(1, body['count'] + 1)]
+    else:
+        return [], [], 'Must supply names, or name-prefix and count'
+    if not machine_names:
+        return [], [], 'Must create at least one WinServer'
+    if len(machine_names) > const.VLAB_WINSERVER_BULK_MAX:
+        return [], [], 'Cannot create more than {} WinServers at once'.format(const.VLAB_WINSERVER_BULK_MAX)
+    if len(set(machine_names)) != len(machine_names):
+        return [], [], 'Names must be unique'
+    for machine_name in machine_names:
+        error = _name_error(machine_name)
+        if error:
+            return [], [], error
+    shared_config = body.get('ip-config', {})
+    if shared_config.get('static-ip', ''):
+        return [], [], 'Supply static-ips instead of ip-config.static-ip; every WinServer needs its own IP'
+    static_ips = body.get('static-ips', [''] * len(machine_names))
+    if len(static_ips) != len(machine_names):
+        return [], [], 'Supplied {} static-ips for {} WinServers'.format(len(static_ips), len(machine_names))
+    if any(static_ips) and len(set(static_ips)) != len(static_ips):
+        return [], [], 'static-ips must be unique'
+    ip_configs = []
+    for machine_name, static_ip in zip(machine_names, static_ips):
+        supplied_config = dict(shared_config)
+        supplied_config['static-ip'] = static_ip
+        ip_config, error = _get_ip_config(supplied_config)
+        if error:
+            return [], [], '{}: {}'.format(machine_name, error)
+        ip_configs.append(ip_config)
+    return machine_names, ip_configs, ''
+
+
+def _get_network_changes(username, body):
+    """Work out which WinServer moves to which network, and check them all up front
+
+    :Returns: Tuple - (Dictionary of machine name -> network, error String)
+
+    :param username: The user who owns the WinServers and networks
+    :type username: String
+
+    :param body: The API params supplied by the user
+    :type body: Dictionary
+    """
+    if 'changes' in body and ('name' in body or 'new_network' in body):
+        return {}, 'Supply changes, or name and new_network, not both'
+    elif 'changes' in body:
+        pairs = [(x['name'], x['new_network']) for x in body['changes']]
+    elif 'name' in body and 'new_network' in body:
+        pairs = [(body['name'], body['new_network'])]
+    else:
+        return {}, 'Must supply name and new_network, or changes'
+    if not pairs:
+        return {}, 'Must change at least one WinServer'
+    if len(pairs) > const.VLAB_WINSERVER_BULK_MAX:
+        return {}, 'Cannot change more than {} WinServers at once'.format(const.VLAB_WINSERVER_BULK_MAX)
+    changes = {x: '{}_{}'.format(username, y) for x, y in pairs}
+    if len(changes) != len(pairs):
+        return {}, 'Names must be unique'
+    return changes, ''
+
 
 def _get_ip_config(supplied_config):
     """Ensures API defaults are applied to object
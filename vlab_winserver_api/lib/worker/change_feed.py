@@ -0,0 +1,298 @@
+# -*- coding: UTF-8 -*-
+"""
+An in-memory model of every VM under ``INF_VCENTER_TOP_LVL_DIR``, kept up to
+date by following the vCenter PropertyCollector with ``WaitForUpdatesEx``.
+
+With ``VLAB_WINSERVER_CHANGE_FEED`` enabled, each worker process runs one
+``ChangeFeed`` thread with its own vCenter session (it blocks in
+``WaitForUpdatesEx``, so it cannot borrow from the session pool). The first
+update after (re)connecting is the full inventory; after that vCenter only
+sends what changed. ``show_winserver`` answers from the model while it's in
+sync, and falls back to asking vCenter while the feed is (re)syncing.
+
+The console URL still costs one call per VM, because clone tickets are single use.
+"""
+import os
+import time
+import threading
+
+from pyVmomi import vim, vmodl
+from celery.utils.log import get_task_logger
+
+from vlab_winserver_api.lib import const
+from vlab_winserver_api.lib.worker import inventory, session
+
+
+logger = get_task_logger(__name__)
+logger.setLevel(const.VLAB_WINSERVER_LOG_LEVEL.upper())
+
+FOLDER_PROPERTIES = ['name', 'parent']
+VM_PROPERTIES = inventory.VM_PROPERTIES + ['parent']
+
+
+def enabled():
+    """Check if the worker should follow the vCenter change feed
+
+    :Returns: Boolean
+    """
+    return str(const.VLAB_WINSERVER_CHANGE_FEED).lower() in ('true', '1', 'yes')
+
+
+class InventoryModel(object):
+    """The properties of every folder, VM, and network the feed has seen, by moid"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._objects = {}
+        self.version = ''
+        self.ready = False
+        self.heartbeat = 0
+
+    def reset(self):
+        """Forget everything, i.e. before a full resync
+
+        :Returns: None
+        """
+        with self._lock:
+            self._objects = {}
+            self.version = ''
+            self.ready = False
+
+    def apply(self, update_set):
+        """Merge a ``WaitForUpdatesEx`` result into the model
+
+        :Returns: None
+
+        :param update_set: The changes vCenter reported
+        :type update_set: vmodl.query.PropertyCollector.UpdateSet
+        """
+        with self._lock:
+            for filter_update in update_set.filterSet or []:
+                for object_update in filter_update.objectSet or []:
+                    self._apply_object(object_update)
+            self.version = update_set.version
+
+    def _apply_object(self, object_update):
+        """Merge the changes to one object; call while holding the lock"""
+        moid = object_update.obj._moId
+        if object_update.kind == 'leave':
+            self._objects.pop(moid, None)
+            return
+        if object_update.kind == 'enter' or moid not in self._objects:
+            self._objects[moid] = {'obj': object_update.obj}
+        props = self._objects[moid]
+        for change in object_update.changeSet or []:
+            if change.op in ('assign', 'add'):
+                props[change.name] = change.val
+            else:
+                # remove or indirectRemove
+                props.pop(change.name, None)
+
+    def fresh(self, max_age):
+        """Check if the model is synced, and the feed has heard from vCenter recently
+
+        :Returns: Boolean
+
+        :param max_age: The most seconds since vCenter last answered
+        :type max_age: Integer
+        """
+        return self.ready and time.time() - self.heartbeat < max_age
+
+    def vms(self, username):
+        """Obtain the VMs in a user's folder, in the same format as ``inventory.retrieve_vms``
+
+        :Returns: List of Dictionaries
+
+        :param username: The user who owns the VMs
+        :type username: String
+        """
+        vms = []
+        with self._lock:
+            for props in self._objects.values():
+                if not isinstance(props['obj'], vim.VirtualMachine):
+                    continue
+                parent = props.get('parent', None)
+                folder = self._objects.get(parent._moId, {}) if parent is not None else {}
+                if folder.get('name', None) != username:
+                    continue
+                vm = {x: y for x, y in props.items() if x not in ('obj', 'parent', 'network')}
+                vm['vm'] = props['obj']
+                vm['network'] = [self._objects[x._moId]['name'] for x in props.get('network', [])
+                                 if 'name' in self._objects.get(x._moId, {})]
+                vms.append(vm)
+        return vms
+
+    def show(self, username, component, console):
+        """Describe a user's VMs like ``inventory.show``, without asking vCenter
+
+        :Returns: Dictionary
+
+        :param username: The name of the user who owns the VMs
+        :type username: String
+
+        :param component: Only include VMs with this component in the meta data
+        :type component: String
+
+        :param console: Makes the HTML console URL
+        :type console: vlab_winserver_api.lib.worker.inventory.ConsoleUrl
+        """
+        found = {}
+        for props in self.vms(username):
+            meta_data = inventory.get_meta(props.get('config.annotation', None))
+            if meta_data['component'] != component:
+                continue
+            found[props['name']] = inventory.to_info(props, meta_data, username, console)
+        return found
+
+
+class ChangeFeed(object):
+    """Follows the vCenter change feed in a background thread
+
+    :param model: Where to keep the inventory
+    :type model: InventoryModel
+
+    :param connect: Optional - A callable that returns a new, logged in vCenter object
+    :type connect: Function
+
+    :param wait: How many seconds vCenter can hold a ``WaitForUpdatesEx`` call open
+    :type wait: Integer
+    """
+    def __init__(self, model=None, connect=None, wait=None):
+        self.model = model if model else InventoryModel()
+        self.wait = wait if wait else const.VLAB_WINSERVER_CHANGE_FEED_WAIT
+        self._connect = connect if connect else session._connect
+        self._stop = threading.Event()
+        self._thread = None
+        self._vcenter = None
+        self._console = None
+
+    def start(self):
+        """Start following the feed in a daemon thread
+
+        :Returns: None
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop following the feed, at the latest after ``wait`` seconds
+
+        :Returns: None
+        """
+        self._stop.set()
+
+    def run(self):
+        """Follow the feed until stopped, reconnecting whenever the session breaks
+
+        :Returns: None
+        """
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                self.follow()
+                backoff = 1
+            except Exception as doh:
+                logger.error('vCenter change feed failed: {}'.format(doh))
+                self.model.ready = False
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, self.wait)
+
+    def follow(self):
+        """Open a session, sync the whole inventory, then apply changes as they happen
+
+        :Returns: None
+        """
+        vcenter = self._connect()
+        collector = None
+        try:
+            collector = vcenter.content.propertyCollector.CreatePropertyCollector()
+            collector.CreateFilter(spec=_filter_spec(vcenter), partialUpdates=False)
+            self._vcenter, self._console = vcenter, None
+            self.model.reset()
+            options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self.wait)
+            while not self._stop.is_set():
+                try:
+                    update_set = collector.WaitForUpdatesEx(version=self.model.version, options=options)
+                except vmodl.query.InvalidCollectorVersion:
+                    logger.warning('vCenter change feed lost its place; resyncing')
+                    self.model.reset()
+                    continue
+                self.model.heartbeat = time.time()
+                if update_set is None:
+                    # nothing changed within maxWaitSeconds
+                    continue
+                self.model.apply(update_set)
+                if not update_set.truncated:
+                    self.model.ready = True
+        finally:
+            self.model.ready = False
+            self._vcenter = None
+            if collector is not None:
+                try:
+                    collector.DestroyPropertyCollector()
+                except Exception:
+                    pass
+            session._close(vcenter)
+
+    def show(self, username, component):
+        """Describe a user's VMs from the model
+
+        :Returns: Dictionary, or None if the model is not in sync
+
+        :param username: The name of the user who owns the VMs
+        :type username: String
+
+        :param component: Only include VMs with this component in the meta data
+        :type component: String
+        """
+        vcenter = self._vcenter
+        if vcenter is None or not self.model.fresh(self.wait * 2):
+            return None
+        vms = self.model.vms(username)
+        if vms and self._console is None:
+            self._console = inventory.ConsoleUrl(vcenter)
+        return self.model.show(username, component, self._console)
+
+
+def _filter_spec(vcenter):
+    """Define which objects and properties the feed follows
+
+    :Returns: vmodl.query.PropertyCollector.FilterSpec
+    """
+    pc = vmodl.query.PropertyCollector
+    # get_by_name searches below the top folder, so it can never find the folder itself
+    top_folder = vcenter.get_vm_folder(const.INF_VCENTER_TOP_LVL_DIR)
+    vm_to_network = pc.TraversalSpec(name='vmToNetwork', type=vim.VirtualMachine,
+                                     path='network', skip=False)
+    folder_to_child = pc.TraversalSpec(name='folderToChild', type=vim.Folder,
+                                       path='childEntity', skip=False,
+                                       selectSet=[pc.SelectionSpec(name='folderToChild'), vm_to_network])
+    return pc.FilterSpec(objectSet=[pc.ObjectSpec(obj=top_folder, skip=True, selectSet=[folder_to_child])],
+                         propSet=[pc.PropertySpec(type=vim.Folder, pathSet=FOLDER_PROPERTIES),
+                                  pc.PropertySpec(type=vim.VirtualMachine, pathSet=VM_PROPERTIES),
+                                  pc.PropertySpec(type=vim.Network, pathSet=['name'])])
+
+
+_FEED = None
+_FEED_PID = None
+_FEED_LOCK = threading.Lock()
+
+
+def get_feed():
+    """Obtain the change feed of the current process, starting it if needed
+
+    Like the session pool, a feed inherited from a parent process (whose thread
+    did not survive the fork) is replaced.
+
+    :Returns: ChangeFeed, or None if the feed is disabled
+    """
+    global _FEED, _FEED_PID
+    if not enabled():
+        return None
+    with _FEED_LOCK:
+        if _FEED is None or _FEED_PID != os.getpid():
+            _FEED = ChangeFeed()
+            _FEED_PID = os.getpid()
+        _FEED.start()
+        return _FEED
@@ -0,0 +1,170 @@
+# -*- coding: UTF-8 -*-
+"""
+Detects when a newly deployed WinServer is ready to be configured.
+
+A new WinServer walks through the C:\\unattend.xml answer file on first boot,
+then reboots. The guest credentials are not valid until after that reboot, so
+the guest is considered ready once vCenter reports a new boot time, VMware
+Tools is running with a green heartbeat, and the credentials are accepted.
+"""
+import time
+
+from pyVmomi import vim
+
+from vlab_winserver_api.lib import const
+from vlab_winserver_api.lib.worker import inventory
+
+
+READINESS_PROPERTIES = ['runtime.bootTime', 'guest.toolsRunningStatus', 'guestHeartbeatStatus']
+# The local admin account baked into the WinServer images
+GUEST_USER = 'Administrator'
+GUEST_PASSWORD = 'a'
+
+
+def boot_time(vcenter, the_vm, timeout=const.VLAB_WINSERVER_BOOT_TIME_TIMEOUT,
+              sleep=time.sleep, clock=time.time):
+    """Obtain when the VM last booted; record this right after deploying a VM
+
+    vCenter sets the boot time a moment after the power on task completes.
+    Without it, ``GuestReadiness`` would take the first boot for the reboot,
+    so this waits until vCenter reports one.
+
+    :Returns: String
+
+    :Raises: RuntimeError if vCenter reports no boot time within ``timeout`` seconds
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param the_vm: The virtual machine
+    :type the_vm: vim.VirtualMachine
+
+    :param timeout: The most seconds to wait on a boot time
+    :type timeout: Integer
+
+    :param sleep: Makes the function testable without waiting; don't set this
+    :type sleep: Function
+
+    :param clock: Makes the function testable without waiting; don't set this
+    :type clock: Function
+    """
+    deadline = clock() + timeout
+    while True:
+        booted_at = inventory.retrieve_properties(vcenter, the_vm, ['runtime.bootTime']).get('runtime.bootTime', None)
+        if booted_at is not None:
+            return _timestamp(booted_at)
+        remaining = deadline - clock()
+        if remaining <= 0:
+            error = 'No boot time for VM {} within {} seconds'.format(the_vm.name, timeout)
+            raise RuntimeError(error)
+        sleep(min(1, remaining))
+
+
+def _timestamp(value):
+    """Boot times get passed between tasks, so they're compared as ISO 8601 strings
+
+    :Returns: String or None
+
+    :param value: A boot time reported by vCenter
+    :type value: datetime.datetime
+    """
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+class GuestReadiness(object):
+    """Tracks a WinServer through first boot and the post-unattend reboot.
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param the_vm: The virtual machine
+    :type the_vm: vim.VirtualMachine
+
+    :param first_boot: The boot time of the VM before the unattend reboot, from ``boot_time``
+    :type first_boot: String
+
+    :param user: The guest account that is valid after the reboot
+    :type user: String
+
+    :param password: The password of the guest account
+    :type password: String
+    """
+    def __init__(self, vcenter, the_vm, first_boot, user, password):
+        self._vcenter = vcenter
+        self._the_vm = the_vm
+        self._first_boot = first_boot
+        self._creds = vim.vm.guest.NamePasswordAuthentication(username=user, password=password)
+        self.rebooted = False
+
+    def check(self):
+        """Poll vCenter once
+
+        :Returns: Boolean
+        """
+        props = inventory.retrieve_properties(self._vcenter, self._the_vm, READINESS_PROPERTIES)
+        if not self.rebooted:
+            booted_at = _timestamp(props.get('runtime.bootTime', None))
+            self.rebooted = booted_at is not None and booted_at != self._first_boot
+            if not self.rebooted:
+                return False
+        if props.get('guest.toolsRunningStatus', None) != vim.vm.GuestInfo.ToolsRunningStatus.guestToolsRunning:
+            return False
+        if props.get('guestHeartbeatStatus', None) != 'green':
+            return False
+        return self._creds_ok()
+
+    def _creds_ok(self):
+        """Probe the guest with the post-reboot credentials
+
+        :Returns: Boolean
+        """
+        auth_manager = self._vcenter.content.guestOperationsManager.authManager
+        try:
+            auth_manager.ValidateCredentialsInGuest(vm=self._the_vm, auth=self._creds)
+        except vim.fault.GuestOperationsFault:
+            # InvalidGuestLogin, GuestOperationsUnavailable, etc
+            return False
+        return True
+
+
+def wait_for_guest(readiness, logger, timeout=const.VLAB_WINSERVER_GUEST_TIMEOUT,
+                   sleep=time.sleep, clock=time.time):
+    """Block until a guest is ready, polling with exponential backoff
+
+    :Returns: None
+
+    :Raises: RuntimeError if the guest is not ready within ``timeout`` seconds
+
+    :param readiness: Tracks the state of the guest
+    :type readiness: GuestReadiness
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param timeout: The most seconds to wait on the guest
+    :type timeout: Integer
+
+    :param sleep: Makes the function testable without waiting; don't set this
+    :type sleep: Function
+
+    :param clock: Makes the function testable without waiting; don't set this
+    :type clock: Function
+    """
+    deadline = clock() + timeout
+    delay = const.VLAB_WINSERVER_GUEST_POLL_MIN
+    was_rebooted = readiness.rebooted
+    while not readiness.check():
+        if readiness.rebooted and not was_rebooted:
+            # The guest is close to ready once it reboots; poll quickly again
+            logger.info('Guest rebooted after running unattend.xml')
+            was_rebooted = True
+            delay = const.VLAB_WINSERVER_GUEST_POLL_MIN
+        remaining = deadline - clock()
+        if remaining <= 0:
+            error = 'Guest not ready within {} seconds'.format(timeout)
+            raise RuntimeError(error)
+        sleep(min(delay, remaining))
+        delay = min(delay * 2, const.VLAB_WINSERVER_GUEST_POLL_MAX)
+    logger.info('Guest is ready')
@@ -0,0 +1,329 @@
+# -*- coding: UTF-8 -*-
+"""
+Bulk retrieval of virtual machine details via the vCenter PropertyCollector.
+
+Reading a property off a pyVmomi object is a round trip to vCenter, so calling
+``virtual_machine.get_info`` on every VM in a folder costs dozens of requests
+per VM. The functions here fetch everything needed to describe the VMs in a
+folder with a single PropertyCollector call, and do the filtering locally.
+"""
+import ssl
+import textwrap
+import threading
+
+import ujson
+import OpenSSL
+from pyVmomi import vim, vmodl
+
+from vlab_winserver_api.lib import const
+
+
+VM_PROPERTIES = ['name', 'runtime.powerState', 'config.annotation', 'guest.net', 'network']
+UNKNOWN_META = {'component': 'Unknown',
+                'created': 0,
+                'version': "Unknown",
+                'generation': 0,
+                'configured': False
+               }
+
+# username -> moid of their VM folder; folders are effectively permanent,
+# so the index only gets invalidated if vCenter says the folder is gone.
+_FOLDERS = {}
+_FOLDERS_LOCK = threading.Lock()
+
+
+def user_folder(vcenter, username):
+    """Obtain the folder that holds a user's VMs, without walking every folder
+    under ``INF_VCENTER_TOP_LVL_DIR`` once the folder has been found.
+
+    :Returns: vim.Folder
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param username: The user who owns the folder
+    :type username: String
+    """
+    with _FOLDERS_LOCK:
+        moid = _FOLDERS.get(username, None)
+    if moid is not None:
+        return vim.Folder(moid, stub=vcenter._conn._stub)
+    folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+    with _FOLDERS_LOCK:
+        _FOLDERS[username] = folder._moId
+    return folder
+
+
+def vm_by_moid(vcenter, moid):
+    """Rebuild a VM object from its managed object id, i.e. one passed between tasks
+
+    :Returns: vim.VirtualMachine
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param moid: The managed object id of the VM
+    :type moid: String
+    """
+    return vim.VirtualMachine(moid, stub=vcenter._conn._stub)
+
+
+def forget_folder(username):
+    """Drop a user's folder from the index, i.e. after vCenter reports it missing
+
+    :Returns: None
+
+    :param username: The user who owns the folder
+    :type username: String
+    """
+    with _FOLDERS_LOCK:
+        _FOLDERS.pop(username, None)
+
+
+def find_vm(vcenter, username, machine_name, component):
+    """Resolve a VM by name with a server-side search, instead of reading the
+    name of every VM in the user's folder.
+
+    :Returns: vim.VirtualMachine
+
+    :Raises: ValueError if the user has no VM by that name and component
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param username: The user who owns the VM
+    :type username: String
+
+    :param machine_name: The name of the VM
+    :type machine_name: String
+
+    :param component: The kind of VM, as recorded in the VM meta data
+    :type component: String
+    """
+    search_index = vcenter.content.searchIndex
+    try:
+        the_vm = search_index.FindChild(entity=user_folder(vcenter, username), name=machine_name)
+    except vmodl.fault.ManagedObjectNotFound:
+        forget_folder(username)
+        the_vm = search_index.FindChild(entity=user_folder(vcenter, username), name=machine_name)
+    if isinstance(the_vm, vim.VirtualMachine):
+        annotation = retrieve_properties(vcenter, the_vm, ['config.annotation']).get('config.annotation', None)
+        if get_meta(annotation)['component'] == component:
+            return the_vm
+    raise ValueError('No {} named {} found'.format(component, machine_name))
+
+
+def name_taken(vcenter, username, machine_name):
+    """Check if a user already has a VM (of any kind) by a name, before spending
+    minutes on a deploy that vCenter would refuse at the end
+
+    :Returns: Boolean
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param username: The user who owns the VMs
+    :type username: String
+
+    :param machine_name: The name of the new VM
+    :type machine_name: String
+    """
+    search_index = vcenter.content.searchIndex
+    try:
+        found = search_index.FindChild(entity=user_folder(vcenter, username), name=machine_name)
+    except vmodl.fault.ManagedObjectNotFound:
+        forget_folder(username)
+        found = search_index.FindChild(entity=user_folder(vcenter, username), name=machine_name)
+    return found is not None
+
+
+def retrieve_properties(vcenter, obj, properties):
+    """Read a handful of properties off one object in a single round trip
+
+    :Returns: Dictionary
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param obj: The object to read properties from
+    :type obj: pyVmomi.VmomiSupport.ManagedObject
+
+    :param properties: The property paths to read, i.e. ``config.annotation``
+    :type properties: List
+    """
+    pc = vmodl.query.PropertyCollector
+    filter_spec = pc.FilterSpec(objectSet=[pc.ObjectSpec(obj=obj, skip=False)],
+                                propSet=[pc.PropertySpec(type=type(obj), pathSet=properties)])
+    result = vcenter.content.propertyCollector.RetrievePropertiesEx(specSet=[filter_spec],
+                                                                    options=pc.RetrieveOptions())
+    if not result:
+        return {}
+    return {x.name: x.val for x in result.objects[0].propSet}
+
+
+def retrieve_vms(vcenter, folder, properties=VM_PROPERTIES):
+    """Obtain the properties of every VM in a folder, and the names of the
+    networks they are connected to, in one PropertyCollector call.
+
+    :Returns: List of Dictionaries
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param folder: The folder that contains the VMs
+    :type folder: vim.Folder
+
+    :param properties: The VM property paths to read. Defaults to what ``show`` needs.
+    :type properties: List
+    """
+    pc = vmodl.query.PropertyCollector
+    vm_to_network = pc.TraversalSpec(name='vmToNetwork', type=vim.VirtualMachine,
+                                     path='network', skip=False)
+    folder_to_child = pc.TraversalSpec(name='folderToChild', type=vim.Folder,
+                                       path='childEntity', skip=False,
+                                       selectSet=[vm_to_network])
+    filter_spec = pc.FilterSpec(objectSet=[pc.ObjectSpec(obj=folder, skip=True, selectSet=[folder_to_child])],
+                                propSet=[pc.PropertySpec(type=vim.VirtualMachine, pathSet=properties),
+                                         pc.PropertySpec(type=vim.Network, pathSet=['name'])])
+    collector = vcenter.content.propertyCollector
+    objects = []
+    result = collector.RetrievePropertiesEx(specSet=[filter_spec], options=pc.RetrieveOptions())
+    while result:
+        objects += result.objects
+        if not result.token:
+            break
+        result = collector.ContinueRetrievePropertiesEx(token=result.token)
+
+    network_names = {}
+    vms = []
+    for obj in objects:
+        props = {x.name: x.val for x in obj.propSet}
+        if isinstance(obj.obj, vim.VirtualMachine):
+            props['vm'] = obj.obj
+            vms.append(props)
+        elif 'name' in props:
+            network_names[obj.obj._moId] = props['name']
+    for vm in vms:
+        vm['network'] = [network_names[x._moId] for x in vm.get('network', []) if x._moId in network_names]
+    return vms
+
+
+def get_meta(annotation):
+    """Parse the meta data vLab stores in the VM notes, like ``virtual_machine.get_info``
+
+    :Returns: Dictionary
+
+    :param annotation: The notes of a VM
+    :type annotation: String
+    """
+    try:
+        meta_data = ujson.loads(annotation)
+    except (ValueError, TypeError):
+        # ValueError -> VM created, but notes not updated
+        # TypeError  -> VM failed to be created, or is still being deployed
+        meta_data = dict(UNKNOWN_META)
+    return meta_data
+
+
+def show(vcenter, folder, username, component):
+    """Describe every VM of a given component in a user's folder; returns the
+    same shape as calling ``virtual_machine.get_info`` on each VM.
+
+    :Returns: Dictionary
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param folder: The user's folder
+    :type folder: vim.Folder
+
+    :param username: The name of the user who owns the VMs
+    :type username: String
+
+    :param component: Only include VMs with this component in the meta data
+    :type component: String
+    """
+    found = {}
+    console = None
+    for props in retrieve_vms(vcenter, folder):
+        meta_data = get_meta(props.get('config.annotation', None))
+        if meta_data['component'] != component:
+            continue
+        if console is None:
+            # Only pay for the TLS handshake if there's a VM to report on
+            console = ConsoleUrl(vcenter)
+        found[props['name']] = to_info(props, meta_data, username, console)
+    return found
+
+
+def to_info(props, meta_data, username, console):
+    """Convert the properties of one VM into the ``get_info`` format
+
+    :Returns: Dictionary
+
+    :param props: The properties of the VM, from ``retrieve_vms``
+    :type props: Dictionary
+
+    :param meta_data: The parsed VM notes
+    :type meta_data: Dictionary
+
+    :param username: The name of the user who owns the VM
+    :type username: String
+
+    :param console: Makes the HTML console URL
+    :type console: ConsoleUrl
+    """
+    ips = []
+    for nic in props.get('guest.net', []):
+        ips += nic.ipAddress
+    # No point is showing the IPv6 link local addrs if a firewall wont forward them
+    ips = [x for x in ips if not x.startswith('fe80::')]
+    user_prefix = '{}_'.format(username)
+    networks = [x.replace(user_prefix, '') for x in props.get('network', []) if x.startswith(username)]
+    details = {}
+    details['state'] = props.get('runtime.powerState', None)
+    details['console'] = console.url(props['vm'], props['name'])
+    details['ips'] = ips
+    details['networks'] = networks
+    details['moid'] = props['vm']._moId
+    details['meta'] = meta_data
+    return details
+
+
+class ConsoleUrl(object):
+    """Builds the HTML5 console URL for many VMs, looking up the server-wide
+    parts (cert thumbprint and instance UUID) only once.
+
+    Every URL still needs its own clone ticket; the tickets are single use.
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+    """
+    def __init__(self, vcenter):
+        self._content = vcenter.content
+        vcenter_cert = ssl.get_server_certificate((const.INF_VCENTER_SERVER, const.INF_VCENTER_PORT))
+        self._thumbprint = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, vcenter_cert).digest('sha1').decode()
+        self._server_guid = self._content.about.instanceUuid
+
+    def url(self, the_vm, name):
+        """Obtain the console URL for a VM
+
+        :Returns: (Really long) String
+
+        :param the_vm: The virtual machine
+        :type the_vm: vim.VirtualMachine
+
+        :param name: The name of the virtual machine
+        :type name: String
+        """
+        ticket = self._content.sessionManager.AcquireCloneTicket()
+        url = """\
+        https://{0}/ui/webconsole.html?vmId={1}&vmName={2}&serverGuid={3}&
+        locale=en_US&host={0}&sessionTicket={4}&thumbprint={5}
+        """.format(const.INF_VCENTER_SERVER,
+                   the_vm._moId,
+                   name,
+                   self._server_guid,
+                   ticket,
+                   self._thumbprint)
+        return textwrap.dedent(url).replace('\n', '')
@@ -0,0 +1,230 @@
+# -*- coding: UTF-8 -*-
+"""
+Connecting VMs to networks.
+
+``virtual_machine.change_network`` blocks on its reconfigure task. The
+functions here only start the task, so a ``TaskWaiter`` can wait on the NIC
+changes of many VMs at once.
+
+``vcenter.networks`` reads the name of every network in vCenter, one round
+trip per network, each time a session is checked out of the pool. With a
+portgroup per user network that's hundreds of requests per deploy, so
+``resolve`` keeps a per-process index of network name -> moid instead. The
+index expires after ``VLAB_WINSERVER_NETWORK_CACHE_TTL`` seconds, and a name
+that's not in the index reloads it once, so new networks are found right away.
+Before a VM is connected to a network from the index, the network is checked
+once; a portgroup that was deleted (or deleted and made again) also reloads
+the index, instead of failing the deploy or reconfigure later on.
+"""
+import time
+import threading
+
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim
+
+from vlab_winserver_api.lib import const
+from vlab_winserver_api.lib.metrics import REGISTRY
+
+
+class NetworkResolver(object):
+    """Finds networks by name, for both standard and distributed portgroups
+
+    :param ttl: How many seconds to trust the index before reloading it
+    :type ttl: Integer
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._index = {}
+        self._loaded = 0
+        self._hits = 0
+        self._misses = 0
+
+    def resolve(self, vcenter, name, check=False):
+        """Obtain a network by name
+
+        :Returns: vim.Network or vim.dvs.DistributedVirtualPortgroup
+
+        :Raises: KeyError if vCenter has no network by that name
+
+        :param vcenter: The vCenter object
+        :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+        :param name: The name of the network
+        :type name: String
+
+        :param check: Set to True to make sure a network from the index still exists; costs one round trip
+        :type check: Boolean
+        """
+        start = time.time()
+        with self._lock:
+            fresh = time.time() - self._loaded < self.ttl
+            found = self._index.get(name, None) if fresh else None
+        hit = found is not None
+        if not hit:
+            self.load(vcenter)
+            with self._lock:
+                found = self._index.get(name, None)
+        self._record(hit, time.time() - start)
+        if found is None:
+            raise KeyError(name)
+        kind, moid = found
+        network = kind(moid, stub=vcenter._conn._stub)
+        if hit and check and _current_name(network) != name:
+            # The portgroup was deleted since the index was loaded
+            self.invalidate()
+            return self.resolve(vcenter, name)
+        return network
+
+    def load(self, vcenter):
+        """Read the name of every network in vCenter with one PropertyCollector call
+
+        :Returns: None
+
+        :param vcenter: The vCenter object
+        :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+        """
+        index = {}
+        for obj, props in _retrieve_networks(vcenter):
+            if 'name' in props:
+                index[props['name']] = (type(obj), obj._moId)
+        with self._lock:
+            self._index = index
+            self._loaded = time.time()
+
+    def invalidate(self):
+        """Forget every network, i.e. after vCenter reports a network is gone
+
+        :Returns: None
+        """
+        with self._lock:
+            self._index = {}
+            self._loaded = 0
+
+    def _record(self, hit, elapsed):
+        """Track the lookup latency and hit ratio
+
+        :Returns: None
+        """
+        result = 'hit' if hit else 'miss'
+        REGISTRY.inc('winserver_network_lookup_total', result=result)
+        REGISTRY.observe('winserver_network_lookup_seconds', elapsed, result=result)
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+            ratio = self._hits / (self._hits + self._misses)
+        REGISTRY.set('winserver_network_lookup_hit_ratio', ratio)
+
+
+def _current_name(network):
+    """Obtain the name vCenter has for a network now
+
+    :Returns: String, or None if the network no longer exists
+    """
+    try:
+        return network.name
+    except vmodl.fault.ManagedObjectNotFound:
+        return None
+
+
+def _retrieve_networks(vcenter):
+    """Obtain the name of every network in vCenter
+
+    :Returns: List of Tuples - (vim.Network, Dictionary of properties)
+    """
+    pc = vmodl.query.PropertyCollector
+    view = vcenter.content.viewManager.CreateContainerView(container=vcenter.content.rootFolder,
+                                                          type=[vim.Network],
+                                                          recursive=True)
+    try:
+        view_to_network = pc.TraversalSpec(name='viewToNetwork', type=vim.view.ContainerView,
+                                           path='view', skip=False)
+        filter_spec = pc.FilterSpec(objectSet=[pc.ObjectSpec(obj=view, skip=True, selectSet=[view_to_network])],
+                                    propSet=[pc.PropertySpec(type=vim.Network, pathSet=['name'])])
+        collector = vcenter.content.propertyCollector
+        objects = []
+        result = collector.RetrievePropertiesEx(specSet=[filter_spec], options=pc.RetrieveOptions())
+        while result:
+            objects += result.objects
+            if not result.token:
+                break
+            result = collector.ContinueRetrievePropertiesEx(token=result.token)
+    finally:
+        view.Destroy()
+    return [(x.obj, {y.name: y.val for y in x.propSet}) for x in objects]
+
+
+_RESOLVER = None
+_RESOLVER_LOCK = threading.Lock()
+
+
+def get_resolver():
+    """Obtain the network resolver shared by the whole process
+
+    :Returns: NetworkResolver
+    """
+    global _RESOLVER
+    with _RESOLVER_LOCK:
+        if _RESOLVER is None:
+            _RESOLVER = NetworkResolver(const.VLAB_WINSERVER_NETWORK_CACHE_TTL)
+        return _RESOLVER
+
+
+def resolve(vcenter, name):
+    """Obtain a network by name to connect a VM to; a drop-in for ``vcenter.networks[name]``
+
+    :Returns: vim.Network or vim.dvs.DistributedVirtualPortgroup
+
+    :Raises: KeyError if vCenter has no network by that name
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param name: The name of the network
+    :type name: String
+    """
+    return get_resolver().resolve(vcenter, name, check=True)
+
+
+def change_task(the_vm, network, adapter_label='Network adapter 1'):
+    """Start moving a VM's NIC to a different network, like
+    ``virtual_machine.change_network`` but without blocking on the task
+
+    :Returns: vim.Task
+
+    :Raises: RuntimeError if the VM has no such NIC
+
+    :param the_vm: The virtual machine to update
+    :type the_vm: vim.VirtualMachine
+
+    :param network: The standard or distributed portgroup to connect the VM to
+    :type network: vim.Network
+
+    :param adapter_label: The name of the virtual NIC to connect to the network
+    :type adapter_label: String
+    """
+    devices = [x for x in the_vm.config.hardware.device if x.deviceInfo.label == adapter_label]
+    if not devices:
+        error = "VM has no network adapter named {}".format(adapter_label)
+        raise RuntimeError(error)
+    nicspec = vim.vm.device.VirtualDeviceSpec()
+    nicspec.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
+    nicspec.device = devices[0]
+    nicspec.device.wakeOnLanEnabled = True
+    if isinstance(network, vim.dvs.DistributedVirtualPortgroup):
+        dvs_port_connection = vim.dvs.PortConnection()
+        dvs_port_connection.portgroupKey = network.key
+        dvs_port_connection.switchUuid = network.config.distributedVirtualSwitch.uuid
+        nicspec.device.backing = vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo()
+        nicspec.device.backing.port = dvs_port_connection
+    else:
+        nicspec.device.backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo()
+        nicspec.device.backing.network = network
+        nicspec.device.backing.deviceName = network.name
+    nicspec.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
+    nicspec.device.connectable.startConnected = True
+    nicspec.device.connectable.allowGuestControl = True
+    nicspec.device.connectable.connected = True
+    return the_vm.ReconfigVM_Task(spec=vim.vm.ConfigSpec(deviceChange=[nicspec]))
@@ -0,0 +1,356 @@
+# -*- coding: UTF-8 -*-
+"""
+Picks the datastore and resource pool for every new WinServer.
+
+Sending every deploy to ``INF_VCENTER_DATASTORE`` saturates that datastore's
+I/O queue during a bulk create, while the others sit idle. Instead, each
+linked clone goes to one of the ``VLAB_WINSERVER_DATASTORES`` (a datastore
+cluster name counts as all of its datastores), and one of the
+``VLAB_WINSERVER_RESOURCE_POOLS``.
+
+The ``VLAB_WINSERVER_PLACEMENT_POLICY`` ranks the datastores:
+
+- ``balanced`` weighs the free space against how many deploys are already
+  running on a datastore, and how long its recent deploys took.
+- ``most-free`` only looks at the free space.
+
+Either way, datastores that are inaccessible, in maintenance, or would drop
+below ``VLAB_WINSERVER_PLACEMENT_RESERVE`` GB of free space are skipped, and
+the resource pool with the fewest running deploys is used.
+
+Free space is read from vCenter at most every ``VLAB_WINSERVER_PLACEMENT_TTL``
+seconds. The running deploys and their latency are tracked per worker process.
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim
+
+from vlab_winserver_api.lib import const
+from vlab_winserver_api.lib.metrics import REGISTRY
+
+
+GB = 1024 ** 3
+# How much the latest deploy moves a datastore's latency average
+LATENCY_WEIGHT = 0.3
+DATASTORE_PROPERTIES = ['name', 'parent', 'summary.freeSpace', 'summary.capacity',
+                        'summary.accessible', 'summary.maintenanceMode']
+
+
+class Datastore(object):
+    """What the engine knows about a candidate datastore
+
+    :param name: The name of the datastore
+    :type name: String
+
+    :param moid: The managed object id of the datastore
+    :type moid: String
+
+    :param free: Free space, in bytes
+    :type free: Integer
+
+    :param capacity: Total space, in bytes
+    :type capacity: Integer
+
+    :param accessible: Set to False if the hosts cannot reach the datastore
+    :type accessible: Boolean
+
+    :param maintenance: The maintenance mode vCenter reports, i.e. ``normal``
+    :type maintenance: String
+    """
+    def __init__(self, name, moid, free, capacity, accessible=True, maintenance='normal'):
+        self.name = name
+        self.moid = moid
+        self.free = free
+        self.capacity = capacity
+        self.accessible = accessible
+        self.maintenance = maintenance
+        # Deploys this process has running on the datastore
+        self.in_flight = 0
+        # Moving average of how long deploys on the datastore took, in seconds
+        self.latency = 0.0
+
+
+class Placement(object):
+    """Where one deploy goes
+
+    :param datastore: Where the disks of the new VM go
+    :type datastore: vim.Datastore
+
+    :param pool: The name of the resource pool to run the new VM in
+    :type pool: String
+    """
+    def __init__(self, datastore, pool):
+        self.datastore = datastore
+        self.pool = pool
+
+
+class BalancedPolicy(object):
+    """Prefers free space, but avoids datastores that are busy or slow
+
+    :param reserve: Bytes of free space to set aside for each deploy
+    :type reserve: Integer
+
+    :param latency_scale: How many seconds of deploy latency halves a datastore's score
+    :type latency_scale: Float
+    """
+    def __init__(self, reserve, latency_scale=60.0):
+        self.reserve = reserve
+        self.latency_scale = latency_scale
+
+    def score(self, datastore):
+        """Rank a datastore; the highest score gets the next deploy
+
+        :Returns: Float
+
+        :param datastore: The candidate
+        :type datastore: Datastore
+        """
+        free = datastore.free - datastore.in_flight * self.reserve
+        return free / ((1 + datastore.in_flight) * (1 + datastore.latency / self.latency_scale))
+
+
+class MostFreePolicy(object):
+    """Sends every deploy to the datastore with the most free space
+
+    :param reserve: Bytes of free space to set aside for each deploy
+    :type reserve: Integer
+    """
+    def __init__(self, reserve):
+        self.reserve = reserve
+
+    def score(self, datastore):
+        """Rank a datastore; the highest score gets the next deploy
+
+        :Returns: Float
+
+        :param datastore: The candidate
+        :type datastore: Datastore
+        """
+        return float(datastore.free - datastore.in_flight * self.reserve)
+
+
+POLICIES = {'balanced': BalancedPolicy, 'most-free': MostFreePolicy}
+
+
+def get_policy(name, reserve):
+    """Make a placement policy by name
+
+    :Returns: BalancedPolicy or MostFreePolicy
+
+    :Raises: ValueError for an unknown policy
+
+    :param name: The name of the policy, i.e. ``balanced``
+    :type name: String
+
+    :param reserve: Bytes of free space to set aside for each deploy
+    :type reserve: Integer
+    """
+    policy = POLICIES.get(name.lower(), None)
+    if policy is None:
+        raise ValueError('Unknown placement policy: {}'.format(name))
+    return policy(reserve)
+
+
+class PlacementEngine(object):
+    """Chooses a datastore and resource pool for each deploy
+
+    :param datastores: The names of the candidate datastores or datastore clusters
+    :type datastores: List
+
+    :param pools: The names of the candidate resource pools
+    :type pools: List
+
+    :param policy: Ranks the datastores; anything with a ``score(datastore)`` method
+    :type policy: BalancedPolicy
+
+    :param ttl: How many seconds to trust the free space vCenter last reported
+    :type ttl: Integer
+    """
+    def __init__(self, datastores, pools, policy, ttl):
+        self.datastores = datastores
+        self.pools = pools
+        self.policy = policy
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._candidates = {}
+        self._pools = {x: 0 for x in pools}
+        self._loaded = 0
+
+    def load(self, vcenter):
+        """Read the capacity of the candidate datastores with one PropertyCollector call
+
+        :Returns: None
+
+        :param vcenter: The vCenter object
+        :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+        """
+        self.update(_retrieve_datastores(vcenter, self.datastores))
+
+    def update(self, found):
+        """Replace what's known about the capacity of the datastores, keeping the deploy counts
+
+        :Returns: None
+
+        :param found: The current state of each candidate datastore
+        :type found: List of Datastore
+        """
+        with self._lock:
+            candidates = {}
+            for datastore in found:
+                known = self._candidates.get(datastore.moid, None)
+                if known is not None:
+                    datastore.in_flight = known.in_flight
+                    datastore.latency = known.latency
+                candidates[datastore.moid] = datastore
+            self._candidates = candidates
+            self._loaded = time.time()
+
+    def choose(self):
+        """Pick the datastore and pool for the next deploy, and count it as running
+
+        :Returns: Tuple - (Datastore, String)
+
+        :Raises: RuntimeError if no datastore has room
+        """
+        with self._lock:
+            eligible = [x for x in self._candidates.values() if self._has_room(x)]
+            if not eligible:
+                error = 'No datastore has room for another WinServer; checked {}'.format(', '.join(self.datastores))
+                raise RuntimeError(error)
+            datastore = max(eligible, key=lambda x: (self.policy.score(x), x.name))
+            pool = min(self.pools, key=lambda x: self._pools[x])
+            datastore.in_flight += 1
+            self._pools[pool] += 1
+            self._record(datastore)
+        return datastore, pool
+
+    def release(self, datastore, pool, seconds=None):
+        """Record that a deploy finished
+
+        :Returns: None
+
+        :param datastore: Where the deploy went
+        :type datastore: Datastore
+
+        :param pool: The name of the resource pool the deploy went to
+        :type pool: String
+
+        :param seconds: How long the deploy took; None if it failed
+        :type seconds: Float
+        """
+        with self._lock:
+            # A reload while the deploy ran replaced the object, but kept the counts
+            datastore = self._candidates.get(datastore.moid, datastore)
+            datastore.in_flight -= 1
+            self._pools[pool] -= 1
+            if seconds is not None:
+                if datastore.latency:
+                    datastore.latency += LATENCY_WEIGHT * (seconds - datastore.latency)
+                else:
+                    datastore.latency = seconds
+                REGISTRY.observe('winserver_placement_deploy_seconds', seconds, datastore=datastore.name)
+            self._record(datastore)
+
+    @contextmanager
+    def place(self, vcenter):
+        """Pick where a deploy goes for the duration of a ``with`` block, which
+        should run the deploy so it gets timed
+
+        :Returns: A context manager that yields a Placement
+
+        :param vcenter: The vCenter object
+        :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+        """
+        if time.time() - self._loaded >= self.ttl:
+            self.load(vcenter)
+        datastore, pool = self.choose()
+        start = time.time()
+        seconds = None
+        try:
+            yield Placement(vim.Datastore(datastore.moid, stub=vcenter._conn._stub), pool)
+            seconds = time.time() - start
+        finally:
+            self.release(datastore, pool, seconds)
+
+    def _has_room(self, datastore):
+        """Check if a datastore can take another deploy; call while holding the lock"""
+        if not datastore.accessible or datastore.maintenance != 'normal':
+            return False
+        return datastore.free - (datastore.in_flight + 1) * self.policy.reserve >= 0
+
+    def _record(self, datastore):
+        """Track the deploys running on a datastore; call while holding the lock"""
+        REGISTRY.set('winserver_placement_in_flight', datastore.in_flight, datastore=datastore.name)
+
+
+def _retrieve_datastores(vcenter, names):
+    """Obtain the capacity of the named datastores, and of the datastores in the named clusters
+
+    :Returns: List of Datastore
+    """
+    pc = vmodl.query.PropertyCollector
+    view = vcenter.content.viewManager.CreateContainerView(container=vcenter.content.rootFolder,
+                                                          type=[vim.Datastore, vim.StoragePod],
+                                                          recursive=True)
+    try:
+        view_to_datastore = pc.TraversalSpec(name='viewToDatastore', type=vim.view.ContainerView,
+                                             path='view', skip=False)
+        filter_spec = pc.FilterSpec(objectSet=[pc.ObjectSpec(obj=view, skip=True, selectSet=[view_to_datastore])],
+                                    propSet=[pc.PropertySpec(type=vim.Datastore, pathSet=DATASTORE_PROPERTIES),
+                                             pc.PropertySpec(type=vim.StoragePod, pathSet=['name'])])
+        collector = vcenter.content.propertyCollector
+        objects = []
+        result = collector.RetrievePropertiesEx(specSet=[filter_spec], options=pc.RetrieveOptions())
+        while result:
+            objects += result.objects
+            if not result.token:
+                break
+            result = collector.ContinueRetrievePropertiesEx(token=result.token)
+    finally:
+        view.Destroy()
+    found = [(x.obj, {y.name: y.val for y in x.propSet}) for x in objects]
+    clusters = {x._moId for x, props in found if isinstance(x, vim.StoragePod) and props.get('name', None) in names}
+    datastores = []
+    for obj, props in found:
+        if not isinstance(obj, vim.Datastore):
+            continue
+        parent = props.get('parent', None)
+        if props.get('name', None) in names or (parent is not None and parent._moId in clusters):
+            datastores.append(Datastore(name=props['name'],
+                                        moid=obj._moId,
+                                        free=props.get('summary.freeSpace', 0),
+                                        capacity=props.get('summary.capacity', 0),
+                                        accessible=props.get('summary.accessible', False),
+                                        maintenance=props.get('summary.maintenanceMode', None) or 'normal'))
+    return datastores
+
+
+def _names(value):
+    """Split a comma separated setting, i.e. ``VLAB_WINSERVER_DATASTORES``
+
+    :Returns: List
+    """
+    return [x.strip() for x in value.split(',') if x.strip()]
+
+
+_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
+
+
+def get_engine():
+    """Obtain the placement engine shared by the whole process
+
+    :Returns: PlacementEngine
+    """
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            policy = get_policy(const.VLAB_WINSERVER_PLACEMENT_POLICY, const.VLAB_WINSERVER_PLACEMENT_RESERVE * GB)
+            _ENGINE = PlacementEngine(datastores=_names(const.VLAB_WINSERVER_DATASTORES),
+                                      pools=_names(const.VLAB_WINSERVER_RESOURCE_POOLS),
+                                      policy=policy,
+                                      ttl=const.VLAB_WINSERVER_PLACEMENT_TTL)
+        return _ENGINE
@@ -0,0 +1,326 @@
+# -*- coding: UTF-8 -*-
+"""
+Pooled, long lived sessions to vCenter for the backend worker.
+
+Logging into vCenter is a full SOAP login plus a fetch of the service content,
+and vCenter caps the number of concurrent sessions. Instead of every task
+creating (and tearing down) a new ``vCenter`` object, each worker process keeps
+a small pool of authenticated sessions that tasks borrow and return.
+"""
+import os
+import ssl
+import time
+import threading
+import http.client
+from contextlib import contextmanager
+
+from pyVmomi import vim
+from celery.utils.log import get_task_logger
+from vlab_inf_common.vmware import vCenter
+
+from vlab_winserver_api.lib import const
+from vlab_winserver_api.lib.metrics import REGISTRY
+from vlab_winserver_api.lib.worker import timing
+
+
+logger = get_task_logger(__name__)
+logger.setLevel(const.VLAB_WINSERVER_LOG_LEVEL.upper())
+
+# Errors that mean the session itself is broken, not the work done with it
+SESSION_ERRORS = (vim.fault.NotAuthenticated, ConnectionError, http.client.HTTPException, ssl.SSLError)
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+class PooledvCenter(vCenter):
+    """A vCenter session that's reused between tasks
+
+    ``vCenter.networks`` is memoized for the life of the object, which is fine
+    for a session used by one task. A pooled session would never notice the
+    networks created after login, so this one keeps its own network list, and
+    forgets it on ``reset``.
+    """
+    def __init__(self, *args, **kwargs):
+        super(PooledvCenter, self).__init__(*args, **kwargs)
+        self._network_map = None
+
+    @property
+    def networks(self):
+        """The networks VMs can use, by name; read once per checkout
+
+        :Returns: Dictionary
+        """
+        if self._network_map is None:
+            self._network_map = {x.name: x for x in self.get_by_type(vim.Network)}
+        return self._network_map
+
+    def reset(self):
+        """Forget what was read during the last checkout
+
+        :Returns: None
+        """
+        self._network_map = None
+
+
+class SessionPool(object):
+    """A bounded set of authenticated vCenter sessions that get reused between tasks.
+
+    :param max_size: The most sessions the pool will have checked out at once
+    :type max_size: Integer
+
+    :param timeout: How long (in seconds) to block waiting on a free session
+    :type timeout: Integer
+
+    :param keepalive: Idle sessions older than this many seconds are validated
+                      before being reused, and get pinged so vCenter doesn't
+                      expire them.
+    :type keepalive: Integer
+
+    :param factory: Optional - A callable that returns a new, logged in vCenter object
+    :type factory: Function
+    """
+    def __init__(self, max_size, timeout, keepalive, factory=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.pid = os.getpid()
+        self._factory = factory if factory else _connect
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = []
+        self._pinger = None
+
+    def checkout(self):
+        """Obtain a usable session, logging in again if the idle one expired
+
+        :Returns: vlab_inf_common.vmware.vCenter
+
+        :Raises: RuntimeError if no session frees up within ``timeout`` seconds
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            error = 'No vCenter session available within {} seconds'.format(self.timeout)
+            raise RuntimeError(error)
+        try:
+            vcenter = self._reuse()
+            if vcenter is None:
+                logger.debug('Opening new vCenter session')
+                vcenter = self._factory()
+        except Exception:
+            self._slots.release()
+            raise
+        self._start_pinger()
+        return vcenter
+
+    def checkin(self, vcenter, discard=False):
+        """Return a session to the pool
+
+        :Returns: None
+
+        :param vcenter: The session that was obtained via ``checkout``
+        :type vcenter: vlab_inf_common.vmware.vCenter
+
+        :param discard: Set to True to logout instead of keeping the session
+        :type discard: Boolean
+        """
+        try:
+            with self._lock:
+                keep = not discard and len(self._idle) < self.max_size
+                if keep:
+                    self._idle.append((vcenter, time.time()))
+            if not keep:
+                _close(vcenter)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def session(self):
+        """Borrow a session for the duration of a ``with`` block
+
+        A session that fails with an authentication or connection error is
+        thrown away, so the next checkout logs in again.
+        """
+        with timing.span('vcenter.checkout'):
+            vcenter = self.checkout()
+        vcenter.reset()
+        discard = False
+        try:
+            yield vcenter
+        except SESSION_ERRORS:
+            discard = True
+            raise
+        finally:
+            self.checkin(vcenter, discard=discard)
+
+    def ping(self):
+        """Keep idle sessions alive, and logout of any that vCenter already expired
+
+        :Returns: None
+        """
+        now = time.time()
+        with self._lock:
+            stale = [x for x in self._idle if now - x[1] >= self.keepalive]
+            self._idle = [x for x in self._idle if now - x[1] < self.keepalive]
+        for vcenter, _ in stale:
+            try:
+                alive = _is_alive(vcenter)
+            except Exception as doh:
+                logger.exception(doh)
+                alive = False
+            if alive:
+                with self._lock:
+                    self._idle.append((vcenter, time.time()))
+            else:
+                _close(vcenter)
+
+    def close(self):
+        """Logout of every idle session
+
+        :Returns: None
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for vcenter, _ in idle:
+            _close(vcenter)
+
+    @property
+    def idle(self):
+        """The number of sessions waiting to be reused
+
+        :Returns: Integer
+        """
+        return len(self._idle)
+
+    def _reuse(self):
+        """Pop the most recently used idle session that's still valid
+
+        :Returns: vlab_inf_common.vmware.vCenter or None
+        """
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                vcenter, last_used = self._idle.pop()
+            try:
+                alive = time.time() - last_used < self.keepalive or _is_alive(vcenter)
+            except Exception:
+                # It's no longer in the pool, so nothing else would logout of it
+                _close(vcenter)
+                raise
+            if alive:
+                return vcenter
+            logger.debug('Discarding expired vCenter session')
+            _close(vcenter)
+
+    def _start_pinger(self):
+        """Lazily start the background thread that keeps idle sessions alive"""
+        with self._lock:
+            if self._pinger is None or not self._pinger.is_alive():
+                self._pinger = threading.Thread(target=self._ping_forever, daemon=True)
+                self._pinger.start()
+
+    def _ping_forever(self):
+        """Body of the keepalive thread"""
+        while True:
+            time.sleep(self.keepalive)
+            try:
+                self.ping()
+            except Exception as doh:
+                logger.exception(doh)
+
+
+def get_pool():
+    """Obtain the session pool for the current process.
+
+    Celery forks its worker processes, and a socket cannot be shared between
+    processes, so a pool inherited from the parent process is replaced.
+
+    :Returns: SessionPool
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None or _POOL.pid != os.getpid():
+            _POOL = SessionPool(max_size=const.VLAB_WINSERVER_VCENTER_POOL_SIZE,
+                                timeout=const.VLAB_WINSERVER_VCENTER_POOL_TIMEOUT,
+                                keepalive=const.VLAB_WINSERVER_VCENTER_KEEPALIVE)
+    return _POOL
+
+
+def vcenter_session():
+    """Borrow a session from this process's pool; a drop-in for ``with vCenter(...)``
+
+    :Returns: A context manager that yields a vlab_inf_common.vmware.vCenter
+    """
+    return get_pool().session()
+
+
+def _connect():
+    """Login to vCenter
+
+    :Returns: PooledvCenter
+    """
+    vcenter = PooledvCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
+                            password=const.INF_VCENTER_PASSWORD)
+    count_calls(vcenter._conn._stub)
+    return vcenter
+
+
+def count_calls(stub):
+    """Record the count and latency of every vCenter round trip made through a
+    SOAP stub, by method (i.e. ``RetrievePropertiesEx``) or property read
+
+    Objects rebuilt from a moid with this stub are counted too.
+
+    :Returns: None
+
+    :param stub: The SOAP stub of a vCenter session
+    :type stub: pyVmomi.SoapAdapter.SoapStubAdapter
+    """
+    stub.InvokeMethod = _timed(stub.InvokeMethod, 'method')
+    stub.InvokeAccessor = _timed(stub.InvokeAccessor, 'property')
+
+
+def _timed(invoke, kind):
+    """Wrap an ``Invoke*`` function of a SOAP stub with metrics
+
+    :Returns: Function
+    """
+    def timed_invoke(mo, info, *args, **kwargs):
+        start = time.time()
+        result = 'error'
+        try:
+            answer = invoke(mo, info, *args, **kwargs)
+            result = 'ok'
+            return answer
+        finally:
+            REGISTRY.inc('winserver_vcenter_calls_total', kind=kind, method=info.name, result=result)
+            REGISTRY.observe('winserver_vcenter_call_seconds', time.time() - start, kind=kind, method=info.name)
+    return timed_invoke
+
+
+def _is_alive(vcenter):
+    """Determine if vCenter still considers a session to be logged in
+
+    :Returns: Boolean
+
+    :param vcenter: The session to check
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    try:
+        return vcenter.content.sessionManager.currentSession is not None
+    except SESSION_ERRORS:
+        return False
+
+
+def _close(vcenter):
+    """Logout of a session, ignoring errors from sessions that are already dead
+
+    :Returns: None
+
+    :param vcenter: The session to close
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    try:
+        vcenter.close()
+    except Exception as doh:
+        logger.debug('Error closing vCenter session: {}'.format(doh))
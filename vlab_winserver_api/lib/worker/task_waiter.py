@@ -0,0 +1,165 @@
+# -*- coding: UTF-8 -*-
+"""
+Wait on many vCenter tasks at once.
+
+``vlab_inf_common.vmware.consume_task`` polls ``task.info`` once a second,
+which is two round trips per task per second, and it can only wait on one
+task. A ``TaskWaiter`` watches any number of tasks through one filter on a
+private PropertyCollector, and vCenter answers ``WaitForUpdatesEx`` as soon
+as one of them changes.
+"""
+import time
+import threading
+
+from pyVmomi import vim, vmodl
+
+from vlab_winserver_api.lib import const
+
+
+# Longest a single WaitForUpdatesEx call blocks, so cancel() takes effect quickly
+WAIT_SLICE = 5
+
+
+class TaskWaiter(object):
+    """Waits for a batch of vCenter tasks to finish
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param timeout: Optional - How many seconds to wait for all the tasks.
+                    Defaults to ``VLAB_WINSERVER_TASK_TIMEOUT``.
+    :type timeout: Integer
+    """
+    def __init__(self, vcenter, timeout=None):
+        self._vcenter = vcenter
+        self.timeout = timeout if timeout else const.VLAB_WINSERVER_TASK_TIMEOUT
+        self._tasks = {}
+        self._props = {}
+        self._cancelled = threading.Event()
+
+    def add(self, key, the_task):
+        """Include a task in the batch
+
+        :Returns: None
+
+        :param key: What to call the task in the results, i.e. the VM name
+        :type key: Object
+
+        :param the_task: The vCenter task
+        :type the_task: vim.Task
+        """
+        self._tasks[key] = the_task
+
+    def cancel(self):
+        """Stop waiting, i.e. from another thread; the unfinished tasks get cancelled
+
+        :Returns: None
+        """
+        self._cancelled.set()
+
+    def result(self, key):
+        """Obtain what a finished task returned, i.e. the VM a clone made
+
+        :Returns: Object
+
+        :param key: The key the task was added with
+        :type key: Object
+        """
+        return self._props.get(self._tasks[key]._moId, {}).get('info.result', None)
+
+    def wait(self):
+        """Block until every task is done, the timeout passes, or ``cancel`` is called.
+        Tasks still running after a timeout or cancel are cancelled in vCenter,
+        and fail with ``vim.fault.Timedout``.
+
+        :Returns: Dictionary - key -> None if the task worked, or the fault it failed with
+        """
+        if not self._tasks:
+            return {}
+        pc = vmodl.query.PropertyCollector
+        keys = {y._moId: x for x, y in self._tasks.items()}
+        filter_spec = pc.FilterSpec(objectSet=[pc.ObjectSpec(obj=x, skip=False) for x in self._tasks.values()],
+                                    propSet=[pc.PropertySpec(type=vim.Task, pathSet=['info.state', 'info.error', 'info.result'])])
+        deadline = time.time() + self.timeout
+        results = {}
+        # A private collector, so the filter goes away with it
+        collector = self._vcenter.content.propertyCollector.CreatePropertyCollector()
+        try:
+            collector.CreateFilter(spec=filter_spec, partialUpdates=True)
+            version = ''
+            while len(results) < len(self._tasks):
+                remaining = deadline - time.time()
+                if self._cancelled.is_set():
+                    self._give_up(results, 'Cancelled waiting on task')
+                    break
+                elif remaining <= 0:
+                    self._give_up(results, 'Timeout of {} seconds exceeded for task'.format(self.timeout))
+                    break
+                options = pc.WaitOptions(maxWaitSeconds=max(1, int(min(remaining, WAIT_SLICE))))
+                update_set = collector.WaitForUpdatesEx(version=version, options=options)
+                if update_set is None:
+                    continue
+                version = update_set.version
+                for filter_update in update_set.filterSet or []:
+                    for object_update in filter_update.objectSet or []:
+                        moid = object_update.obj._moId
+                        props = self._props.setdefault(moid, {})
+                        for change in object_update.changeSet or []:
+                            props[change.name] = change.val
+                        if props.get('info.state', None) == vim.TaskInfo.State.success:
+                            results[keys[moid]] = None
+                        elif props.get('info.state', None) == vim.TaskInfo.State.error:
+                            results[keys[moid]] = props.get('info.error', None)
+        finally:
+            collector.DestroyPropertyCollector()
+        return results
+
+    def _give_up(self, results, reason):
+        """Cancel the unfinished tasks, and record that they timed out
+
+        :Returns: None
+        """
+        for key, the_task in self._tasks.items():
+            if key in results:
+                continue
+            try:
+                the_task.CancelTask()
+            except vmodl.MethodFault:
+                # Not every task can be cancelled, and it might have just finished
+                pass
+            results[key] = vim.fault.Timedout(msg='{} {}'.format(reason, the_task._moId))
+
+
+def wait_for_task(vcenter, the_task, timeout=None):
+    """Wait for one vCenter task; a drop-in for ``consume_task``
+
+    :Returns: vim.TaskInfo.result
+
+    :Raises: RuntimeError if the task fails or times out
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param the_task: The vCenter task
+    :type the_task: vim.Task
+
+    :param timeout: Optional - How many seconds to wait. Defaults to ``VLAB_WINSERVER_TASK_TIMEOUT``.
+    :type timeout: Integer
+    """
+    waiter = TaskWaiter(vcenter, timeout=timeout)
+    waiter.add('task', the_task)
+    fault = waiter.wait()['task']
+    if fault is not None:
+        raise RuntimeError(fault_message(fault))
+    return waiter.result('task')
+
+
+def fault_message(fault):
+    """Convert the fault of a failed vCenter task into an error message
+
+    :Returns: String
+
+    :param fault: The error of the task
+    :type fault: vmodl.MethodFault
+    """
+    return getattr(fault, 'msg', None) or '{}'.format(fault)
@@ -2,13 +2,116 @@
 """
 Entry point logic for available backend worker tasks
 """
-from celery import Celery
+import time
+
+from celery import Celery, chain
+from celery.signals import before_task_publish, task_failure, task_postrun, task_prerun, worker_process_init
+from celery.utils.time import maybe_iso8601
 from vlab_api_common import get_task_logger
 
-from vlab_winserver_api.lib import const
-from vlab_winserver_api.lib.worker import vmware
+from vlab_winserver_api.lib import const, metrics, queues, results, admission, dedupe
+from vlab_winserver_api.lib.metrics import REGISTRY
+from vlab_winserver_api.lib.cache import get_cache
+from vlab_winserver_api.lib.worker import vmware, change_feed, timing, warm_pool
+
+app = Celery('winserver', broker=const.VLAB_MESSAGE_BROKER)
+queues.configure(app)
+results.configure(app)
+app.conf.beat_schedule = {
+    'refill-warm-pool': {
+        'task': 'winserver.pool.refill',
+        'schedule': const.VLAB_WINSERVER_POOL_REFILL_INTERVAL,
+        # a refill that waited longer than the interval is redundant
+        'options': {'expires': const.VLAB_WINSERVER_POOL_REFILL_INTERVAL},
+    },
+}
+
+
+# Tasks sent by the worker, i.e. the phases of create, get stamped too
+before_task_publish.connect(metrics.stamp_sent)
+# Fail now on bad deploy limit settings, instead of on the first create
+admission.get_admission()
+# Likewise for a warm pool without a shared refill lock
+warm_pool.check_settings()
+
+
+@task_prerun.connect
+def start_timer(task=None, **kwargs):
+    """Record how long a task sat in the queue, and when it started"""
+    now = time.time()
+    task.request.winserver_started = now
+    sent_at = getattr(task.request, 'winserver_sent_at', None)
+    if sent_at is None:
+        return
+    if task.request.eta:
+        # A retry with a countdown isn't waiting on the queue until the countdown ends
+        sent_at = max(sent_at, maybe_iso8601(task.request.eta).timestamp())
+    REGISTRY.observe('winserver_task_queue_seconds', max(0, now - sent_at), task=task.name)
+
+
+@task_failure.connect
+def count_failure(sender=None, **kwargs):
+    """Count the tasks that raised, instead of returning an error"""
+    REGISTRY.inc('winserver_task_exceptions_total', task=sender.name)
+
+
+@task_failure.connect
+def release_deploy(sender=None, task_id=None, args=None, **kwargs):
+    """Give back the deploy lease and VM name claim of a create that raised,
+    so it stops counting against the limits, and the create can be retried"""
+    if sender.name == 'winserver.create_many':
+        admission.get_admission().release(task_id)
+    elif sender.name == 'winserver.create' and args:
+        _create_done(task_id, args[0], args[1])
+    elif sender.name.startswith('winserver.create_many.') and args:
+        # The phases carry the id the lease was taken under
+        admission.get_admission().release(args[0]['task-id'])
+    elif sender.name.startswith('winserver.create.') and args:
+        _create_done(args[0]['task-id'], args[0]['username'], args[0]['machine-name'])
+
+
+def _create_done(task_id, username, machine_name):
+    """Give back what a create held while it ran; the deploy lease, and the claim on the VM name
 
-app = Celery('winserver', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
+    :Returns: None
+
+    :param task_id: The id of the task the client polls
+    :type task_id: String
+
+    :param username: The user who owns the new VM
+    :type username: String
+
+    :param machine_name: The name of the new VM
+    :type machine_name: String
+    """
+    admission.get_admission().release(task_id)
+    dedupe.get_deduplicator().finish('create', username, machine_name, task_id)
+
+
+@task_postrun.connect
+def dump_metrics(task=None, retval=None, state=None, **kwargs):
+    """Record how long a task took and how it ended, then publish the metrics
+    of this worker process"""
+    if task is not None:
+        started = getattr(task.request, 'winserver_started', None)
+        phase = getattr(task.request, 'winserver_phase', '')
+        if started is not None:
+            REGISTRY.observe('winserver_task_seconds', time.time() - started, task=task.name, phase=phase)
+        if state == 'SUCCESS' and isinstance(retval, dict) and retval.get('error', None):
+            result = 'error'
+        else:
+            result = '{}'.format(state).lower()
+        REGISTRY.inc('winserver_tasks_total', task=task.name, result=result)
+    try:
+        metrics.dump()
+    except OSError:
+        pass
+
+
+@worker_process_init.connect
+def start_change_feed(**kwargs):
+    """Warm up the inventory model as soon as a worker process starts"""
+    change_feed.get_feed()
 
 
 @app.task(name='winserver.show', bind=True)
@@ -26,21 +129,31 @@ def show(self, username, txn_id):
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_WINSERVER_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
+    cache = get_cache()
+    generation = cache.generation(username)
     try:
-        info = vmware.show_winserver(username)
+        with timing.recording(logger, resp['params']):
+            info = vmware.show_winserver(username)
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
     else:
         logger.info('Task complete')
         resp['content'] = info
+        cache.put(username, info, generation)
     return resp
 
 
-@app.task(name='winserver.create', bind=True)
+@app.task(name='winserver.create', bind=True, max_retries=None)
 def create(self, username, machine_name, image, network, ip_config, txn_id):
     """Deploy a new instance of WinServer
 
+    This task claims a VM from the warm pool, or deploys one. It then replaces itself with a chain of
+    phases (wait-for-guest, configure-ip, finalize) that reschedule themselves
+    instead of blocking a worker while the guest boots. The last phase inherits
+    the id of this task, so clients poll one task id for the final result.
+    While the deploy limits are hit, the task waits its turn in the queue.
+
     :Returns: Dictionary
 
     :param username: The name of the user who wants to create a new WinServer
@@ -64,15 +177,391 @@ def create(self, username, machine_name, image, network, ip_config, txn_id):
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_WINSERVER_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
+    busy = admission.get_admission().admit(self.request.id, username, queue=True)
+    if busy:
+        logger.info('Waiting to deploy: {}'.format(busy))
+        raise self.retry(countdown=admission.get_admission().retry_after)
+    get_cache().invalidate(username)
+    _set_phase(self, self.request.id, 'deploy')
     try:
-        resp['content'] = vmware.create_winserver(username, machine_name, image, network, ip_config, logger)
+        with timing.recording(logger, resp['params']):
+            deployed = vmware.claim_winserver(username, machine_name, image, network, logger)
+            if deployed is None:
+                deployed = vmware.deploy_winserver(username, machine_name, image, network, logger)
+            else:
+                deployed['warm'] = True
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
+        _create_done(self.request.id, username, machine_name)
+        logger.info('Task complete')
+        return resp
+    state = {'username': username,
+             'machine-name': machine_name,
+             'image': image,
+             'ip-config': ip_config,
+             'txn-id': txn_id,
+             'task-id': self.request.id,
+             'moid': deployed['moid'],
+             'boot-time': deployed['boot-time'],
+             'deadline': time.time() + const.VLAB_WINSERVER_GUEST_TIMEOUT,
+             'deployed-at': time.time(),
+             'meta-set': False,
+             'warm': deployed.get('warm', False),
+             'resp': resp,
+            }
+    logger.info('VM deployed')
+    return self.replace(chain(wait_for_guest.s(state), configure_ip.s(), finalize.s()))
+
+
+@app.task(name='winserver.create.wait_for_guest', bind=True, max_retries=None)
+def wait_for_guest(self, state):
+    """Create phase: wait for the guest to reboot after running unattend.xml
+
+    :Returns: Dictionary
+
+    :param state: The progress of creating the WinServer
+    :type state: Dictionary
+    """
+    if state['ip-config']['static-ip'] and not state.get('warm', False):
+        # A DHCP address doesn't need guest credentials, so only wait when
+        # we have to log into the guest to set the IP. Warm pool VMs have
+        # already been through the reboot.
+        logger = _phase_logger(state)
+        _set_phase(self, state['task-id'], 'wait-for-guest')
+        with timing.recording(logger, state['resp']['params']) as timings:
+            if not vmware.guest_ready(state['moid'], state['boot-time']):
+                _retry_until(self, state, 'Guest not ready within {} seconds'.format(const.VLAB_WINSERVER_GUEST_TIMEOUT))
+            if 'deployed-at' in state:
+                # The time between checks is spent waiting too
+                timings.add('wait-for-guest', time.time() - state['deployed-at'])
+        logger.info('Guest is ready')
+    return state
+
+
+@app.task(name='winserver.create.configure_ip', bind=True)
+def configure_ip(self, state):
+    """Create phase: set a static IP, if one was requested
+
+    :Returns: Dictionary
+
+    :param state: The progress of creating the WinServer
+    :type state: Dictionary
+    """
+    if state['ip-config']['static-ip'] and not state['resp']['error']:
+        logger = _phase_logger(state)
+        _set_phase(self, state['task-id'], 'configure-ip')
+        try:
+            with timing.recording(logger, state['resp']['params']):
+                vmware.configure_ip(state['moid'], state['ip-config'], logger)
+        except ValueError as doh:
+            logger.error('Task failed: {}'.format(doh))
+            state['resp']['error'] = '{}'.format(doh)
+    return state
+
+
+@app.task(name='winserver.create.finalize', bind=True, max_retries=None)
+def finalize(self, state):
+    """Create phase: record the meta data, and wait for the VM to have an IP
+
+    :Returns: Dictionary
+
+    :param state: The progress of creating the WinServer
+    :type state: Dictionary
+    """
+    logger = _phase_logger(state)
+    resp = state['resp']
+    if not resp['error']:
+        _set_phase(self, state['task-id'], 'finalize')
+        with timing.recording(logger, resp['params']):
+            info = vmware.finalize_winserver(state['username'], state['moid'], state['image'],
+                                             set_meta=not state['meta-set'])
+        state['meta-set'] = True
+        get_cache().invalidate(state['username'])
+        if not any(x['ips'] for x in info.values()):
+            _retry_until(self, state, 'Unable to obtain an IP within {} seconds'.format(const.VLAB_WINSERVER_GUEST_TIMEOUT))
+        resp['content'] = info
+    _create_done(state['task-id'], state['username'], state['machine-name'])
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='winserver.create_many', bind=True, max_retries=None)
+def create_many(self, username, machine_names, image, network, ip_configs, txn_id):
+    """Deploy many new instances of WinServer, i.e. for a class or test lab
+
+    Works like ``create``, but every phase handles all the VMs, so clients
+    poll one task id. While it runs, the task status reports the phase of
+    every VM. All the VMs count against the deploy limits.
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to create the WinServers
+    :type username: String
+
+    :param machine_names: The names of the new instances of WinServer
+    :type machine_names: List
+
+    :param image: The image/version of WinServer to create
+    :type image: String
+
+    :param network: The name of the network to connect the new WinServer instances up to
+    :type network: String
+
+    :param ip_configs: The IPv4 network configuration of each WinServer instance
+    :type ip_configs: List
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_WINSERVER_LOG_LEVEL.upper())
+    logger.info('Task starting')
+    try:
+        busy = admission.get_admission().admit(self.request.id, username, count=len(machine_names), queue=True)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        return {'content' : {}, 'error': '{}'.format(doh), 'params': {}}
+    if busy:
+        logger.info('Waiting to deploy: {}'.format(busy))
+        raise self.retry(countdown=admission.get_admission().retry_after)
+    get_cache().invalidate(username)
+    _set_phase(self, self.request.id, 'deploy')
+    deployed = vmware.deploy_many(username, machine_names, image, network, logger)
+    machines = {}
+    for machine_name, ip_config in zip(machine_names, ip_configs):
+        machine = deployed[machine_name]
+        machines[machine_name] = {'moid': machine.get('moid', None),
+                                  'boot-time': machine.get('boot-time', None),
+                                  'warm': machine.get('warm', False),
+                                  'ip-config': ip_config,
+                                  'phase': 'error' if machine.get('error', None) else 'deploy',
+                                  'error': machine.get('error', None),
+                                  'meta-set': False,
+                                  'info': None,
+                                 }
+    state = {'username': username,
+             'image': image,
+             'txn-id': txn_id,
+             'task-id': self.request.id,
+             'deadline': time.time() + const.VLAB_WINSERVER_GUEST_TIMEOUT,
+             'machines': machines,
+            }
+    logger.info('VMs deployed')
+    return self.replace(chain(wait_for_guests.s(state), configure_ips.s(), finalize_many.s()))
+
+
+@app.task(name='winserver.create_many.wait_for_guests', bind=True, max_retries=None)
+def wait_for_guests(self, state):
+    """Bulk create phase: wait for the guests that need a static IP to finish unattend.xml
+
+    :Returns: Dictionary
+
+    :param state: The progress of creating the WinServers
+    :type state: Dictionary
+    """
+    waiting = [x for x, y in state['machines'].items()
+               if y['ip-config']['static-ip'] and not y['warm'] and y['phase'] == 'deploy']
+    if waiting:
+        _set_phase(self, state['task-id'], 'wait-for-guest', _machine_phases(state))
+        results = vmware.fan_out(lambda x: vmware.guest_ready(state['machines'][x]['moid'],
+                                                              state['machines'][x]['boot-time']),
+                                 waiting)
+        for machine_name, ready in results.items():
+            if isinstance(ready, Exception):
+                _machine_failed(state, machine_name, ready)
+            elif ready:
+                state['machines'][machine_name]['phase'] = 'wait-for-guest'
+        waiting = [x for x in waiting if state['machines'][x]['phase'] == 'deploy']
+        _retry_many(self, state, waiting, 'Guest not ready within {} seconds'.format(const.VLAB_WINSERVER_GUEST_TIMEOUT))
+    return state
+
+
+@app.task(name='winserver.create_many.configure_ips', bind=True)
+def configure_ips(self, state):
+    """Bulk create phase: set the static IPs that were requested
+
+    :Returns: Dictionary
+
+    :param state: The progress of creating the WinServers
+    :type state: Dictionary
+    """
+    logger = _phase_logger(state)
+    todo = [x for x, y in state['machines'].items() if y['ip-config']['static-ip'] and not y['error']]
+    if todo:
+        _set_phase(self, state['task-id'], 'configure-ip', _machine_phases(state))
+        results = vmware.fan_out(lambda x: vmware.configure_ip(state['machines'][x]['moid'],
+                                                               state['machines'][x]['ip-config'],
+                                                               logger),
+                                 todo)
+        for machine_name, result in results.items():
+            if isinstance(result, Exception):
+                _machine_failed(state, machine_name, result)
+            else:
+                state['machines'][machine_name]['phase'] = 'configure-ip'
+    return state
+
+
+@app.task(name='winserver.create_many.finalize', bind=True, max_retries=None)
+def finalize_many(self, state):
+    """Bulk create phase: record the meta data, and wait for every VM to have an IP
+
+    :Returns: Dictionary
+
+    :param state: The progress of creating the WinServers
+    :type state: Dictionary
+    """
+    logger = _phase_logger(state)
+    todo = [x for x, y in state['machines'].items() if not y['error'] and y['info'] is None]
+    if todo:
+        _set_phase(self, state['task-id'], 'finalize', _machine_phases(state))
+        results = vmware.fan_out(lambda x: vmware.finalize_winserver(state['username'],
+                                                                     state['machines'][x]['moid'],
+                                                                     state['image'],
+                                                                     set_meta=not state['machines'][x]['meta-set']),
+                                 todo)
+        get_cache().invalidate(state['username'])
+        for machine_name, info in results.items():
+            machine = state['machines'][machine_name]
+            if isinstance(info, Exception):
+                _machine_failed(state, machine_name, info)
+                continue
+            machine['meta-set'] = True
+            if any(x['ips'] for x in info.values()):
+                machine['info'] = info
+                machine['phase'] = 'done'
+        waiting = [x for x in todo if state['machines'][x]['phase'] != 'done' and not state['machines'][x]['error']]
+        _retry_many(self, state, waiting, 'Unable to obtain an IP within {} seconds'.format(const.VLAB_WINSERVER_GUEST_TIMEOUT))
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    errors = []
+    for machine_name in sorted(state['machines'].keys()):
+        machine = state['machines'][machine_name]
+        if machine['error']:
+            errors.append('{}: {}'.format(machine_name, machine['error']))
+        elif machine['info']:
+            resp['content'].update(machine['info'])
+    if errors:
+        resp['error'] = '; '.join(errors)
+    admission.get_admission().release(state['task-id'])
     logger.info('Task complete')
     return resp
 
 
+def _machine_phases(state):
+    """Summarize which phase every VM of a bulk create is in
+
+    :Returns: Dictionary
+    """
+    return {x: y['phase'] for x, y in state['machines'].items()}
+
+
+def _machine_failed(state, machine_name, error):
+    """Record that one VM of a bulk create failed, without failing the others
+
+    :Returns: None
+
+    :Raises: The error, if it's a bug and not a failure to create the VM
+    """
+    if not isinstance(error, (ValueError, RuntimeError)):
+        raise error
+    _phase_logger(state).error('{} failed: {}'.format(machine_name, error))
+    state['machines'][machine_name]['phase'] = 'error'
+    state['machines'][machine_name]['error'] = '{}'.format(error)
+
+
+def _retry_many(task, state, waiting, error):
+    """Reschedule a bulk phase while some VMs are still waiting; after the
+    deadline, the VMs that are still waiting fail and the rest carry on.
+
+    :Returns: None
+
+    :Raises: celery.exceptions.Retry
+
+    :param task: The currently running task
+    :type task: celery.Task
+
+    :param state: The progress of creating the WinServers
+    :type state: Dictionary
+
+    :param waiting: The names of the VMs that are not ready yet
+    :type waiting: List
+
+    :param error: The message the waiting VMs fail with once the deadline passes
+    :type error: String
+    """
+    if not waiting:
+        return
+    if time.time() > state['deadline']:
+        for machine_name in waiting:
+            _machine_failed(state, machine_name, RuntimeError(error))
+        return
+    # The VMs are still deploying, so they must keep counting against the limits
+    admission.get_admission().renew(state['task-id'], state['username'], count=len(state['machines']))
+    countdown = min(const.VLAB_WINSERVER_GUEST_POLL_MIN * 2 ** task.request.retries,
+                    const.VLAB_WINSERVER_GUEST_POLL_MAX)
+    raise task.retry(args=[state], countdown=countdown)
+
+
+def _phase_logger(state):
+    """Log the phases of create under the client's transaction id, and the original task id
+
+    :Returns: logging.LoggerAdapter
+
+    :param state: The progress of creating the WinServer
+    :type state: Dictionary
+    """
+    return get_task_logger(txn_id=state['txn-id'], task_id=state['task-id'], loglevel=const.VLAB_WINSERVER_LOG_LEVEL.upper())
+
+
+def _set_phase(task, task_id, phase, machines=None):
+    """Report which phase of a multi-phase task is running via the task status
+
+    :Returns: None
+
+    :param task: The currently running task
+    :type task: celery.Task
+
+    :param task_id: The id of the task the client is polling
+    :type task_id: String
+
+    :param phase: The name of the phase
+    :type phase: String
+
+    :param machines: Optional - The phase of every VM in a bulk create
+    :type machines: Dictionary
+    """
+    task.request.winserver_phase = phase
+    if not task_id:
+        # Called directly, not by a worker (i.e. in tests)
+        return
+    meta = {'phase': phase}
+    if machines is not None:
+        meta['machines'] = machines
+    task.update_state(task_id=task_id, state='PROGRESS', meta=meta)
+
+
+def _retry_until(task, state, error):
+    """Reschedule a waiting phase with exponential backoff, instead of sleeping
+
+    :Raises: celery.exceptions.Retry, or RuntimeError once the deadline passes
+
+    :param task: The currently running task
+    :type task: celery.Task
+
+    :param state: The progress of creating the WinServer
+    :type state: Dictionary
+
+    :param error: The message to fail with once the deadline passes
+    :type error: String
+    """
+    if time.time() > state['deadline']:
+        raise RuntimeError(error)
+    # The VM is still deploying, so it must keep counting against the limits
+    admission.get_admission().renew(state['task-id'], state['username'])
+    countdown = min(const.VLAB_WINSERVER_GUEST_POLL_MIN * 2 ** task.request.retries,
+                    const.VLAB_WINSERVER_GUEST_POLL_MAX)
+    raise task.retry(args=[state], countdown=countdown)
+
+
 @app.task(name='winserver.delete', bind=True)
 def delete(self, username, machine_name, txn_id):
     """Destroy an instance of WinServer
@@ -92,12 +581,49 @@ def delete(self, username, machine_name, txn_id):
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        vmware.delete_winserver(username, machine_name, logger)
+        with timing.recording(logger, resp['params']):
+            vmware.delete_winserver(username, machine_name, logger)
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
     else:
         logger.info('Task complete')
+    finally:
+        get_cache().invalidate(username)
+        dedupe.get_deduplicator().finish('delete', username, machine_name, self.request.id)
+    return resp
+
+
+@app.task(name='winserver.delete_many', bind=True)
+def delete_many(self, username, machine_names, txn_id):
+    """Destroy many instances of WinServer, i.e. when tearing down a lab
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to delete their WinServers
+    :type username: String
+
+    :param machine_names: The names of the instances to delete; None deletes every WinServer the user has
+    :type machine_names: List
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_WINSERVER_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        resp['content'] = vmware.delete_many(username, machine_names, logger)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        errors = ['{}: {}'.format(x, y['error']) for x, y in sorted(resp['content'].items()) if 'error' in y]
+        if errors:
+            resp['error'] = '; '.join(errors)
+        logger.info('Task complete')
+    finally:
+        get_cache().invalidate(username)
     return resp
 
 
@@ -113,7 +639,7 @@ def image(self, txn_id):
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_WINSERVER_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
-    resp['content'] = {'image': vmware.list_images()}
+    resp['content'] = {'image': vmware.list_images(), 'templates': vmware.list_templates()}
     logger.info('Task complete')
     return resp
 
@@ -129,5 +655,71 @@ def modify_network(self, username, machine_name, new_network, txn_id):
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
+    finally:
+        get_cache().invalidate(username)
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='winserver.modify_networks', bind=True)
+def modify_networks(self, username, changes, txn_id):
+    """Change the network one, or many instances of WinServer are connected to
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who owns the WinServers
+    :type username: String
+
+    :param changes: The name of each instance -> the name of the network to connect it to
+    :type changes: Dictionary
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_WINSERVER_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        resp['content'] = vmware.update_networks(username, changes, logger)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        errors = ['{}: {}'.format(x, y['error']) for x, y in sorted(resp['content'].items()) if 'error' in y]
+        if errors:
+            resp['error'] = '; '.join(errors)
+        logger.info('Task complete')
+    finally:
+        get_cache().invalidate(username)
+    return resp
+
+
+@app.task(name='winserver.pool.refill', bind=True)
+def refill_pool(self):
+    """Keep the warm pool topped off; ran by Celery beat
+
+    :Returns: Dictionary
+    """
+    logger = get_task_logger(txn_id='refill-warm-pool', task_id=self.request.id, loglevel=const.VLAB_WINSERVER_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    vmware.refill_pool(logger)
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='winserver.pool', bind=True)
+def pool(self, txn_id):
+    """Obtain the size of the warm pool, and how well it's working
+
+    :Returns: Dictionary
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_WINSERVER_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    resp['content'] = {'pool': vmware.pool_status(), 'metrics': metrics.collect()}
     logger.info('Task complete')
     return resp
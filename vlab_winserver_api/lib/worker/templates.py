@@ -0,0 +1,288 @@
+# -*- coding: UTF-8 -*-
+"""
+Fast deploys of WinServer via linked clones.
+
+Uploading an OVA copies the whole disk for every new VM. When
+``VLAB_WINSERVER_DEPLOY_MODE`` is ``linked-clone``, each image version is
+imported once into the ``VLAB_WINSERVER_TEMPLATE_DIR`` folder and snapshotted.
+New instances are then linked clones of that snapshot, which only creates a
+delta disk.
+
+The templates are left as powered off VMs (not marked as vCenter templates)
+and are never booted, so every clone still runs C:\\unattend.xml on first boot.
+A template is only "ready" once it has its snapshot; an import that's still
+running (or died part way) is ignored.
+
+Only one deploy imports a template at a time; it holds a claim on the image
+(see ``dedupe.py``) while it does. Other deploys of that image upload the OVA
+instead of waiting on the import. A template without a snapshot that's older
+than ``VLAB_WINSERVER_TEMPLATE_IMPORT_TIMEOUT`` is left from an import that
+died, so it's destroyed and imported again.
+"""
+import time
+import uuid
+
+from vlab_inf_common.vmware import Ova, vim, virtual_machine
+
+from vlab_winserver_api.lib import const, dedupe
+from vlab_winserver_api.lib.worker import inventory, networks, placement
+from vlab_winserver_api.lib.worker.task_waiter import wait_for_task
+
+
+LINKED_CLONE = 'linked-clone'
+TEMPLATE_SNAPSHOT = 'vlab-base'
+
+
+def enabled():
+    """Check if new WinServers should be linked clones
+
+    :Returns: Boolean
+    """
+    return const.VLAB_WINSERVER_DEPLOY_MODE.lower() == LINKED_CLONE
+
+
+def template_name(image):
+    """Convert an image version into the name of its template VM
+
+    :Returns: String
+
+    :param image: The image/version of WinServer
+    :type image: String
+    """
+    return 'WinServer-{}-template'.format(image)
+
+
+def ready_templates(vcenter):
+    """Obtain the image versions that have a template ready to clone
+
+    :Returns: List
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+    """
+    folder = inventory.user_folder(vcenter, const.VLAB_WINSERVER_TEMPLATE_DIR)
+    ready = []
+    for props in inventory.retrieve_vms(vcenter, folder, properties=['name', 'snapshot']):
+        if props.get('snapshot', None) is None:
+            continue
+        name = props['name']
+        if name.startswith('WinServer-') and name.endswith('-template'):
+            ready.append(name[len('WinServer-'):-len('-template')])
+    return sorted(ready)
+
+
+def find_template(vcenter, image):
+    """Obtain the template VM and its snapshot for an image version
+
+    :Returns: Tuple - (vim.VirtualMachine, vim.vm.Snapshot). The snapshot is None
+              if the template is still being imported, or the import died;
+              both are None if there's no template
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param image: The image/version of WinServer
+    :type image: String
+    """
+    folder = inventory.user_folder(vcenter, const.VLAB_WINSERVER_TEMPLATE_DIR)
+    the_template = vcenter.content.searchIndex.FindChild(entity=folder, name=template_name(image))
+    if not isinstance(the_template, vim.VirtualMachine):
+        return None, None
+    snapshot = inventory.retrieve_properties(vcenter, the_template, ['snapshot']).get('snapshot', None)
+    if snapshot is None:
+        return the_template, None
+    return the_template, snapshot.currentSnapshot
+
+
+def import_template(vcenter, ova, network_map, image, logger):
+    """Upload an OVA one time, and snapshot it so it can be cloned
+
+    :Returns: Tuple - (vim.VirtualMachine, vim.vm.Snapshot)
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param ova: The OVA of the WinServer image
+    :type ova: vlab_inf_common.vmware.Ova
+
+    :param network_map: The mapping of networks defined in the OVA with what's in vCenter
+    :type network_map: List of vim.OvfManager.NetworkMapping
+
+    :param image: The image/version of WinServer
+    :type image: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    logger.info('Importing template for WinServer {}'.format(image))
+    the_template = virtual_machine.deploy_from_ova(vcenter, ova, network_map,
+                                                   const.VLAB_WINSERVER_TEMPLATE_DIR,
+                                                   template_name(image), logger,
+                                                   power_on=False)
+    wait_for_task(vcenter, the_template.CreateSnapshot_Task(name=TEMPLATE_SNAPSHOT,
+                                                            description='Base disk for linked clones',
+                                                            memory=False,
+                                                            quiesce=False))
+    return the_template, the_template.snapshot.currentSnapshot
+
+
+def clone(vcenter, the_template, snapshot, username, machine_name, network, logger):
+    """Create a new WinServer as a linked clone of a template
+
+    :Returns: vim.VirtualMachine
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param the_template: The template VM
+    :type the_template: vim.VirtualMachine
+
+    :param snapshot: The snapshot of the template to clone
+    :type snapshot: vim.vm.Snapshot
+
+    :param username: The name of the user who wants the new WinServer
+    :type username: String
+
+    :param machine_name: The name of the new instance of WinServer
+    :type machine_name: String
+
+    :param network: The network to connect the new WinServer to
+    :type network: vim.Network
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    with placement.get_engine().place(vcenter) as target:
+        relocate_spec = vim.vm.RelocateSpec(diskMoveType='createNewChildDiskBacking',
+                                            datastore=target.datastore,
+                                            pool=vcenter.resource_pools[target.pool])
+        clone_spec = vim.vm.CloneSpec(location=relocate_spec,
+                                      snapshot=snapshot,
+                                      powerOn=False,
+                                      template=False)
+        logger.debug('Creating linked clone on {}'.format(target.datastore._moId))
+        the_vm = wait_for_task(vcenter, the_template.CloneVM_Task(folder=inventory.user_folder(vcenter, username),
+                                                                  name=machine_name,
+                                                                  spec=clone_spec))
+    wait_for_task(vcenter, networks.change_task(the_vm, network))
+    logger.debug("Powering on {}'s new VM {}".format(username, machine_name))
+    wait_for_task(vcenter, the_vm.PowerOnVM_Task())
+    return the_vm
+
+
+def deploy(vcenter, entry, username, machine_name, image, network, logger):
+    """Create a new WinServer as a linked clone, importing the template first if needed
+
+    :Returns: vim.VirtualMachine, or None if another deploy is importing the
+              template; upload the OVA instead
+
+    :Raises: ValueError for an invalid network
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param entry: The image catalog entry for the image version
+    :type entry: Dictionary
+
+    :param username: The name of the user who wants the new WinServer
+    :type username: String
+
+    :param machine_name: The name of the new instance of WinServer
+    :type machine_name: String
+
+    :param image: The image/version of WinServer
+    :type image: String
+
+    :param network: The name of the network to connect the new WinServer to
+    :type network: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    try:
+        the_network = networks.resolve(vcenter, network)
+    except KeyError:
+        raise ValueError('No such network named {}'.format(network))
+    the_template, snapshot = find_template(vcenter, image)
+    if snapshot is None:
+        the_template, snapshot = _import_once(vcenter, entry, image, the_template, the_network, logger)
+        if snapshot is None:
+            return None
+    return clone(vcenter, the_template, snapshot, username, machine_name, the_network, logger)
+
+
+def _import_once(vcenter, entry, image, partial, the_network, logger):
+    """Import the template of an image, unless another deploy already is
+
+    :Returns: Tuple - (vim.VirtualMachine, vim.vm.Snapshot), or (None, None) if
+              another deploy is importing the template
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param entry: The image catalog entry for the image version
+    :type entry: Dictionary
+
+    :param image: The image/version of WinServer
+    :type image: String
+
+    :param partial: The template VM left by an import that's running or died; None if there's no template
+    :type partial: vim.VirtualMachine
+
+    :param the_network: The network to map the network of the OVA to
+    :type the_network: vim.Network
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    deduplicator = dedupe.get_deduplicator()
+    token = str(uuid.uuid4())
+    owner = deduplicator.claim('import', const.VLAB_WINSERVER_TEMPLATE_DIR, image, token,
+                               ttl=const.VLAB_WINSERVER_TEMPLATE_IMPORT_TIMEOUT)
+    if owner is not None:
+        logger.info('Template for WinServer {} is being imported by another deploy'.format(image))
+        return None, None
+    try:
+        if partial is not None:
+            if _age(vcenter, partial) < const.VLAB_WINSERVER_TEMPLATE_IMPORT_TIMEOUT:
+                # A worker that doesn't share our store is likely still importing it
+                logger.info('Template for WinServer {} is still being imported'.format(image))
+                return None, None
+            logger.info('Destroying the unfinished import of the template for WinServer {}'.format(image))
+            wait_for_task(vcenter, partial.Destroy_Task())
+        network_map = vim.OvfManager.NetworkMapping()
+        network_map.name = entry['networks'][0]
+        network_map.network = the_network
+        ova = Ova(entry['path'])
+        try:
+            return import_template(vcenter, ova, [network_map], image, logger)
+        except vim.fault.DuplicateName:
+            logger.info('Template for WinServer {} was imported by another deploy'.format(image))
+            return None, None
+        except Exception:
+            # Don't leave a template without a snapshot for the next deploy to wait on
+            leftover, snapshot = find_template(vcenter, image)
+            if leftover is not None and snapshot is None:
+                wait_for_task(vcenter, leftover.Destroy_Task())
+            raise
+        finally:
+            ova.close()
+    finally:
+        deduplicator.finish('import', const.VLAB_WINSERVER_TEMPLATE_DIR, image, token)
+
+
+def _age(vcenter, the_vm):
+    """Obtain how many seconds ago a VM was created
+
+    :Returns: Float - infinity if vCenter doesn't say
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param the_vm: The virtual machine
+    :type the_vm: vim.VirtualMachine
+    """
+    created = inventory.retrieve_properties(vcenter, the_vm, ['config.createDate']).get('config.createDate', None)
+    if created is None:
+        return float('inf')
+    return time.time() - created.timestamp()
@@ -0,0 +1,105 @@
+# -*- coding: UTF-8 -*-
+"""
+Lightweight timing of the steps inside a task.
+
+A task starts ``recording`` into its response, and the worker code wraps each
+step in ``span``. Every span is logged as JSON through the task logger (so it
+carries the ``txn_id``), added to the ``winserver_span_seconds`` metric, and
+totaled into ``resp['params']['timings']``. A slow deploy can then be
+diagnosed from the task result alone::
+
+    {"deploy.upload": {"seconds": 812.301, "count": 1},
+     "wait-for-guest.check": {"seconds": 4.127, "count": 31}, ...}
+
+``span`` does nothing outside of ``recording``, so the worker functions don't
+need to know if anyone is listening. Recording is per thread.
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+import ujson
+
+from vlab_winserver_api.lib.metrics import REGISTRY
+
+
+_CURRENT = threading.local()
+
+
+class Timings(object):
+    """Totals how long each named step of a task took
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param target: Where to keep the totals, under the ``timings`` key; i.e. ``resp['params']``
+    :type target: Dictionary
+    """
+    def __init__(self, logger, target):
+        self._logger = logger
+        self._target = target
+
+    @contextmanager
+    def span(self, name):
+        """Time a block of code
+
+        :param name: What the block does, i.e. ``deploy.upload``
+        :type name: String
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds):
+        """Record a step that was timed some other way, i.e. across task retries
+
+        :Returns: None
+
+        :param name: What the step did
+        :type name: String
+
+        :param seconds: How long it took
+        :type seconds: Float
+        """
+        totals = self._target.setdefault('timings', {})
+        total = totals.setdefault(name, {'seconds': 0, 'count': 0})
+        total['seconds'] = round(total['seconds'] + seconds, 3)
+        total['count'] += 1
+        REGISTRY.observe('winserver_span_seconds', seconds, span=name)
+        self._logger.info(ujson.dumps({'span': name, 'seconds': round(seconds, 3)}))
+
+
+@contextmanager
+def recording(logger, target):
+    """Send the spans of this thread to a ``Timings`` for the duration of a ``with`` block
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param target: Where to keep the totals, under the ``timings`` key; i.e. ``resp['params']``
+    :type target: Dictionary
+    """
+    timings = Timings(logger, target)
+    previous = getattr(_CURRENT, 'timings', None)
+    _CURRENT.timings = timings
+    try:
+        yield timings
+    finally:
+        _CURRENT.timings = previous
+
+
+@contextmanager
+def span(name):
+    """Time a block of code, if the current thread is ``recording``
+
+    :param name: What the block does, i.e. ``deploy.upload``
+    :type name: String
+    """
+    timings = getattr(_CURRENT, 'timings', None)
+    if timings is None:
+        yield
+    else:
+        with timings.span(name):
+            yield
@@ -1,12 +1,14 @@
 # -*- coding: UTF-8 -*-
 """Business logic for backend worker tasks"""
 import time
-import random
-import os.path
+from concurrent.futures import ThreadPoolExecutor
 from celery.utils.log import get_task_logger
-from vlab_inf_common.vmware import vCenter, Ova, vim, virtual_machine, consume_task
+from vlab_inf_common.vmware import Ova, vim, virtual_machine
 
-from vlab_winserver_api.lib import const
+from vlab_winserver_api.lib import const, catalog
+from vlab_winserver_api.lib.worker import change_feed, guest, inventory, networks, templates, timing, warm_pool
+from vlab_winserver_api.lib.worker.session import vcenter_session
+from vlab_winserver_api.lib.worker.task_waiter import TaskWaiter, fault_message, wait_for_task
 
 
 logger = get_task_logger(__name__)
@@ -21,15 +23,16 @@ def show_winserver(username):
     :param username: The user requesting info about their WinServer
     :type username: String
     """
-    winserver_vms = {}
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        winserver_vms = {}
-        for vm in folder.childEntity:
-            info = virtual_machine.get_info(vcenter, vm, username)
-            if info['meta']['component'] == 'WinServer':
-                winserver_vms[vm.name] = info
+    feed = change_feed.get_feed()
+    if feed is not None:
+        with timing.span('show.change-feed'):
+            winserver_vms = feed.show(username, component='WinServer')
+        if winserver_vms is not None:
+            return winserver_vms
+    with vcenter_session() as vcenter:
+        with timing.span('show.inventory'):
+            folder = inventory.user_folder(vcenter, username)
+            winserver_vms = inventory.show(vcenter, folder, username, component='WinServer')
     return winserver_vms
 
 
@@ -47,21 +50,95 @@ def delete_winserver(username, machine_name, logger):
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        for entity in folder.childEntity:
-            if entity.name == machine_name:
-                info = virtual_machine.get_info(vcenter, entity, username)
-                if info['meta']['component'] == 'WinServer':
-                    logger.debug('powering off VM')
-                    virtual_machine.power(entity, state='off')
-                    delete_task = entity.Destroy_Task()
-                    logger.debug('blocking while VM is being destroyed')
-                    consume_task(delete_task)
-                    break
-        else:
-            raise ValueError('No {} named {} found'.format('winserver', machine_name))
+    with vcenter_session() as vcenter:
+        with timing.span('delete.find'):
+            the_vm = inventory.find_vm(vcenter, username, machine_name, component='WinServer')
+        logger.debug('powering off VM')
+        with timing.span('delete.power-off'):
+            power_off(vcenter, the_vm)
+        logger.debug('blocking while VM is being destroyed')
+        with timing.span('delete.destroy'):
+            wait_for_task(vcenter, the_vm.Destroy_Task())
+
+
+def delete_many(username, machine_names, logger):
+    """Destroy many of a user's WinServers at once
+
+    The VMs are found with one inventory pass. Then all the power-offs run
+    at the same time, followed by all the destroys, and each batch of vCenter
+    tasks is waited on together.
+
+    :Returns: Dictionary - machine name -> ``{'deleted': True}``, or the ``error``
+
+    :param username: The user who wants to delete their WinServers
+    :type username: String
+
+    :param machine_names: The names of the VMs to delete; None deletes every WinServer the user has
+    :type machine_names: List
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    report = {}
+    with vcenter_session() as vcenter:
+        folder = inventory.user_folder(vcenter, username)
+        found = {}
+        for props in inventory.retrieve_vms(vcenter, folder, properties=['name', 'config.annotation', 'runtime.powerState']):
+            if inventory.get_meta(props.get('config.annotation', None))['component'] == 'WinServer':
+                found[props['name']] = props
+        if machine_names is None:
+            machine_names = sorted(found.keys())
+        targets = {}
+        for machine_name in machine_names:
+            if machine_name in found:
+                targets[machine_name] = found[machine_name]['vm']
+            else:
+                report[machine_name] = {'error': 'No WinServer named {} found'.format(machine_name)}
+
+        logger.debug('powering off {} VMs'.format(len(targets)))
+        waiter = TaskWaiter(vcenter)
+        for machine_name, the_vm in targets.items():
+            if found[machine_name].get('runtime.powerState', None) == vim.VirtualMachinePowerState.poweredOn:
+                waiter.add(machine_name, the_vm.PowerOffVM_Task())
+        for machine_name, fault in waiter.wait().items():
+            # A VM that's already off is fine to destroy
+            if fault is not None and not isinstance(fault, vim.fault.InvalidPowerState):
+                report[machine_name] = {'error': fault_message(fault)}
+
+        logger.debug('blocking while VMs are being destroyed')
+        waiter = TaskWaiter(vcenter)
+        for machine_name, the_vm in targets.items():
+            if machine_name not in report:
+                waiter.add(machine_name, the_vm.Destroy_Task())
+        for machine_name, fault in waiter.wait().items():
+            if fault is None:
+                report[machine_name] = {'deleted': True}
+            else:
+                report[machine_name] = {'error': fault_message(fault)}
+    return report
+
+
+def power_off(vcenter, the_vm):
+    """Pull the power on a VM, if it's on
+
+    :Returns: None
+
+    :Raises: RuntimeError if the VM would not power off
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param the_vm: The virtual machine
+    :type the_vm: vim.VirtualMachine
+    """
+    power_state = inventory.retrieve_properties(vcenter, the_vm, ['runtime.powerState']).get('runtime.powerState', None)
+    if power_state != vim.VirtualMachinePowerState.poweredOn:
+        return
+    waiter = TaskWaiter(vcenter)
+    waiter.add('power-off', the_vm.PowerOffVM_Task())
+    fault = waiter.wait()['power-off']
+    if fault is not None and not isinstance(fault, vim.fault.InvalidPowerState):
+        raise RuntimeError(fault_message(fault))
 
 
 def create_winserver(username, machine_name, image, network, ip_config, logger):
@@ -87,50 +164,333 @@ def create_winserver(username, machine_name, image, network, ip_config, logger):
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        image_name = convert_name(image)
-        logger.info(image_name)
-        try:
-            ova = Ova(os.path.join(const.VLAB_WINSERVER_IMAGES_DIR, image_name))
-        except FileNotFoundError:
-            error = 'Invalid version of Windows Server supplied: {}'.format(image)
-            raise ValueError(error)
+    with vcenter_session() as vcenter:
+        the_vm = _deploy(vcenter, username, machine_name, image, network, logger)
+        if ip_config['static-ip']:
+            # The VM will walk through the C:\unattend.xml answer file and then
+            # reboot. We wont have valid login creds until after the reboot.
+            with timing.span('wait-for-guest'):
+                readiness = guest.GuestReadiness(vcenter, the_vm, guest.boot_time(vcenter, the_vm),
+                                                 user=guest.GUEST_USER, password=guest.GUEST_PASSWORD)
+                guest.wait_for_guest(readiness, logger)
+            with timing.span('configure-ip'):
+                _config_static_ip(vcenter, the_vm, ip_config, logger)
+        with timing.span('finalize.set-meta'):
+            _set_meta(the_vm, image)
+        with timing.span('finalize.get-info'):
+            info = virtual_machine.get_info(vcenter, the_vm, username, ensure_ip=True)
+        return {the_vm.name: info}
+
+
+def deploy_winserver(username, machine_name, image, network, logger):
+    """The first phase of creating a WinServer; deploys and powers on the VM.
+
+    :Returns: Dictionary - the ``moid`` and ``boot-time`` of the new VM
+
+    :param username: The name of the user who wants to create a new WinServer
+    :type username: String
+
+    :param machine_name: The name of the new instance of WinServer
+    :type machine_name: String
+
+    :param image: The image/version of WinServer to create
+    :type image: String
+
+    :param network: The name of the network to connect the new WinServer instance up to
+    :type network: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    with vcenter_session() as vcenter:
+        the_vm = _deploy(vcenter, username, machine_name, image, network, logger)
+        with timing.span('deploy.boot-time'):
+            boot_time = guest.boot_time(vcenter, the_vm)
+        return {'moid': the_vm._moId, 'boot-time': boot_time}
+
+
+def deploy_many(username, machine_names, image, network, logger):
+    """The first phase of creating many WinServers at once; claims or deploys
+    every VM, at most ``VLAB_WINSERVER_BULK_CONCURRENCY`` at a time.
+
+    All the deploys share this process's image catalog entry and vCenter
+    session pool. A VM that fails to deploy doesn't stop the others.
+
+    :Returns: Dictionary - machine name -> the ``moid``, ``boot-time`` and
+              ``warm`` of the new VM, or the ``error`` if it failed
+
+    :param username: The name of the user who wants to create the WinServers
+    :type username: String
+
+    :param machine_names: The names of the new instances of WinServer
+    :type machine_names: List
+
+    :param image: The image/version of WinServer to create
+    :type image: String
+
+    :param network: The name of the network to connect the new WinServer instances up to
+    :type network: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    def deploy_one(machine_name):
+        deployed = claim_winserver(username, machine_name, image, network, logger)
+        if deployed is None:
+            deployed = deploy_winserver(username, machine_name, image, network, logger)
+            deployed['warm'] = False
+        else:
+            deployed['warm'] = True
+        return deployed
+
+    first = []
+    if templates.enabled() and machine_names:
+        # Deploy one VM before the rest, so only one deploy imports the template
+        first = machine_names[:1]
+    results = fan_out(deploy_one, first)
+    results.update(fan_out(deploy_one, [x for x in machine_names if x not in results]))
+    deployed = {}
+    for machine_name, result in results.items():
+        if isinstance(result, Exception):
+            if not isinstance(result, (ValueError, RuntimeError)):
+                raise result
+            deployed[machine_name] = {'error': '{}'.format(result)}
+        else:
+            deployed[machine_name] = result
+    return deployed
+
+
+def fan_out(func, items):
+    """Call a function on every item, at most ``VLAB_WINSERVER_BULK_CONCURRENCY`` at a time
+
+    :Returns: Dictionary - item -> the return value, or the exception raised
+
+    :param func: The function to call; it's passed one item
+    :type func: Function
+
+    :param items: The things to call the function on
+    :type items: List
+    """
+    if not items:
+        return {}
+    results = {}
+    with ThreadPoolExecutor(max_workers=const.VLAB_WINSERVER_BULK_CONCURRENCY) as executor:
+        futures = {x: executor.submit(func, x) for x in items}
+        for item, future in futures.items():
+            try:
+                results[item] = future.result()
+            except Exception as doh:
+                results[item] = doh
+    return results
+
+
+def claim_winserver(username, machine_name, image, network, logger):
+    """Try to create a WinServer by claiming a VM from the warm pool
+
+    :Returns: Dictionary - the ``moid`` and ``boot-time`` of the VM, or None if
+              the pool had nothing to give
+
+    :param username: The name of the user who wants to create a new WinServer
+    :type username: String
+
+    :param machine_name: The name of the new instance of WinServer
+    :type machine_name: String
+
+    :param image: The image/version of WinServer to create
+    :type image: String
+
+    :param network: The name of the network to connect the new WinServer instance up to
+    :type network: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    if not warm_pool.enabled(image):
+        return None
+    with vcenter_session() as vcenter:
+        with timing.span('deploy.check-name'):
+            if inventory.name_taken(vcenter, username, machine_name):
+                # Don't take a VM out of the pool just to fail renaming it
+                raise ValueError('You already have a VM named {}'.format(machine_name))
         try:
+            the_network = networks.resolve(vcenter, network)
+        except KeyError:
+            raise ValueError('No such network named {}'.format(network))
+        with timing.span('deploy.warm-pool-claim'):
+            the_vm = warm_pool.claim(vcenter, username, machine_name, image, the_network, logger)
+        if the_vm is None:
+            return None
+        return {'moid': the_vm._moId, 'boot-time': guest.boot_time(vcenter, the_vm)}
+
+
+def refill_pool(logger):
+    """Top off the warm pool of every image version
+
+    :Returns: None
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    if not warm_pool.pool_sizes():
+        return
+    with vcenter_session() as vcenter:
+        warm_pool.refill(vcenter, _deploy, logger)
+
+
+def pool_status():
+    """Obtain the size of the warm pool of every image version
+
+    :Returns: Dictionary
+    """
+    if not warm_pool.pool_sizes():
+        return {}
+    with vcenter_session() as vcenter:
+        return warm_pool.status(vcenter)
+
+
+def guest_ready(moid, first_boot):
+    """Check once if a new WinServer has finished the unattend.xml reboot
+
+    :Returns: Boolean
+
+    :param moid: The managed object id of the VM
+    :type moid: String
+
+    :param first_boot: The boot time recorded when the VM was deployed
+    :type first_boot: String
+    """
+    with vcenter_session() as vcenter:
+        the_vm = inventory.vm_by_moid(vcenter, moid)
+        readiness = guest.GuestReadiness(vcenter, the_vm, first_boot,
+                                         user=guest.GUEST_USER, password=guest.GUEST_PASSWORD)
+        with timing.span('wait-for-guest.check'):
+            return readiness.check()
+
+
+def configure_ip(moid, ip_config, logger):
+    """Set a static IP on a WinServer that's ready to be configured
+
+    :Returns: None
+
+    :param moid: The managed object id of the VM
+    :type moid: String
+
+    :param ip_config: The IPv4 network configuration for the WinServer instance
+    :type ip_config: Dictionary
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    with vcenter_session() as vcenter:
+        the_vm = inventory.vm_by_moid(vcenter, moid)
+        with timing.span('configure-ip.config-static-ip'):
+            _config_static_ip(vcenter, the_vm, ip_config, logger)
+
+
+def finalize_winserver(username, moid, image, set_meta):
+    """The last phase of creating a WinServer; records the meta data, and
+    reports on the new VM.
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who owns the new WinServer
+    :type username: String
+
+    :param moid: The managed object id of the VM
+    :type moid: String
+
+    :param image: The image/version of WinServer that was created
+    :type image: String
+
+    :param set_meta: Set to False if a previous attempt already set the meta data
+    :type set_meta: Boolean
+    """
+    with vcenter_session() as vcenter:
+        the_vm = inventory.vm_by_moid(vcenter, moid)
+        if set_meta:
+            with timing.span('finalize.set-meta'):
+                _set_meta(the_vm, image)
+        with timing.span('finalize.get-info'):
+            info = virtual_machine.get_info(vcenter, the_vm, username)
+        return {the_vm.name: info}
+
+
+def _deploy(vcenter, username, machine_name, image, network, logger):
+    """Create a new VM of a given WinServer version, either by uploading the
+    OVA or as a linked clone of a template (see ``VLAB_WINSERVER_DEPLOY_MODE``)
+
+    :Returns: vim.VirtualMachine
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+    """
+    logger.info(convert_name(image))
+    with timing.span('deploy.catalog'):
+        entry = catalog.get_catalog().get(image)
+    if entry is None:
+        error = 'Invalid version of Windows Server supplied: {}'.format(image)
+        raise ValueError(error)
+    with timing.span('deploy.check-name'):
+        if inventory.name_taken(vcenter, username, machine_name):
+            raise ValueError('You already have a VM named {}'.format(machine_name))
+    if templates.enabled():
+        with timing.span('deploy.linked-clone'):
+            the_vm = templates.deploy(vcenter, entry, username, machine_name, image, network, logger)
+        if the_vm is not None:
+            return the_vm
+        logger.info('Uploading the OVA while the template is imported')
+    try:
+        with timing.span('deploy.resolve-network'):
             network_map = vim.OvfManager.NetworkMapping()
-            network_map.name = ova.networks[0]
-            try:
-                network_map.network = vcenter.networks[network]
-            except KeyError:
-                raise ValueError('No such network named {}'.format(network))
+            network_map.name = entry['networks'][0]
+            network_map.network = networks.resolve(vcenter, network)
+    except KeyError:
+        raise ValueError('No such network named {}'.format(network))
+    try:
+        # Still have to open the OVA to stream the disks up to vCenter
+        with timing.span('deploy.open-ova'):
+            ova = Ova(entry['path'])
+    except FileNotFoundError:
+        error = 'Invalid version of Windows Server supplied: {}'.format(image)
+        raise ValueError(error)
+    try:
+        with timing.span('deploy.upload'):
             the_vm = virtual_machine.deploy_from_ova(vcenter, ova, [network_map],
                                                      username, machine_name, logger)
-        finally:
-            ova.close()
-        if ip_config['static-ip']:
-            # Hack - The VM will walk through the C:\unattend.xml answer file
-            # and then reboot. We wont have valid login creds until after the
-            # reboot. Trying to *notice* the reboot is a race condition nightmare
-            time.sleep(300)
-            virtual_machine.config_static_ip(vcenter,
-                                             the_vm,
-                                             ip_config['static-ip'],
-                                             ip_config['default-gateway'],
-                                             ip_config['netmask'],
-                                             ip_config['dns'],
-                                             user='Administrator',
-                                             password='a',
-                                             logger=logger,
-                                             os='windows')
-        meta_data = {'component' : "WinServer",
-                     'created': time.time(),
-                     'version': image,
-                     'configured': False,
-                     'generation': 1,
-                    }
-        virtual_machine.set_meta(the_vm, meta_data)
-        info = virtual_machine.get_info(vcenter, the_vm, username, ensure_ip=True)
-        return {the_vm.name: info}
+    finally:
+        ova.close()
+    return the_vm
+
+
+def _config_static_ip(vcenter, the_vm, ip_config, logger):
+    """Set the IP of a WinServer via the guest tools
+
+    :Returns: None
+    """
+    virtual_machine.config_static_ip(vcenter,
+                                     the_vm,
+                                     ip_config['static-ip'],
+                                     ip_config['default-gateway'],
+                                     ip_config['netmask'],
+                                     ip_config['dns'],
+                                     user=guest.GUEST_USER,
+                                     password=guest.GUEST_PASSWORD,
+                                     logger=logger,
+                                     os='windows')
+
+
+def _set_meta(the_vm, image):
+    """Record that the VM is a WinServer in the VM notes
+
+    :Returns: None
+    """
+    meta_data = {'component' : "WinServer",
+                 'created': time.time(),
+                 'version': image,
+                 'configured': False,
+                 'generation': 1,
+                }
+    virtual_machine.set_meta(the_vm, meta_data)
 
 
 def list_images():
@@ -138,9 +498,18 @@ def list_images():
 
     :Returns: List
     """
-    images = os.listdir(const.VLAB_WINSERVER_IMAGES_DIR)
-    images = [convert_name(x, to_version=True) for x in images]
-    return images
+    return catalog.get_catalog().images()
+
+
+def list_templates():
+    """Obtain the versions of WinServer that have a template ready for linked clones
+
+    :Returns: List
+    """
+    if not templates.enabled():
+        return []
+    with vcenter_session() as vcenter:
+        return templates.ready_templates(vcenter)
 
 
 def convert_name(name, to_version=False):
@@ -155,10 +524,7 @@ def convert_name(name, to_version=False):
     :param to_version: Set to True to covert the name of an OVA to the version
     :type to_version: Boolean
     """
-    if to_version:
-        return name.split('-')[-1].replace('.ova', '')
-    else:
-        return 'WinServer-{}.ova'.format(name)
+    return catalog.convert_name(name, to_version=to_version)
 
 
 def update_network(username, machine_name, new_network):
@@ -173,23 +539,64 @@ def update_network(username, machine_name, new_network):
     :param new_network: The name of the new network to connect the VM to
     :type new_network: String
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        for entity in folder.childEntity:
-            if entity.name == machine_name:
-                info = virtual_machine.get_info(vcenter, entity, username)
-                if info['meta']['component'] == 'WinServer':
-                    the_vm = entity
-                    break
-        else:
+    with vcenter_session() as vcenter:
+        try:
+            the_vm = inventory.find_vm(vcenter, username, machine_name, component='WinServer')
+        except ValueError:
             error = 'No Windows Server named {} found'.format(machine_name)
             raise ValueError(error)
 
         try:
-            network = vcenter.networks[new_network]
+            network = networks.resolve(vcenter, new_network)
         except KeyError:
-            error = 'No VM named {} found'.format(machine_name)
+            error = 'No network named {} found'.format(new_network)
             raise ValueError(error)
         else:
-            virtual_machine.change_network(the_vm, network)
+            wait_for_task(vcenter, networks.change_task(the_vm, network))
+
+
+def update_networks(username, changes, logger):
+    """Move many of a user's WinServers to different networks at once
+
+    The VMs are found with one inventory pass, and the networks come from the
+    resolver index. All the NIC changes are started before waiting on any of them.
+
+    :Returns: Dictionary - machine name -> ``{'network': <name>}``, or the ``error``
+
+    :param username: The name of the user who owns the virtual machines
+    :type username: String
+
+    :param changes: The name of each VM -> the name of the network to connect it to
+    :type changes: Dictionary
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    report = {}
+    with vcenter_session() as vcenter:
+        folder = inventory.user_folder(vcenter, username)
+        found = {}
+        for props in inventory.retrieve_vms(vcenter, folder, properties=['name', 'config.annotation']):
+            if inventory.get_meta(props.get('config.annotation', None))['component'] == 'WinServer':
+                found[props['name']] = props['vm']
+        logger.debug('reconfiguring {} VMs'.format(len(changes)))
+        waiter = TaskWaiter(vcenter)
+        for machine_name, new_network in changes.items():
+            if machine_name not in found:
+                report[machine_name] = {'error': 'No WinServer named {} found'.format(machine_name)}
+                continue
+            try:
+                the_network = networks.resolve(vcenter, new_network)
+            except KeyError:
+                report[machine_name] = {'error': 'No network named {} found'.format(new_network)}
+                continue
+            try:
+                waiter.add(machine_name, networks.change_task(found[machine_name], the_network))
+            except RuntimeError as doh:
+                report[machine_name] = {'error': '{}'.format(doh)}
+        for machine_name, fault in waiter.wait().items():
+            if fault is None:
+                report[machine_name] = {'network': changes[machine_name]}
+            else:
+                report[machine_name] = {'error': fault_message(fault)}
+    return report
@@ -0,0 +1,303 @@
+# -*- coding: UTF-8 -*-
+"""
+A warm pool of WinServer VMs that have already been through first boot.
+
+Pool VMs live in the ``VLAB_WINSERVER_POOL_DIR`` folder and start out on the
+``VLAB_WINSERVER_POOL_NETWORK`` network. The size of the pool per image version
+is set with ``VLAB_WINSERVER_WARM_POOL``, i.e. ``2016:2,2012R2:1``.
+
+The state of a pool VM is kept in its notes:
+
+- ``ready`` is False while the VM is running C:\\unattend.xml, and True after it
+  has rebooted and the guest credentials work.
+- A user claims a ready VM by rewriting its notes with the ``changeVersion`` it
+  read. vCenter rejects the change if another worker got there first, so two
+  creates can never be handed the same VM. A claimed VM that's still in the
+  pool folder after ``VLAB_WINSERVER_POOL_CLAIM_TIMEOUT`` seconds was left by
+  a worker that died part way through the hand over, so refill destroys it.
+
+Only one refill runs at a time; it holds a claim in the dedupe store (see
+``dedupe.py``) for up to ``VLAB_WINSERVER_POOL_REFILL_TTL`` seconds. A refill
+deploys at most one VM per image version, so it's done well before then, and
+the next beat deploys the next one. That claim only keeps out other refills
+that can see it, so ``VLAB_WINSERVER_CACHE_URL`` must be a ``sqlite:///`` file
+every worker shares; with ``memory://``, each prefork child would hold its own
+claim and refill the pool past its size. The worker refuses to start that way
+(see ``check_settings``).
+
+Machine names are checked by the API before a create is queued, so a claim
+doesn't check them again.
+"""
+import time
+import uuid
+
+import ujson
+from vlab_inf_common.vmware import vim, virtual_machine
+
+from vlab_winserver_api.lib import const, dedupe
+from vlab_winserver_api.lib.metrics import REGISTRY
+from vlab_winserver_api.lib.worker import guest, inventory, networks
+from vlab_winserver_api.lib.worker.task_waiter import TaskWaiter, wait_for_task
+
+
+COMPONENT = 'WinServerPool'
+POOL_PROPERTIES = ['name', 'config.annotation', 'config.changeVersion']
+
+
+def pool_sizes():
+    """Parse ``VLAB_WINSERVER_WARM_POOL`` into the number of VMs to keep per image
+
+    :Returns: Dictionary
+    """
+    sizes = {}
+    for entry in const.VLAB_WINSERVER_WARM_POOL.split(','):
+        if not entry.strip():
+            continue
+        image, _, size = entry.partition(':')
+        sizes[image.strip()] = int(size or 1)
+    return sizes
+
+
+def check_settings():
+    """Refuse a warm pool whose refills can't see each other's claim
+
+    :Returns: None
+
+    :Raises: RuntimeError
+    """
+    if pool_sizes() and const.VLAB_WINSERVER_CACHE_URL.startswith('memory://'):
+        raise RuntimeError('The warm pool needs a shared refill lock; set VLAB_WINSERVER_CACHE_URL to a sqlite:/// file on a volume the workers share')
+
+
+def enabled(image):
+    """Check if there's a warm pool for an image version
+
+    :Returns: Boolean
+
+    :param image: The image/version of WinServer
+    :type image: String
+    """
+    return pool_sizes().get(image, 0) > 0
+
+
+def pool_vm_name(image):
+    """Make a unique name for a new pool VM
+
+    :Returns: String
+
+    :param image: The image/version of WinServer
+    :type image: String
+    """
+    return 'WinServer-{}-pool-{}'.format(image, uuid.uuid4().hex[:8])
+
+
+def pool_vms(vcenter, image):
+    """Obtain the VMs in the pool for an image version, including ones still being deployed
+
+    :Returns: List of Dictionaries
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param image: The image/version of WinServer
+    :type image: String
+    """
+    folder = inventory.user_folder(vcenter, const.VLAB_WINSERVER_POOL_DIR)
+    prefix = 'WinServer-{}-pool-'.format(image)
+    found = []
+    for props in inventory.retrieve_vms(vcenter, folder, properties=POOL_PROPERTIES):
+        props['meta'] = inventory.get_meta(props.get('config.annotation', None))
+        # A claimed VM keeps its notes, but might already have the user's name
+        meta = props['meta']
+        renamed = meta['component'] == COMPONENT and meta.get('claimed', None) and meta.get('version', None) == image
+        if props['name'].startswith(prefix) or renamed:
+            found.append(props)
+    return found
+
+
+def status(vcenter):
+    """Describe the pool of every image version
+
+    :Returns: Dictionary
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+    """
+    info = {}
+    for image, size in pool_sizes().items():
+        vms = pool_vms(vcenter, image)
+        ready = len([x for x in vms if _is_ready(x)])
+        info[image] = {'size': size, 'ready': ready, 'warming': len(vms) - ready}
+        REGISTRY.set('winserver_pool_ready', ready, image=image)
+    return info
+
+
+def refill(vcenter, deploy, logger):
+    """Promote pool VMs that finished first boot, and deploy one of any that are missing
+
+    :Returns: None
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param deploy: Creates a new VM; same args as ``vmware._deploy``
+    :type deploy: Function
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    deduplicator = dedupe.get_deduplicator()
+    token = str(uuid.uuid4())
+    if deduplicator.claim('refill', const.VLAB_WINSERVER_POOL_DIR, 'pool', token,
+                          ttl=const.VLAB_WINSERVER_POOL_REFILL_TTL) is not None:
+        logger.info('Another refill of the warm pool is running')
+        return
+    try:
+        _refill(vcenter, deploy, logger)
+    finally:
+        deduplicator.finish('refill', const.VLAB_WINSERVER_POOL_DIR, 'pool', token)
+
+
+def _refill(vcenter, deploy, logger):
+    """The body of ``refill``, ran while holding the refill claim
+
+    :Returns: None
+    """
+    for image, size in pool_sizes().items():
+        vms = []
+        for props in pool_vms(vcenter, image):
+            meta = props['meta']
+            if meta['component'] != COMPONENT:
+                vms.append(props)
+            elif meta.get('claimed', None):
+                if time.time() - meta.get('claimed-at', meta['created']) > const.VLAB_WINSERVER_POOL_CLAIM_TIMEOUT:
+                    logger.error('{} was never handed to {}; destroying it'.format(props['name'], meta['claimed']))
+                    _destroy(vcenter, props['vm'])
+                else:
+                    vms.append(props)
+            elif not meta.get('ready', False):
+                if _promote(vcenter, props, logger):
+                    vms.append(props)
+            else:
+                vms.append(props)
+        ready = len([x for x in vms if _is_ready(x)])
+        REGISTRY.set('winserver_pool_ready', ready, image=image)
+        if len(vms) < size:
+            name = pool_vm_name(image)
+            logger.info('Adding {} to the warm pool'.format(name))
+            started = time.time()
+            the_vm = deploy(vcenter, const.VLAB_WINSERVER_POOL_DIR, name, image,
+                            const.VLAB_WINSERVER_POOL_NETWORK, logger)
+            meta = {'component': COMPONENT,
+                    'version': image,
+                    'created': started,
+                    'boot-time': guest.boot_time(vcenter, the_vm),
+                    'ready': False,
+                   }
+            virtual_machine.set_meta(the_vm, meta)
+
+
+def _promote(vcenter, props, logger):
+    """Mark a pool VM ready, once it's done running C:\\unattend.xml
+
+    Pool VMs that never become ready are destroyed, so the next refill replaces them.
+
+    :Returns: Boolean - False if the VM was destroyed
+    """
+    meta = props['meta']
+    readiness = guest.GuestReadiness(vcenter, props['vm'], meta.get('boot-time', None),
+                                     user=guest.GUEST_USER, password=guest.GUEST_PASSWORD)
+    if readiness.check():
+        meta['ready'] = True
+        virtual_machine.set_meta(props['vm'], meta)
+        REGISTRY.observe('winserver_pool_refill_seconds', time.time() - meta['created'], image=meta['version'])
+        logger.info('{} is ready'.format(props['name']))
+    elif time.time() - meta['created'] > const.VLAB_WINSERVER_GUEST_TIMEOUT:
+        logger.error('{} never became ready; destroying it'.format(props['name']))
+        _destroy(vcenter, props['vm'])
+        return False
+    return True
+
+
+def claim(vcenter, username, machine_name, image, network, logger):
+    """Hand a ready pool VM to a user
+
+    :Returns: vim.VirtualMachine, or None if the pool had no VM to give
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param username: The name of the user who wants a new WinServer
+    :type username: String
+
+    :param machine_name: The name to give the VM
+    :type machine_name: String
+
+    :param image: The image/version of WinServer
+    :type image: String
+
+    :param network: The network to connect the VM to
+    :type network: vim.Network
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    for props in pool_vms(vcenter, image):
+        if not _is_ready(props):
+            continue
+        if not _take(vcenter, props, username):
+            logger.debug('Lost the race for {}'.format(props['name']))
+            continue
+        REGISTRY.inc('winserver_pool_claims_total', result='hit', image=image)
+        logger.info('Claimed {} from the warm pool'.format(props['name']))
+        the_vm = props['vm']
+        try:
+            wait_for_task(vcenter, the_vm.Rename_Task(newName=machine_name))
+            wait_for_task(vcenter, inventory.user_folder(vcenter, username).MoveIntoFolder_Task([the_vm]))
+            wait_for_task(vcenter, networks.change_task(the_vm, network))
+        except RuntimeError as doh:
+            # i.e. the user already has a VM with that name
+            logger.error('Unable to hand over {}: {}'.format(props['name'], doh))
+            _destroy(vcenter, the_vm)
+            return None
+        return the_vm
+    REGISTRY.inc('winserver_pool_claims_total', result='miss', image=image)
+    return None
+
+
+def _take(vcenter, props, username):
+    """Compare-and-swap on the VM notes, so only one worker can claim a VM
+
+    :Returns: Boolean
+    """
+    meta = dict(props['meta'], ready=False, claimed=username)
+    meta['claimed-at'] = time.time()
+    spec = vim.vm.ConfigSpec(changeVersion=props['config.changeVersion'],
+                             annotation=ujson.dumps(meta))
+    try:
+        wait_for_task(vcenter, props['vm'].ReconfigVM_Task(spec))
+    except RuntimeError:
+        # vim.fault.ConcurrentAccess; someone else changed the VM first
+        return False
+    return True
+
+
+def _is_ready(props):
+    """Check the notes of a pool VM
+
+    :Returns: Boolean
+    """
+    return props['meta']['component'] == COMPONENT and props['meta'].get('ready', False) is True
+
+
+def _destroy(vcenter, the_vm):
+    """Power off and delete a VM
+
+    :Returns: None
+    """
+    waiter = TaskWaiter(vcenter)
+    waiter.add('power-off', the_vm.PowerOffVM_Task())
+    # Ignore the fault; the VM might already be off
+    waiter.wait()
+    wait_for_task(vcenter, the_vm.Destroy_Task())
+